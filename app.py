@@ -2,8 +2,12 @@ import logging
 from logging.handlers import RotatingFileHandler
 from flask import Flask, request, jsonify
 import os
+import time
 from config import Config
+import extensions
 from extensions import init_mongo
+import db_metrics
+import metrics
 from blueprints.main import main_bp
 from blueprints.auth import auth_bp
 from auth import init_login_manager, get_user_context
@@ -109,6 +113,54 @@ def create_app(config_class=Config):
             pass
         return resp
 
+    # Latência por template de rota e requisições em andamento (metrics.py, exposto em /metrics)
+    @app.before_request
+    def _http_metrics_begin():
+        from flask import g
+        g.http_metrics_start = time.perf_counter()
+        metrics.http_in_flight.inc(app='flask')
+
+    @app.after_request
+    def _http_metrics_observe(resp):
+        from flask import g
+        start = g.get('http_metrics_start')
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            metrics.observe_request('flask', request.method, route, resp.status_code, time.perf_counter() - start)
+        return resp
+
+    @app.teardown_request
+    def _http_metrics_end(exc):
+        from flask import g
+        if g.pop('http_metrics_start', None) is not None:
+            metrics.http_in_flight.dec(app='flask')
+
+    # Invalidações de cache publicadas por outros workers (extensions.SharedInvalidation)
+    @app.before_request
+    def _sync_response_cache():
+        extensions.cache_invalidation.sync(extensions.mongo_db)
+
+    # Operações no Mongo por requisição (db_metrics.py): Server-Timing e log estruturado
+    @app.before_request
+    def _db_metrics_begin():
+        from flask import g
+        g.db_metrics_token = db_metrics.begin()
+
+    @app.after_request
+    def _db_metrics_header(resp):
+        stats = db_metrics.current()
+        if stats is not None:
+            resp.headers.add('Server-Timing', stats.server_timing())
+            db_metrics.report(stats, request.method, request.path, resp.status_code)
+        return resp
+
+    @app.teardown_request
+    def _db_metrics_end(exc):
+        from flask import g
+        token = g.pop('db_metrics_token', None)
+        if token is not None:
+            db_metrics.end(token)
+
     @app.errorhandler(404)
     def _handle_404(e):
         if _is_api_request():
@@ -0,0 +1,144 @@
+"""Cache de respostas para rotas assíncronas (FastAPI).
+
+`AsyncResponseCache.cached(...)` decora um handler `async def` e guarda o valor
+retornado, com chave `namespace + papel + scope_id + parâmetros da rota`:
+
+- TTL: dentro de `ttl` segundos a resposta é servida direto do cache.
+- Stale-while-revalidate: por mais `stale_ttl` segundos a resposta vencida
+  ainda é servida enquanto uma única tarefa em segundo plano recalcula.
+- Single-flight: requisições simultâneas para a mesma chave sem valor em
+  cache aguardam a mesma computação (50 dashboards abertos → 1 agregação).
+- Invalidação: cada entrada leva as tags devolvidas por `tags(user)` (ver
+  cache_tags.py); o cache assina `extensions.publish_invalidation`. Uma
+  computação em andamento cujas tags forem invalidadas não grava o resultado
+  (a geração da chave mudou) e sai de `_inflight`, para que a próxima
+  requisição recalcule em vez de aguardar um valor já obsoleto.
+
+O armazenamento é o mesmo `LRUTTLCache` do Flask (orçamento em bytes, LRU,
+estatísticas). Exceções do handler (inclusive HTTPException) não são
+guardadas e são repassadas a todos que aguardavam a computação.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from extensions import LRUTTLCache, subscribe_invalidation
+import metrics
+
+
+class AsyncResponseCache:
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.store = LRUTTLCache(max_bytes=max_bytes)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._inflight_tags: Dict[str, frozenset] = {}
+        # Geração por chave: incrementada quando a invalidação alcança uma computação em andamento
+        self._generations: Dict[str, int] = {}
+        self.coalesced = 0
+        self.stale_served = 0
+        self.refreshes = 0
+        self.discarded = 0
+        subscribe_invalidation(self.invalidate_tags)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        """Remove as entradas com as `tags` e descarta as computações em andamento que as usam."""
+        tags = set(tags or ())
+        for key, key_tags in list(self._inflight_tags.items()):
+            if key_tags & tags:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._inflight.pop(key, None)
+                self._inflight_tags.pop(key, None)
+        return self.store.invalidate_tags(tags)
+
+    @staticmethod
+    def _key(namespace: str, user: Optional[Dict[str, Any]], params: Dict[str, Any]) -> str:
+        role = (user or {}).get('role')
+        scope_id = (user or {}).get('scope_id')
+        raw = json.dumps(params, sort_keys=True, default=str, separators=(',', ':'))
+        return f'{namespace}:{role}:{scope_id}:{raw}'
+
+    async def _compute(self, key: str, producer: Callable[[], Awaitable[Any]], ttl: float, stale_ttl: float, tags: Iterable[str]) -> Any:
+        """Executa `producer` uma única vez por chave; chamadas concorrentes aguardam o mesmo resultado."""
+        pending = self._inflight.get(key)
+        if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        fut = asyncio.get_running_loop().create_future()
+        tags = frozenset(tags or ())
+        generation = self._generations.get(key, 0)
+        self._inflight[key] = fut
+        self._inflight_tags[key] = tags
+        try:
+            value = await producer()
+        except BaseException as exc:
+            if not fut.done():
+                fut.set_exception(exc)
+                fut.exception()  # marca como consumida quando ninguém aguardava
+            raise
+        else:
+            if self._generations.get(key, 0) == generation:
+                self.store.set(key, (value, time.time() + ttl), ttl=ttl + stale_ttl, tags=tags)
+            else:
+                # Invalidada durante a computação: quem aguardava recebe o valor, o cache não
+                self.discarded += 1
+            if not fut.done():
+                fut.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+                self._inflight_tags.pop(key, None)
+            if key not in self._inflight:
+                self._generations.pop(key, None)
+
+    async def _revalidate(self, key: str, producer: Callable[[], Awaitable[Any]], ttl: float, stale_ttl: float, tags: Iterable[str]) -> None:
+        self.refreshes += 1
+        try:
+            with metrics.track_job('route_cache_revalidate'):
+                await self._compute(key, producer, ttl, stale_ttl, tags)
+        except BaseException:
+            pass
+
+    def cached(
+        self,
+        namespace: str,
+        ttl: float = 30,
+        stale_ttl: float = 0,
+        tags: Optional[Callable[[Optional[Dict[str, Any]]], Awaitable[Iterable[str]]]] = None,
+    ):
+        """Decorador para handlers `async def`; o parâmetro `user` (se houver) define papel/escopo."""
+        def decorator(fn):
+            sig = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                bound = sig.bind_partial(*args, **kwargs)
+                user = bound.arguments.get('user')
+                params = {k: v for k, v in bound.arguments.items() if k != 'user'}
+                key = self._key(namespace, user, params)
+
+                async def producer():
+                    return await fn(*args, **kwargs)
+
+                entry = self.store.get(key)
+                if entry is not None:
+                    value, fresh_until = entry
+                    if time.time() >= fresh_until and key not in self._inflight:
+                        # Serve o valor vencido e recalcula em segundo plano
+                        self.stale_served += 1
+                        entry_tags = list(await tags(user)) if tags else []
+                        asyncio.get_running_loop().create_task(self._revalidate(key, producer, ttl, stale_ttl, entry_tags))
+                    return value
+                entry_tags = list(await tags(user)) if tags else []
+                return await self._compute(key, producer, ttl, stale_ttl, entry_tags)
+
+            return wrapper
+        return decorator
+
+    def stats(self) -> Dict[str, Any]:
+        out = self.store.stats()
+        out.update({'coalesced': self.coalesced, 'stale_served': self.stale_served, 'refreshes': self.refreshes,
+                    'discarded': self.discarded})
+        return out
@@ -5,6 +5,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime
 # Removido: from models.usuario import Usuario, LogAuditoria
 import extensions
+from hierarchy import hierarchy_graph
 from bson.objectid import ObjectId
 from config.ui_blocks import get_ui_blocks_config
 import secrets
@@ -170,6 +171,14 @@ class MongoUser:
     def _central_id_of_local(self, tipo: str, raw_id):
         """Obtém o central_id do local (almoxarifado/sub_almoxarifado/setor/central)."""
         tipo = (tipo or '').lower()
+        # Caminho rápido: grafo da hierarquia em memória (sem I/O por salto)
+        try:
+            if hierarchy_graph.ensure_loaded(extensions.mongo_db):
+                c = hierarchy_graph.central_of(tipo, raw_id)
+                if c:
+                    return str(c.get('_id'))
+        except Exception:
+            pass
         if tipo == 'central':
             c = self._find_by_id('centrais', raw_id)
             try:
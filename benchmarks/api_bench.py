@@ -0,0 +1,299 @@
+"""Benchmark das rotas quentes da API FastAPI.
+
+Sobe o app em processo (httpx + ASGITransport, sem servidor HTTP), com uma
+base gerada por scripts/seed_synthetic.py, e mede por rota: latência
+(p50/p90/p99/máx), vazão e operações no Mongo por requisição (lidas do
+cabeçalho `Server-Timing` de db_metrics.py). O resultado é um JSON com o
+commit corrente, para comparar execuções:
+
+    python benchmarks/api_bench.py --mock --output bench-main.json
+    python benchmarks/api_bench.py --mongo-uri mongodb://localhost:27017 --compare bench-main.json
+
+- `--mock`: mongomock em memória. Mede o custo do código Python; o Mongo não
+  emite eventos de comando, então as operações são contadas por chamada de
+  coleção (sem duração nem documentos).
+- `--mongo-uri`: mongod local na base `--db` (recriada, a menos que
+  `--reuse`); os índices de index_spec.py são aplicados antes da medição.
+- Rotas com cache de resposta (async_cache.py) são medidas com o cache
+  aquecido; `--cold` esvazia o cache antes de cada requisição.
+- Distribuição e entrada gravam de verdade: rode sobre uma base descartável.
+"""
+import sys
+import os
+import asyncio
+import json
+import math
+import platform
+import re
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import db_metrics
+
+_SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) ops, (\d+) docs"')
+_PERCENTIS = (50, 90, 99)
+
+
+class _CountingCollection:
+    """Conta cada chamada de coleção na requisição corrente (mongomock não emite eventos de comando)."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            stats = db_metrics.current()
+            if stats is not None:
+                stats.add(name, 0.0)
+            return attr(*args, **kwargs)
+        return call
+
+
+def counting_mock_database(sync_db):
+    """Banco mock do app (mesmas restrições de `_supports_pipeline`) com contagem de operações."""
+    from fastapi_app.main import _AsyncMockDatabase
+
+    class _CountingMockDatabase(_AsyncMockDatabase):
+        def __getitem__(self, name: str):
+            return _CountingCollection(super().__getitem__(name))
+
+        def __getattr__(self, name: str):
+            return _CountingCollection(super().__getattr__(name))
+
+    return _CountingMockDatabase(sync_db)
+
+
+class Scenario:
+    """Uma rota medida: `build(i)` devolve (método, caminho, params, corpo) da i-ésima requisição."""
+
+    def __init__(self, name: str, build: Callable[[int], tuple]):
+        self.name = name
+        self.build = build
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil por posição mais próxima (valores já ordenados)."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[k]
+
+
+def summarize(latencies_ms: List[float], ops: List[int], statuses: List[int], wall_s: float) -> Dict[str, Any]:
+    lat = sorted(latencies_ms)
+    out: Dict[str, Any] = {
+        'requests': len(lat),
+        'errors': sum(1 for s in statuses if s >= 400),
+        'rps': round(len(lat) / wall_s, 1) if wall_s > 0 else 0.0,
+        'mean_ms': round(sum(lat) / len(lat), 3) if lat else 0.0,
+        'max_ms': round(lat[-1], 3) if lat else 0.0,
+        'db_ops_mean': round(sum(ops) / len(ops), 2) if ops else 0.0,
+        'db_ops_max': max(ops) if ops else 0,
+    }
+    for p in _PERCENTIS:
+        out[f'p{p}_ms'] = round(percentile(lat, p), 3)
+    return out
+
+
+def default_scenarios(sync_db) -> List[Scenario]:
+    """Rotas quentes, com alvos escolhidos na base semeada (produtos com saldo, setores do mesmo almoxarifado)."""
+    produtos = list(sync_db['produtos'].find({}, {'_id': 1, 'nome': 1, 'codigo': 1}).sort('_id', 1).limit(200))
+    estoques = list(sync_db['estoques'].find({'local_tipo': 'almoxarifado', 'quantidade_atual': {'$gte': 50}},
+                                             {'produto_id': 1, 'local_id': 1}).sort('_id', 1).limit(200))
+    if not produtos or not estoques:
+        raise RuntimeError('Base sem produtos/estoques: rode o seed antes do benchmark.')
+    setor_do_almox: Dict[str, str] = {}
+    for s in sync_db['setores'].find({}, {'almoxarifado_id': 1}).sort('_id', 1):
+        setor_do_almox.setdefault(str(s.get('almoxarifado_id')), str(s['_id']))
+    estoques = [e for e in estoques if e['local_id'] in setor_do_almox] or estoques
+    termos = sorted({(p.get('nome') or '').split(' ')[0] for p in produtos if p.get('nome')}) or ['a']
+    validade = (datetime.now(timezone.utc) + timedelta(days=365)).isoformat()
+
+    def pid(i):
+        return str(produtos[i % len(produtos)]['_id'])
+
+    def estoque(i):
+        return estoques[i % len(estoques)]
+
+    def distribuicao(i):
+        e = estoque(i)
+        return ('POST', '/api/movimentacoes/distribuicao', None, {
+            'produto_id': e['produto_id'], 'quantidade': 1, 'origem_tipo': 'almoxarifado', 'origem_id': e['local_id'],
+            'destino_tipo': 'setor', 'destino_id': setor_do_almox.get(e['local_id'], e['local_id']),
+        })
+
+    def entrada(i):
+        e = estoque(i)
+        return ('POST', '/api/movimentacoes/entrada', None, {
+            'produto_id': e['produto_id'], 'quantidade': 5, 'destino_tipo': 'almoxarifado', 'destino_id': e['local_id'],
+            'lote': f'BENCH-{i}', 'data_validade': validade, 'nota_fiscal': f'NF-BENCH-{i}',
+        })
+
+    return [
+        Scenario('estoque_hierarquia', lambda i: ('GET', '/api/estoque/hierarquia', {'page': 1 + i % 5, 'per_page': 20}, None)),
+        Scenario('produtos_search', lambda i: ('GET', '/api/produtos/search', {'q': termos[i % len(termos)], 'limit': 10}, None)),
+        Scenario('produto_detalhes', lambda i: ('GET', f'/api/produtos/{pid(i)}', None, None)),
+        Scenario('movimentacoes', lambda i: ('GET', '/api/movimentacoes', {'page': 1 + i % 5, 'per_page': 20}, None)),
+        Scenario('dashboard_stats', lambda i: ('GET', '/api/dashboard/stats', None, None)),
+        Scenario('relatorio_consumo_setores', lambda i: ('GET', '/api/relatorios/consumo_setores', None, None)),
+        Scenario('distribuicao', distribuicao),
+        Scenario('entrada', entrada),
+    ]
+
+
+async def _run_scenario(client, scenario: Scenario, headers: Dict[str, str], requests: int, concurrency: int,
+                        warmup: int, cold: bool, route_cache) -> Dict[str, Any]:
+    for i in range(warmup):
+        method, path, params, body = scenario.build(i)
+        await client.request(method, path, params=params, json=body, headers=headers)
+
+    latencies: List[float] = []
+    ops: List[int] = []
+    statuses: List[int] = []
+    counter = iter(range(warmup, warmup + requests))
+
+    async def worker():
+        for i in counter:
+            method, path, params, body = scenario.build(i)
+            if cold:
+                route_cache.store.clear()
+            t0 = time.perf_counter()
+            r = await client.request(method, path, params=params, json=body, headers=headers)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            statuses.append(r.status_code)
+            m = _SERVER_TIMING.search(r.headers.get('server-timing', ''))
+            if m:
+                ops.append(int(m.group(2)))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize(latencies, ops, statuses, time.perf_counter() - t0)
+
+
+async def run_async(sync_db, async_db, requests: int = 200, concurrency: int = 8, warmup: int = 10,
+                    cold: bool = False, only: Optional[List[str]] = None, log=print) -> Dict[str, Any]:
+    """Mede cada cenário contra o app FastAPI com `db.db = async_db`; devolve {cenário: métricas}."""
+    import httpx
+    import index_spec
+    from fastapi_app import main as fastapi_main
+
+    fastapi_main.db.db = async_db
+    await index_spec.apply_async(async_db, log=None)
+    fastapi_main.route_cache.store.clear()
+
+    admin = sync_db['usuarios'].find_one({'username': 'bench-admin'})
+    admin_id = admin['_id'] if admin else sync_db['usuarios'].insert_one({
+        'nome': 'Benchmark', 'username': 'bench-admin', 'email': 'bench-admin@local', 'role': 'super_admin',
+        'scope_id': None, 'ativo': True,
+    }).inserted_id
+    token = fastapi_main.create_access_token({'sub': str(admin_id)}, expires_delta=timedelta(hours=2))
+    headers = {'Authorization': f'Bearer {token}'}
+
+    results: Dict[str, Any] = {}
+    transport = httpx.ASGITransport(app=fastapi_main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for scenario in default_scenarios(sync_db):
+            if only and scenario.name not in only:
+                continue
+            results[scenario.name] = await _run_scenario(client, scenario, headers, requests, concurrency, warmup,
+                                                         cold, fastapi_main.route_cache)
+            if log:
+                r = results[scenario.name]
+                log(f"[Bench] {scenario.name:<28} p50={r['p50_ms']:>8.2f}ms p99={r['p99_ms']:>8.2f}ms "
+                    f"{r['rps']:>8.1f} req/s ops={r['db_ops_mean']:>6.1f} erros={r['errors']}")
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Linhas de variação de p50/p99/ops por cenário em relação a uma execução anterior."""
+    lines = []
+    for name, cur in current.get('results', {}).items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        parts = []
+        for key in ('p50_ms', 'p99_ms', 'db_ops_mean'):
+            if base.get(key):
+                parts.append(f'{key} {base[key]} -> {cur[key]} ({(cur[key] - base[key]) / base[key] * 100:+.1f}%)')
+        lines.append(f'{name}: ' + ', '.join(parts))
+    return lines
+
+
+if __name__ == '__main__':
+    # CLI: python benchmarks/api_bench.py [--mock | --mongo-uri URI] [--requests N] [--output arquivo.json]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark das rotas quentes da API FastAPI')
+    parser.add_argument('--mock', action='store_true', help='usa mongomock em memória')
+    parser.add_argument('--mongo-uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--db', default='almox_bench', help='base usada com --mongo-uri (é recriada)')
+    parser.add_argument('--reuse', action='store_true', help='não recria a base (reaproveita um seed anterior)')
+    parser.add_argument('--produtos', type=int, default=5000)
+    parser.add_argument('--movimentacoes', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help='requisições medidas por cenário')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--cold', action='store_true', help='esvazia o cache de respostas antes de cada requisição')
+    parser.add_argument('--only', nargs='*', help='nomes dos cenários a medir')
+    parser.add_argument('--output', help='grava o JSON neste arquivo (além da saída padrão)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    from scripts.seed_synthetic import seed_synthetic
+
+    if args.mock:
+        import mongomock
+        sync_db = mongomock.MongoClient()[args.db]
+        async_db = counting_mock_database(sync_db)
+        backend = 'mongomock'
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from pymongo import MongoClient
+        sync_db = MongoClient(args.mongo_uri)[args.db]
+        async_db = AsyncIOMotorClient(args.mongo_uri, event_listeners=[db_metrics.CommandStatsListener()])[args.db]
+        backend = 'mongod'
+
+    dataset = {'produtos': args.produtos, 'movimentacoes': args.movimentacoes, 'seed': args.seed}
+    if args.mock or not args.reuse:
+        seed_synthetic(sync_db, produtos=args.produtos, movimentacoes=args.movimentacoes, seed=args.seed, reset=True)
+
+    results = asyncio.run(run_async(sync_db, async_db, requests=args.requests, concurrency=args.concurrency,
+                                    warmup=args.warmup, cold=args.cold, only=args.only))
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'backend': backend,
+        'dataset': dataset,
+        'config': {'requests': args.requests, 'concurrency': args.concurrency, 'warmup': args.warmup, 'cold': args.cold},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            fh.write(text + '\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fh:
+            for line in compare(report, json.load(fh)):
+                print('[Bench]', line)
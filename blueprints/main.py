@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, session
+from flask import Blueprint, render_template, request, jsonify, current_app, session, stream_with_context
 from flask_login import current_user
 # Removido: from models.hierarchy import Central, Almoxarifado, SubAlmoxarifado, Setor
 # Removido: from models.produto import Produto, EstoqueProduto, LoteProduto, MovimentacaoProduto
@@ -10,6 +10,18 @@ from auth import (require_any_level, require_manager_or_above, require_admin_or_
                   ScopeFilter, ensure_csrf_token, extract_csrf_header, get_csrf_token, log_auditoria)
 from config.ui_blocks import get_ui_blocks_config
 import extensions
+import cache_tags
+from hierarchy import PARENT_FIELDS, hierarchy_graph, local_of_estoque, _norm_tipo
+import pagination
+import stock_listing
+import reorder_points
+import lot_expiry
+import metrics
+from lot_allocation import AllocationRequest, ReturnRequest, lot_allocator
+import count_estimates
+from count_estimates import count_estimator
+from product_search import fold, product_index, relevance
+from canonical_ids import id_query, ids_query, legacy_ids, strict_ids_enabled
 from pymongo import ReturnDocument
 from datetime import datetime, timezone
 from datetime import timedelta
@@ -17,6 +29,7 @@ from bson import ObjectId
 import csv
 import io
 import os
+import re
 import json as _json
 from urllib.request import Request as _UrlRequest, urlopen as _urlopen
 from urllib.error import URLError as _URLError, HTTPError as _HTTPError
@@ -24,6 +37,9 @@ from werkzeug.security import generate_password_hash
 
 main_bp = Blueprint('main', __name__)
 
+# Documentos lidos por ida ao banco (e linhas por bloco enviado) nas exportações em streaming
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '2000'))
+
 # CSRF enforcement for JSON API and token provisioning for HTML pages
 @main_bp.before_request
 def _csrf_enforcement_and_provisioning():
@@ -55,6 +71,43 @@ def _csrf_enforcement_and_provisioning():
         except Exception:
             pass
 
+# Endpoints que alteram a hierarquia (central → almox → sub → setor)
+_HIERARCHY_WRITE_ENDPOINTS = {
+    'main.api_centrais_create', 'main.api_centrais_update', 'main.api_centrais_delete',
+    'main.api_almoxarifados_create', 'main.api_almoxarifados_update', 'main.api_almoxarifados_delete',
+    'main.api_sub_almoxarifados_create', 'main.api_sub_almoxarifados_update', 'main.api_sub_almoxarifados_delete',
+    'main.api_setores_create', 'main.api_setores_update', 'main.api_setores_delete',
+}
+
+# Atualizações que podem trocar o pai do local: o `escopo` denormalizado é regravado
+_REPARENT_ENDPOINTS = {
+    'main.api_almoxarifados_update': 'almoxarifado',
+    'main.api_sub_almoxarifados_update': 'sub_almoxarifado',
+    'main.api_setores_update': 'setor',
+}
+
+# Endpoints que alteram dados de produto exibidos nas listagens em cache
+_CATALOG_WRITE_ENDPOINTS = {'main.api_produto_update', 'main.api_produto_delete'}
+
+@main_bp.after_request
+def _invalidate_hierarchy_graph(response):
+    """Recarrega o grafo da hierarquia após escrita bem-sucedida em centrais/almox/sub/setores
+    e invalida as respostas em cache que exibem nomes de locais/produtos."""
+    try:
+        if response.status_code < 400:
+            if request.endpoint in _HIERARCHY_WRITE_ENDPOINTS:
+                hierarchy_graph.invalidate(extensions.mongo_db)
+                tipo = _REPARENT_ENDPOINTS.get(request.endpoint)
+                data = request.get_json(silent=True) or {}
+                if tipo and any(f in data for f in PARENT_FIELDS):
+                    hierarchy_graph.restamp(extensions.mongo_db, tipo, (request.view_args or {}).get('id'))
+                extensions.publish_invalidation([cache_tags.HIERARCHY_TAG])
+            elif request.endpoint in _CATALOG_WRITE_ENDPOINTS:
+                extensions.publish_invalidation([cache_tags.CATALOG_TAG])
+    except Exception:
+        pass
+    return response
+
 # ====== HEALTHCHECKS ======
 @main_bp.route('/health/mongo', methods=['GET'])
 def health_mongo():
@@ -118,6 +171,12 @@ def test_mongo():
 # Helper compartilhado para resolver documento por id sequencial ou ObjectId string
 def _find_by_id(coll_name: str, value):
     coll = extensions.mongo_db[coll_name]
+    if strict_ids_enabled():
+        # Modo estrito: resolve o id uma vez e consulta por um único valor
+        legacy_ids.ensure_loaded(extensions.mongo_db)
+        q = id_query(value, coll_name)
+        if q is not None:
+            return coll.find_one(q)
     doc = None
     try:
         # tentar id sequencial
@@ -136,6 +195,96 @@ def _find_by_id(coll_name: str, value):
         doc = coll.find_one({'id': value}) or coll.find_one({'_id': value})
     return doc
 
+def _ref_values(coll_name: str, value, doc=None) -> list:
+    """Valores com que chaves estrangeiras podem referenciar o documento (para `$in`).
+
+    Resolve o documento (id sequencial, ObjectId ou id legado mapeado) e devolve
+    todas as suas formas, para casar linhas gravadas antes e depois de
+    `scripts/migrate_canonical_ids.py`; no modo estrito, só `str(_id)`.
+    Sem documento, devolve as formas do próprio valor recebido.
+    """
+    if doc is None and value is not None:
+        doc = _find_by_id(coll_name, value)
+    if doc is not None:
+        oid = doc.get('_id')
+        if strict_ids_enabled():
+            return [str(oid)]
+        out = [str(oid), oid]
+        if doc.get('id') is not None:
+            out += [doc['id'], str(doc['id'])]
+        return list(dict.fromkeys(out))
+    out = [value]
+    if str(value).isdigit():
+        out.append(int(value))
+    if ObjectId.is_valid(str(value)):
+        out.append(ObjectId(str(value)))
+    return out
+
+def _persist_id(doc):
+    """Valor gravado em chaves estrangeiras: `str(_id)` no modo estrito, senão o id sequencial quando existir."""
+    if strict_ids_enabled() or doc.get('id') is None:
+        return str(doc.get('_id'))
+    return doc.get('id')
+
+def _escopo_of(tipo: str, local_id):
+    """Escopo denormalizado (ids canônicos dos ancestrais) de um local, para gravar em estoques/movimentações."""
+    hierarchy_graph.ensure_loaded(extensions.mongo_db)
+    return hierarchy_graph.scope_of(tipo, local_id)
+
+def _baixar_lotes(pid_out, tipo: str, local_id, quantidade: float) -> dict:
+    """Baixa `quantidade` dos lotes do produto no local, vencimento mais próximo primeiro (FEFO).
+
+    Devolve `{lotes, sem_lote}` para gravar na movimentação."""
+    req = AllocationRequest([pid_out], tipo, [local_id], quantidade)
+    return lot_allocator.allocate(extensions.mongo_db['lotes'], req).result()
+
+def _devolver_lotes(pid_out, tipo: str, local_id, quantidade: float, from_tipo: str, from_id) -> dict:
+    """Credita `quantidade` que volta de (`from_tipo`, `from_id`) nos lotes baixados pelas saídas do local para lá.
+
+    Devolve `{lotes, sem_lote}` para gravar na movimentação."""
+    db = extensions.mongo_db
+    req = ReturnRequest([pid_out], tipo, [local_id], quantidade, from_tipo, [from_id])
+    return lot_allocator.give_back(db['lotes'], db['movimentacoes'], req).result()
+
+def _index_produto(doc):
+    """Atualiza o índice de busca de produtos após uma escrita e publica a nova versão."""
+    try:
+        db = extensions.mongo_db
+        if product_index.ensure_loaded(db):
+            product_index.upsert(doc)
+            product_index.publish(db, doc.get('_id'))
+    except Exception:
+        pass
+
+def _publish_stock_change(produto_ref, locais):
+    """Invalida as respostas em cache (estq:/mov:/resd:) afetadas por uma escrita de estoque.
+
+    `locais` é uma lista de (tipo, id); o produto é publicado em todas as suas formas de id.
+    """
+    try:
+        pids = [produto_ref]
+        pdoc = produto_ref if isinstance(produto_ref, dict) else _find_by_id('produtos', produto_ref)
+        if pdoc:
+            pids = [pdoc.get('id'), pdoc.get('_id'), produto_ref if not isinstance(produto_ref, dict) else None]
+        hierarchy_graph.ensure_loaded(extensions.mongo_db)
+        extensions.publish_invalidation(cache_tags.stock_change_tags(hierarchy_graph, pids, locais))
+    except Exception:
+        pass
+
+_CACHE_SCOPE_FIELD = {
+    'admin_central': 'central_id',
+    'gerente_almox': 'almoxarifado_id',
+    'resp_sub_almox': 'sub_almoxarifado_id',
+    'operador_setor': 'setor_id',
+}
+
+def _cache_scope_tags():
+    """Tags de dependência das listagens em cache (escopo do usuário atual, catálogo e hierarquia)."""
+    level = getattr(current_user, 'nivel_acesso', None)
+    field = _CACHE_SCOPE_FIELD.get(level)
+    hierarchy_graph.ensure_loaded(extensions.mongo_db)
+    return cache_tags.scope_tags(hierarchy_graph, level, getattr(current_user, field, None) if field else None)
+
 def _get_hierarchy_context():
     """Retorna dicionário com listas de centrais, almoxarifados, subs e setores filtrados pelo escopo do usuário."""
     ctx = {
@@ -1403,7 +1552,7 @@ def api_relatorios_admin_consumo_gastos():
             codigo = (pdoc or {}).get('codigo') or '-'
             pid_out = pid
             if pdoc:
-                pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+                pid_out = _persist_id(pdoc)
             items.append({
                 'produto_id': pid_out,
                 'produto_nome': nome,
@@ -1631,42 +1780,14 @@ def api_compras_sugestoes():
         except Exception:
             stock_map = {}
 
-        # 2) Vencimento próximo por produto: menor data de vencimento (> agora) com quantidade > 0
+        # 2) Vencimento próximo por produto: menor `data_validade` (> agora) com quantidade > 0, pelo índice de validade
         lotes_map = {}
         now = datetime.utcnow()
         try:
-            lotes = db['lotes']
-            for l in lotes.find({}):
-                pid = l.get('produto_id')
-                if pid is None:
-                    continue
-                q_atual = float(l.get('quantidade_atual', 0) or 0)
-                dv_raw = l.get('data_vencimento')
-                if not dv_raw:
-                    continue
-                dv_dt = None
-                if isinstance(dv_raw, datetime):
-                    dv_dt = dv_raw
-                elif isinstance(dv_raw, str):
-                    try:
-                        dv_dt = datetime.fromisoformat(dv_raw)
-                    except Exception:
-                        dv_dt = None
-                if dv_dt is None:
+            for rec in lot_expiry.next_expiry(db['lotes'], now):
+                if rec.get('_id') is None:
                     continue
-                # ignorar lotes vencidos ou com zero
-                if dv_dt <= now:
-                    continue
-                if q_atual <= 0:
-                    continue
-                # escolher o mais próximo
-                rec = lotes_map.get(str(pid))
-                if rec is None:
-                    lotes_map[str(pid)] = {'produto_id': pid, 'prox_vencimento': dv_dt}
-                else:
-                    cur_dt = rec.get('prox_vencimento')
-                    if cur_dt is None or (dv_dt < cur_dt):
-                        rec['prox_vencimento'] = dv_dt
+                lotes_map[str(rec['_id'])] = {'produto_id': rec['_id'], 'prox_vencimento': rec['prox_vencimento']}
         except Exception:
             lotes_map = {}
 
@@ -2023,7 +2144,7 @@ def api_compras_lista_get():
             # Normalizar produto_id para o formato usado no resto da aplicação
             pid_out = None
             if pdoc:
-                pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+                pid_out = _persist_id(pdoc)
             else:
                 pid_out = produto_key
             itens.append({
@@ -2198,7 +2319,7 @@ def api_compras_finalizar():
                     'produto_nome': '-',
                     'produto_codigo': '-'
                 }
-            pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+            pid_out = _persist_id(pdoc)
             return {
                 'produto_key': k,
                 'produto_id': pid_out,
@@ -2433,6 +2554,20 @@ def compras_csv(compra_id):
 
 # ==================== BUSCA RÁPIDA DE PRODUTOS ====================
 
+def _busca_rapida_regex(db, q, ativos_flag):
+    """Caminho antigo da busca rápida (regex + ranking em até 120 candidatos), usado se o índice não carregar."""
+    tokens = [t for t in fold(q).split() if t]
+    or_clauses = []
+    for t in (tokens or [q]):
+        or_clauses.append({'nome': {'$regex': t, '$options': 'i'}})
+        or_clauses.append({'codigo': {'$regex': t, '$options': 'i'}})
+        or_clauses.append({'descricao': {'$regex': t, '$options': 'i'}})
+    filter_query = {'$or': or_clauses} if or_clauses else {}
+    if ativos_flag:
+        filter_query['ativo'] = True
+    cursor = db['produtos'].find(filter_query, {'id': 1, '_id': 1, 'nome': 1, 'codigo': 1, 'descricao': 1, 'ativo': 1, 'categoria_id': 1}).limit(120)
+    return [(relevance(doc, q), doc) for doc in cursor]
+
 @main_bp.route('/api/produtos/busca-rapida')
 @require_any_level
 def api_produtos_busca_rapida():
@@ -2457,71 +2592,20 @@ def api_produtos_busca_rapida():
         limit = max(1, min(limit, 25))
         ativos_flag = str(request.args.get('ativos', 'true')).lower() in ('true', '1', 't', 'yes', 'y')
 
-        import unicodedata
-        def normalize(s):
-            try:
-                s = str(s)
-                s = unicodedata.normalize('NFD', s)
-                s = ''.join(c for c in s if unicodedata.category(c) != 'Mn')
-                return s.lower()
-            except Exception:
-                return str(s).lower()
-
-        q_norm = normalize(q)
-        tokens = [t for t in q_norm.split() if t]
-        # Construir filtro amplo por regex para reduzir o conjunto
-        or_clauses = []
-        for t in (tokens or [q]):
-            try:
-                or_clauses.append({'nome': {'$regex': t, '$options': 'i'}})
-                or_clauses.append({'codigo': {'$regex': t, '$options': 'i'}})
-                or_clauses.append({'descricao': {'$regex': t, '$options': 'i'}})
-            except Exception:
-                pass
-        filter_query = {'$or': or_clauses} if or_clauses else {}
-        if ativos_flag:
-            filter_query['ativo'] = True
-
-        prod_coll = db['produtos']
-        # Pegar um conjunto ampliado para aplicar ranking do lado do servidor
-        cursor = prod_coll.find(filter_query, {'id': 1, '_id': 1, 'nome': 1, 'codigo': 1, 'descricao': 1, 'ativo': 1, 'categoria_id': 1}).limit(120)
-
         # Carregar categorias para exibir nome
         categorias_coll = db['categorias']
         categorias_by_seq = {c.get('id'): c for c in categorias_coll.find({}, {'id': 1, 'nome': 1}) if 'id' in c}
         categorias_by_oid = {str(c.get('_id')): c for c in categorias_coll.find({}, {'_id': 1, 'nome': 1})}
 
-        def relevance(doc):
-            nome = normalize(doc.get('nome') or '')
-            codigo = normalize(doc.get('codigo') or '')
-            desc = normalize(doc.get('descricao') or '')
-            score = 0
-            # Boosts
-            if q_norm == codigo:
-                score += 120
-            if q_norm == nome:
-                score += 90
-            # Startswith boosts
-            if codigo.startswith(q_norm):
-                score += 60
-            if nome.startswith(q_norm):
-                score += 45
-            # Token-based
-            for t in (tokens or [q_norm]):
-                if t in codigo:
-                    score += 35
-                if t in nome:
-                    score += 25
-                if t in desc:
-                    score += 10
-            # Ativo tem leve prioridade
-            if bool(doc.get('ativo', True)):
-                score += 5
-            return score
+        if product_index.ensure_loaded(db):
+            # Índice em memória: ranking sobre todos os produtos que casam, sem varrer a coleção
+            scored = product_index.search(q, limit=limit, ativos=ativos_flag)
+        else:
+            scored = _busca_rapida_regex(db, q, ativos_flag)
 
         items_raw = []
-        for doc in cursor:
-            pid = doc.get('id') if doc.get('id') is not None else str(doc.get('_id'))
+        for score, doc in scored:
+            pid = _persist_id(doc)
             # Categoria
             cat_raw = doc.get('categoria_id')
             cat_nome = None
@@ -2535,7 +2619,7 @@ def api_produtos_busca_rapida():
                 'codigo': doc.get('codigo'),
                 'ativo': bool(doc.get('ativo', True)),
                 'categoria_nome': cat_nome,
-                '_score': relevance(doc),
+                '_score': score,
                 '_pid_candidates': [pid] + ([int(pid)] if str(pid).isdigit() else [])
             })
 
@@ -2907,7 +2991,7 @@ def api_produtos_create():
     coll = extensions.mongo_db['produtos']
     existing = coll.find_one({'codigo': codigo})
     if existing:
-        pid_out = existing.get('id') if existing.get('id') is not None else str(existing.get('_id'))
+        pid_out = _persist_id(existing)
         return jsonify({'id': pid_out, 'message': 'Produto existente'}), 200
     doc = {
         'central_id': data.get('central_id'),
@@ -2919,6 +3003,10 @@ def api_produtos_create():
         'ativo': bool(data.get('ativo', True)),
         'created_at': datetime.utcnow()
     }
+    try:
+        doc['estoque_minimo'] = reorder_points.parse_point(data.get('estoque_minimo'))
+    except ValueError:
+        return jsonify({'error': 'estoque_minimo deve ser um número maior ou igual a zero'}), 400
     # Resolver categoria via categoria_id; caso contrário, aceitar texto livre em 'categoria'
     categoria_id = data.get('categoria_id')
     if categoria_id is not None:
@@ -2939,7 +3027,7 @@ def api_produtos_create():
             if not categoria_resolvida:
                 return jsonify({'error': 'Categoria informada não existe'}), 400
             # Persistir id resolvido normalizado (sequencial se existir, senão _id string)
-            doc['categoria_id'] = categoria_resolvida.get('id') if categoria_resolvida.get('id') is not None else str(categoria_resolvida.get('_id'))
+            doc['categoria_id'] = _persist_id(categoria_resolvida)
         except Exception:
             return jsonify({'error': 'Falha ao validar categoria_id'}), 400
     else:
@@ -2951,6 +3039,8 @@ def api_produtos_create():
     # Removido: categorias_especificas na criação para garantir categoria única
 
     res = coll.insert_one(doc)
+    doc['_id'] = res.inserted_id
+    _index_produto(doc)
     return jsonify({'id': str(res.inserted_id)})
 
 @main_bp.route('/api/produtos/gerar-codigo', methods=['POST'])
@@ -3587,9 +3677,9 @@ def api_sub_almoxarifados():
             normalized_central_id = central_doc.get('id') if central_doc and 'id' in central_doc else None
 
         # Normalizar IDs de saída preferindo id sequencial; fallback para _id como string ou valor bruto
-        sid_out = doc.get('id') if doc.get('id') is not None else str(doc.get('_id'))
+        sid_out = _persist_id(doc)
         if almox_doc:
-            aid_out = almox_doc.get('id') if almox_doc.get('id') is not None else str(almox_doc.get('_id'))
+            aid_out = _persist_id(almox_doc)
         else:
             if isinstance(raw_aid, int):
                 aid_out = raw_aid
@@ -3599,7 +3689,7 @@ def api_sub_almoxarifados():
                 except Exception:
                     aid_out = None
         if central_doc:
-            cid_out = central_doc.get('id') if central_doc.get('id') is not None else str(central_doc.get('_id'))
+            cid_out = _persist_id(central_doc)
         else:
             if isinstance(raw_cid, int):
                 cid_out = raw_cid
@@ -4223,6 +4313,14 @@ def api_setores_delete(id):
             coll.delete_one({'id': id})
     return jsonify({'status': 'deleted'})
 
+def _count_total(coll, query, mode, namespace):
+    """Total conforme o modo `count` (ver count_estimates.py); None em `none`."""
+    if mode == count_estimates.NONE:
+        return None
+    if mode == count_estimates.EXACT:
+        return coll.count_documents(query)
+    return count_estimator.get(count_estimator.key(namespace, query), lambda: coll.count_documents(query))
+
 @main_bp.route('/api/produtos')
 @require_any_level
 def api_produtos():
@@ -4260,13 +4358,22 @@ def api_produtos():
             {'descricao': {'$regex': search, '$options': 'i'}}
         ]
 
+    try:
+        count_mode = count_estimates.parse_count_mode(request.args.get('count'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     coll = extensions.mongo_db['produtos']
-    total = coll.count_documents(filter_query)
-    pages = max(1, (total + per_page - 1) // per_page)
-    page = max(1, min(page, pages))
+    total = _count_total(coll, filter_query, count_mode, 'produtos')
+    pages = count_estimates.total_pages(total, per_page)
+    if count_mode == count_estimates.EXACT:
+        page = max(1, min(page, pages))
     skip = max(0, (page - 1) * per_page)
 
-    cursor = coll.find(filter_query).sort('created_at', -1).skip(skip).limit(per_page)
+    # Linha extra só para has_more
+    rows = list(coll.find(filter_query).sort('created_at', -1).skip(skip).limit(per_page + 1))
+    has_more = len(rows) > per_page
+    cursor = rows[:per_page]
 
     # Opcional: carregar categorias para mostrar nome/cor
     categorias_coll = extensions.mongo_db['categorias']
@@ -4276,7 +4383,7 @@ def api_produtos():
     items = []
     for doc in cursor:
         # Normalizar id para string quando não existir id sequencial
-        pid = doc.get('id') if doc.get('id') is not None else str(doc.get('_id'))
+        pid = _persist_id(doc)
         # Aplicar escopo: níveis restritos só veem produtos da própria central
         if enforce_scope:
             try:
@@ -4315,7 +4422,9 @@ def api_produtos():
         'page': page,
         'pages': pages,
         'per_page': per_page,
-        'total': total
+        'total': total,
+        'count': count_mode,
+        'has_more': has_more
     })
 
 @main_bp.route('/api/produtos/<string:produto_id>')
@@ -4516,10 +4625,16 @@ def api_produto_update(produto_id):
             if not categoria_resolvida:
                 return jsonify({'error': 'Categoria informada não existe'}), 400
             # Persistir id resolvido
-            update_fields['categoria_id'] = categoria_resolvida.get('id') if categoria_resolvida.get('id') is not None else str(categoria_resolvida.get('_id'))
+            update_fields['categoria_id'] = _persist_id(categoria_resolvida)
         except Exception:
             return jsonify({'error': 'Falha ao validar categoria_id'}), 400
 
+    if 'estoque_minimo' in data:
+        try:
+            update_fields['estoque_minimo'] = reorder_points.parse_point(data.get('estoque_minimo'))
+        except ValueError:
+            return jsonify({'error': 'estoque_minimo deve ser um número maior ou igual a zero'}), 400
+
     # Removido: alteração de categorias_especificas para garantir categoria única por produto
 
     update_fields['updated_at'] = datetime.utcnow()
@@ -4542,6 +4657,10 @@ def api_produto_update(produto_id):
     )
     if not res:
         return jsonify({'error': 'Produto não encontrado'}), 404
+    _index_produto(res)
+    if 'estoque_minimo' in update_fields:
+        # Linhas de estoque que herdam o mínimo do produto passam a usar o novo valor
+        reorder_points.propagate(extensions.mongo_db['estoques'], _ref_values('produtos', None, doc=res), update_fields['estoque_minimo'])
 
     # Resolver categoria por nome novamente
     categoria_nome = None
@@ -4593,6 +4712,7 @@ def api_produto_delete(produto_id):
     )
     if not res:
         return jsonify({'error': 'Produto não encontrado'}), 404
+    _index_produto(res)
     return jsonify({'success': True})
 
 @main_bp.route('/api/produtos/<string:produto_id>/estoque')
@@ -4617,14 +4737,7 @@ def api_produto_estoque(produto_id):
     try:
         coll = extensions.mongo_db['estoques']
         # Montar filtros possíveis para produto_id
-        pid_candidates = []
-        if str(produto_id).isdigit():
-            pid_candidates.append(int(produto_id))
-        pid_candidates.append(produto_id)
-        try:
-            pid_candidates.append(ObjectId(produto_id))
-        except Exception:
-            pass
+        pid_candidates = _ref_values('produtos', produto_id)
         cursor = coll.find({'produto_id': {'$in': pid_candidates}})
         for s in cursor:
             quantidade = float(s.get('quantidade', s.get('quantidade_atual', 0)) or 0)
@@ -4666,20 +4779,13 @@ def api_produto_lotes(produto_id):
     items = []
     try:
         coll = extensions.mongo_db['lotes']
-        pid_candidates = []
-        if str(produto_id).isdigit():
-            pid_candidates.append(int(produto_id))
-        pid_candidates.append(produto_id)
-        try:
-            pid_candidates.append(ObjectId(produto_id))
-        except Exception:
-            pass
+        pid_candidates = _ref_values('produtos', produto_id)
         for l in coll.find({'produto_id': {'$in': pid_candidates}}).limit(50):
             items.append({
                 'numero_lote': l.get('lote') or l.get('numero_lote'),
                 'quantidade_atual': l.get('quantidade_atual', 0),
                 'data_fabricacao': l.get('data_fabricacao'),
-                'data_vencimento': l.get('data_vencimento'),
+                'data_vencimento': lot_expiry.expiry_of(l),
                 'observacoes': l.get('observacoes')
             })
     except Exception:
@@ -4925,6 +5031,63 @@ def api_produto_movimentacoes(produto_id):
         pass
     return jsonify({'items': items, 'pagination': {'page': page, 'per_page': per_page, 'total': total}})
 
+def _estoque_hierarquia_row(s):
+    """Item da listagem a partir de uma linha de `stock_listing` (produto, local e saldos já resolvidos)."""
+    pdoc = s.get('produto') or {}
+    produto_id_out = pdoc.get('id')
+    if produto_id_out is None and pdoc:
+        produto_id_out = str(pdoc.get('_id'))
+    if produto_id_out is None:
+        produto_id_out = s.get('produto_id')
+    tipo, node = stock_listing.local_node(hierarchy_graph, s)
+    local_id = s.get('_local_id')
+    if node:
+        local_id = node.get('id') if node.get('id') is not None else str(node.get('_id'))
+    return {
+        'produto_id': produto_id_out,
+        'produto_nome': pdoc.get('nome') or '-',
+        'produto_codigo': pdoc.get('codigo') or '-',
+        'local_tipo': 'subalmoxarifado' if tipo == 'sub_almoxarifado' else (tipo or 'almoxarifado'),
+        'local_id': local_id,
+        'local_nome': (node or {}).get('nome') or s.get('local_nome') or s.get('nome_local') or 'Local',
+        'quantidade': float(s.get('_atual') or 0),
+        'quantidade_disponivel': float(s.get('_disp') or 0),
+        'quantidade_inicial': float(s.get('_inicial') or 0),
+        'data_atualizacao': s.get('updated_at') or s.get('data_atualizacao')
+    }
+
+def _estoque_hierarquia_pipeline(coll, query, page, per_page, no_pagination, tipo_filtro, local_filtro, status_filtro):
+    """`api_estoque_hierarquia` em uma agregação (ver stock_listing.py); Python só serializa."""
+    rules = stock_listing.RESERVA_RULES
+    status_match = rules.status_filter(status_filtro) if status_filtro else None
+    if status_match is not None:
+        query = {'$and': [query, status_match]} if query else status_match
+    post = []
+    if tipo_filtro:
+        post.append(stock_listing.tipo_match(_norm_tipo(tipo_filtro)))
+    if local_filtro:
+        post.append(stock_listing.local_match(hierarchy_graph, local_filtro))
+    post_match = {'$and': post} if post else None
+
+    # O escopo do usuário já está em `query` (escopo/locais permitidos): nenhuma linha é descartada
+    # depois do $skip/$limit, então páginas e total batem
+    def _items(rows):
+        return [_estoque_hierarquia_row(s) for s in rows]
+
+    if no_pagination:
+        items = _items(coll.aggregate(stock_listing.rows_pipeline(query, rules, post_match), allowDiskUse=True))
+        return {'items': items, 'pagination': {'page': 1, 'per_page': len(items), 'pages': 1, 'total': len(items)}}
+
+    per_page = max(1, min(per_page, 100))
+    page = max(1, page)
+    rows, total = stock_listing.unpack_page(list(coll.aggregate(stock_listing.page_pipeline(query, (page - 1) * per_page, per_page, rules, post_match=post_match))))
+    pages = max(1, (total + per_page - 1) // per_page)
+    if page > pages:
+        # Página além do fim: devolve a última, como antes
+        page = pages
+        rows, total = stock_listing.unpack_page(list(coll.aggregate(stock_listing.page_pipeline(query, (page - 1) * per_page, per_page, rules, post_match=post_match))))
+    return {'items': _items(rows), 'pagination': {'page': page, 'per_page': per_page, 'pages': pages, 'total': total}}
+
 @main_bp.route('/api/estoque/hierarquia')
 @require_any_level
 def api_estoque_hierarquia():
@@ -4973,6 +5136,9 @@ def api_estoque_hierarquia():
         if not ids: return {}
         try:
             coll = extensions.mongo_db[coll_name]
+            if strict_ids_enabled():
+                legacy_ids.ensure_loaded(extensions.mongo_db)
+                return {str(d['_id']): d for d in coll.find(ids_query(ids, coll_name))}
             # Separar tipos de ID
             oids = []
             ints = []
@@ -5123,71 +5289,85 @@ def api_estoque_hierarquia():
                 if level == 'operador_setor' and setor_seed is None:
                     return jsonify({'items': [], 'pagination': {'page': 1, 'per_page': 0, 'pages': 1, 'total': 0}})
 
-                if central_seed is None:
-                    if level == 'gerente_almox' and almox_seed is not None:
-                        a = _find_one('almoxarifados', almox_seed)
-                        central_seed = (a or {}).get('central_id')
-                    elif level == 'resp_sub_almox' and sub_seed is not None:
-                        sdoc = _find_one('sub_almoxarifados', sub_seed)
-                        a = _find_one('almoxarifados', (sdoc or {}).get('almoxarifado_id'))
-                        central_seed = (a or {}).get('central_id')
-                    elif level == 'operador_setor' and setor_seed is not None:
-                        se = _find_one('setores', setor_seed)
-                        sdoc = _find_one('sub_almoxarifados', (se or {}).get('sub_almoxarifado_id'))
-                        a = _find_one('almoxarifados', (sdoc or {}).get('almoxarifado_id'))
-                        central_seed = (a or {}).get('central_id')
-
-                allowed_central_vals = []
-                if central_seed is not None:
-                    cdoc = _find_one('centrais', central_seed)
-                    if cdoc:
-                        allowed_central_vals = _id_values([cdoc.get('_id'), cdoc.get('id'), central_seed])
-                    else:
-                        allowed_central_vals = _id_values([central_seed])
-
-                allowed_almox_vals = []
-                allowed_sub_vals = []
-                allowed_setor_vals = []
-
-                if level == 'admin_central':
-                    if not allowed_central_vals:
+                # Escopo denormalizado: igualdade única em escopo.<nível> (após backfill)
+                hierarchy_graph.ensure_loaded(extensions.mongo_db)
+                seed_by_level = {'admin_central': central_seed, 'gerente_almox': almox_seed, 'resp_sub_almox': sub_seed, 'operador_setor': setor_seed}
+                escopo_filter = hierarchy_graph.scope_filter(level, seed_by_level.get(level))
+                if escopo_filter is not None:
+                    query = {'$and': [query, escopo_filter]} if query else escopo_filter
+                else:
+                    if central_seed is None:
+                        if level == 'gerente_almox' and almox_seed is not None:
+                            a = _find_one('almoxarifados', almox_seed)
+                            central_seed = (a or {}).get('central_id')
+                        elif level == 'resp_sub_almox' and sub_seed is not None:
+                            sdoc = _find_one('sub_almoxarifados', sub_seed)
+                            a = _find_one('almoxarifados', (sdoc or {}).get('almoxarifado_id'))
+                            central_seed = (a or {}).get('central_id')
+                        elif level == 'operador_setor' and setor_seed is not None:
+                            se = _find_one('setores', setor_seed)
+                            sdoc = _find_one('sub_almoxarifados', (se or {}).get('sub_almoxarifado_id'))
+                            a = _find_one('almoxarifados', (sdoc or {}).get('almoxarifado_id'))
+                            central_seed = (a or {}).get('central_id')
+
+                    allowed_central_vals = []
+                    if central_seed is not None:
+                        cdoc = _find_one('centrais', central_seed)
+                        if cdoc:
+                            allowed_central_vals = _id_values([cdoc.get('_id'), cdoc.get('id'), central_seed])
+                        else:
+                            allowed_central_vals = _id_values([central_seed])
+
+                    allowed_almox_vals = []
+                    allowed_sub_vals = []
+                    allowed_setor_vals = []
+
+                    if level == 'admin_central':
+                        if not allowed_central_vals:
+                            return jsonify({'items': [], 'pagination': {'page': 1, 'per_page': 0, 'pages': 1, 'total': 0}})
+                        almox_docs = list(extensions.mongo_db['almoxarifados'].find({'central_id': {'$in': allowed_central_vals}}, {'_id': 1, 'id': 1}))
+                        allowed_almox_vals = _id_values([x.get('_id') for x in almox_docs] + [x.get('id') for x in almox_docs])
+                    elif level == 'gerente_almox':
+                        allowed_almox_vals = _id_values([almox_seed])
+                    elif level == 'resp_sub_almox':
+                        allowed_sub_vals = _id_values([sub_seed])
+                    elif level == 'operador_setor':
+                        allowed_setor_vals = _id_values([setor_seed])
+
+                    if level in ('admin_central', 'gerente_almox') and allowed_almox_vals:
+                        sub_docs = list(extensions.mongo_db['sub_almoxarifados'].find({'almoxarifado_id': {'$in': allowed_almox_vals}}, {'_id': 1, 'id': 1}))
+                        allowed_sub_vals = _id_values(list(allowed_sub_vals) + [x.get('_id') for x in sub_docs] + [x.get('id') for x in sub_docs])
+
+                    if level in ('admin_central', 'gerente_almox', 'resp_sub_almox') and allowed_sub_vals:
+                        setor_q = {'$or': [{'sub_almoxarifado_id': {'$in': allowed_sub_vals}}, {'sub_almoxarifado_ids': {'$in': allowed_sub_vals}}]}
+                        setor_docs = list(extensions.mongo_db['setores'].find(setor_q, {'_id': 1, 'id': 1}))
+                        allowed_setor_vals = _id_values(list(allowed_setor_vals) + [x.get('_id') for x in setor_docs] + [x.get('id') for x in setor_docs])
+
+                    scope_ors = []
+                    if allowed_central_vals:
+                        scope_ors += [{'central_id': {'$in': allowed_central_vals}}, {'local_tipo': 'central', 'local_id': {'$in': allowed_central_vals}}]
+                    if allowed_almox_vals:
+                        scope_ors += [{'almoxarifado_id': {'$in': allowed_almox_vals}}, {'local_tipo': 'almoxarifado', 'local_id': {'$in': allowed_almox_vals}}]
+                    if allowed_sub_vals:
+                        scope_ors += [{'sub_almoxarifado_id': {'$in': allowed_sub_vals}}, {'local_tipo': {'$in': ['subalmoxarifado', 'sub_almoxarifado']}, 'local_id': {'$in': allowed_sub_vals}}]
+                    if allowed_setor_vals:
+                        scope_ors += [{'setor_id': {'$in': allowed_setor_vals}}, {'local_tipo': 'setor', 'local_id': {'$in': allowed_setor_vals}}]
+
+                    if not scope_ors:
                         return jsonify({'items': [], 'pagination': {'page': 1, 'per_page': 0, 'pages': 1, 'total': 0}})
-                    almox_docs = list(extensions.mongo_db['almoxarifados'].find({'central_id': {'$in': allowed_central_vals}}, {'_id': 1, 'id': 1}))
-                    allowed_almox_vals = _id_values([x.get('_id') for x in almox_docs] + [x.get('id') for x in almox_docs])
-                elif level == 'gerente_almox':
-                    allowed_almox_vals = _id_values([almox_seed])
-                elif level == 'resp_sub_almox':
-                    allowed_sub_vals = _id_values([sub_seed])
-                elif level == 'operador_setor':
-                    allowed_setor_vals = _id_values([setor_seed])
-
-                if level in ('admin_central', 'gerente_almox') and allowed_almox_vals:
-                    sub_docs = list(extensions.mongo_db['sub_almoxarifados'].find({'almoxarifado_id': {'$in': allowed_almox_vals}}, {'_id': 1, 'id': 1}))
-                    allowed_sub_vals = _id_values(list(allowed_sub_vals) + [x.get('_id') for x in sub_docs] + [x.get('id') for x in sub_docs])
-
-                if level in ('admin_central', 'gerente_almox', 'resp_sub_almox') and allowed_sub_vals:
-                    setor_q = {'$or': [{'sub_almoxarifado_id': {'$in': allowed_sub_vals}}, {'sub_almoxarifado_ids': {'$in': allowed_sub_vals}}]}
-                    setor_docs = list(extensions.mongo_db['setores'].find(setor_q, {'_id': 1, 'id': 1}))
-                    allowed_setor_vals = _id_values(list(allowed_setor_vals) + [x.get('_id') for x in setor_docs] + [x.get('id') for x in setor_docs])
-
-                scope_ors = []
-                if allowed_central_vals:
-                    scope_ors += [{'central_id': {'$in': allowed_central_vals}}, {'local_tipo': 'central', 'local_id': {'$in': allowed_central_vals}}]
-                if allowed_almox_vals:
-                    scope_ors += [{'almoxarifado_id': {'$in': allowed_almox_vals}}, {'local_tipo': 'almoxarifado', 'local_id': {'$in': allowed_almox_vals}}]
-                if allowed_sub_vals:
-                    scope_ors += [{'sub_almoxarifado_id': {'$in': allowed_sub_vals}}, {'local_tipo': {'$in': ['subalmoxarifado', 'sub_almoxarifado']}, 'local_id': {'$in': allowed_sub_vals}}]
-                if allowed_setor_vals:
-                    scope_ors += [{'setor_id': {'$in': allowed_setor_vals}}, {'local_tipo': 'setor', 'local_id': {'$in': allowed_setor_vals}}]
-
-                if not scope_ors:
-                    return jsonify({'items': [], 'pagination': {'page': 1, 'per_page': 0, 'pages': 1, 'total': 0}})
 
-                scope_filter = {'$or': scope_ors}
-                query = {'$and': [query, scope_filter]} if query else scope_filter
+                    scope_filter = {'$or': scope_ors}
+                    query = {'$and': [query, scope_filter]} if query else scope_filter
         except Exception:
             return jsonify({'items': [], 'pagination': {'page': 1, 'per_page': 0, 'pages': 1, 'total': 0}})
 
+        # Uma agregação: filtros, classificação do local, página, produtos e total
+        if not extensions.mongo_is_mock and hierarchy_graph.ensure_loaded(extensions.mongo_db):
+            result = _estoque_hierarquia_pipeline(coll, query, page, per_page, no_pagination, tipo_filtro, local_filtro, status_filtro)
+            try: extensions.response_cache.set(cache_key, result, ttl=extensions.RESPONSE_CACHE_TAGGED_TTL, tags=_cache_scope_tags())
+            except: pass
+            return jsonify(result)
+
         base_total = coll.count_documents(query)
         projection = {
             'produto_id': 1, 'setor_id': 1, 'sub_almoxarifado_id': 1,
@@ -5200,14 +5380,14 @@ def api_estoque_hierarquia():
 
         cursor = None
         if no_pagination:
-            cursor = coll.find(query, projection).sort('updated_at', -1)
+            cursor = coll.find(query, projection).sort(list(stock_listing.DEFAULT_SORT.items()))
         else:
             per_page = max(1, min(per_page, 100))
             total_pages_base = max(1, (base_total + per_page - 1) // per_page)
             page = max(1, min(page, total_pages_base))
             skip = (page - 1) * per_page
             batch_limit = min(per_page * 5, 500) # Aumentado para reduzir chance de página vazia
-            cursor = coll.find(query, projection).sort('updated_at', -1).skip(skip).limit(batch_limit)
+            cursor = coll.find(query, projection).sort(list(stock_listing.DEFAULT_SORT.items())).skip(skip).limit(batch_limit)
             
         # Buscar dados em memória para processamento em lote
         items_raw = list(cursor)
@@ -5364,7 +5544,7 @@ def api_estoque_hierarquia():
         }
 
     result = {'items': items, 'pagination': pagination}
-    try: extensions.response_cache.set(cache_key, result, ttl=10)
+    try: extensions.response_cache.set(cache_key, result, ttl=extensions.RESPONSE_CACHE_TAGGED_TTL, tags=_cache_scope_tags())
     except: pass
     return jsonify(result)
 
@@ -5383,14 +5563,14 @@ def api_estoque_hierarquia_export():
     status_filtro = (request.args.get('status') or '').strip().lower()
     local_filtro = (request.args.get('local') or '').strip()
 
-    def normalize_tipo(t):
-        return str(t or '').lower().replace('-', '').replace('_', '')
-
     # Otimização: Resolução em lote
     def _bulk_resolve(coll_name, ids):
         if not ids: return {}
         try:
             coll = extensions.mongo_db[coll_name]
+            if strict_ids_enabled():
+                legacy_ids.ensure_loaded(extensions.mongo_db)
+                return {str(d['_id']): d for d in coll.find(ids_query(ids, coll_name))}
             oids = []
             ints = []
             strs = []
@@ -5417,7 +5597,7 @@ def api_estoque_hierarquia_export():
         except Exception:
             return {}
 
-    # Preparar candidatos de produto
+    # Preparar candidatos de produto (id em qualquer forma ou trecho do nome/código)
     accepted_prod_ids = []
     if produto_filtro:
         if produto_filtro.isdigit():
@@ -5428,10 +5608,11 @@ def api_estoque_hierarquia_export():
         accepted_prod_ids.append(produto_filtro)
         try:
             produtos_coll = extensions.mongo_db['produtos']
+            pattern = re.escape(produto_filtro)
             prods = list(produtos_coll.find({
                 '$or': [
-                    {'nome': {'$regex': produto_filtro, '$options': 'i'}},
-                    {'codigo': {'$regex': produto_filtro, '$options': 'i'}}
+                    {'nome': {'$regex': pattern, '$options': 'i'}},
+                    {'codigo': {'$regex': pattern, '$options': 'i'}}
                 ]
             }, {'id': 1, '_id': 1}))
             for p in prods:
@@ -5442,42 +5623,23 @@ def api_estoque_hierarquia_export():
         except Exception:
             pass
 
-    items = []
     try:
         coll = extensions.mongo_db['estoques']
-        query = {}
+        # Filtros de produto, tipo/local (mesma classificação da listagem) e status no próprio find
+        clauses = []
         if accepted_prod_ids:
-            query['produto_id'] = {'$in': accepted_prod_ids}
-            
-        tipo_norm = normalize_tipo(tipo_filtro) if tipo_filtro else ''
-        local_val = local_filtro if local_filtro else None
-        
-        or_clauses = []
-        if tipo_norm:
-            if tipo_norm == 'setor':
-                or_clauses.append({'setor_id': {'$exists': True}})
-                or_clauses.append({'local_tipo': 'setor'})
-            elif tipo_norm in ('subalmoxarifado', 'sub_almoxarifado'):
-                or_clauses.append({'sub_almoxarifado_id': {'$exists': True}})
-                or_clauses.append({'local_tipo': 'subalmoxarifado'})
-            elif tipo_norm == 'almoxarifado':
-                or_clauses.append({'almoxarifado_id': {'$exists': True}})
-                or_clauses.append({'local_tipo': 'almoxarifado'})
-            elif tipo_norm == 'central':
-                or_clauses.append({'central_id': {'$exists': True}})
-                or_clauses.append({'local_tipo': 'central'})
-        
-        if local_val is not None:
-            or_clauses.extend([
-                {'local_id': local_val},
-                {'setor_id': local_val},
-                {'sub_almoxarifado_id': local_val},
-                {'almoxarifado_id': local_val},
-                {'central_id': local_val}
-            ])
-            
-        if or_clauses:
-            query['$or'] = or_clauses
+            clauses.append({'produto_id': {'$in': accepted_prod_ids}})
+        tipo_norm = _norm_tipo(tipo_filtro) if tipo_filtro else None
+        local_vals = None
+        if local_filtro:
+            hierarchy_graph.ensure_loaded(extensions.mongo_db)
+            local_vals = stock_listing.local_ids(hierarchy_graph, local_filtro)
+        if tipo_norm or local_vals:
+            clauses.append(stock_listing.classified_filter(tipo_norm, local_vals))
+        status_match = stock_listing.RESERVA_RULES.status_filter(status_filtro) if status_filtro else None
+        if status_match is not None:
+            clauses.append(status_match)
+        query = {'$and': clauses} if clauses else {}
 
         try:
             level = getattr(current_user, 'nivel_acesso', None)
@@ -5600,18 +5762,21 @@ def api_estoque_hierarquia_export():
         except Exception:
             return "Erro ao aplicar escopo", 500
 
-        # Busca sem paginação
-        cursor = coll.find(query).sort('updated_at', -1)
-        items_raw = list(cursor)
-        
+        # Busca sem paginação, lida do cursor em lotes
+        cursor = coll.find(query).sort('updated_at', -1).batch_size(EXPORT_BATCH_SIZE)
+    except Exception as e:
+        current_app.logger.error(f"Erro export: {e}")
+        return "Erro ao gerar exportação", 500
+
+    # Locais são poucos e se repetem entre lotes: ficam em cache durante a exportação
+    loc_maps = {'centrais': {}, 'almoxarifados': {}, 'sub_almoxarifados': {}, 'setores': {}}
+
+    def _export_rows(batch):
         # 1. Coletar IDs para Bulk Load
         prod_ids_to_fetch = set()
-        loc_ids_to_fetch = {
-            'centrais': set(), 'almoxarifados': set(),
-            'sub_almoxarifados': set(), 'setores': set()
-        }
-        
-        for s in items_raw:
+        loc_ids_to_fetch = {k: set() for k in loc_maps}
+
+        for s in batch:
             if s.get('produto_id'): prod_ids_to_fetch.add(s.get('produto_id'))
             l_id = None
             l_coll = None
@@ -5627,16 +5792,17 @@ def api_estoque_hierarquia_export():
                     elif lt in ('subalmoxarifado', 'sub_almoxarifado'): l_coll = 'sub_almoxarifados'
                     elif lt == 'almoxarifado': l_coll = 'almoxarifados'
                     elif lt == 'central': l_coll = 'centrais'
-            if l_id and l_coll: loc_ids_to_fetch[l_coll].add(l_id)
+            if l_id and l_coll and str(l_id) not in loc_maps[l_coll]: loc_ids_to_fetch[l_coll].add(l_id)
 
-        # 2. Executar Bulk Queries
+        # 2. Executar Bulk Queries (produtos por lote; locais só os ainda não vistos)
         prod_map = _bulk_resolve('produtos', prod_ids_to_fetch)
-        loc_maps = {k: _bulk_resolve(k, v) for k, v in loc_ids_to_fetch.items()}
+        for k, v in loc_ids_to_fetch.items():
+            if v: loc_maps[k].update(_bulk_resolve(k, v))
 
-        for s in items_raw:
+        for s in batch:
             raw_pid = s.get('produto_id')
             pdoc = prod_map.get(str(raw_pid))
-            
+        
             produto_nome = (pdoc or {}).get('nome') or '-'
             produto_codigo = (pdoc or {}).get('codigo') or '-'
             produto_id_out = (pdoc or {}).get('id')
@@ -5672,64 +5838,51 @@ def api_estoque_hierarquia_export():
             disponivel = float(s.get('quantidade_disponivel', quantidade - reservada) or 0)
             inicial = float(s.get('quantidade_inicial', quantidade) or 0)
 
-            # filtros python
-            if produto_filtro:
-                pf = produto_filtro.lower()
-                nome_ok = pf in str(produto_nome).lower()
-                cod_ok = pf in str(produto_codigo).lower()
-                id_ok = (str(raw_pid) == produto_filtro) or (str(produto_id_out) == produto_filtro)
-                try: id_ok = id_ok or (str(ObjectId(produto_filtro)) == str(raw_pid))
-                except: pass
-                if not (nome_ok or cod_ok or id_ok): continue
-
-            if tipo_filtro and normalize_tipo(tipo) != normalize_tipo(tipo_filtro): continue
-            if local_filtro and str(local_id) != str(local_filtro): continue
-
-            if status_filtro:
-                limiar_baixo = max(inicial * 0.1, 5)
-                if status_filtro == 'zerado' and not (disponivel <= 0): continue
-                elif status_filtro == 'baixo' and not (disponivel > 0 and disponivel <= limiar_baixo): continue
-                elif status_filtro in ('disponivel', 'normal') and not (disponivel > limiar_baixo): continue
-
-            try:
-                if getattr(current_user, 'nivel_acesso', None) in ('admin_central', 'gerente_almox', 'resp_sub_almox', 'operador_setor'):
-                    if not current_user.can_access_produto(produto_id_out): continue
-            except: continue
+            yield [
+                produto_id_out, produto_codigo, produto_nome,
+                tipo, local_id, local_nome,
+                quantidade, disponivel, inicial,
+                s.get('updated_at') or s.get('data_atualizacao')
+            ]
 
-            items.append({
-                'produto_id': produto_id_out,
-                'produto_codigo': produto_codigo,
-                'produto_nome': produto_nome,
-                'local_tipo': tipo,
-                'local_id': local_id,
-                'local_nome': local_nome,
-                'quantidade': quantidade,
-                'quantidade_disponivel': disponivel,
-                'quantidade_inicial': inicial,
-                'data_atualizacao': s.get('updated_at') or s.get('data_atualizacao')
-            })
+    def _generate():
+        # CSV escrito lote a lote: memória constante independente do tamanho da exportação
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=';')
 
-    except Exception as e:
-        current_app.logger.error(f"Erro export: {e}")
-        return "Erro ao gerar exportação", 500
+        def _flush():
+            chunk = output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            return chunk
 
-    # Gerar CSV
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';')
-    writer.writerow(['produto_id', 'produto_codigo', 'produto_nome', 'local_tipo', 'local_id', 'local_nome',
-                     'quantidade', 'quantidade_disponivel', 'quantidade_inicial', 'data_atualizacao'])
-    for it in items:
-        writer.writerow([
-            it.get('produto_id'), it.get('produto_codigo'), it.get('produto_nome'),
-            it.get('local_tipo'), it.get('local_id'), it.get('local_nome'),
-            it.get('quantidade'), it.get('quantidade_disponivel'), it.get('quantidade_inicial'),
-            it.get('data_atualizacao')
-        ])
-    
-    csv_data = output.getvalue()
-    output.close()
-    
-    response = current_app.response_class(csv_data, mimetype='text/csv')
+        writer.writerow(['produto_id', 'produto_codigo', 'produto_nome', 'local_tipo', 'local_id', 'local_nome',
+                         'quantidade', 'quantidade_disponivel', 'quantidade_inicial', 'data_atualizacao'])
+        yield _flush()
+        batch = []
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    writer.writerows(_export_rows(batch))
+                    batch = []
+                    yield _flush()
+            if batch:
+                writer.writerows(_export_rows(batch))
+                yield _flush()
+        except Exception:
+            # Cabeçalhos (status 200) já enviados: marca o arquivo como incompleto e relança para o servidor
+            # abortar a resposta em partes (sem o bloco final o cliente vê a transferência interrompida)
+            current_app.logger.exception("Erro export: exportação interrompida")
+            output.seek(0)
+            output.truncate(0)
+            writer.writerow(['#ERRO', 'Exportação interrompida por erro no servidor; o arquivo está incompleto'])
+            yield _flush()
+            raise
+        finally:
+            cursor.close()
+
+    response = current_app.response_class(stream_with_context(_generate()), mimetype='text/csv')
     response.headers['Content-Disposition'] = 'attachment; filename="estoque_hierarquia.csv"'
     return response
 
@@ -5869,19 +6022,19 @@ def api_dashboard_estoque_baixo():
                 # Almoxarifados na central
                 almox_ids = []
                 for a in db['almoxarifados'].find({'central_id': central_user}, {'id': 1, '_id': 1}):
-                    val = a.get('id') if a.get('id') is not None else str(a.get('_id'))
+                    val = _persist_id(a)
                     almox_ids.append(val)
                 allowed_almox_ids = set(str(x) for x in almox_ids)
                 # Sub‑almoxarifados dos almoxarifados
                 sub_ids = []
                 for s in db['sub_almoxarifados'].find({'almoxarifado_id': {'$in': almox_ids}}, {'id': 1, '_id': 1}):
-                    val = s.get('id') if s.get('id') is not None else str(s.get('_id'))
+                    val = _persist_id(s)
                     sub_ids.append(val)
                 allowed_sub_ids = set(str(x) for x in sub_ids)
                 # Setores dos sub‑almoxarifados
                 set_ids = []
                 for st in db['setores'].find({'sub_almoxarifado_id': {'$in': sub_ids}}, {'id': 1, '_id': 1}):
-                    val = st.get('id') if st.get('id') is not None else str(st.get('_id'))
+                    val = _persist_id(st)
                     set_ids.append(val)
                 allowed_setor_ids = set(str(x) for x in set_ids)
             elif level == 'gerente_almox' and almox_user is not None:
@@ -5889,20 +6042,20 @@ def api_dashboard_estoque_baixo():
                 # Sub‑almoxarifados do almoxarifado
                 sub_ids = []
                 for s in db['sub_almoxarifados'].find({'almoxarifado_id': almox_user}, {'id': 1, '_id': 1}):
-                    val = s.get('id') if s.get('id') is not None else str(s.get('_id'))
+                    val = _persist_id(s)
                     sub_ids.append(val)
                 allowed_sub_ids = set(str(x) for x in sub_ids)
                 # Setores desses sub‑almoxarifados
                 set_ids = []
                 for st in db['setores'].find({'sub_almoxarifado_id': {'$in': sub_ids}}, {'id': 1, '_id': 1}):
-                    val = st.get('id') if st.get('id') is not None else str(st.get('_id'))
+                    val = _persist_id(st)
                     set_ids.append(val)
                 allowed_setor_ids = set(str(x) for x in set_ids)
             elif level == 'resp_sub_almox' and sub_user is not None:
                 allowed_sub_ids = set([str(sub_user)])
                 set_ids = []
                 for st in db['setores'].find({'sub_almoxarifado_id': sub_user}, {'id': 1, '_id': 1}):
-                    val = st.get('id') if st.get('id') is not None else str(st.get('_id'))
+                    val = _persist_id(st)
                     set_ids.append(val)
                 allowed_setor_ids = set(str(x) for x in set_ids)
             elif level == 'operador_setor' and setor_user is not None:
@@ -5911,110 +6064,79 @@ def api_dashboard_estoque_baixo():
             # Em caso de erro ao derivar escopo, manter filtros nulos
             pass
 
-        # Agregar estoque disponível e total por produto dentro do escopo
-        agg = {}
+        def _in_legacy_scope(s):
+            # Sem backfill de escopo: mesmo teste por campos de local usado antes
+            lt = str(s.get('local_tipo') or '').lower()
+            lid = s.get('local_id')
+            lid_str = str(lid) if lid is not None else None
+            sid = s.get('setor_id')
+            aid = s.get('almoxarifado_id')
+            sbid = s.get('sub_almoxarifado_id')
+            cid = s.get('central_id')
+            if allowed_setor_ids is not None:
+                return (sid is not None and str(sid) in allowed_setor_ids) or (lt == 'setor' and lid_str in allowed_setor_ids)
+            if allowed_sub_ids is not None:
+                allowed = (sbid is not None and str(sbid) in allowed_sub_ids) or (lt in ('sub_almoxarifado', 'subalmoxarifado') and lid_str in allowed_sub_ids)
+                if not allowed and allowed_setor_ids is not None and sid is not None:
+                    allowed = str(sid) in allowed_setor_ids
+                return allowed
+            if allowed_almox_ids is not None:
+                allowed = (aid is not None and str(aid) in allowed_almox_ids) or (lt == 'almoxarifado' and lid_str in allowed_almox_ids)
+                if not allowed and allowed_sub_ids is not None and sbid is not None:
+                    allowed = str(sbid) in allowed_sub_ids
+                if not allowed and allowed_setor_ids is not None and sid is not None:
+                    allowed = str(sid) in allowed_setor_ids
+                return allowed
+            if allowed_central_id is not None:
+                if cid is not None and str(cid) == str(allowed_central_id):
+                    return True
+                return bool((allowed_almox_ids and aid is not None and str(aid) in allowed_almox_ids)
+                            or (allowed_sub_ids and sbid is not None and str(sbid) in allowed_sub_ids)
+                            or (allowed_setor_ids and sid is not None and str(sid) in allowed_setor_ids))
+            return True
+
+        # Só as linhas abaixo do ponto de reposição (flag `abaixo_minimo`, índices parciais idx_est_baixo_*);
+        # com o backfill de escopo o filtro por local é uma igualdade em escopo.<nível>
+        hierarchy_graph.ensure_loaded(db)
+        escopo_filter = None
+        if level != 'super_admin':
+            seed_by_level = {'admin_central': central_user, 'gerente_almox': almox_user, 'resp_sub_almox': sub_user, 'operador_setor': setor_user}
+            escopo_filter = hierarchy_graph.scope_filter(level, seed_by_level.get(level))
+        projection = dict(reorder_points.PROJECTION, produto_id=1, local_tipo=1, local_id=1, setor_id=1,
+                          sub_almoxarifado_id=1, almoxarifado_id=1, central_id=1, nome_local=1)
+        rows = []
         try:
-            cursor = estoques.find({})
-            for s in cursor:
-                raw_pid = s.get('produto_id')
-                if raw_pid is None:
+            for s in estoques.find(reorder_points.low_stock_query(escopo_filter), projection):
+                if s.get('produto_id') is None:
                     continue
-                # Filtrar por escopo
-                allowed = True
-                if level != 'super_admin':
-                    lt = str(s.get('local_tipo') or '').lower()
-                    lid = s.get('local_id')
-                    lid_str = str(lid) if lid is not None else None
-                    sid = s.get('setor_id')
-                    aid = s.get('almoxarifado_id')
-                    sbid = s.get('sub_almoxarifado_id')
-                    cid = s.get('central_id')
-                    if allowed_setor_ids is not None:
-                        allowed = (sid is not None and str(sid) in allowed_setor_ids) or (lt == 'setor' and lid_str in allowed_setor_ids)
-                    elif allowed_sub_ids is not None:
-                        allowed = (sbid is not None and str(sbid) in allowed_sub_ids) or (lt in ('sub_almoxarifado', 'subalmoxarifado') and lid_str in allowed_sub_ids)
-                        if not allowed and allowed_setor_ids is not None and sid is not None:
-                            allowed = str(sid) in allowed_setor_ids
-                    elif allowed_almox_ids is not None:
-                        allowed = (aid is not None and str(aid) in allowed_almox_ids) or (lt == 'almoxarifado' and lid_str in allowed_almox_ids)
-                        if not allowed and allowed_sub_ids is not None and sbid is not None:
-                            allowed = str(sbid) in allowed_sub_ids
-                        if not allowed and allowed_setor_ids is not None and sid is not None:
-                            allowed = str(sid) in allowed_setor_ids
-                    elif allowed_central_id is not None:
-                        ok_by_central = (cid is not None and str(cid) == str(allowed_central_id))
-                        ok_by_local = False
-                        if allowed_almox_ids and aid is not None and str(aid) in allowed_almox_ids:
-                            ok_by_local = True
-                        if allowed_sub_ids and sbid is not None and str(sbid) in allowed_sub_ids:
-                            ok_by_local = True
-                        if allowed_setor_ids and sid is not None and str(sid) in allowed_setor_ids:
-                            ok_by_local = True
-                        allowed = ok_by_central or ok_by_local
-                    else:
-                        allowed = True
-                    if not allowed:
-                        continue
-
-                key = str(raw_pid)
-                rec = agg.get(key)
-                if rec is None:
-                    rec = {'raw_pid': raw_pid, 'quantidade': 0.0, 'disponivel': 0.0}
-                quantidade = float(s.get('quantidade', s.get('quantidade_atual', 0)) or 0)
-                reservada = float(s.get('quantidade_reservada', 0) or 0)
-                # Alinhar com /api/estoque/hierarquia: disponível = quantidade - reservada
-                disponivel = float(s.get('quantidade_disponivel', quantidade - reservada) or 0)
-                rec['quantidade'] += quantidade
-                rec['disponivel'] += disponivel
-                agg[key] = rec
+                if level != 'super_admin' and escopo_filter is None and not _in_legacy_scope(s):
+                    continue
+                disponivel = reorder_points.available(s)
+                if disponivel < 0:
+                    continue
+                rows.append((s, disponivel, reorder_points.point(s)))
         except Exception:
             pass
 
-        # Montar lista de produtos com estoque baixo
-        items = []
-        for key, rec in agg.items():
-            raw_pid = rec['raw_pid']
-            # Verificação explícita de escopo de produto removida.
-            # Confiamos no filtro por locais acima (central/almox/sub/setor) para respeitar o escopo.
-            # Se futuras regras exigirem checagem por produto, aplicar aqui de forma tolerante.
-
-            pdoc = _find_by_id('produtos', raw_pid)
-            nome = (pdoc or {}).get('nome') or 'Produto'
-            unidade = (pdoc or {}).get('unidade_medida')
-            estoque_min = None
-            try:
-                estoque_min_val = (pdoc or {}).get('estoque_minimo')
-                if isinstance(estoque_min_val, (int, float)):
-                    estoque_min = float(estoque_min_val)
-            except Exception:
-                estoque_min = None
-            inicial = float(rec.get('quantidade', 0.0))
-            disponivel = float(rec.get('disponivel', 0.0))
-            if estoque_min is None:
-                estoque_min = max(inicial * 0.1, 5.0)
-
-            # Condição de estoque baixo
-            if disponivel <= estoque_min and disponivel >= 0:
-                pid_out = None
-                if pdoc:
-                    pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
-                else:
-                    pid_out = str(raw_pid)
-                items.append({
-                    'id': pid_out,
-                    'nome': nome,
-                    'local': 'Total',
-                    'estoque_atual': disponivel,
-                    'estoque_minimo': estoque_min,
-                    'unidade_medida': unidade
-                })
-
-        # Ordenar por severidade (menor razão estoque/min primeiro) e limitar
-        items.sort(key=lambda x: (x['estoque_atual'] / (x['estoque_minimo'] or 1.0)))
+        # Ordenar por severidade (menor razão estoque/ponto primeiro) e limitar antes de resolver produtos
+        rows.sort(key=lambda r: r[1] / (r[2] or 1.0))
         limit = int(request.args.get('limit', 20))
         limit = max(1, min(limit, 100))
-        items = items[:limit]
 
+        items = []
+        for s, disponivel, ponto in rows[:limit]:
+            raw_pid = s.get('produto_id')
+            pdoc = _find_by_id('produtos', raw_pid)
+            tipo, local_id = local_of_estoque(s)
+            node = hierarchy_graph.node(stock_listing.TIPO_COLLECTIONS.get(tipo), local_id) if tipo else None
+            items.append({
+                'id': _persist_id(pdoc) if pdoc else str(raw_pid),
+                'nome': (pdoc or {}).get('nome') or 'Produto',
+                'local': (node or {}).get('nome') or s.get('nome_local') or 'Local',
+                'estoque_atual': disponivel,
+                'estoque_minimo': ponto,
+                'unidade_medida': (pdoc or {}).get('unidade_medida')
+            })
         return jsonify({'success': True, 'produtos': items})
     except Exception as e:
         try:
@@ -6049,26 +6171,7 @@ def api_dashboard_vencimentos():
         dias_aviso = int(request.args.get('dias_aviso', 30))
         dias_aviso = max(1, min(dias_aviso, 180))
 
-        now = datetime.now(timezone.utc)
-
-        def _parse_date(value):
-            if not value:
-                return None
-            if isinstance(value, datetime):
-                return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
-            try:
-                dt = datetime.fromisoformat(str(value))
-            except Exception:
-                dt = None
-            if dt is None:
-                return None
-            if dt.tzinfo is None:
-                try:
-                    local_tz = datetime.now().astimezone().tzinfo
-                except Exception:
-                    local_tz = timezone.utc
-                dt = dt.replace(tzinfo=local_tz)
-            return dt
+        now = datetime.utcnow()
 
         def _resolve_produto(pid):
             try:
@@ -6085,50 +6188,61 @@ def api_dashboard_vencimentos():
             except Exception:
                 return None
 
-        total_vencidos = 0
-        total_proximos = 0
-        items = []
-
-        # Buscar lotes com quantidade atual positiva quando disponível
-        try:
-            cursor = coll_lotes.find({'$or': [
-                {'quantidade_atual': {'$gt': 0}},
-                {'quantidade_atual': {'$exists': False}}
-            ]}).limit(500)
-        except Exception:
-            cursor = []
+        # Escopo por igualdade em escopo.<nível> depois da migração dos lotes; antes dela, conferência por produto
+        level = getattr(current_user, 'nivel_acesso', None)
+        scope = None
+        check_produto = level != 'super_admin'
+        hierarchy_graph.ensure_loaded(db)
+        migrated = lot_expiry.ready(hierarchy_graph)
+        if check_produto and migrated:
+            seed_by_level = {
+                'admin_central': getattr(current_user, 'central_id', None),
+                'gerente_almox': getattr(current_user, 'almoxarifado_id', None),
+                'resp_sub_almox': getattr(current_user, 'sub_almoxarifado_id', None),
+                'operador_setor': getattr(current_user, 'setor_id', None),
+            }
+            scope = hierarchy_graph.scope_filter(level, seed_by_level.get(level))
+            check_produto = scope is None
 
-        for l in cursor:
-            raw_pid = l.get('produto_id')
-            # Verificação de escopo de acesso ao produto
+        def _visible(l):
+            if not check_produto:
+                return True
             try:
-                if not current_user.can_access_produto(raw_pid):
-                    continue
+                return current_user.can_access_produto(l.get('produto_id'))
             except Exception:
                 # negar por segurança
-                continue
-
-            dv = _parse_date(l.get('data_vencimento'))
-            if not dv:
-                continue
-            try:
-                # Normalizar timezone para evitar erros em comparação
-                if dv.tzinfo is None:
-                    dv = dv.replace(tzinfo=timezone.utc)
-            except Exception:
-                pass
-            dias = int((dv - now).total_seconds() // 86400)
-
-            status = None
-            if dias < 0:
-                status = 'vencido'
-                total_vencidos += 1
-            elif dias <= dias_aviso:
-                status = 'proximo'
-                total_proximos += 1
+                return False
+
+        # Vencidos e próximos (até dias_aviso dias inteiros) numa faixa de `data_validade`, já em ordem de vencimento
+        janela = dias_aviso + 1
+        selected = []
+        if check_produto or not migrated:
+            # Antes da migração entram também os lotes com a validade só nos campos antigos
+            if migrated:
+                lots = lot_expiry.expiring(coll_lotes, janela, now=now, include_expired=True)
             else:
-                # fora da janela, não incluir
-                continue
+                lots = lot_expiry.expiring_with_legacy(coll_lotes, janela, now=now, include_expired=True)
+            total_vencidos = 0
+            total_proximos = 0
+            for l in lots:
+                if not _visible(l):
+                    continue
+                if lot_expiry.expiry_of(l) < now:
+                    total_vencidos += 1
+                else:
+                    total_proximos += 1
+                if len(selected) < limit:
+                    selected.append(l)
+        else:
+            total_vencidos = coll_lotes.count_documents(lot_expiry.expiring_query(0, scope, now, include_expired=True))
+            total_proximos = coll_lotes.count_documents(lot_expiry.expiring_query(janela, scope, now))
+            selected = list(lot_expiry.expiring(coll_lotes, janela, scope, now=now, include_expired=True, limit=limit))
+
+        items = []
+        for l in selected:
+            raw_pid = l.get('produto_id')
+            dv = lot_expiry.expiry_of(l)
+            dias = lot_expiry.days_until(dv, now)
 
             # Resolver dados do produto
             pdoc = _resolve_produto(raw_pid)
@@ -6146,15 +6260,11 @@ def api_dashboard_vencimentos():
                 'produto_id': produto_id_out,
                 'produto_nome': produto_nome,
                 'numero_lote': l.get('lote') or l.get('numero_lote'),
-                'data_vencimento': dv.isoformat(),
+                'data_vencimento': dv.replace(tzinfo=timezone.utc).isoformat(),
                 'dias_para_vencer': dias,
-                'status': status
+                'status': 'vencido' if dias < 0 else 'proximo'
             })
 
-        # Ordenar: vencidos primeiro (dias menor), depois próximos por menor dias
-        items.sort(key=lambda x: (0 if x['status'] == 'vencido' else 1, x['dias_para_vencer']))
-        items = items[:limit]
-
         return jsonify({
             'success': True,
             'total_vencidos': total_vencidos,
@@ -6403,16 +6513,8 @@ def api_movimentacoes():
     # Filtro por produto: pode ser nome/código (texto) ou id
     if filtros['produto']:
         produto_text = filtros['produto']
-        pid_candidates = []
-        if produto_text.isdigit():
-            pid_candidates.append(int(produto_text))
-        # ObjectId
-        try:
-            pid_candidates.append(ObjectId(produto_text))
-        except Exception:
-            pass
-        # String direta
-        pid_candidates.append(produto_text)
+        # Id do produto em todas as formas (sequencial, ObjectId, str(_id), legado mapeado)
+        pid_candidates = _ref_values('produtos', produto_text)
 
         # Montar $or considerando produto_id e texto em nome/código
         prod_match = [{
@@ -6591,18 +6693,34 @@ def api_movimentacoes():
             # Fallback silencioso (escopo será aplicado dentro do loop)
             pass
 
-    total = coll.count_documents(query or {})
     page = max(1, page)
     per_page = max(1, min(per_page, 100))
     skip = max(0, (page - 1) * per_page)
 
-    cursor = coll.find(query or {}).sort('data_movimentacao', -1).skip(skip).limit(per_page)
+    # Paginação por cursor (keyset, ver pagination.py); `page` segue aceito sem cursor
+    cursor_token = (request.args.get('cursor') or '').strip() or None
+    try:
+        count_mode = count_estimates.parse_count_mode(request.args.get('count'), count_estimates.NONE if cursor_token else count_estimates.EXACT)
+        paged_query, direction = pagination.apply_cursor(query or {}, cursor_token)
+    except pagination.InvalidCursor:
+        return jsonify({'error': 'Cursor inválido'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    total = _count_total(coll, query or {}, count_mode, 'movimentacoes')
+    cursor = coll.find(paged_query).sort(pagination.sort_spec(direction))
+    if cursor_token is None:
+        cursor = cursor.skip(skip)
+    cursor = cursor.limit(per_page + 1)
 
     # Otimização: Resolução em lote
     def _bulk_resolve(coll_name, ids):
         if not ids: return {}
         try:
             coll = extensions.mongo_db[coll_name]
+            if strict_ids_enabled():
+                legacy_ids.ensure_loaded(extensions.mongo_db)
+                return {str(d['_id']): d for d in coll.find(ids_query(ids, coll_name))}
             oids = []
             ints = []
             strs = []
@@ -6630,7 +6748,7 @@ def api_movimentacoes():
             return {}
 
     # 1. Coletar IDs
-    items_raw = list(cursor)
+    items_raw, cursors = pagination.page_cursors(list(cursor), per_page, direction, first_page=cursor_token is None and page == 1)
     prod_ids = set()
     loc_ids = {
         'centrais': set(), 'almoxarifados': set(),
@@ -6743,17 +6861,20 @@ def api_movimentacoes():
         })
 
     # Construir paginação compatível com template
-    total_pages = max(1, (total + per_page - 1) // per_page)
-    pagination = {
-        'current_page': page,
+    pagination_out = {
+        'current_page': page if cursor_token is None else None,
         'per_page': per_page,
-        'total_pages': total_pages,
-        'total': total
+        'total_pages': count_estimates.total_pages(total, per_page),
+        'total': total,
+        'count': count_mode,
+        'has_more': cursors['next_cursor'] is not None,
+        'next_cursor': cursors['next_cursor'],
+        'prev_cursor': cursors['prev_cursor'],
     }
 
-    result = {'items': items, 'pagination': pagination}
+    result = {'items': items, 'pagination': pagination_out}
     try:
-        extensions.response_cache.set(cache_key, result, ttl=10)
+        extensions.response_cache.set(cache_key, result, ttl=extensions.RESPONSE_CACHE_TAGGED_TTL, tags=_cache_scope_tags())
     except Exception:
         pass
     return jsonify(result)
@@ -6774,15 +6895,8 @@ def api_produto_almoxarifados(produto_id):
         almox_coll = db['almoxarifados']
         estoque_coll = db['estoques']
 
-        # Normalizar candidatos de produto_id para consulta
-        pid_candidates = []
-        if str(produto_id).isdigit():
-            pid_candidates.append(int(produto_id))
-        pid_candidates.append(produto_id)
-        try:
-            pid_candidates.append(ObjectId(produto_id))
-        except Exception:
-            pass
+        # Todas as formas do id do produto (antes e depois da migração de ids canônicos)
+        pid_candidates = _ref_values('produtos', produto_id)
 
         # Mapear estoques por almoxarifado_id
         estoque_por_almox = {}
@@ -6806,10 +6920,16 @@ def api_produto_almoxarifados(produto_id):
         items = []
         for a in almox_coll.find({'$or': [{'ativo': True}, {'ativo': {'$exists': False}}]}).sort('nome', 1):
             # id de saída preferindo sequencial e caindo para _id
-            aid_out = a.get('id') if a.get('id') is not None else str(a.get('_id'))
+            aid_out = _persist_id(a)
             nome = a.get('nome') or a.get('descricao') or 'Sem nome'
-            key = str(a.get('id') if a.get('id') is not None else a.get('_id'))
-            est = estoque_por_almox.get(key)
+            # Linhas de estoque podem referenciar o almoxarifado pelo id sequencial ou por str(_id)
+            est = None
+            for key in dict.fromkeys(str(v) for v in _ref_values('almoxarifados', None, doc=a)):
+                row = estoque_por_almox.get(key)
+                if row is not None:
+                    est = est or {'quantidade': 0.0, 'disponivel': 0.0}
+                    est['quantidade'] += row['quantidade']
+                    est['disponivel'] += row['disponivel']
             items.append({
                 'id': aid_out,
                 'nome': nome,
@@ -6881,8 +7001,8 @@ def api_produto_recebimento(produto_id):
         almox_nome = almox.get('nome') or almox.get('descricao') or 'Almoxarifado'
 
         # Normalizar ids de persistência (preferir id sequencial se existir)
-        pid_out = produto.get('id') if produto.get('id') is not None else str(produto.get('_id'))
-        aid_out = almox.get('id') if almox.get('id') is not None else str(almox.get('_id'))
+        pid_out = _persist_id(produto)
+        aid_out = _persist_id(almox)
 
         # Datas
         now = datetime.now(timezone.utc)
@@ -6897,7 +7017,8 @@ def api_produto_recebimento(produto_id):
                 return None
         data_recebimento = _parse_date(data.get('data_recebimento')) or now
         data_fabricacao = _parse_date(data.get('data_fabricacao'))
-        data_vencimento = _parse_date(data.get('data_vencimento'))
+        data_vencimento = lot_expiry.parse(data.get('data_vencimento') or data.get('data_validade'))
+        escopo = _escopo_of('almoxarifado', aid_out)
 
         # Atualizar/incrementar estoque
         estoque_filter = {'produto_id': pid_out, 'local_tipo': 'almoxarifado', 'local_id': aid_out}
@@ -6912,6 +7033,7 @@ def api_produto_recebimento(produto_id):
                 'local_id': aid_out,
                 'almoxarifado_id': aid_out,
                 'nome_local': almox_nome,
+                'escopo': escopo,
                 'updated_at': now
             },
             '$setOnInsert': {
@@ -6924,6 +7046,7 @@ def api_produto_recebimento(produto_id):
             return_document=ReturnDocument.AFTER,
             upsert=True
         )
+        reorder_points.sync(estoques, estoque_res)
 
         # Registrar movimentação
         mov_doc = {
@@ -6940,6 +7063,7 @@ def api_produto_recebimento(produto_id):
             'lote': data.get('lote') or None,
             'local_tipo': 'almoxarifado',
             'local_id': aid_out,
+            'escopo': escopo,
             'created_at': now
         }
         mov_ins = movimentacoes.insert_one(mov_doc)
@@ -6957,22 +7081,20 @@ def api_produto_recebimento(produto_id):
                     'lote': lote_num,
                     'almoxarifado_id': aid_out,
                     'data_fabricacao': data_fabricacao,
-                    'data_vencimento': data_vencimento,
+                    'data_validade': data_vencimento,
+                    'escopo': escopo,
                     'fornecedor': data.get('fornecedor'),
                     'updated_at': now
                 },
+                '$unset': {f: '' for f in lot_expiry.LEGACY_FIELDS},
                 '$setOnInsert': {
                     'created_at': now
                 }
             }
             lotes.find_one_and_update(lote_filter, lote_update, upsert=True)
+            lot_allocator.forget([pid_out])
 
-        try:
-            extensions.response_cache.clear_prefix('mov:')
-            extensions.response_cache.clear_prefix('estq:')
-            extensions.response_cache.clear_prefix('resd:')
-        except Exception:
-            pass
+        _publish_stock_change(produto, [('almoxarifado', aid_out)])
         return jsonify({
             'success': True,
             'movimentacao_id': str(mov_ins.inserted_id),
@@ -7071,7 +7193,7 @@ def api_produto_lote_entrada(produto_id, numero_lote):
                     ldoc = lcoll.find_one({'produto_id': pid_out, 'lote': lote_num, 'almoxarifado_id': almox_id})
                     if ldoc:
                         lote_df = ldoc.get('data_fabricacao')
-                        lote_dv = ldoc.get('data_vencimento')
+                        lote_dv = lot_expiry.expiry_of(ldoc)
             except Exception:
                 pass
             return jsonify({'success': True, 'entrada': {
@@ -7157,7 +7279,7 @@ def api_produto_lote_entrada(produto_id, numero_lote):
                     local_tipo = entrada.get('local_tipo') or entrada.get('destino_tipo') or 'almoxarifado'
                     if produto_id_out is not None and local_id is not None:
                         estoque_filter = {'produto_id': produto_id_out, 'local_tipo': local_tipo, 'local_id': local_id}
-                        estoques.find_one_and_update(
+                        estoque_doc = estoques.find_one_and_update(
                             estoque_filter,
                             {
                                 '$inc': {
@@ -7167,8 +7289,10 @@ def api_produto_lote_entrada(produto_id, numero_lote):
                                 '$set': {
                                     'updated_at': now
                                 }
-                            }
+                            },
+                            return_document=ReturnDocument.AFTER
                         )
+                        reorder_points.sync(estoques, estoque_doc)
                 except Exception:
                     pass
 
@@ -7205,15 +7329,23 @@ def api_produto_lote_entrada(produto_id, numero_lote):
                     sf = {}
                     if df_payload:
                         sf['data_fabricacao'] = df_payload
+                    update = {}
                     if dv_payload:
-                        sf['data_vencimento'] = dv_payload
+                        sf['data_validade'] = lot_expiry.parse(dv_payload)
+                        update['$unset'] = {f: '' for f in lot_expiry.LEGACY_FIELDS}
                     if sf:
-                        extensions.mongo_db['lotes'].update_one({'produto_id': pid_out, 'lote': lote_num, 'almoxarifado_id': almox_id}, {'$set': sf})
+                        update['$set'] = sf
+                        extensions.mongo_db['lotes'].update_one({'produto_id': pid_out, 'lote': lote_num, 'almoxarifado_id': almox_id}, update)
         except Exception:
             pass
+        lot_allocator.forget([entrada.get('produto_id')])
 
         res = coll.update_one({'_id': entrada.get('_id')}, {'$set': set_fields})
         ok = bool(getattr(res, 'modified_count', 0))
+        _publish_stock_change(entrada.get('produto_id'), [(
+            entrada.get('local_tipo') or entrada.get('destino_tipo') or 'almoxarifado',
+            entrada.get('local_id') or entrada.get('almoxarifado_id') or entrada.get('destino_id'),
+        )])
         return jsonify({'success': True, 'updated': ok})
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro ao editar entrada de lote: {e}'})
@@ -7223,18 +7355,7 @@ def api_produto_lote_entrada(produto_id, numero_lote):
 def api_produto_entradas_sem_lote(produto_id):
     try:
         coll = extensions.mongo_db['movimentacoes']
-        pid_candidates = [produto_id]
-        try:
-            if str(produto_id).isdigit():
-                pid_candidates.append(int(produto_id))
-        except Exception:
-            pass
-        try:
-            oid = ObjectId(str(produto_id))
-            pid_candidates.append(oid)
-            pid_candidates.append(str(oid))
-        except Exception:
-            pass
+        pid_candidates = _ref_values('produtos', produto_id)
         query = {
             'produto_id': {'$in': pid_candidates},
             'tipo': 'entrada',
@@ -7292,6 +7413,7 @@ def api_mov_definir_lote(mov_id):
                             'produto_id': pid_out,
                             'lote': novo_lote,
                             'almoxarifado_id': almox_id,
+                            'escopo': _escopo_of('almoxarifado', almox_id),
                             'updated_at': now
                         },
                         '$setOnInsert': {'created_at': now}
@@ -7304,18 +7426,17 @@ def api_mov_definir_lote(mov_id):
         df = payload.get('data_fabricacao')
         dv = payload.get('data_vencimento')
         set_extra = {}
+        update = {}
         if df:
             set_extra['data_fabricacao'] = df
         if dv:
-            set_extra['data_vencimento'] = dv
+            set_extra['data_validade'] = lot_expiry.parse(dv)
+            update['$unset'] = {f: '' for f in lot_expiry.LEGACY_FIELDS}
         if set_extra:
-            lotes.update_one({'produto_id': pid_out, 'lote': novo_lote, 'almoxarifado_id': almox_id}, {'$set': set_extra})
-        try:
-            extensions.response_cache.clear_prefix('mov:')
-            extensions.response_cache.clear_prefix('estq:')
-            extensions.response_cache.clear_prefix('resd:')
-        except Exception:
-            pass
+            update['$set'] = set_extra
+            lotes.update_one({'produto_id': pid_out, 'lote': novo_lote, 'almoxarifado_id': almox_id}, update)
+        lot_allocator.forget([pid_out])
+        _publish_stock_change(pid_out, [(m.get('local_tipo') or m.get('destino_tipo') or 'almoxarifado', almox_id)])
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -7365,7 +7486,7 @@ def api_movimentacoes_transferencia():
             prod_doc = None
         if not prod_doc:
             return jsonify({'error': 'Produto não encontrado'}), 404
-        pid_out = prod_doc.get('id') if prod_doc.get('id') is not None else str(prod_doc.get('_id'))
+        pid_out = _persist_id(prod_doc)
 
         # Verificação de escopo do produto
         try:
@@ -7451,10 +7572,7 @@ def api_movimentacoes_transferencia():
         def _id_out(doc, raw):
             if doc is None:
                 return str(raw)
-            val = doc.get('id')
-            if val is None:
-                val = str(doc.get('_id'))
-            return val
+            return _persist_id(doc)
         def _field_by_tipo(tipo: str):
             t = str(tipo).lower()
             if t in ('setor', 'setores'):
@@ -7518,6 +7636,7 @@ def api_movimentacoes_transferencia():
             return jsonify({'error': 'Falha ao verificar escopo de movimentação'}), 403
 
         now = datetime.now(timezone.utc)
+        escopo_origem = _escopo_of(origem_tipo, origem_id_out)
 
         # localizar estoque de origem e validar disponibilidade
         origem_filter1 = {'produto_id': pid_out, 'local_tipo': str(origem_tipo).lower(), 'local_id': origem_id_out}
@@ -7534,7 +7653,7 @@ def api_movimentacoes_transferencia():
             return jsonify({'error': 'Quantidade insuficiente na origem'}), 400
 
         # decrementar origem
-        estoques.find_one_and_update(
+        estoque_doc = estoques.find_one_and_update(
             origem_filter1,
             {
                 '$inc': {
@@ -7542,10 +7661,18 @@ def api_movimentacoes_transferencia():
                     'quantidade_disponivel': -quantidade
                 },
                 '$set': {
+                    'escopo': escopo_origem,
                     'updated_at': now
                 }
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        reorder_points.sync(estoques, estoque_doc)
+        if str(origem_tipo).lower() in ('setor', 'setores'):
+            # Setor não guarda lotes: a volta (estorno) credita os lotes que as distribuições baixaram no destino
+            alocacao = _devolver_lotes(pid_out, destino_tipo, destino_id_out, quantidade, 'setor', origem_id_out)
+        else:
+            alocacao = _baixar_lotes(pid_out, origem_tipo, origem_id_out, quantidade)
 
         # incrementar destino (upsert)
         dfield = _field_by_tipo(destino_tipo)
@@ -7554,6 +7681,7 @@ def api_movimentacoes_transferencia():
             'local_tipo': str(destino_tipo).lower(),
             'local_id': destino_id_out,
             'nome_local': destino_nome,
+            'escopo': _escopo_of(destino_tipo, destino_id_out),
             'updated_at': now
         }
         if dfield:
@@ -7574,6 +7702,7 @@ def api_movimentacoes_transferencia():
             return_document=ReturnDocument.AFTER,
             upsert=True
         )
+        reorder_points.sync(estoques, dest_res)
 
         # registrar movimentação
         mov_doc = {
@@ -7590,9 +7719,12 @@ def api_movimentacoes_transferencia():
             'usuario_responsavel': getattr(current_user, 'username', None),
             'motivo': data.get('motivo'),
             'observacoes': data.get('observacoes'),
-            'created_at': now
+            'escopo': escopo_origem,
+            'created_at': now,
+            **alocacao
         }
         mov_ins = movimentacoes.insert_one(mov_doc)
+        _publish_stock_change(prod_doc, [(origem_tipo, origem_id_out), (destino_tipo, destino_id_out)])
 
         return jsonify({
             'success': True,
@@ -7660,7 +7792,7 @@ def api_movimentacoes_distribuicao():
             prod_doc = None
         if not prod_doc:
             return jsonify({'error': 'Produto não encontrado'}), 404
-        pid_out = prod_doc.get('id') if prod_doc.get('id') is not None else str(prod_doc.get('_id'))
+        pid_out = _persist_id(prod_doc)
 
         # Verificação de escopo do produto
         try:
@@ -7694,10 +7826,7 @@ def api_movimentacoes_distribuicao():
         def _id_out(doc, raw):
             if doc is None:
                 return str(raw)
-            val = doc.get('id')
-            if val is None:
-                val = str(doc.get('_id'))
-            return val
+            return _persist_id(doc)
         def _field_by_tipo(tipo: str):
             t = str(tipo).lower()
             if t in ('setor', 'setores'):
@@ -7741,6 +7870,7 @@ def api_movimentacoes_distribuicao():
             return jsonify({'error': 'Falha ao verificar escopo da origem'}), 403
 
         now = datetime.now(timezone.utc)
+        escopo_origem = _escopo_of(origem_tipo, origem_id_out)
 
         # estoque origem e disponibilidade
         origem_filter1 = {'produto_id': pid_out, 'local_tipo': str(origem_tipo).lower(), 'local_id': origem_id_out}
@@ -7792,7 +7922,7 @@ def api_movimentacoes_distribuicao():
                 return jsonify({'error': 'Quantidade alocada excede o disponível na origem'}), 400
 
             # decrementar origem
-            estoques.find_one_and_update(
+            estoque_doc = estoques.find_one_and_update(
                 origem_filter1,
                 {
                     '$inc': {
@@ -7800,10 +7930,13 @@ def api_movimentacoes_distribuicao():
                         'quantidade_disponivel': -total_distribuido
                     },
                     '$set': {
+                        'escopo': escopo_origem,
                         'updated_at': now
                     }
-                }
+                },
+                return_document=ReturnDocument.AFTER
             )
+            reorder_points.sync(estoques, estoque_doc)
 
             for item in destinos_resolvidos:
                 sdoc = item['doc']
@@ -7819,9 +7952,10 @@ def api_movimentacoes_distribuicao():
                     'local_id': setor_id_out,
                     'nome_local': setor_nome,
                     'setor_id': setor_id_out,
+                    'escopo': _escopo_of('setor', setor_id_out),
                     'updated_at': now
                 }
-                estoques.find_one_and_update(
+                estoque_doc = estoques.find_one_and_update(
                     dest_filter,
                     {
                         '$inc': {
@@ -7836,6 +7970,7 @@ def api_movimentacoes_distribuicao():
                     upsert=True,
                     return_document=ReturnDocument.AFTER
                 )
+                reorder_points.sync(estoques, estoque_doc)
 
                 mov_doc = {
                     'produto_id': pid_out,
@@ -7851,17 +7986,14 @@ def api_movimentacoes_distribuicao():
                     'usuario_responsavel': getattr(current_user, 'username', None),
                     'motivo': data.get('motivo'),
                     'observacoes': data.get('observacoes'),
-                    'created_at': now
+                    'escopo': escopo_origem,
+                    'created_at': now,
+                    **_baixar_lotes(pid_out, origem_tipo, origem_id_out, q)
                 }
                 movimentacoes.insert_one(mov_doc)
                 mov_count += 1
 
-            try:
-                extensions.response_cache.clear_prefix('mov:')
-                extensions.response_cache.clear_prefix('estq:')
-                extensions.response_cache.clear_prefix('resd:')
-            except Exception:
-                pass
+            _publish_stock_change(prod_doc, [(origem_tipo, origem_id_out)] + [('setor', _id_out(d['doc'], d['raw_sid'])) for d in destinos_resolvidos])
             return jsonify({'success': True, 'movimentacoes_criadas': mov_count, 'total_distribuido': total_distribuido, 'saldo_origem': float(disponivel - total_distribuido)})
 
         # formato antigo: divisão igual
@@ -7902,7 +8034,7 @@ def api_movimentacoes_distribuicao():
         total_distribuido = quantidade_total
 
         # decrementar origem uma vez pelo total
-        estoques.find_one_and_update(
+        estoque_doc = estoques.find_one_and_update(
             origem_filter1,
             {
                 '$inc': {
@@ -7910,10 +8042,13 @@ def api_movimentacoes_distribuicao():
                     'quantidade_disponivel': -quantidade_total
                 },
                 '$set': {
+                    'escopo': escopo_origem,
                     'updated_at': now
                 }
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        reorder_points.sync(estoques, estoque_doc)
 
         # incrementar destino(s) e registrar movimentações de saída
         mov_count = 0
@@ -7928,9 +8063,10 @@ def api_movimentacoes_distribuicao():
                 'local_id': setor_id_out,
                 'nome_local': setor_nome,
                 'setor_id': setor_id_out,
+                'escopo': _escopo_of('setor', setor_id_out),
                 'updated_at': now
             }
-            estoques.find_one_and_update(
+            estoque_doc = estoques.find_one_and_update(
                 dest_filter,
                 {
                     '$inc': {
@@ -7945,6 +8081,7 @@ def api_movimentacoes_distribuicao():
                 upsert=True,
                 return_document=ReturnDocument.AFTER
             )
+            reorder_points.sync(estoques, estoque_doc)
 
             mov_doc = {
                 'produto_id': pid_out,
@@ -7960,17 +8097,14 @@ def api_movimentacoes_distribuicao():
                 'usuario_responsavel': getattr(current_user, 'username', None),
                 'motivo': data.get('motivo'),
                 'observacoes': data.get('observacoes'),
-                'created_at': now
+                'escopo': escopo_origem,
+                'created_at': now,
+                **_baixar_lotes(pid_out, origem_tipo, origem_id_out, q_each)
             }
             movimentacoes.insert_one(mov_doc)
             mov_count += 1
 
-        try:
-            extensions.response_cache.clear_prefix('mov:')
-            extensions.response_cache.clear_prefix('estq:')
-            extensions.response_cache.clear_prefix('resd:')
-        except Exception:
-            pass
+        _publish_stock_change(prod_doc, [(origem_tipo, origem_id_out)] + [('setor', _id_out(sdoc, raw_sid)) for sdoc, raw_sid in destinos_docs])
         return jsonify({'success': True, 'movimentacoes_criadas': mov_count, 'total_distribuido': total_distribuido, 'saldo_origem': float(disponivel - total_distribuido)}), 200
     except Exception as e:
         return jsonify({'error': f'Falha ao executar distribuição: {e}'}), 500
@@ -8329,7 +8463,7 @@ def api_demandas():
 
     now = datetime.now(timezone.utc)
     doc = {
-        'produto_id': prod_doc.get('id') if prod_doc.get('id') is not None else str(prod_doc.get('_id')),
+        'produto_id': _persist_id(prod_doc),
         'setor_id': sid,
         'quantidade_solicitada': quantidade,
         'unidade_medida': unidade_medida,
@@ -8516,7 +8650,7 @@ def api_demandas_finalizar():
                 pdoc = prod_coll.find_one({'id': k}, {'id': 1, '_id': 1, 'nome': 1, 'codigo': 1, 'unidade_medida': 1})
             if not pdoc:
                 return {'produto_key': k, 'produto_id': k, 'produto_nome': '-', 'produto_codigo': '-', 'unidade_medida': None}
-            pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+            pid_out = _persist_id(pdoc)
             return {'produto_key': k, 'produto_id': pid_out, 'produto_nome': pdoc.get('nome') or '-', 'produto_codigo': pdoc.get('codigo') or '-', 'unidade_medida': pdoc.get('unidade_medida')}
         now = datetime.utcnow()
         items_out = []
@@ -8811,7 +8945,9 @@ def api_setor_produto_resumo_dia(setor_id, produto_id):
         }
     }
     try:
-        extensions.response_cache.set(cache_key, result, ttl=10)
+        hierarchy_graph.ensure_loaded(extensions.mongo_db)
+        tags = cache_tags.local_stock_tags(hierarchy_graph, produto_id, 'setor', setor_id)
+        extensions.response_cache.set(cache_key, result, ttl=extensions.RESPONSE_CACHE_TAGGED_TTL, tags=tags)
     except Exception:
         pass
     return jsonify(result)
@@ -8858,7 +8994,7 @@ def api_setor_registro_consumo():
         if not pdoc:
             pdoc = produtos.find_one({'id': raw_pid}) or produtos.find_one({'_id': raw_pid})
         if pdoc:
-            pid_out_norm = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+            pid_out_norm = _persist_id(pdoc)
     except Exception:
         pid_out_norm = None
 
@@ -8917,7 +9053,7 @@ def api_setor_registro_consumo():
         if not pdoc:
             pdoc = produtos.find_one({'id': raw_pid}) or produtos.find_one({'_id': raw_pid})
         if pdoc:
-            pid_out = pdoc.get('id') if pdoc.get('id') is not None else str(pdoc.get('_id'))
+            pid_out = _persist_id(pdoc)
             pid_cands.extend(_id_candidates(pid_out))
     except Exception:
         pass
@@ -8938,7 +9074,7 @@ def api_setor_registro_consumo():
         except Exception:
             sdoc = None
     if sdoc:
-        sid_out = sdoc.get('id') if sdoc.get('id') is not None else str(sdoc.get('_id'))
+        sid_out = _persist_id(sdoc)
         sid_cands.extend(_id_candidates(sid_out))
 
     # localizar estoque do setor (compatível com variações de schema: tipo/local_tipo, local_id/setor_id)
@@ -9016,16 +9152,19 @@ def api_setor_registro_consumo():
             {'$or': [{'local_tipo': 'setor'}, {'tipo': 'setor'}]}
         ]
     })
-    estoques.find_one_and_update(
+    escopo = _escopo_of('setor', raw_sid)
+    estoque_atualizado = estoques.find_one_and_update(
         target_filter,
         {
             '$inc': inc_fields,
             '$set': {
+                'escopo': escopo,
                 'updated_at': now
             }
         },
         return_document=ReturnDocument.AFTER
     )
+    reorder_points.sync(estoques, estoque_atualizado)
 
     # nome do setor para log
     setor_doc = None
@@ -9049,17 +9188,21 @@ def api_setor_registro_consumo():
         'destino_nome': 'Consumo do dia',
         'usuario_responsavel': getattr(current_user, 'username', None),
         'observacoes': data.get('observacoes'),
+        'escopo': escopo,
         'created_at': now
     }
     movimentacoes.insert_one(mov_doc)
 
-    try:
-        extensions.response_cache.clear_prefix('mov:')
-        extensions.response_cache.clear_prefix('estq:')
-        extensions.response_cache.clear_prefix('resd:')
-    except Exception:
-        pass
+    _publish_stock_change(raw_pid, [('setor', raw_sid)])
     return jsonify({'success': True, 'quantidade_registrada': qtd})
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas do processo no formato texto do Prometheus (ver metrics.py)."""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Não autorizado'}), 401
+    return current_app.response_class(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
 @main_bp.route('/health/app', methods=['GET'])
 def health_app():
     try:
@@ -9067,6 +9210,11 @@ def health_app():
         from flask import current_app
         st = current_app.config.get('START_TIME') or time.time()
         up = max(0, int(time.time() - st))
-        return jsonify({'ok': True, 'uptime_seconds': up, 'mongo_available': bool(current_app.config.get('MONGO_AVAILABLE'))})
+        return jsonify({
+            'ok': True,
+            'uptime_seconds': up,
+            'mongo_available': bool(current_app.config.get('MONGO_AVAILABLE')),
+            'response_cache': extensions.response_cache.stats(),
+        })
     except Exception:
         return jsonify({'ok': False}), 200
@@ -0,0 +1,72 @@
+"""Tags de dependência para respostas em cache de estoque e movimentações.
+
+Cada resposta em cache declara de quais dados depende; cada escrita de estoque
+publica as tags que afetou (`extensions.publish_invalidation`). O cache remove
+exatamente as entradas que compartilham alguma tag, o que permite TTLs de
+minutos sem servir saldo velho depois de uma distribuição.
+
+Formato das tags:
+- `escopo:*`                        — listagens sem recorte de escopo (super_admin)
+- `escopo:<chave>:<id canônico>`    — listagens recortadas por central/almox/sub/setor
+- `estoque:<produto>@<tipo>:<id>`   — um produto em um local (ex.: resumo do dia do setor)
+- `catalogo` / `hierarquia`         — nomes de produtos e locais exibidos nas listagens
+- `*`                               — qualquer escrita sem tags precisas (remove tudo)
+
+Ids de local são canônicos (`str(_id)`, via grafo da hierarquia); o produto é
+publicado em todas as formas conhecidas (`id` sequencial e `str(_id)`).
+"""
+from typing import Any, Iterable, List, Optional, Set, Tuple
+
+from hierarchy import HierarchyGraph, SCOPE_KEYS, _norm_tipo
+
+SCOPE_ALL = 'escopo:*'
+CATALOG_TAG = 'catalogo'
+HIERARCHY_TAG = 'hierarquia'
+ALL_TAG = '*'
+
+_OWN_KEY = dict(zip(('central', 'almoxarifado', 'sub_almoxarifado', 'setor'), SCOPE_KEYS))
+
+
+def _local_canon(graph: HierarchyGraph, tipo: str, local_id: Any) -> Optional[str]:
+    key = _OWN_KEY.get(tipo)
+    if not key:
+        return None
+    return graph.scope_of(tipo, local_id).get(key) or (str(local_id) if local_id is not None else None)
+
+
+def stock_tag(produto_id: Any, tipo: str, local_canon: str) -> str:
+    return f'estoque:{produto_id}@{tipo}:{local_canon}'
+
+
+def stock_change_tags(graph: HierarchyGraph, produto_ids: Iterable[Any], locais: Iterable[Tuple[str, Any]]) -> Set[str]:
+    """Tags afetadas por uma escrita de estoque de `produto_ids` nos `locais` (tipo, id)."""
+    pids = {str(p) for p in produto_ids if p is not None}
+    tags = {SCOPE_ALL}
+    for raw_tipo, local_id in locais:
+        tipo = _norm_tipo(raw_tipo)
+        canon = _local_canon(graph, tipo, local_id)
+        if canon is None:
+            continue
+        for key, value in graph.scope_of(tipo, local_id).items():
+            if value:
+                tags.add(f'escopo:{key}:{value}')
+        for pid in pids:
+            tags.add(stock_tag(pid, tipo, canon))
+    return tags
+
+
+def scope_tags(graph: HierarchyGraph, role: Optional[str], scope_id: Any) -> List[str]:
+    """Tags de uma listagem feita por um usuário com `role`/`scope_id`.
+
+    Papéis sem escopo (ou escopo que não resolve) dependem de qualquer escrita.
+    """
+    resolved = graph.scope_value(role, scope_id) if role else None
+    scope = SCOPE_ALL if resolved is None else f'escopo:{resolved[0]}:{resolved[1]}'
+    return [scope, CATALOG_TAG, HIERARCHY_TAG, ALL_TAG]
+
+
+def local_stock_tags(graph: HierarchyGraph, produto_id: Any, tipo: str, local_id: Any) -> List[str]:
+    """Tag de uma resposta que depende de um produto em um único local."""
+    tipo = _norm_tipo(tipo)
+    canon = _local_canon(graph, tipo, local_id)
+    return [stock_tag(produto_id, tipo, canon) if canon else SCOPE_ALL, CATALOG_TAG, HIERARCHY_TAG, ALL_TAG]
@@ -0,0 +1,168 @@
+"""Ids canônicos e modo estrito de resolução.
+
+Historicamente as chaves estrangeiras (`produto_id`, `local_id`, `setor_id`...)
+foram gravadas em formatos misturados: id sequencial numérico (Flask), string
+do ObjectId (FastAPI) e, às vezes, o próprio ObjectId. Por isso os helpers de
+consulta geram 2–4 candidatos por id e montam `$or` sobre `id`/`_id`.
+
+A forma canônica é `str(_id)`. `scripts/migrate_canonical_ids.py` reescreve as
+chaves estrangeiras nessa forma e registra em `ids_legados` o mapeamento
+`(coleção, id legado) → id canônico`, usado para traduzir ids antigos que
+ainda chegam pela API (URLs salvas, front-end Flask com ids numéricos).
+
+Modo estrito (`STRICT_IDS=1`): depois da migração, as rotas resolvem o id de
+entrada uma única vez (`canonical_id`) e consultam com um único valor
+(`id_query`/`ids_query`). Sem a variável, nada muda.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import ObjectId
+
+from hierarchy import _norm_tipo
+
+ID_MAP_COLLECTION = 'ids_legados'
+META_KEY = 'ids_canonicos'
+
+# Campo -> coleção referenciada
+FIELD_TARGETS = {
+    'produto_id': 'produtos',
+    'categoria_id': 'categorias',
+    'usuario_id': 'usuarios',
+    'central_id': 'centrais',
+    'central_ids': 'centrais',
+    'almoxarifado_id': 'almoxarifados',
+    'almoxarifado_ids': 'almoxarifados',
+    'sub_almoxarifado_id': 'sub_almoxarifados',
+    'sub_almoxarifado_ids': 'sub_almoxarifados',
+    'setor_id': 'setores',
+}
+
+# Campos polimórficos: a coleção vem do campo de tipo correspondente
+TYPED_FIELDS = {
+    'local_id': 'local_tipo',
+    'origem_id': 'origem_tipo',
+    'destino_id': 'destino_tipo',
+    'local_origem_id': 'local_origem_tipo',
+    'local_destino_id': 'local_destino_tipo',
+}
+
+TIPO_COLLECTIONS = {
+    'central': 'centrais',
+    'almoxarifado': 'almoxarifados',
+    'sub_almoxarifado': 'sub_almoxarifados',
+    'setor': 'setores',
+}
+
+
+def strict_ids_enabled() -> bool:
+    return (os.environ.get('STRICT_IDS') or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def collection_for_tipo(tipo: Any) -> Optional[str]:
+    return TIPO_COLLECTIONS.get(_norm_tipo(tipo))
+
+
+class LegacyIdMap:
+    """Mapeamento em memória `id legado → str(_id)`, carregado de `ids_legados`.
+
+    Ids sequenciais se repetem entre coleções; sem a coleção, só resolve
+    quando o valor legado é único em todo o mapa.
+    """
+
+    def __init__(self, max_age: float = 300.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._by_coll: Dict[str, Dict[str, str]] = {}
+        self._by_value: Dict[str, Optional[str]] = {}
+        self._source = None
+        self._loaded_at = 0.0
+
+    def _needs_reload(self, db) -> bool:
+        return self._source is not db or (time.time() - self._loaded_at) > self.max_age
+
+    def _swap(self, db, docs: List[Dict[str, Any]]) -> None:
+        by_coll: Dict[str, Dict[str, str]] = {}
+        by_value: Dict[str, Optional[str]] = {}
+        for d in docs or []:
+            legacy, canon = str(d.get('legado')), d.get('canonico')
+            if not canon:
+                continue
+            by_coll.setdefault(d.get('colecao'), {})[legacy] = canon
+            by_value[legacy] = canon if by_value.get(legacy, canon) == canon else None
+        with self._lock:
+            self._by_coll = by_coll
+            self._by_value = by_value
+            self._source = db
+            self._loaded_at = time.time()
+
+    def ensure_loaded(self, db) -> bool:
+        if db is None:
+            return False
+        if not self._needs_reload(db):
+            return True
+        try:
+            self._swap(db, list(db[ID_MAP_COLLECTION].find({}, {'colecao': 1, 'legado': 1, 'canonico': 1})))
+            return True
+        except Exception:
+            return False
+
+    async def ensure_loaded_async(self, db) -> bool:
+        if db is None:
+            return False
+        if not self._needs_reload(db):
+            return True
+        try:
+            cursor = db[ID_MAP_COLLECTION].find({}, {'colecao': 1, 'legado': 1, 'canonico': 1})
+            self._swap(db, await cursor.to_list(length=None))
+            return True
+        except Exception:
+            return False
+
+    def remember(self, coll_name: str, legacy: Any, canon: str) -> None:
+        with self._lock:
+            self._by_coll.setdefault(coll_name, {})[str(legacy)] = canon
+            prev = self._by_value.get(str(legacy), canon)
+            self._by_value[str(legacy)] = canon if prev == canon else None
+
+    def resolve(self, value: Any, coll_name: Optional[str] = None) -> Optional[str]:
+        if value is None:
+            return None
+        if isinstance(value, ObjectId):
+            return str(value)
+        s = str(value).strip()
+        if not s:
+            return None
+        if ObjectId.is_valid(s):
+            return s
+        if coll_name:
+            return self._by_coll.get(coll_name, {}).get(s)
+        return self._by_value.get(s)
+
+
+legacy_ids = LegacyIdMap()
+
+
+def canonical_id(value: Any, coll_name: Optional[str] = None) -> Optional[str]:
+    """Forma canônica (`str(_id)`) de um id recebido; `None` se não resolver."""
+    return legacy_ids.resolve(value, coll_name)
+
+
+def id_query(value: Any, coll_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Filtro de igualdade única pelo `_id`; `None` quando o id não resolve."""
+    canon = canonical_id(value, coll_name)
+    if canon is None or not ObjectId.is_valid(canon):
+        return None
+    return {'_id': ObjectId(canon)}
+
+
+def ids_query(values: Iterable[Any], coll_name: Optional[str] = None) -> Dict[str, Any]:
+    """Filtro `_id $in` com um único valor por id (ids não resolvidos são ignorados)."""
+    oids = []
+    for v in values or []:
+        canon = canonical_id(v, coll_name)
+        if canon is not None and ObjectId.is_valid(canon):
+            oids.append(ObjectId(canon))
+    return {'_id': {'$in': list(dict.fromkeys(oids))}}
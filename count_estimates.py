@@ -0,0 +1,120 @@
+"""Modos de contagem das listagens paginadas (`count=exact|estimate|none`).
+
+Antes de buscar a página, cada listagem rodava `count_documents` com o mesmo
+filtro da página (escopo, texto, status...), o que muitas vezes dobrava o custo
+da requisição. Agora o cliente escolhe:
+
+- `exact`    — `count_documents` a cada requisição (comportamento anterior);
+- `estimate` — total guardado por escopo/filtro em `CountEstimator`: servido do
+  cache e, depois de `fresh` segundos, recalculado em segundo plano (uma única
+  contagem por chave) enquanto o valor anterior continua sendo devolvido;
+- `none`     — sem contagem.
+
+Em todos os modos a página é lida com `per_page + 1` linhas e a resposta traz
+`has_more`, suficiente para "próxima página" sem total.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from extensions import LRUTTLCache
+import metrics
+
+EXACT = 'exact'
+ESTIMATE = 'estimate'
+NONE = 'none'
+COUNT_MODES = (EXACT, ESTIMATE, NONE)
+
+COUNT_ESTIMATE_FRESH = float(os.getenv('COUNT_ESTIMATE_FRESH', '60'))
+COUNT_ESTIMATE_MAX_AGE = float(os.getenv('COUNT_ESTIMATE_MAX_AGE', '3600'))
+
+
+def parse_count_mode(raw: Optional[str], default: str = EXACT) -> str:
+    """Normaliza o parâmetro `count`; levanta ValueError para valores desconhecidos."""
+    mode = (raw or '').strip().lower() or default
+    if mode not in COUNT_MODES:
+        raise ValueError(f"count deve ser um de: {', '.join(COUNT_MODES)}")
+    return mode
+
+
+def total_pages(total: Optional[int], per_page: int) -> Optional[int]:
+    return max(1, (total + per_page - 1) // per_page) if total is not None else None
+
+
+class CountEstimator:
+    def __init__(self, fresh: float = COUNT_ESTIMATE_FRESH, max_age: float = COUNT_ESTIMATE_MAX_AGE):
+        self.fresh = fresh
+        self.max_age = max_age
+        self.store = LRUTTLCache(max_bytes=1024 * 1024)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    @staticmethod
+    def key(namespace: str, query: Dict[str, Any]) -> str:
+        """Chave por listagem + filtro completo (o filtro já carrega o recorte de escopo)."""
+        return f"{namespace}:{json.dumps(query, sort_keys=True, default=str, separators=(',', ':'))}"
+
+    def _store(self, key: str, value: int) -> None:
+        self.store.set(key, (int(value), time.time() + self.fresh), ttl=self.max_age)
+
+    def _claim(self, key: str) -> bool:
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.refreshes += 1
+            return True
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            self._refreshing.discard(key)
+
+    async def _refresh_async(self, key: str, counter: Callable[[], Awaitable[int]]) -> None:
+        try:
+            with metrics.track_job('count_estimate_refresh'):
+                self._store(key, await counter())
+        except Exception:
+            pass
+        finally:
+            self._release(key)
+
+    def _refresh(self, key: str, counter: Callable[[], int]) -> None:
+        try:
+            with metrics.track_job('count_estimate_refresh'):
+                self._store(key, counter())
+        except Exception:
+            pass
+        finally:
+            self._release(key)
+
+    async def get_async(self, key: str, counter: Callable[[], Awaitable[int]]) -> int:
+        """Total estimado; a primeira requisição de uma chave conta de forma síncrona."""
+        entry = self.store.get(key)
+        if entry is None:
+            value = int(await counter())
+            self._store(key, value)
+            return value
+        value, fresh_until = entry
+        if time.time() >= fresh_until and self._claim(key):
+            asyncio.get_running_loop().create_task(self._refresh_async(key, counter))
+        return value
+
+    def get(self, key: str, counter: Callable[[], int]) -> int:
+        """Versão síncrona (Flask): a revalidação roda em uma thread daemon."""
+        entry = self.store.get(key)
+        if entry is None:
+            value = int(counter())
+            self._store(key, value)
+            return value
+        value, fresh_until = entry
+        if time.time() >= fresh_until and self._claim(key):
+            threading.Thread(target=self._refresh, args=(key, counter), daemon=True).start()
+        return value
+
+
+count_estimator = CountEstimator()
+metrics.register_cache('count_estimates', count_estimator.store.stats)
@@ -0,0 +1,125 @@
+"""Contagem de operações no MongoDB por requisição (Flask e FastAPI).
+
+Handlers que consultam dentro de laços (um `find_one` por setor para subir a
+hierarquia, um `can_access_produto` por linha) só apareciam quando a latência
+já tinha explodido. `CommandStatsListener` é registrado nos clientes pymongo e
+Motor e soma, na requisição corrente, o número de comandos, o tempo de ida e
+volta e os documentos devolvidos. A requisição corrente fica em um
+`ContextVar`: no Flask o listener roda na própria thread da requisição; no
+Motor ele roda no executor, que copia o contexto da tarefa que chamou.
+
+Ao fim da requisição os dois apps:
+- acrescentam `Server-Timing: db;dur=<ms>;desc="<n> ops, <d> docs"`;
+- registram uma linha JSON no logger `almox.db` (método, rota, status,
+  operações por comando, tempo e documentos);
+- registram um aviso quando a requisição passa de `MONGO_OP_BUDGET` operações,
+  o sinal típico de N+1.
+
+Com o mongomock (testes e modo sem banco) não há eventos de comando e os
+contadores ficam zerados.
+"""
+import json
+import logging
+import os
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from pymongo import monitoring
+
+OP_BUDGET = int(os.getenv('MONGO_OP_BUDGET', '50'))
+LOG_REQUESTS = os.getenv('MONGO_LOG_REQUESTS', 'true').strip().lower() in ('1', 'true', 'yes')
+
+logger = logging.getLogger('almox.db')
+
+# Comandos internos do driver que não são trabalho da requisição
+_IGNORED = {'hello', 'ismaster', 'isMaster', 'ping', 'endSessions', 'saslStart', 'saslContinue', 'buildInfo'}
+
+
+class RequestStats:
+    def __init__(self):
+        self.ops = 0
+        self.ms = 0.0
+        self.docs = 0
+        self.commands: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, command: str, ms: float, docs: int = 0) -> None:
+        with self._lock:
+            self.ops += 1
+            self.ms += ms
+            self.docs += docs
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.ms:.1f};desc="{self.ops} ops, {self.docs} docs"'
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'db_ops': self.ops, 'db_ms': round(self.ms, 1), 'db_docs': self.docs, 'db_commands': dict(self.commands)}
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar('db_request_stats', default=None)
+
+
+def current() -> Optional[RequestStats]:
+    return _current.get()
+
+
+def begin():
+    """Abre a contagem da requisição; devolve o token para `end`."""
+    return _current.set(RequestStats())
+
+
+def end(token) -> Optional[RequestStats]:
+    stats = _current.get()
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Token de outro contexto (hooks do Flask em contextos diferentes)
+        _current.set(None)
+    return stats
+
+
+def report(stats: Optional[RequestStats], method: str, path: str, status: int, budget: Optional[int] = None) -> None:
+    """Linha JSON por requisição e aviso quando o orçamento de operações é ultrapassado."""
+    if stats is None:
+        return
+    budget = OP_BUDGET if budget is None else budget
+    entry = {'method': method, 'path': path, 'status': status, **stats.as_dict()}
+    if budget and stats.ops > budget:
+        logger.warning(json.dumps(dict(entry, event='db_op_budget_exceeded', budget=budget), ensure_ascii=False))
+    elif LOG_REQUESTS and stats.ops:
+        logger.info(json.dumps(dict(entry, event='db_request'), ensure_ascii=False))
+
+
+def _docs_in(reply: Any) -> int:
+    if not isinstance(reply, dict):
+        return 0
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        batch = cursor.get('firstBatch', cursor.get('nextBatch'))
+        return len(batch) if isinstance(batch, list) else 0
+    if isinstance(reply.get('values'), list):
+        return len(reply['values'])
+    if isinstance(reply.get('value'), dict):
+        return 1
+    return 0
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    """Soma cada comando concluído nas estatísticas da requisição corrente, se houver uma."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        stats = _current.get()
+        if stats is None or event.command_name in _IGNORED:
+            return
+        stats.add(event.command_name, event.duration_micros / 1000.0, _docs_in(event.reply))
+
+    def failed(self, event):
+        stats = _current.get()
+        if stats is None or event.command_name in _IGNORED:
+            return
+        stats.add(event.command_name, event.duration_micros / 1000.0)
@@ -1,56 +1,327 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError, AutoReconnect
 from werkzeug.security import generate_password_hash
+from collections import OrderedDict
 from datetime import datetime
+import json
 import os
+import sys
+import threading
 import time
 
+import cache_tags
+import db_metrics
+import index_spec
+import metrics
+from hierarchy import META_COLLECTION
+
 # MongoDB (persistência oficial)
 mongo_client: MongoClient | None = None
 mongo_db = None
+# Banco em memória (mongomock): sem operadores de agregação como `$convert`
+mongo_is_mock = False
+
+class LRUTTLCache:
+    """Cache LRU com TTL por entrada e orçamento de memória em bytes.
+
+    - `get`/`set` são O(1) (OrderedDict) e `get` renova a recência da chave.
+    - O tamanho de cada entrada é estimado pelo JSON serializado; ao passar de
+      `max_bytes`, as entradas menos usadas são descartadas.
+    - Entradas vencidas são removidas na leitura e por uma varredura em thread
+      daemon a cada `sweep_interval` segundos (iniciada no primeiro `set`).
+    - `stats()` expõe hits, misses, evictions, expirations e bytes em uso.
+    - `set(..., tags=[...])` registra dependências; `invalidate_tags` remove
+      todas as entradas que compartilham alguma tag (ver cache_tags.py).
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, sweep_interval: float = 30.0):
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (data, exp, size, tags)
+        self._tags = {}  # tag -> set(keys)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _size_of(data) -> int:
+        try:
+            return len(json.dumps(data, default=str, separators=(',', ':')).encode('utf-8'))
+        except Exception:
+            return sys.getsizeof(data)
+
+    def _drop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+            self._untag(key, entry[3])
 
-class SimpleTTLCache:
-    def __init__(self, max_size: int = 1000):
-        self.store = {}
-        self.order = []
-        self.max_size = max_size
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
 
     def get(self, key):
-        val = self.store.get(key)
-        if not val:
-            return None
-        data, exp = val
-        if exp is not None and exp < time.time():
-            try:
-                del self.store[key]
-            except Exception:
-                pass
-            return None
-        return data
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, exp = entry[0], entry[1]
+            if exp is not None and exp < time.time():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return data
 
-    def set(self, key, data, ttl: int = 30):
+    def set(self, key, data, ttl: int = 30, tags=None):
         exp = (time.time() + ttl) if ttl and ttl > 0 else None
-        self.store[key] = (data, exp)
-        self.order.append(key)
-        if len(self.order) > self.max_size:
-            old = self.order.pop(0)
-            try:
-                del self.store[old]
-            except Exception:
-                pass
+        size = self._size_of(data)
+        tags = frozenset(tags or ())
+        with self._lock:
+            self._drop(key)
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            self._data[key] = (data, exp, size, tags)
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes and self._data:
+                old_key, entry = self._data.popitem(last=False)
+                self._bytes -= entry[2]
+                self._untag(old_key, entry[3])
+                self.evictions += 1
+        self._ensure_sweeper()
+
+    def delete(self, key):
+        with self._lock:
+            self._drop(key)
 
     def clear_prefix(self, prefix: str):
-        try:
-            keys = [k for k in list(self.store.keys()) if str(k).startswith(prefix)]
+        with self._lock:
+            for k in [k for k in self._data if str(k).startswith(prefix)]:
+                self._drop(k)
+
+    def invalidate_tags(self, tags) -> int:
+        """Remove as entradas marcadas com qualquer uma das `tags`; retorna quantas saíram."""
+        with self._lock:
+            keys = set()
+            for tag in tags or ():
+                keys.update(self._tags.get(tag, ()))
             for k in keys:
+                self._drop(k)
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def purge_expired(self) -> int:
+        """Remove todas as entradas vencidas; retorna quantas saíram."""
+        now = time.time()
+        with self._lock:
+            expired = [k for k, entry in self._data.items() if entry[1] is not None and entry[1] < now]
+            for k in expired:
+                self._drop(k)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None or not self.sweep_interval or self.sweep_interval <= 0:
+            return
+        def _run():
+            while True:
+                time.sleep(self.sweep_interval)
                 try:
-                    del self.store[k]
+                    with metrics.track_job('cache_sweep'):
+                        self.purge_expired()
                 except Exception:
                     pass
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=_run, name='response-cache-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected': self.rejected,
+                'invalidations': self.invalidations,
+                'tags': len(self._tags),
+            }
+
+response_cache = LRUTTLCache(int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024))))
+# TTL das respostas invalidadas por tag (estoque/movimentações): a invalidação
+# por escrita chega aos outros processos via `cache_invalidation` (sistema_meta);
+# o TTL só limita a vida de uma entrada se o banco ficar inacessível
+RESPONSE_CACHE_TAGGED_TTL = int(os.environ.get('RESPONSE_CACHE_TAGGED_TTL', '300'))
+
+# Eventos de invalidação: escritas publicam tags, caches assinam
+_invalidation_subscribers = []
+
+def subscribe_invalidation(callback):
+    if callback not in _invalidation_subscribers:
+        _invalidation_subscribers.append(callback)
+
+def _notify(tags):
+    for callback in list(_invalidation_subscribers):
+        try:
+            callback(tags)
+        except Exception:
+            pass
+
+
+class SharedInvalidation:
+    """Propaga as tags invalidadas para os demais processos (gunicorn -w N).
+
+    Mesmo esquema do índice de produtos: cada publicação incrementa
+    `sistema_meta.cache_invalidacao.versao` e acrescenta as tags ao log
+    `alteracoes` (últimos `log_size`). Antes de servir uma requisição, cada
+    processo checa a versão no máximo a cada `check_interval` segundos e
+    invalida localmente as tags pendentes; se ficou para trás além do log,
+    invalida tudo (`cache_tags.ALL_TAG`).
+    """
+
+    META_KEY = 'cache_invalidacao'
+
+    def __init__(self, check_interval: float = 1.0, log_size: int = 500):
+        self.check_interval = check_interval
+        self.log_size = log_size
+        self._lock = threading.Lock()
+        self._remote_version = None
+        self._checked_at = 0.0
+
+    def _publish_update(self, tags):
+        return {
+            '$inc': {'versao': 1},
+            '$push': {'alteracoes': {'$each': [list(tags)], '$slice': -self.log_size}},
+        }
+
+    def _adopt(self, meta):
+        # Só adota a nova versão se ninguém mais publicou desde a última checagem;
+        # senão, a próxima `sync` aplica as tags pendentes (inclusive as próprias)
+        with self._lock:
+            remote = (meta or {}).get('versao')
+            if isinstance(self._remote_version, int) and remote == self._remote_version + 1:
+                self._remote_version = remote
+            else:
+                self._checked_at = 0.0
+
+    def _pending_tags(self, meta):
+        """Tags publicadas desde a versão local; `None` se ficaram fora do log."""
+        remote = (meta or {}).get('versao', 0)
+        log = (meta or {}).get('alteracoes') or []
+        if not isinstance(self._remote_version, int) or not isinstance(remote, int):
+            return None
+        gap = remote - self._remote_version
+        if gap < 0 or gap > len(log):
+            return None
+        tags = []
+        for entry in log[len(log) - gap:]:
+            tags.extend(entry or [])
+        return list(dict.fromkeys(tags))
+
+    def _apply(self, meta):
+        with self._lock:
+            remote = (meta or {}).get('versao', 0)
+            if self._remote_version is None:
+                # Primeira checagem do processo: nada em cache é anterior a ela
+                self._remote_version = remote
+                return
+            if remote == self._remote_version:
+                return
+            tags = self._pending_tags(meta)
+            self._remote_version = remote
+        _notify(tags if tags is not None else [cache_tags.ALL_TAG])
+
+    def _due(self) -> bool:
+        now = time.time()
+        if (now - self._checked_at) < self.check_interval:
+            return False
+        self._checked_at = now
+        return True
+
+    def publish(self, db, tags) -> None:
+        if db is None:
+            return
+        try:
+            meta = db[META_COLLECTION].find_one_and_update(
+                {'_id': self.META_KEY}, self._publish_update(tags), upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self._adopt(meta)
+        except Exception:
+            pass
+
+    async def publish_async(self, db, tags) -> None:
+        if db is None:
+            return
+        try:
+            meta = await db[META_COLLECTION].find_one_and_update(
+                {'_id': self.META_KEY}, self._publish_update(tags), upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self._adopt(meta)
+        except Exception:
+            pass
+
+    def sync(self, db) -> None:
+        """Aplica as invalidações publicadas por outros processos (pymongo/mongomock)."""
+        if db is None or not self._due():
+            return
+        try:
+            self._apply(db[META_COLLECTION].find_one({'_id': self.META_KEY}))
         except Exception:
             pass
 
-response_cache = SimpleTTLCache(2000)
+    async def sync_async(self, db) -> None:
+        """Mesmo que `sync`, para Motor ou o wrapper assíncrono do mongomock."""
+        if db is None or not self._due():
+            return
+        try:
+            self._apply(await db[META_COLLECTION].find_one({'_id': self.META_KEY}))
+        except Exception:
+            pass
+
+
+cache_invalidation = SharedInvalidation(float(os.environ.get('RESPONSE_CACHE_SYNC_INTERVAL', '1.0')))
+
+def publish_invalidation(tags, shared=True):
+    """Invalida as tags nos caches deste processo e, com `shared`, publica no
+    `sistema_meta` do banco do Flask para os demais processos (o FastAPI publica
+    no seu banco com `cache_invalidation.publish_async`)."""
+    tags = list(tags or ())
+    if not tags:
+        return
+    _notify(tags)
+    if shared:
+        cache_invalidation.publish(mongo_db, tags)
+
+subscribe_invalidation(response_cache.invalidate_tags)
+metrics.register_cache('response_cache', response_cache.stats)
 
 def ensure_collections_and_indexes(db, logger=None):
     """Cria coleções essenciais e índices (idempotente)."""
@@ -72,40 +343,8 @@ def ensure_collections_and_indexes(db, logger=None):
         for name in required:
             if name not in existing:
                 db.create_collection(name)
-        # Índices essenciais
-        db['usuarios'].create_index([('username', ASCENDING)], unique=True, name='idx_unique_username')
-        db['produtos'].create_index([('codigo', ASCENDING)], name='idx_prod_codigo')
-        db['produtos'].create_index([('nome', ASCENDING)], name='idx_prod_nome')
-        try:
-            db['movimentacoes'].create_index([('data_movimentacao', ASCENDING)], name='idx_mov_data_movimentacao')
-        except Exception:
-            pass
-        try:
-            db['movimentacoes'].create_index([('tipo', ASCENDING)], name='idx_mov_tipo')
-            db['movimentacoes'].create_index([('produto_id', ASCENDING)], name='idx_mov_produto')
-        except Exception:
-            pass
-        try:
-            db['estoques'].create_index([('produto_id', ASCENDING)], name='idx_est_produto')
-            db['estoques'].create_index([('local_tipo', ASCENDING), ('local_id', ASCENDING)], name='idx_est_local')
-            db['estoques'].create_index([('updated_at', DESCENDING)], name='idx_est_updated')
-            # Índices esparsos para campos de localização específicos
-            db['estoques'].create_index([('setor_id', ASCENDING)], name='idx_est_setor', sparse=True)
-            db['estoques'].create_index([('sub_almoxarifado_id', ASCENDING)], name='idx_est_sub', sparse=True)
-            db['estoques'].create_index([('almoxarifado_id', ASCENDING)], name='idx_est_almox', sparse=True)
-            db['estoques'].create_index([('central_id', ASCENDING)], name='idx_est_central', sparse=True)
-        except Exception:
-            pass
-        try:
-            db['logs_auditoria'].create_index([('timestamp', ASCENDING)], name='idx_audit_time')
-            db['logs_auditoria'].create_index([('usuario_id', ASCENDING)], name='idx_audit_user')
-        except Exception:
-            pass
-        try:
-            db['listas_compras'].create_index([('usuario_id', ASCENDING)], name='idx_lista_usuario')
-            db['listas_compras'].create_index([('created_at', ASCENDING)], name='idx_lista_created')
-        except Exception:
-            pass
+        # Índices declarados em index_spec.py (os mesmos aplicados pelo FastAPI no startup)
+        index_spec.apply(db, log=logger.info if logger is not None else print)
     except Exception as e:
         if logger is not None:
             logger.error(f'[Mongo Init] Falha ao criar coleções/índices: {e}')
@@ -126,11 +365,12 @@ def _sanitize_mongo_uri(uri: str) -> str:
 
 def init_mongo(app):
     """Inicializa cliente MongoDB usando configurações do app e semeia usuário admin padrão se necessário."""
-    global mongo_client, mongo_db
+    global mongo_client, mongo_db, mongo_is_mock
     if app.config.get('TESTING'):
         import mongomock
         dbname = app.config.get('MONGO_DB') or 'almox_sms_test'
         mongo_client = mongomock.MongoClient()
+        mongo_is_mock = True
         mongo_db = mongo_client[dbname]
         try:
             for name in ['usuarios','centrais','almoxarifados','sub_almoxarifados','setores','categorias','produtos','movimentacoes','locais','logs_auditoria','listas_compras','estoques','lotes','compras','demandas']:
@@ -193,6 +433,8 @@ def init_mongo(app):
 
             mongo_client = MongoClient(
                 mongo_uri,
+                event_listeners=[db_metrics.CommandStatsListener(), index_spec.SlowQueryListener(log=app.logger.warning),
+                                 metrics.PoolMetricsListener('flask')],
                 **client_kwargs,
             )
             # Testar conectividade rapidamente para evitar travar o startup
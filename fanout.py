@@ -0,0 +1,54 @@
+"""Consultas independentes em paralelo, com limite de concorrência (FastAPI).
+
+Handlers que resolvem várias coleções auxiliares (categoria, lotes, estoques,
+os quatro mapas de locais, histórico) faziam um `await` depois do outro: a
+latência era a soma das consultas. `gather` dispara as consultas como tarefas
+e a latência passa a ser a da mais lenta, mas no máximo `limit` ficam em voo
+ao mesmo tempo por chamada. Assim uma nota com 2.000 itens não ocupa o pool
+inteiro do Motor (`maxPoolSize`) nem deixa as outras requisições esperando
+conexão.
+
+- Recebe fábricas sem argumentos (`lambda: ...`, `functools.partial`), não
+  corrotinas: cada corrotina só é criada depois de obter o semáforo. Uma
+  fábrica cancelada antes de começar nunca cria a corrotina, então não sobra
+  "coroutine was never awaited" nem consulta criada à toa.
+- As tarefas copiam o contexto da requisição; as operações continuam somadas
+  em db_metrics.py.
+- Se uma consulta falhar (sem `return_exceptions`), as que ainda não
+  terminaram são canceladas antes de a exceção subir.
+- Com o banco mock (síncrono) o resultado é o mesmo, só que sem paralelismo.
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+FANOUT_LIMIT = max(1, int(os.getenv('MONGO_FANOUT_LIMIT', '8')))
+
+
+async def gather(*factories: Callable[[], Awaitable[Any]], limit: Optional[int] = None,
+                 return_exceptions: bool = False) -> List[Any]:
+    """Como `asyncio.gather` sobre `factory()` de cada fábrica, com no máximo `limit`
+    (padrão `MONGO_FANOUT_LIMIT`) em execução."""
+    if not factories:
+        return []
+    sem = asyncio.Semaphore(max(1, limit or FANOUT_LIMIT))
+
+    async def bounded(factory):
+        async with sem:
+            return await factory()
+
+    tasks = [asyncio.ensure_future(bounded(f)) for f in factories]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def gather_dict(factories: Dict[str, Callable[[], Awaitable[Any]]],
+                      limit: Optional[int] = None) -> Dict[str, Any]:
+    """`gather` sobre um dicionário nome → fábrica; devolve nome → resultado."""
+    results = await gather(*factories.values(), limit=limit)
+    return dict(zip(factories.keys(), results))
@@ -1,19 +1,49 @@
 from fastapi import FastAPI, HTTPException, Query, Depends, Header, status
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
-from typing import List, Optional, Dict, Any
+from types import SimpleNamespace
+from typing import List, Optional, Dict, Any, Iterable, Tuple
+from collections import OrderedDict
 import os
+import asyncio
+import functools
 import math
+import itertools
+import csv
+import io
+import json
+import time
 import mongomock
 from pydantic import BaseModel, Field
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
+from pymongo import InsertOne, UpdateOne
 from pymongo.errors import DuplicateKeyError
 from jose import JWTError, jwt
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from hierarchy import PARENT_FIELDS, hierarchy_graph, local_of_estoque
+import pagination
+import stock_listing
+import reorder_points
+import lot_expiry
+import count_estimates
+from count_estimates import count_estimator
+from product_search import product_index
+from stock_ledger import STOCK_FIELDS, InsufficientStock, StockNotFound, take_async
+from lot_allocation import AllocationRequest, ReturnRequest, lot_allocator
+from canonical_ids import canonical_id, id_query, ids_query, legacy_ids, strict_ids_enabled
+from async_cache import AsyncResponseCache
+from extensions import cache_invalidation, publish_invalidation
+import cache_tags
+import index_spec
+import db_metrics
+import fanout
+import metrics
+
 # Carregar variáveis de ambiente
 load_dotenv()
 
@@ -44,6 +74,75 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cache de respostas (dashboard, estoque, relatórios): chave por papel + escopo + parâmetros
+route_cache = AsyncResponseCache(int(os.getenv("FASTAPI_CACHE_MAX_BYTES", str(16 * 1024 * 1024))))
+metrics.register_cache("route_cache", route_cache.stats)
+
+# Escritas que publicam tags precisas; as demais invalidam o cache inteiro
+_PRECISE_INVALIDATION_PATHS = {
+    "/api/movimentacoes/entrada",
+    "/api/movimentacoes/distribuicao",
+    "/api/movimentacoes/estorno_distribuicao",
+    "/api/movimentacoes/consumo",
+    "/api/movimentacoes/saida_justificada",
+}
+_NO_INVALIDATION_PATHS = {"/api/auth/login", "/api/produtos/gerar-codigo"}
+
+@app.middleware("http")
+async def _http_metrics_per_request(request, call_next):
+    # Latência por template de rota e requisições em andamento (metrics.py, exposto em /metrics)
+    start = time.perf_counter()
+    status_code = 500
+    metrics.http_in_flight.inc(app="fastapi")
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        metrics.http_in_flight.dec(app="fastapi")
+        route = request.scope.get("route")
+        metrics.observe_request("fastapi", request.method, getattr(route, "path", None), status_code, time.perf_counter() - start)
+
+@app.middleware("http")
+async def _db_metrics_per_request(request, call_next):
+    # Operações no Mongo por requisição (db_metrics.py): Server-Timing e log estruturado
+    token = db_metrics.begin()
+    try:
+        response = await call_next(request)
+        stats = db_metrics.current()
+        if stats is not None:
+            response.headers.append("Server-Timing", stats.server_timing())
+            db_metrics.report(stats, request.method, request.url.path, response.status_code)
+        return response
+    finally:
+        db_metrics.end(token)
+
+@app.middleware("http")
+async def _invalidate_route_cache_on_write(request, call_next):
+    # Aplica antes as invalidações publicadas por outros workers (extensions.SharedInvalidation)
+    await cache_invalidation.sync_async(db.db)
+    response = await call_next(request)
+    try:
+        path = request.url.path
+        if (
+            request.method in ("POST", "PUT", "PATCH", "DELETE")
+            and path.startswith("/api/")
+            and response.status_code < 400
+            and path not in _PRECISE_INVALIDATION_PATHS
+            and path not in _NO_INVALIDATION_PATHS
+            and not path.endswith("/atender")
+        ):
+            await _publish_invalidation([cache_tags.ALL_TAG])
+    except Exception:
+        pass
+    return response
+
+
+async def _publish_invalidation(tags: List[str]) -> None:
+    """Invalida o cache deste processo e publica as tags em `sistema_meta` para os demais."""
+    publish_invalidation(tags, shared=False)
+    await cache_invalidation.publish_async(db.db, tags)
+
 # Cliente Mongo Async
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 MONGO_DB = os.getenv("MONGO_DB", "almox_db")
@@ -52,6 +151,8 @@ class Database:
     client: AsyncIOMotorClient = None
     db = None
     is_mock: bool = False
+    index_task: Optional[asyncio.Task] = None
+    loop_lag_task: Optional[asyncio.Task] = None
 
 db = Database()
 
@@ -74,17 +175,27 @@ class _AsyncMockCursor:
         self._cursor = self._cursor.limit(n)
         return self
 
+    def batch_size(self, n: int):
+        return self
+
     async def to_list(self, length: Optional[int] = None):
-        items = list(self._cursor)
+        # Como no Motor: com `length`, consome só o próximo bloco e o restante fica para a próxima chamada
         if length is None:
-            return items
-        return items[:length]
+            return list(self._cursor)
+        return list(itertools.islice(self._cursor, length))
+
+    async def close(self):
+        self._cursor.close()
 
 
 class _AsyncMockCollection:
     def __init__(self, collection):
         self._collection = collection
 
+    @property
+    def database(self):
+        return _AsyncMockDatabase(self._collection.database)
+
     async def find_one(self, *args, **kwargs):
         return self._collection.find_one(*args, **kwargs)
 
@@ -97,9 +208,15 @@ class _AsyncMockCollection:
     async def insert_one(self, *args, **kwargs):
         return self._collection.insert_one(*args, **kwargs)
 
+    async def insert_many(self, *args, **kwargs):
+        return self._collection.insert_many(*args, **kwargs)
+
     async def update_one(self, *args, **kwargs):
         return self._collection.update_one(*args, **kwargs)
 
+    async def update_many(self, *args, **kwargs):
+        return self._collection.update_many(*args, **kwargs)
+
     async def find_one_and_update(self, *args, **kwargs):
         return self._collection.find_one_and_update(*args, **kwargs)
 
@@ -112,6 +229,28 @@ class _AsyncMockCollection:
     async def count_documents(self, *args, **kwargs):
         return self._collection.count_documents(*args, **kwargs)
 
+    async def create_index(self, *args, **kwargs):
+        return self._collection.create_index(*args, **kwargs)
+
+    async def index_information(self):
+        return self._collection.index_information()
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        # mongomock não aceita o UpdateOne do pymongo atual: aplica as operações em sequência
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "upserted_count": 0}
+        for op in requests:
+            if isinstance(op, InsertOne):
+                self._collection.insert_one(op._doc)
+                counts["inserted_count"] += 1
+            elif isinstance(op, UpdateOne):
+                res = self._collection.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+                counts["matched_count"] += res.matched_count
+                counts["modified_count"] += res.modified_count
+                counts["upserted_count"] += 1 if res.upserted_id is not None else 0
+            else:
+                raise NotImplementedError(type(op).__name__)
+        return SimpleNamespace(acknowledged=True, **counts)
+
 
 class _AsyncMockDatabase:
     def __init__(self, database):
@@ -231,13 +370,25 @@ def _is_expired(validade: Any, now: Optional[datetime] = None) -> bool:
 def _public_id(doc: Optional[Dict[str, Any]]) -> Optional[str]:
     if not doc:
         return None
+    if strict_ids_enabled() and doc.get("_id") is not None:
+        return str(doc.get("_id"))
     if doc.get("id") is not None:
         return str(doc.get("id"))
     if doc.get("_id") is not None:
         return str(doc.get("_id"))
     return None
 
+def _persist_id(doc: Dict[str, Any]) -> Any:
+    """Valor gravado em chaves estrangeiras: `str(_id)` no modo estrito, senão o id legado."""
+    if strict_ids_enabled() or doc.get("id") is None:
+        return str(doc.get("_id"))
+    return doc.get("id")
+
 def _build_id_query(value: str) -> Dict[str, Any]:
+    if strict_ids_enabled():
+        q = id_query(value)
+        if q is not None:
+            return q
     value = str(value)
     ors: List[Dict[str, Any]] = [{"id": value}, {"_id": value}]
     if value.isdigit():
@@ -249,6 +400,10 @@ def _build_id_query(value: str) -> Dict[str, Any]:
 def _id_candidates(value: Any) -> List[Any]:
     if value is None:
         return []
+    if strict_ids_enabled():
+        canon = canonical_id(value)
+        if canon is not None:
+            return [canon]
     out: List[Any] = []
     if isinstance(value, ObjectId):
         out.append(value)
@@ -263,6 +418,11 @@ def _id_candidates(value: Any) -> List[Any]:
     return list(dict.fromkeys(out))
 
 async def _produto_id_candidates(produto_ref: Any) -> List[Any]:
+    if strict_ids_enabled():
+        await legacy_ids.ensure_loaded_async(db.db)
+        canon = canonical_id(produto_ref, "produtos")
+        if canon is not None:
+            return [canon]
     base = list(_id_candidates(produto_ref))
     s = str(produto_ref)
     ors: List[Dict[str, Any]] = [{"id": s}, {"codigo": s}]
@@ -283,8 +443,69 @@ async def _produto_id_candidates(produto_ref: Any) -> List[Any]:
     return list(dict.fromkeys(base))
 
 async def _find_one_by_id(coll: str, value: str) -> Optional[Dict[str, Any]]:
+    if strict_ids_enabled():
+        await legacy_ids.ensure_loaded_async(db.db)
+        q = id_query(value, coll)
+        if q is not None:
+            return await db.db[coll].find_one(q)
     return await db.db[coll].find_one(_build_id_query(value))
 
+def _ids_lookup_query(ids: List[Any]) -> Dict[str, Any]:
+    """Filtro para buscar vários documentos por id (um valor por id no modo estrito)."""
+    if strict_ids_enabled():
+        return ids_query(ids)
+    q_ids: List[Any] = []
+    for i in ids:
+        q_ids.extend(_id_candidates(i))
+        q_ids.append(i)
+    q_ids = list(dict.fromkeys(q_ids))
+    return {"$or": [{"_id": {"$in": q_ids}}, {"id": {"$in": q_ids}}]}
+
+async def _hier_node(coll: str, value: Any) -> Optional[Dict[str, Any]]:
+    """Resolve central/almoxarifado/sub/setor pelo grafo em memória; consulta o banco apenas se ausente."""
+    if not value:
+        return None
+    if await hierarchy_graph.ensure_loaded_async(db.db):
+        doc = hierarchy_graph.node(coll, value)
+        if doc is not None:
+            return doc
+    return await _find_one_by_id(coll, str(value))
+
+async def _escopo_of(tipo: Optional[str], local_id: Any) -> Dict[str, Optional[str]]:
+    """Subdocumento `escopo` (ids canônicos de central/almox/sub/setor) gravado em estoques e movimentações."""
+    await hierarchy_graph.ensure_loaded_async(db.db)
+    return hierarchy_graph.scope_of(tipo, local_id)
+
+async def _route_cache_tags(user: Optional[Dict[str, Any]]) -> List[str]:
+    """Tags de dependência de uma resposta em cache para o escopo do usuário."""
+    await hierarchy_graph.ensure_loaded_async(db.db)
+    if not user:
+        return cache_tags.scope_tags(hierarchy_graph, None, None)
+    return cache_tags.scope_tags(hierarchy_graph, user.get("role"), user.get("scope_id"))
+
+async def _index_produto(doc: Optional[Dict[str, Any]]) -> None:
+    """Atualiza o índice de busca de produtos após uma escrita e publica a nova versão."""
+    try:
+        if await product_index.ensure_loaded_async(db.db):
+            product_index.upsert(doc)
+            await product_index.publish_async(db.db, doc.get("_id"))
+    except Exception:
+        pass
+
+async def _publish_stock_change(produtos: List[Any], locais: List[Any]) -> None:
+    """Invalida respostas em cache afetadas por uma escrita de estoque (produtos × locais (tipo, id))."""
+    try:
+        pids: List[Any] = []
+        for p in produtos:
+            if isinstance(p, dict):
+                pids.extend([p.get("id"), p.get("_id")])
+            else:
+                pids.append(p)
+        await hierarchy_graph.ensure_loaded_async(db.db)
+        await _publish_invalidation(cache_tags.stock_change_tags(hierarchy_graph, pids, locais))
+    except Exception:
+        pass
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -342,12 +563,12 @@ async def _resolve_parent_chain_from_setor(setor: Dict[str, Any]) -> Dict[str, O
             sub_id = None
 
     if not almox_id and sub_id:
-        sub = await _find_one_by_id("sub_almoxarifados", sub_id)
+        sub = await _hier_node("sub_almoxarifados", sub_id)
         almox_id = _norm_id(sub.get("almoxarifado_id")) if sub else None
 
     central_id = None
     if almox_id:
-        almox = await _find_one_by_id("almoxarifados", almox_id)
+        almox = await _hier_node("almoxarifados", almox_id)
         central_id = _norm_id(almox.get("central_id")) if almox else None
 
     return {"central_id": central_id, "almoxarifado_id": almox_id, "sub_almoxarifado_id": sub_id}
@@ -407,7 +628,9 @@ async def startup_db_client():
         timeout_ms = 5000
         if env in ("test", "testing") or os.environ.get("PYTEST_CURRENT_TEST"):
             timeout_ms = 200
-        db.client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=timeout_ms)
+        db.client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=timeout_ms,
+                                       event_listeners=[db_metrics.CommandStatsListener(), index_spec.SlowQueryListener(),
+                                                        metrics.PoolMetricsListener("fastapi")])
         db.db = db.client[MONGO_DB]
         await db.client.admin.command("ping")
         print(f"Conectado ao MongoDB Async: {MONGO_DB}")
@@ -422,6 +645,9 @@ async def startup_db_client():
         print(f"Falha ao conectar no MongoDB Async: {exc}")
         print("Usando banco mock em memória (mongomock)")
 
+    # Índices de index_spec.py em segundo plano: o app atende enquanto são criados
+    db.index_task = asyncio.create_task(index_spec.apply_async(db.db))
+    db.loop_lag_task = asyncio.create_task(metrics.watch_event_loop())
     await _ensure_super_admin()
     setor_nome = "ALMOX - Hospital Municipal de Angicos"
     try:
@@ -433,9 +659,13 @@ async def startup_db_client():
             )
     except Exception:
         pass
+    if strict_ids_enabled():
+        await legacy_ids.ensure_loaded_async(db.db)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if db.loop_lag_task:
+        db.loop_lag_task.cancel()
     if db.client:
         db.client.close()
 
@@ -551,6 +781,32 @@ async def search_produtos(
 ):
     q = (q or "").strip()
     role = user.get("role")
+    allowed: Optional[List[Any]] = None
+    if role in ("admin_central", "gerente_almox", "resp_sub_almox"):
+        allowed = await _allowed_central_ids_for_user(user)
+        if not allowed:
+            return []
+
+    skip = (page - 1) * limit
+    if q and await product_index.ensure_loaded_async(db.db):
+        # Índice em memória (tokens sem acento, prefixos, trigramas e código exato)
+        hits = product_index.search(q, limit=skip + limit, central_ids=allowed)
+        seen_idx: set[str] = set()
+        ranked: List[Dict[str, Any]] = []
+        for _, p in hits:
+            key = str(p.get("codigo") or p.get("id") or p.get("_id"))
+            if key in seen_idx:
+                continue
+            seen_idx.add(key)
+            ranked.append({
+                "id": _public_id(p) or str(p.get("_id")),
+                "nome": p.get("nome"),
+                "codigo": p.get("codigo"),
+                "unidade": p.get("unidade_medida") or p.get("unidade"),
+                "categoria": p.get("categoria"),
+            })
+        return ranked[skip:skip + limit]
+
     base_query: Dict[str, Any] = {}
     if q:
         ors: List[Dict[str, Any]] = [
@@ -563,10 +819,7 @@ async def search_produtos(
         if ObjectId.is_valid(q):
             ors.append({"_id": ObjectId(q)})
         base_query = {"$or": ors}
-    if role in ("admin_central", "gerente_almox", "resp_sub_almox"):
-        allowed = await _allowed_central_ids_for_user(user)
-        if not allowed:
-            return []
+    if allowed is not None:
         if base_query:
             base_query = {"$and": [base_query, {"central_id": {"$in": allowed}}]}
         else:
@@ -575,7 +828,6 @@ async def search_produtos(
     projection = {"nome": 1, "codigo": 1, "unidade_medida": 1, "unidade": 1, "categoria": 1, "id": 1, "updated_at": 1}
     seen: set[str] = set()
     results: List[Dict[str, Any]] = []
-    skip = (page - 1) * limit
 
     for attempt in range(5):
         cursor = (
@@ -635,7 +887,7 @@ async def get_produto_detalhes(produto_id: str, user: Dict[str, Any] = Depends(g
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
         
-    pid_raw = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+    pid_raw = _persist_id(produto)
     pid_candidates: List[Any] = []
     for v in [pid_raw, str(pid_raw), produto.get("_id"), str(produto.get("_id")), produto_id]:
         if v is None:
@@ -649,26 +901,28 @@ async def get_produto_detalhes(produto_id: str, user: Dict[str, Any] = Depends(g
     pid_candidates = list(dict.fromkeys(pid_candidates))
     
     # Resolver Categoria (se houver ID)
-    cat_nome = "Sem Categoria"
-    if produto.get("categoria_id"):
-        cat_q = {}
+    async def fetch_categoria():
         cid = produto.get("categoria_id")
-        if ObjectId.is_valid(cid): cat_q = {"_id": ObjectId(cid)}
-        else: cat_q = {"id": cid}
-        
-        cat = await db.db.categorias.find_one(cat_q)
-        if cat: cat_nome = cat.get("nome")
+        if not cid:
+            return None
+        cat_q = {"_id": ObjectId(cid)} if ObjectId.is_valid(cid) else {"id": cid}
+        return await db.db.categorias.find_one(cat_q)
 
-    lotes_docs: List[Dict[str, Any]] = []
-    try:
-        lotes_cursor = db.db.lotes.find({"produto_id": {"$in": pid_candidates}}).sort("updated_at", -1).limit(50)
-        lotes_docs = await lotes_cursor.to_list(length=20)
-    except Exception:
-        lotes_docs = []
+    async def fetch_lotes():
+        try:
+            lotes_cursor = db.db.lotes.find({"produto_id": {"$in": pid_candidates}}).sort("updated_at", -1).limit(50)
+            return await lotes_cursor.to_list(length=20)
+        except Exception:
+            return []
 
-    # 2. Buscar Estoque por Local
-    estoque_cursor = db.db.estoques.find({"produto_id": {"$in": pid_candidates}})
-    estoques = await estoque_cursor.to_list(length=100)
+    # 2. Categoria, lotes, estoque por local e histórico recente são independentes: em paralelo
+    cat, lotes_docs, estoques, historico = await fanout.gather(
+        fetch_categoria,
+        fetch_lotes,
+        lambda: db.db.estoques.find({"produto_id": {"$in": pid_candidates}}).to_list(length=100),
+        lambda: db.db.movimentacoes.find({"produto_id": {"$in": pid_candidates}}).sort("data_movimentacao", -1).limit(5).to_list(length=5),
+    )
+    cat_nome = (cat.get("nome") if cat else None) or "Sem Categoria"
     
     total = 0.0
     locais_agg: Dict[str, Dict[str, Any]] = {}
@@ -698,24 +952,14 @@ async def get_produto_detalhes(produto_id: str, user: Dict[str, Any] = Depends(g
         
     async def fetch_map_simple(coll, ids):
         if not ids: return {}
-        q_ids = []
-        for i in ids:
-            if ObjectId.is_valid(str(i)): q_ids.append(ObjectId(str(i)))
-            q_ids.append(i)
-            if str(i).isdigit(): q_ids.append(int(i))
-        docs = await db.db[coll].find({"$or": [{"_id": {"$in": q_ids}}, {"id": {"$in": q_ids}}]}).to_list(length=len(ids))
+        docs = await db.db[coll].find(_ids_lookup_query(ids)).to_list(length=len(ids))
         mapping = {}
         for d in docs:
             mapping[str(d.get("_id"))] = d
             if d.get("id"): mapping[str(d.get("id"))] = d
         return mapping
 
-    loc_maps = {
-        "centrais": await fetch_map_simple("centrais", list(loc_ids["centrais"])),
-        "almoxarifados": await fetch_map_simple("almoxarifados", list(loc_ids["almoxarifados"])),
-        "setores": await fetch_map_simple("setores", list(loc_ids["setores"])),
-        "sub_almoxarifados": await fetch_map_simple("sub_almoxarifados", list(loc_ids["sub_almoxarifados"])),
-    }
+    loc_maps = await fanout.gather_dict({coll: functools.partial(fetch_map_simple, coll, list(ids)) for coll, ids in loc_ids.items()})
     
     for e in estoques:
         qtd_raw = e.get("quantidade")
@@ -791,9 +1035,7 @@ async def get_produto_detalhes(produto_id: str, user: Dict[str, Any] = Depends(g
                 prev["updated_at"] = updated_at
             prev["local_nome"] = l_nome or prev.get("local_nome")
         
-    # 3. Buscar Histórico Recente
-    hist_cursor = db.db.movimentacoes.find({"produto_id": {"$in": pid_candidates}}).sort("data_movimentacao", -1).limit(5)
-    historico = await hist_cursor.to_list(length=5)
+    # 3. Histórico Recente
     hist_formatado = []
     
     for h in historico:
@@ -809,7 +1051,7 @@ async def get_produto_detalhes(produto_id: str, user: Dict[str, Any] = Depends(g
     # 4. Buscar Lotes (se houver coleção de lotes)
     lotes_list = []
     for l in lotes_docs:
-        validade = l.get("data_validade")
+        validade = lot_expiry.expiry_of(l)
 
         l_nome = "Desconhecido"
         l_tipo = l.get("local_tipo", "outro")
@@ -894,7 +1136,7 @@ async def limpar_dados_sem_lotes(
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
 
-    pid_raw = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+    pid_raw = _persist_id(produto)
     pid_candidates: List[Any] = []
     for v in [pid_raw, str(pid_raw), produto.get("_id"), str(produto.get("_id")), produto_id]:
         if v is None:
@@ -944,7 +1186,7 @@ async def update_lote(lote_id: str, item: LoteUpdate, user: Dict[str, Any] = Dep
         update_data["numero_lote"] = numero
         changed = True
     if item.data_validade is not None:
-        update_data["data_validade"] = item.data_validade
+        update_data["data_validade"] = lot_expiry.parse(item.data_validade)
         changed = True
     if item.quantidade_atual is not None:
         try:
@@ -1041,6 +1283,7 @@ async def update_lote(lote_id: str, item: LoteUpdate, user: Dict[str, Any] = Dep
                     {"_id": estoque.get("_id")},
                     {"$inc": {"quantidade": float(delta_estoque), "quantidade_atual": float(delta_estoque), "quantidade_disponivel": float(delta_estoque)}, "$set": {"updated_at": now}},
                 )
+                await reorder_points.refresh_async(db.db.estoques, {"_id": estoque.get("_id")})
             else:
                 if float(delta_estoque) < 0:
                     raise HTTPException(status_code=400, detail="Não há estoque correspondente para reduzir")
@@ -1052,13 +1295,16 @@ async def update_lote(lote_id: str, item: LoteUpdate, user: Dict[str, Any] = Dep
                     "local_id": str(lote_local_id),
                     "almoxarifado_id": str(almox_id) if almox_id is not None else None,
                     "sub_almoxarifado_id": str(sub_id) if sub_id is not None else None,
+                    "escopo": await _escopo_of(lote_local_tipo, lote_local_id),
                     "updated_at": now,
                 }
+                estoque_filter = {"produto_id": str(pid), "local_tipo": lote_local_tipo, "local_id": str(lote_local_id)}
                 await db.db.estoques.update_one(
-                    {"produto_id": str(pid), "local_tipo": lote_local_tipo, "local_id": str(lote_local_id)},
+                    estoque_filter,
                     {"$inc": {"quantidade": float(delta_estoque), "quantidade_atual": float(delta_estoque), "quantidade_disponivel": float(delta_estoque)}, "$set": estoque_set, "$setOnInsert": {"created_at": now}},
                     upsert=True,
                 )
+                await reorder_points.refresh_async(db.db.estoques, estoque_filter)
 
             update_data.setdefault("local_tipo", lote_local_tipo)
             update_data.setdefault("local_id", str(lote_local_id))
@@ -1072,6 +1318,7 @@ async def update_lote(lote_id: str, item: LoteUpdate, user: Dict[str, Any] = Dep
         raise HTTPException(status_code=400, detail="Número do lote já existe para este produto")
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Lote não encontrado")
+    lot_allocator.forget([existing.get("produto_id")])
 
     role = (user.get("role") or "").strip()
     if role in ("admin_central", "gerente_almox", "resp_sub_almox") and qty_change_old is not None and qty_change_new is not None:
@@ -1204,10 +1451,12 @@ async def delete_lote(
                     {"_id": estoque.get("_id")},
                     {"$inc": {"quantidade": -float(qtd), "quantidade_atual": -float(qtd), "quantidade_disponivel": -float(qtd)}, "$set": {"updated_at": now}},
                 )
+            await reorder_points.refresh_async(db.db.estoques, {"_id": estoque.get("_id")})
 
     res = await db.db.lotes.delete_one({"_id": existing.get("_id")})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Lote não encontrado")
+    lot_allocator.forget([existing.get("produto_id")])
 
     pid_vals = await _produto_id_candidates(pid)
     if lote_numero:
@@ -1267,7 +1516,19 @@ async def delete_lote(
 
     return {"status": "success", "message": "Lote removido"}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    """Métricas do processo no formato texto do Prometheus (ver metrics.py)."""
+    if not metrics.authorized(authorization):
+        raise HTTPException(status_code=401, detail="Não autorizado")
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/health/app")
+async def get_health_app():
+    return {"ok": True, "mongo_mock": bool(db.is_mock), "route_cache": route_cache.stats()}
+
 @app.get("/api/dashboard/stats")
+@route_cache.cached("dashboard_stats", ttl=30, stale_ttl=120, tags=_route_cache_tags)
 async def get_dashboard_stats(user: Dict[str, Any] = Depends(get_current_user)):
     try:
         if db.db is None:
@@ -1328,9 +1589,13 @@ async def get_dashboard_stats(user: Dict[str, Any] = Depends(get_current_user)):
             total_prod_query = {"central_id": {"$in": allowed_central}}
         total_produtos = await db.db.produtos.count_documents(total_prod_query)
 
+        await hierarchy_graph.ensure_loaded_async(db.db)
+        escopo_filter = hierarchy_graph.scope_filter(role, scope_id) if role != "super_admin" else None
         estoque_ors: List[Dict[str, Any]] = []
         if role == "super_admin":
-            estoque_query = {"quantidade_disponivel": {"$lt": 10}}
+            estoque_query = reorder_points.low_stock_query()
+        elif escopo_filter is not None:
+            estoque_query = reorder_points.low_stock_query(escopo_filter)
         else:
             almox_vals = _id_values(allowed_almox)
             sub_vals = _id_values(allowed_sub)
@@ -1343,7 +1608,7 @@ async def get_dashboard_stats(user: Dict[str, Any] = Depends(get_current_user)):
                 estoque_ors += [{"central_id": {"$in": cent_vals}}, {"local_tipo": "central", "local_id": {"$in": cent_vals}}]
             if not estoque_ors:
                 return {"total_produtos": total_produtos, "baixo_estoque": 0, "locais_ativos": 0, "status_sistema": "Online"}
-            estoque_query = {"$and": [{"quantidade_disponivel": {"$lt": 10}}, {"$or": estoque_ors}]}
+            estoque_query = {"$and": [reorder_points.low_stock_query(), {"$or": estoque_ors}]}
         baixo_estoque = await db.db.estoques.count_documents(estoque_query)
 
         if role == "super_admin":
@@ -1377,33 +1642,58 @@ async def get_dashboard_stats(user: Dict[str, Any] = Depends(get_current_user)):
         }
 
 # --- Rota de Movimentações ---
-@app.get("/api/movimentacoes", response_model=MovimentacaoResponse)
-async def get_movimentacoes(
-    page: int = Query(1, ge=1),
-    per_page: int = Query(20, ge=1, le=100),
-    tipo: Optional[str] = None,
-    produto: Optional[str] = None,
-    user: Dict[str, Any] = Depends(get_current_user),
-):
-    skip = (page - 1) * per_page
-    query: Dict[str, Any] = {}
+def _count_mode(raw: Optional[str], default: str = count_estimates.EXACT) -> str:
+    try:
+        return count_estimates.parse_count_mode(raw, default)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+async def _count_total(coll_name: str, query: Dict[str, Any], mode: str, namespace: str) -> Optional[int]:
+    """Total da listagem conforme o modo `count` (ver count_estimates.py); None em `none`."""
+    coll = db.db[coll_name]
+    if mode == count_estimates.NONE:
+        return None
+    if mode == count_estimates.EXACT:
+        return await coll.count_documents(query)
+    return await count_estimator.get_async(count_estimator.key(namespace, query), lambda: coll.count_documents(query))
 
+def _page_info(page: Optional[int], per_page: int, mode: str, total: Optional[int], has_more: bool) -> Dict[str, Any]:
+    return {
+        "page": page,
+        "per_page": per_page,
+        "count": mode,
+        "total": total,
+        "pages": count_estimates.total_pages(total, per_page),
+        "has_more": has_more,
+    }
+
+async def _movimentacoes_scope(user: Dict[str, Any]) -> Tuple[List[Any], Optional[Dict[str, Any]]]:
+    """(ids aceitos da central do usuário, filtro de escopo das movimentações).
+
+    super_admin não tem recorte: ([], None). Para os demais, filtro None
+    significa que o usuário não tem central resolvível (nenhuma linha visível).
+    """
     role = (user.get("role") or "").strip()
+    if role == "super_admin":
+        return [], None
     scope_id = _norm_id(user.get("scope_id"))
     allowed_central: List[Any] = []
-    if role != "super_admin":
-        central_id = await _compute_user_central_id(role, scope_id, None, strict=False)
-        for v in [central_id]:
-            if not v:
-                continue
-            allowed_central.append(v)
-            if str(v).isdigit():
-                allowed_central.append(int(str(v)))
-            if ObjectId.is_valid(str(v)):
-                allowed_central.append(ObjectId(str(v)))
-        allowed_central = list(dict.fromkeys(allowed_central))
-        if not allowed_central:
-            return {"items": [], "pagination": {"page": page, "total": 0, "pages": 1}}
+    central_id = await _compute_user_central_id(role, scope_id, None, strict=False)
+    for v in [central_id]:
+        if not v:
+            continue
+        allowed_central.append(v)
+        if str(v).isdigit():
+            allowed_central.append(int(str(v)))
+        if ObjectId.is_valid(str(v)):
+            allowed_central.append(ObjectId(str(v)))
+    allowed_central = list(dict.fromkeys(allowed_central))
+    if not allowed_central:
+        return [], None
+    # Escopo denormalizado: igualdade única em escopo.central_id (após backfill)
+    await hierarchy_graph.ensure_loaded_async(db.db)
+    scope_filter: Optional[Dict[str, Any]] = hierarchy_graph.scope_filter(role, scope_id, key="central_id")
+    if scope_filter is None:
         prod_docs = await db.db.produtos.find({"central_id": {"$in": allowed_central}}, {"_id": 1, "id": 1}).to_list(length=20000)
         p_ids: List[Any] = []
         for p in prod_docs:
@@ -1414,10 +1704,55 @@ async def get_movimentacoes(
                 p_ids.append(p.get("id"))
                 p_ids.append(str(p.get("id")))
         p_ids = list(dict.fromkeys(p_ids))
-        scope_filter: Dict[str, Any] = {"$or": [{"central_id": {"$in": allowed_central}}]}
+        scope_filter = {"$or": [{"central_id": {"$in": allowed_central}}]}
         if p_ids:
             scope_filter["$or"].append({"produto_id": {"$in": p_ids}})
-        query = {"$and": [query, scope_filter]} if query else scope_filter
+    return allowed_central, scope_filter
+
+async def _movimentacoes_page(
+    query: Dict[str, Any], page: int, per_page: int, cursor: Optional[str], count: Optional[str]
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Página de movimentações em (data_movimentacao desc, _id desc), por cursor ou por `page`.
+
+    Com `cursor` a página vem do índice sem `skip` (ver pagination.py) e, por
+    padrão, sem contagem (`count=none`); sem cursor mantém o comportamento por
+    página, com total exato.
+    """
+    mode = _count_mode(count, count_estimates.NONE if cursor else count_estimates.EXACT)
+    try:
+        paged_query, direction = pagination.apply_cursor(query, cursor)
+    except pagination.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    find = db.db.movimentacoes.find(paged_query).sort(pagination.sort_spec(direction))
+    if not cursor:
+        find = find.skip((page - 1) * per_page)
+    rows, total = await asyncio.gather(
+        find.limit(per_page + 1).to_list(length=per_page + 1),
+        _count_total("movimentacoes", query, mode, "movimentacoes"),
+    )
+    movs, cursors = pagination.page_cursors(rows, per_page, direction, first_page=not cursor and page == 1)
+    out = _page_info(None if cursor else page, per_page, mode, total, cursors["next_cursor"] is not None)
+    out.update(cursors)
+    return movs, out
+
+@app.get("/api/movimentacoes", response_model=MovimentacaoResponse)
+async def get_movimentacoes(
+    page: int = Query(1, ge=1),
+    per_page: int = Query(20, ge=1, le=100),
+    tipo: Optional[str] = None,
+    produto: Optional[str] = None,
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
+    user: Dict[str, Any] = Depends(get_current_user),
+):
+    query: Dict[str, Any] = {}
+
+    role = (user.get("role") or "").strip()
+    allowed_central, scope_filter = await _movimentacoes_scope(user)
+    if role != "super_admin":
+        if scope_filter is None:
+            return {"items": [], "pagination": {"page": page, "total": 0, "pages": 1}}
+        query = scope_filter
     
     if tipo:
         tipo_norm = (tipo or "").strip().lower()
@@ -1452,10 +1787,7 @@ async def get_movimentacoes(
         else:
             return {"items": [], "pagination": {"total": 0, "page": page}}
 
-    total = await db.db.movimentacoes.count_documents(query)
-    # Ordenar por data decrescente (mais recente primeiro)
-    cursor = db.db.movimentacoes.find(query).sort("data_movimentacao", -1).skip(skip).limit(per_page)
-    movs = await cursor.to_list(length=per_page)
+    movs, pagination_out = await _movimentacoes_page(query, page, per_page, cursor, count)
     
     # Resolver Nomes de Produtos (Bulk)
     prod_ids = set()
@@ -1465,12 +1797,7 @@ async def get_movimentacoes(
     # Helper fetch_map já definido no escopo global ou reutilizar lógica
     async def fetch_map_simple(coll, ids):
         if not ids: return {}
-        q_ids = []
-        for i in ids:
-            if ObjectId.is_valid(str(i)): q_ids.append(ObjectId(str(i)))
-            q_ids.append(i)
-            if str(i).isdigit(): q_ids.append(int(i))
-        docs = await db.db[coll].find({"$or": [{"_id": {"$in": q_ids}}, {"id": {"$in": q_ids}}]}).to_list(length=len(ids))
+        docs = await db.db[coll].find(_ids_lookup_query(ids)).to_list(length=len(ids))
         mapping = {}
         for d in docs:
             mapping[str(d.get("_id"))] = d
@@ -1541,14 +1868,7 @@ async def get_movimentacoes(
             "nota_fiscal": m.get("nota_fiscal")
         })
         
-    return {
-        "items": results,
-        "pagination": {
-            "page": page,
-            "total": total,
-            "pages": math.ceil(total / per_page)
-        }
-    }
+    return {"items": results, "pagination": pagination_out}
 
 @app.get("/api/movimentacoes/setor/{setor_id}", response_model=MovimentacaoResponse)
 async def get_movimentacoes_por_setor(
@@ -1556,6 +1876,8 @@ async def get_movimentacoes_por_setor(
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=100),
     produto_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    count: Optional[str] = None,
     user: Dict[str, Any] = Depends(get_current_user),
 ):
     setor = await _find_one_by_id("setores", setor_id)
@@ -1605,10 +1927,7 @@ async def get_movimentacoes_por_setor(
             p_ids.append(str(produto.get("id")))
         query = {"$and": [query, {"produto_id": {"$in": p_ids}}]}
 
-    skip = (page - 1) * per_page
-    total = await db.db.movimentacoes.count_documents(query)
-    cursor = db.db.movimentacoes.find(query).sort("data_movimentacao", -1).skip(skip).limit(per_page)
-    movs = await cursor.to_list(length=per_page)
+    movs, pagination_out = await _movimentacoes_page(query, page, per_page, cursor, count)
 
     prod_ids = set()
     for m in movs:
@@ -1618,14 +1937,7 @@ async def get_movimentacoes_por_setor(
     async def fetch_map_simple(coll, ids):
         if not ids:
             return {}
-        q_ids = []
-        for i in ids:
-            if ObjectId.is_valid(str(i)):
-                q_ids.append(ObjectId(str(i)))
-            q_ids.append(i)
-            if str(i).isdigit():
-                q_ids.append(int(i))
-        docs = await db.db[coll].find({"$or": [{"_id": {"$in": q_ids}}, {"id": {"$in": q_ids}}]}).to_list(length=len(ids))
+        docs = await db.db[coll].find(_ids_lookup_query(ids)).to_list(length=len(ids))
         mapping = {}
         for d in docs:
             mapping[str(d.get("_id"))] = d
@@ -1694,10 +2006,215 @@ async def get_movimentacoes_por_setor(
             "nota_fiscal": m.get("nota_fiscal"),
         })
 
-    return {"items": results, "pagination": {"page": page, "total": total, "pages": math.ceil(total / per_page)}}
+    return {"items": results, "pagination": pagination_out}
+
+MOV_EXPORT_BATCH_SIZE = int(os.getenv("MOV_EXPORT_BATCH_SIZE", "5000"))
+MOV_EXPORT_NAME_CACHE = int(os.getenv("MOV_EXPORT_NAME_CACHE", "20000"))
+_MOV_EXPORT_FIELDS = [
+    "id", "data", "tipo", "produto_id", "produto_codigo", "produto_nome", "quantidade",
+    "origem_tipo", "origem_id", "origem_nome", "destino_tipo", "destino_id", "destino_nome",
+    "usuario", "nota_fiscal", "lote",
+]
+
+class _NameLRU:
+    """LRU limitado para documentos/nomes resolvidos durante uma exportação."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def missing(self, keys: Iterable[Any]) -> List[Any]:
+        return list(dict.fromkeys(k for k in keys if k is not None and str(k) not in self._data))
+
+    def put(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+def _parse_export_date(raw: Optional[str], end: bool = False) -> Optional[datetime]:
+    """ISO completo ou YYYY-MM-DD; `end` com data simples vira o início do dia seguinte (limite exclusivo)."""
+    text = (raw or "").strip()
+    if not text:
+        return None
+    try:
+        if len(text) == 10:
+            dt = datetime.strptime(text, "%Y-%m-%d")
+            return dt + timedelta(days=1) if end else dt
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data inválida: {text}")
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+async def _export_resolve_produtos(cache: _NameLRU, ids: Iterable[Any]) -> None:
+    missing = cache.missing(ids)
+    if not missing:
+        return
+    docs = await db.db.produtos.find(_ids_lookup_query(missing), {"_id": 1, "id": 1, "nome": 1, "codigo": 1}).to_list(length=None)
+    for d in docs:
+        info = {"nome": d.get("nome"), "codigo": d.get("codigo")}
+        cache.put(str(d.get("_id")), info)
+        if d.get("id") is not None:
+            cache.put(str(d.get("id")), info)
+    for raw in missing:
+        if cache.get(str(raw)) is None:
+            cache.put(str(raw), {})
+
+async def _export_resolve_usuarios(cache: _NameLRU, ids: Iterable[Any]) -> None:
+    missing = cache.missing(ids)
+    if not missing:
+        return
+    docs = await db.db.usuarios.find(_ids_lookup_query(missing), {"_id": 1, "id": 1, "nome": 1, "username": 1}).to_list(length=None)
+    for u in docs:
+        display = (u.get("nome") or u.get("username") or "").strip() or str(u.get("_id"))
+        cache.put(str(u.get("_id")), display)
+        if u.get("id") is not None:
+            cache.put(str(u.get("id")), display)
+    for raw in missing:
+        if cache.get(str(raw)) is None:
+            cache.put(str(raw), str(raw))
+
+def _mov_export_row(m: Dict[str, Any], produtos: _NameLRU, usuarios: _NameLRU) -> Dict[str, Any]:
+    p = produtos.get(str(m.get("produto_id"))) or {}
+    usuario_raw = m.get("usuario_responsavel")
+    return {
+        "id": str(m.get("_id")),
+        "data": _dt_to_utc_iso(m.get("data_movimentacao") or m.get("created_at")),
+        "tipo": m.get("tipo") or m.get("tipo_movimentacao"),
+        "produto_id": str(m.get("produto_id")) if m.get("produto_id") is not None else None,
+        "produto_codigo": p.get("codigo"),
+        "produto_nome": p.get("nome"),
+        "quantidade": float(m.get("quantidade") or 0),
+        "origem_tipo": m.get("local_origem_tipo") or m.get("origem_tipo") or m.get("local_tipo"),
+        "origem_id": _norm_id(m.get("local_origem_id") or m.get("origem_id") or m.get("local_id")),
+        "origem_nome": m.get("origem_nome"),
+        "destino_tipo": m.get("local_destino_tipo") or m.get("destino_tipo"),
+        "destino_id": _norm_id(m.get("local_destino_id") or m.get("destino_id")),
+        "destino_nome": m.get("destino_nome"),
+        "usuario": usuarios.get(str(usuario_raw)) if usuario_raw is not None else None,
+        "nota_fiscal": m.get("nota_fiscal"),
+        "lote": m.get("lote"),
+    }
+
+@app.get("/api/movimentacoes/export")
+async def export_movimentacoes(
+    formato: str = Query("ndjson"),
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    tipo: Optional[str] = None,
+    produto_id: Optional[str] = None,
+    user: Dict[str, Any] = Depends(get_current_user),
+):
+    """Exporta o ledger de movimentações em streaming (NDJSON ou CSV), em ordem cronológica.
+
+    O cursor é lido em blocos de `MOV_EXPORT_BATCH_SIZE`; nomes de produtos e
+    usuários vêm de LRUs preenchidos em lote só com os ids ainda não vistos, sem
+    contagem e sem paginação.
+    """
+    fmt = (formato or "").strip().lower()
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato deve ser ndjson ou csv")
+
+    role = (user.get("role") or "").strip()
+    _, scope_filter = await _movimentacoes_scope(user)
+    clauses: List[Dict[str, Any]] = []
+    if role != "super_admin":
+        if scope_filter is None:
+            raise HTTPException(status_code=403, detail="Usuário sem central associada")
+        clauses.append(scope_filter)
+
+    date_range: Dict[str, Any] = {}
+    inicio = _parse_export_date(data_inicio)
+    fim = _parse_export_date(data_fim, end=True)
+    if inicio is not None:
+        date_range["$gte"] = inicio
+    if fim is not None:
+        date_range["$lt" if len((data_fim or "").strip()) == 10 else "$lte"] = fim
+    if date_range:
+        clauses.append({"data_movimentacao": date_range})
+    tipo_norm = (tipo or "").strip().lower()
+    if tipo_norm:
+        clauses.append({"tipo": {"$in": ["saida", "saida_justificada"]}} if tipo_norm == "saida" else {"tipo": tipo_norm})
+    if produto_id:
+        produto = await _find_one_by_id("produtos", produto_id)
+        ref = [produto.get("_id"), produto.get("id")] if produto else [produto_id]
+        pid_vals: List[Any] = []
+        for v in ref:
+            if v is not None:
+                pid_vals += [v, str(v)]
+        clauses.append({"produto_id": {"$in": list(dict.fromkeys(pid_vals))}})
+    query: Dict[str, Any] = {"$and": clauses} if len(clauses) > 1 else (clauses[0] if clauses else {})
+
+    produtos = _NameLRU(MOV_EXPORT_NAME_CACHE)
+    usuarios = _NameLRU(MOV_EXPORT_NAME_CACHE)
+
+    async def _stream():
+        cursor = db.db.movimentacoes.find(query).sort([("data_movimentacao", 1), ("_id", 1)]).batch_size(MOV_EXPORT_BATCH_SIZE)
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=_MOV_EXPORT_FIELDS, delimiter=";", extrasaction="ignore")
+        if fmt == "csv":
+            writer.writeheader()
+            yield buf.getvalue()
+        try:
+            while True:
+                batch = await cursor.to_list(length=MOV_EXPORT_BATCH_SIZE)
+                if not batch:
+                    break
+                await asyncio.gather(
+                    _export_resolve_produtos(produtos, (m.get("produto_id") for m in batch)),
+                    _export_resolve_usuarios(usuarios, (m.get("usuario_responsavel") for m in batch)),
+                )
+                rows = [_mov_export_row(m, produtos, usuarios) for m in batch]
+                if fmt == "csv":
+                    buf.seek(0)
+                    buf.truncate(0)
+                    writer.writerows(rows)
+                    yield buf.getvalue()
+                else:
+                    yield "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in rows)
+        finally:
+            await cursor.close()
+
+    if fmt == "csv":
+        media_type, filename = "text/csv; charset=utf-8", "movimentacoes.csv"
+    else:
+        media_type, filename = "application/x-ndjson", "movimentacoes.ndjson"
+    return StreamingResponse(_stream(), media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+def _supports_pipeline() -> bool:
+    """Operadores de agregação como `$convert` só existem no MongoDB real (não no banco mock)."""
+    return not isinstance(db.db, _AsyncMockDatabase)
+
+def _estoque_hierarquia_item(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Serializa uma linha de `stock_listing.page_pipeline` (produto, local e saldos já resolvidos)."""
+    p = row.get("produto") or {}
+    tipo, node = stock_listing.local_node(hierarchy_graph, row)
+    default_nome = {"setor": "Setor", "sub_almoxarifado": "Sub-Almoxarifado", "almoxarifado": "Almoxarifado", "central": "Central"}
+    if tipo in default_nome:
+        l_tipo, l_nome = tipo, (node or {}).get("nome") or default_nome[tipo]
+    else:
+        l_tipo, l_nome = row.get("local_tipo", "outro"), "Desconhecido"
+    return {
+        "produto_nome": p.get("nome", "-"),
+        "produto_codigo": p.get("codigo", "-"),
+        "local_nome": l_nome,
+        "local_tipo": l_tipo,
+        "quantidade": float(row.get("_atual") or 0),
+        "quantidade_disponivel": float(row.get("_disp") or 0),
+        "status": row.get("_status") or "Normal",
+    }
 
 # --- Rota Otimizada de Estoque (Exemplo de Migração) ---
 @app.get("/api/estoque/hierarquia", response_model=EstoqueResponse)
+@route_cache.cached("estoque_hierarquia", ttl=30, stale_ttl=60, tags=_route_cache_tags)
 async def get_estoque_hierarquia(
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=100),
@@ -1705,6 +2222,7 @@ async def get_estoque_hierarquia(
     tipo: Optional[str] = None,
     local: Optional[str] = None,
     status: Optional[str] = None,
+    count: Optional[str] = None,
     user: Dict[str, Any] = Depends(get_current_user),
 ):
     """
@@ -1712,6 +2230,7 @@ async def get_estoque_hierarquia(
     Muito mais rápida pois não bloqueia o servidor enquanto busca no banco.
     """
     skip = (page - 1) * per_page
+    count_mode = _count_mode(count)
 
     if db.db is None:
         return {"items": [], "pagination": {"total": 0, "page": page, "pages": 1}}
@@ -1740,10 +2259,14 @@ async def get_estoque_hierarquia(
 
     allowed_central = await _allowed_central_ids_for_user(user) if role != "super_admin" else []
 
+    # Escopo denormalizado: igualdade única em escopo.* dispensa montar listas de almox/sub
+    await hierarchy_graph.ensure_loaded_async(db.db)
+    escopo_filter = hierarchy_graph.scope_filter(role, scope_id) if role != "super_admin" else None
+
     allowed_almox: List[Any] = []
     allowed_sub: List[Any] = []
 
-    if role == "super_admin":
+    if role == "super_admin" or escopo_filter is not None:
         pass
     elif role == "resp_sub_almox" and scope_id:
         allowed_sub = [scope_id]
@@ -1805,7 +2328,9 @@ async def get_estoque_hierarquia(
         ]
 
     query: Dict[str, Any] = base_query
-    if role != "super_admin":
+    if escopo_filter is not None:
+        query = {"$and": [base_query, escopo_filter]} if base_query else escopo_filter
+    elif role != "super_admin":
         scope_ors: List[Dict[str, Any]] = []
         almox_vals = _id_values(allowed_almox)
         sub_vals = _id_values(allowed_sub)
@@ -1821,12 +2346,30 @@ async def get_estoque_hierarquia(
         scope_filter: Dict[str, Any] = {"$or": scope_ors}
         query = {"$and": [base_query, scope_filter]} if base_query else scope_filter
 
-    # Contagem total (Async)
-    total = await db.db.estoques.count_documents(query)
-    
-    # Busca Principal (Async e não bloqueante)
-    cursor = db.db.estoques.find(query).skip(skip).limit(per_page)
-    estoques = await cursor.to_list(length=per_page)
+    # Status calculado no banco: paginação e total já consideram o filtro
+    if status:
+        status_filter = stock_listing.RULES.status_filter(status)
+        if status_filter is None:
+            return {"items": [], "pagination": {"total": 0, "page": page, "pages": 1}}
+        query = {"$and": [query, status_filter]} if query else status_filter
+
+    # Uma agregação: página + produto + local + status (+ total exato no mesmo $facet)
+    if _supports_pipeline() and await hierarchy_graph.ensure_loaded_async(db.db):
+        pipeline = stock_listing.page_pipeline(query, skip, per_page + 1, with_total=count_mode == count_estimates.EXACT)
+        rows, total = stock_listing.unpack_page(await db.db.estoques.aggregate(pipeline).to_list(length=1))
+        if count_mode == count_estimates.ESTIMATE:
+            total = await _count_total("estoques", query, count_mode, "estoques")
+        items = [_estoque_hierarquia_item(r) for r in rows[:per_page]]
+        return {"items": items, "pagination": _page_info(page, per_page, count_mode, total, len(rows) > per_page)}
+
+    # Banco mock: mesmo resultado em consultas separadas (mesma ordem do pipeline)
+    cursor = db.db.estoques.find(query).sort(list(stock_listing.DEFAULT_SORT.items())).skip(skip).limit(per_page + 1)
+    estoques, total = await asyncio.gather(
+        cursor.to_list(length=per_page + 1),
+        _count_total("estoques", query, count_mode, "estoques"),
+    )
+    has_more = len(estoques) > per_page
+    estoques = estoques[:per_page]
 
     # Bulk Resolve (Carregamento em lote Async)
     prod_ids = set()
@@ -1842,33 +2385,19 @@ async def get_estoque_hierarquia(
         elif (e.get("local_tipo") or "").strip().lower() == "sub_almoxarifado" and e.get("local_id"):
             loc_ids["sub_almoxarifados"].add(e.get("local_id"))
 
-    # Executar buscas auxiliares em paralelo (Gather)
-    # Nota: Motor não tem gather nativo na query, mas podemos disparar as tasks
-    # Para simplicidade aqui, faremos await sequencial, que já é rápido
-    
     # Função helper para converter lista de IDs para Dict
     async def fetch_map(coll, ids):
         if not ids: return {}
-        q_ids = []
-        for i in ids:
-            if ObjectId.is_valid(str(i)): q_ids.append(ObjectId(str(i)))
-            q_ids.append(i)
-            if str(i).isdigit(): q_ids.append(int(i))
-            
-        docs = await db.db[coll].find({"$or": [{"_id": {"$in": q_ids}}, {"id": {"$in": q_ids}}]}).to_list(length=len(ids))
+        docs = await db.db[coll].find(_ids_lookup_query(ids)).to_list(length=len(ids))
         mapping = {}
         for d in docs:
             mapping[str(d.get("_id"))] = d
             if d.get("id"): mapping[str(d.get("id"))] = d
         return mapping
 
-    prod_map = await fetch_map("produtos", list(prod_ids))
-    loc_maps = {
-        "centrais": await fetch_map("centrais", list(loc_ids["centrais"])),
-        "almoxarifados": await fetch_map("almoxarifados", list(loc_ids["almoxarifados"])),
-        "setores": await fetch_map("setores", list(loc_ids["setores"])),
-        "sub_almoxarifados": await fetch_map("sub_almoxarifados", list(loc_ids["sub_almoxarifados"]))
-    }
+    # Buscas auxiliares em paralelo (produtos + quatro coleções de locais)
+    loc_maps = await fanout.gather_dict({coll: functools.partial(fetch_map, coll, list(ids)) for coll, ids in {"produtos": prod_ids, **loc_ids}.items()})
+    prod_map = loc_maps.pop("produtos")
 
     # Montar resposta
     results = []
@@ -1922,9 +2451,6 @@ async def get_estoque_hierarquia(
         if disp <= 0: status_calc = "Zerado"
         elif disp <= (inicial * 0.1): status_calc = "Baixo"
 
-        if status and status.lower() != status_calc.lower():
-            continue
-
         results.append({
             "produto_nome": p.get("nome", "-"),
             "produto_codigo": p.get("codigo", "-"),
@@ -1935,13 +2461,43 @@ async def get_estoque_hierarquia(
             "status": status_calc
         })
 
+    return {"items": results, "pagination": _page_info(page, per_page, count_mode, total, has_more)}
+
+class PontoReposicaoRequest(BaseModel):
+    ponto_reposicao: Optional[float] = None
+
+@app.put("/api/estoque/{estoque_id}/ponto_reposicao")
+async def put_ponto_reposicao(estoque_id: str, req: PontoReposicaoRequest, user: Dict[str, Any] = Depends(_require_roles(["admin_central", "gerente_almox", "resp_sub_almox"]))):
+    """Define o ponto de reposição de uma linha de estoque (null volta ao mínimo do produto) e recalcula `abaixo_minimo`."""
+    try:
+        valor = reorder_points.parse_point(req.ponto_reposicao)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    existing = await db.db.estoques.find_one(_build_id_query(estoque_id))
+    if not existing:
+        raise HTTPException(status_code=404, detail="Estoque não encontrado")
+
+    role = user.get("role")
+    if role != "super_admin":
+        await hierarchy_graph.ensure_loaded_async(db.db)
+        scope = hierarchy_graph.scope_value(role, user.get("scope_id"))
+        escopo = existing.get("escopo") or hierarchy_graph.scope_of(*local_of_estoque(existing))
+        if scope is None or (escopo or {}).get(scope[0]) != scope[1]:
+            raise HTTPException(status_code=403, detail="Acesso negado")
+
+    if valor is not None:
+        update = {"$set": {reorder_points.POINT_FIELD: valor, reorder_points.INHERITED_FIELD: False}}
+    else:
+        # Sem ponto próprio a linha volta a herdar o mínimo do produto (ver reorder_points.sync)
+        update = {"$unset": {reorder_points.POINT_FIELD: "", reorder_points.INHERITED_FIELD: ""}}
+    doc = await db.db.estoques.find_one_and_update({"_id": existing["_id"]}, update, return_document=ReturnDocument.AFTER)
+    await reorder_points.sync_async(db.db.estoques, doc)
+    await _publish_stock_change([existing.get("produto_id")], [local_of_estoque(existing)])
     return {
-        "items": results,
-        "pagination": {
-            "page": page,
-            "total": total,
-            "pages": math.ceil(total / per_page)
-        }
+        "status": "success",
+        "ponto_reposicao": reorder_points.point(doc or existing),
+        "abaixo_minimo": reorder_points.is_below(doc or existing),
     }
 
 @app.get("/api/estoque/local")
@@ -2400,32 +2956,27 @@ class EntradaRequest(BaseModel):
 from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
 
-# --- Rota de Entrada (Recebimento) ---
-@app.post("/api/movimentacoes/entrada")
-async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_current_user)):
-    if req.quantidade <= 0:
-        raise HTTPException(status_code=400, detail="Quantidade deve ser maior que zero")
-    if not (req.lote or "").strip():
-        raise HTTPException(status_code=400, detail="Lote é obrigatório")
-    if req.preco_unitario is not None and float(req.preco_unitario) < 0:
-        raise HTTPException(status_code=400, detail="Preço deve ser maior ou igual a zero")
-
-    # 1. Validar Produto
-    prod_query = {"$or": [{"_id": req.produto_id}, {"id": req.produto_id}, {"codigo": req.produto_id}]}
-    if ObjectId.is_valid(req.produto_id):
-        prod_query["$or"].append({"_id": ObjectId(req.produto_id)})
-    elif req.produto_id.isdigit():
-        prod_query["$or"].append({"id": int(req.produto_id)})
-        
-    produto = await db.db.produtos.find_one(prod_query)
-    if not produto:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
-    
-    pid_out = produto.get('id') if produto.get('id') is not None else str(produto.get('_id'))
-
-    # 2. Validar Destino (hierárquico)
-    destino_tipo = (req.destino_tipo or "almoxarifado").strip()
-    destino_id = req.destino_id or req.almoxarifado_id
+async def _fetch_produtos_by_ref(refs: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Resolve várias referências de produto (`_id`, id sequencial ou código) em uma consulta."""
+    refs = list(dict.fromkeys(refs))
+    oids = [ObjectId(r) for r in refs if ObjectId.is_valid(r)]
+    seqs = [int(r) for r in refs if r.isdigit()]
+    produtos = await db.db.produtos.find({"$or": [
+        {"_id": {"$in": oids + refs}},
+        {"id": {"$in": seqs + refs}},
+        {"codigo": {"$in": refs}},
+    ]}).to_list(length=None)
+    by_ref: Dict[str, Dict[str, Any]] = {}
+    # Mesma prioridade da busca individual: _id, depois id, depois código
+    for field in ("codigo", "id", "_id"):
+        for p in produtos:
+            if p.get(field) is not None:
+                by_ref[str(p.get(field))] = p
+    return by_ref
+
+async def _resolve_entrada_destino(destino_tipo: Optional[str], destino_id: Optional[str], user: Dict[str, Any]) -> Dict[str, Any]:
+    """Valida o destino de uma entrada e as permissões do usuário; levanta HTTPException como a rota."""
+    destino_tipo = (destino_tipo or "almoxarifado").strip()
     if not destino_id:
         raise HTTPException(status_code=400, detail="Destino não informado")
 
@@ -2485,40 +3036,102 @@ async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_c
         if not destino_central_id or _norm_id(destino_central_id) != scope_id:
             raise HTTPException(status_code=403, detail="Acesso negado")
 
-    now = _now_utc()
-
-    # 3. Atualizar Estoque (Upsert)
-    estoque_filter = {
-        'produto_id': pid_out, 
-        'local_tipo': destino_tipo, 
-        'local_id': destino_out
+    return {
+        "destino_tipo": destino_tipo,
+        "destino_out": destino_out,
+        "destino_nome": destino_nome,
+        "almox_id_out": almox_id_out,
+        "sub_id_out": sub_id_out,
+        "escopo": await _escopo_of(destino_tipo, destino_out),
     }
-    
-    estoque_update = {
+
+def _entrada_estoque_update(destino: Dict[str, Any], pid_out: Any, quantidade: float, now: datetime) -> Dict[str, Any]:
+    return {
         '$inc': {
-            'quantidade': req.quantidade,
-            'quantidade_disponivel': req.quantidade
+            'quantidade': quantidade,
+            'quantidade_disponivel': quantidade
         },
         '$set': {
             'produto_id': pid_out,
-            'local_tipo': destino_tipo,
-            'local_id': destino_out,
-            'almoxarifado_id': almox_id_out,
-            'sub_almoxarifado_id': sub_id_out,
-            'nome_local': destino_nome,
+            'local_tipo': destino["destino_tipo"],
+            'local_id': destino["destino_out"],
+            'almoxarifado_id': destino["almox_id_out"],
+            'sub_almoxarifado_id': destino["sub_id_out"],
+            'nome_local': destino["destino_nome"],
+            'escopo': destino["escopo"],
             'updated_at': now
         },
         '$setOnInsert': {
             'created_at': now
         }
     }
+
+def _entrada_lote_update(destino: Dict[str, Any], pid_out: Any, lote: str, quantidade: float, data_validade: Any,
+                         preco_unitario: Optional[float], now: datetime) -> Dict[str, Any]:
+    lote_set = {
+        'produto_id': pid_out,
+        'numero_lote': lote,
+        'lote': lote,
+        'data_validade': lot_expiry.parse(data_validade),
+        'local_tipo': destino["destino_tipo"],
+        'local_id': destino["destino_out"],
+        'almoxarifado_id': destino["almox_id_out"],
+        'escopo': destino["escopo"],
+        'updated_at': now
+    }
+    if destino["destino_tipo"] == "sub_almoxarifado":
+        lote_set["sub_almoxarifado_id"] = destino["sub_id_out"]
+    if preco_unitario is not None:
+        lote_set['preco_unitario'] = float(preco_unitario)
+    return {
+        '$inc': {'quantidade_atual': quantidade},
+        '$set': {
+            **lote_set
+        },
+        '$setOnInsert': {'created_at': now}
+    }
+
+# --- Rota de Entrada (Recebimento) ---
+@app.post("/api/movimentacoes/entrada")
+async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_current_user)):
+    if req.quantidade <= 0:
+        raise HTTPException(status_code=400, detail="Quantidade deve ser maior que zero")
+    if not (req.lote or "").strip():
+        raise HTTPException(status_code=400, detail="Lote é obrigatório")
+    if req.preco_unitario is not None and float(req.preco_unitario) < 0:
+        raise HTTPException(status_code=400, detail="Preço deve ser maior ou igual a zero")
+
+    # 1. Validar Produto
+    prod_query = {"$or": [{"_id": req.produto_id}, {"id": req.produto_id}, {"codigo": req.produto_id}]}
+    if ObjectId.is_valid(req.produto_id):
+        prod_query["$or"].append({"_id": ObjectId(req.produto_id)})
+    elif req.produto_id.isdigit():
+        prod_query["$or"].append({"id": int(req.produto_id)})
+        
+    produto = await db.db.produtos.find_one(prod_query)
+    if not produto:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
     
-    await db.db.estoques.find_one_and_update(
+    pid_out = _persist_id(produto)
+
+    # 2. Validar Destino (hierárquico)
+    destino = await _resolve_entrada_destino(req.destino_tipo, req.destino_id or req.almoxarifado_id, user)
+    destino_tipo, destino_out = destino["destino_tipo"], destino["destino_out"]
+    now = _now_utc()
+
+    # 3. Atualizar Estoque (Upsert)
+    estoque_filter = {
+        'produto_id': pid_out, 
+        'local_tipo': destino_tipo, 
+        'local_id': destino_out
+    }
+    estoque_doc = await db.db.estoques.find_one_and_update(
         estoque_filter,
-        estoque_update,
+        _entrada_estoque_update(destino, pid_out, req.quantidade, now),
         upsert=True,
         return_document=ReturnDocument.AFTER
     )
+    await reorder_points.sync_async(db.db.estoques, estoque_doc)
 
     # 4. Registrar Movimentação
     mov_doc = {
@@ -2527,7 +3140,7 @@ async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_c
         'quantidade': req.quantidade,
         'data_movimentacao': now,
         'origem_nome': req.fornecedor or 'Fornecedor',
-        'destino_nome': destino_nome,
+        'destino_nome': destino["destino_nome"],
         'usuario_responsavel': user.get("id"),
         'observacoes': req.observacoes,
         'nota_fiscal': req.nota_fiscal,
@@ -2535,6 +3148,7 @@ async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_c
         'central_id': _norm_id(produto.get("central_id")) if produto else None,
         'local_tipo': destino_tipo,
         'local_id': destino_out,
+        'escopo': destino["escopo"],
         'created_at': now
     }
     
@@ -2543,30 +3157,127 @@ async def post_entrada(req: EntradaRequest, user: Dict[str, Any] = Depends(get_c
     # 5. Registrar Lote (se informado)
     if req.lote:
         lote_filter = {'produto_id': pid_out, 'numero_lote': req.lote}
-        lote_set = {
+        lote_update = _entrada_lote_update(destino, pid_out, req.lote, req.quantidade, req.data_validade, req.preco_unitario, now)
+        await db.db.lotes.find_one_and_update(lote_filter, lote_update, upsert=True)
+        lot_allocator.forget([pid_out])
+
+    await _publish_stock_change([produto], [(destino_tipo, destino_out)])
+    return {"status": "success", "message": "Entrada registrada com sucesso"}
+
+class EntradaNotaItem(BaseModel):
+    produto_id: str
+    quantidade: float
+    lote: str
+    data_validade: datetime
+    preco_unitario: Optional[float] = None
+    observacoes: Optional[str] = None
+
+class EntradaNotaRequest(BaseModel):
+    destino_tipo: Optional[str] = "almoxarifado"  # almoxarifado | sub_almoxarifado
+    destino_id: Optional[str] = None
+    almoxarifado_id: Optional[str] = None  # legado
+    fornecedor: Optional[str] = None
+    nota_fiscal: Optional[str] = None
+    observacoes: Optional[str] = None
+    items: List[EntradaNotaItem]
+
+ENTRADA_LOTE_MAX_ITEMS = int(os.getenv("ENTRADA_LOTE_MAX_ITEMS", "2000"))
+
+@app.post("/api/movimentacoes/entrada/lote")
+async def post_entrada_lote(req: EntradaNotaRequest, user: Dict[str, Any] = Depends(get_current_user)):
+    """Recebe uma nota fiscal inteira (várias linhas de produto/lote) em uma requisição.
+
+    Destino e permissões são validados uma vez e os produtos resolvidos em um
+    único `$in`. A nota é aceita ou recusada inteira: qualquer linha inválida
+    devolve 400 com a lista de erros por linha, sem gravar nada. Estoques e lotes
+    são agregados por chave e gravados em `bulk_write` não ordenados; as
+    movimentações (uma por linha) em um `insert_many`.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="Informe pelo menos um item")
+    if len(req.items) > ENTRADA_LOTE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {ENTRADA_LOTE_MAX_ITEMS} itens por nota")
+
+    destino = await _resolve_entrada_destino(req.destino_tipo, req.destino_id or req.almoxarifado_id, user)
+    destino_tipo, destino_out = destino["destino_tipo"], destino["destino_out"]
+
+    produtos = await _fetch_produtos_by_ref([str(it.produto_id).strip() for it in req.items])
+
+    erros: List[Dict[str, Any]] = []
+    linhas = []
+    for idx, it in enumerate(req.items, start=1):
+        lote = (it.lote or "").strip()
+        produto = produtos.get(str(it.produto_id).strip())
+        if it.quantidade <= 0:
+            erros.append({"linha": idx, "produto_id": it.produto_id, "erro": "Quantidade deve ser maior que zero"})
+        elif not lote:
+            erros.append({"linha": idx, "produto_id": it.produto_id, "erro": "Lote é obrigatório"})
+        elif it.preco_unitario is not None and float(it.preco_unitario) < 0:
+            erros.append({"linha": idx, "produto_id": it.produto_id, "erro": "Preço deve ser maior ou igual a zero"})
+        elif not produto:
+            erros.append({"linha": idx, "produto_id": it.produto_id, "erro": "Produto não encontrado"})
+        else:
+            linhas.append((it, lote, produto, _persist_id(produto)))
+    if erros:
+        raise HTTPException(status_code=400, detail={"message": "Nota fiscal com linhas inválidas", "erros": erros})
+
+    now = _now_utc()
+    por_produto: Dict[str, List[Any]] = {}
+    por_lote: Dict[Any, List[Any]] = {}
+    mov_docs = []
+    for it, lote, produto, pid_out in linhas:
+        por_produto.setdefault(str(pid_out), [pid_out, 0.0])[1] += it.quantidade
+        entry = por_lote.setdefault((str(pid_out), lote), [pid_out, 0.0, it])
+        entry[1] += it.quantidade
+        entry[2] = it  # validade/preço da última linha do lote, como em entradas sucessivas
+        mov_docs.append({
             'produto_id': pid_out,
-            'numero_lote': req.lote,
-            'lote': req.lote,
-            'data_validade': req.data_validade,
+            'tipo': 'entrada',
+            'quantidade': it.quantidade,
+            'data_movimentacao': now,
+            'origem_nome': req.fornecedor or 'Fornecedor',
+            'destino_nome': destino["destino_nome"],
+            'usuario_responsavel': user.get("id"),
+            'observacoes': it.observacoes if it.observacoes is not None else req.observacoes,
+            'nota_fiscal': req.nota_fiscal,
+            'lote': lote,
+            'central_id': _norm_id(produto.get("central_id")),
             'local_tipo': destino_tipo,
             'local_id': destino_out,
-            'almoxarifado_id': almox_id_out,
-            'updated_at': now
-        }
-        if destino_tipo == "sub_almoxarifado":
-            lote_set["sub_almoxarifado_id"] = sub_id_out
-        if req.preco_unitario is not None:
-            lote_set['preco_unitario'] = float(req.preco_unitario)
-        lote_update = {
-            '$inc': {'quantidade_atual': req.quantidade},
-            '$set': {
-                **lote_set
-            },
-            '$setOnInsert': {'created_at': now}
-        }
-        await db.db.lotes.find_one_and_update(lote_filter, lote_update, upsert=True)
+            'escopo': destino["escopo"],
+            'created_at': now
+        })
 
-    return {"status": "success", "message": "Entrada registrada com sucesso"}
+    estoque_filters = [{'produto_id': pid_out, 'local_tipo': destino_tipo, 'local_id': destino_out} for pid_out, _ in por_produto.values()]
+    estoque_ops = [
+        UpdateOne(f, _entrada_estoque_update(destino, pid_out, qtd, now), upsert=True)
+        for f, (pid_out, qtd) in zip(estoque_filters, por_produto.values())
+    ]
+    lote_ops = [
+        UpdateOne(
+            {'produto_id': pid_out, 'numero_lote': lote},
+            _entrada_lote_update(destino, pid_out, lote, qtd, it.data_validade, it.preco_unitario, now),
+            upsert=True,
+        )
+        for (_, lote), (pid_out, qtd, it) in por_lote.items()
+    ]
+    await asyncio.gather(
+        db.db.estoques.bulk_write(estoque_ops, ordered=False),
+        db.db.lotes.bulk_write(lote_ops, ordered=False),
+        db.db.movimentacoes.insert_many(mov_docs, ordered=False),
+    )
+    lot_allocator.forget([pid_out for pid_out, _, _ in por_lote.values()])
+    await reorder_points.refresh_async(db.db.estoques, {'$or': estoque_filters})
+
+    await _publish_stock_change([p for _, _, p, _ in linhas], [(destino_tipo, destino_out)])
+    return {
+        "status": "success",
+        "message": "Entrada da nota fiscal registrada com sucesso",
+        "nota_fiscal": req.nota_fiscal,
+        "linhas": len(linhas),
+        "produtos": len(por_produto),
+        "lotes": len(por_lote),
+    }
 
 class MovimentacaoRequest(BaseModel):
     produto_id: str
@@ -2577,6 +3288,19 @@ class MovimentacaoRequest(BaseModel):
     destino_tipo: str # almoxarifado | sub_almoxarifado | setor
     observacoes: Optional[str] = None
 
+class DistribuicaoLoteItem(BaseModel):
+    produto_id: str
+    quantidade: float
+    observacoes: Optional[str] = None
+
+class DistribuicaoLoteRequest(BaseModel):
+    origem_tipo: Optional[str] = "almoxarifado"  # almoxarifado | sub_almoxarifado
+    origem_id: str
+    destino_id: str
+    destino_tipo: str # almoxarifado | sub_almoxarifado | setor
+    observacoes: Optional[str] = None
+    items: List[DistribuicaoLoteItem]
+
 class SetorConsumoRequest(BaseModel):
     produto_id: str
     quantidade: float
@@ -2744,6 +3468,7 @@ async def create_sub_almoxarifado(item: SubAlmoxarifadoItem, user: Dict[str, Any
              
     res = await db.db.sub_almoxarifados.insert_one(doc)
     doc_out = {k: v for k, v in doc.items() if k != "_id"}
+    await hierarchy_graph.invalidate_async(db.db)
     return {"id": str(res.inserted_id), **doc_out}
 
 @app.put("/api/sub_almoxarifados/{sub_id}")
@@ -2774,6 +3499,9 @@ async def update_sub_almoxarifado(sub_id: str, item: SubAlmoxarifadoItem, user:
     res = await db.db.sub_almoxarifados.update_one(q, {"$set": update_data})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Sub-Almoxarifado não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
+    if "almoxarifado_id" in update_data:
+        await hierarchy_graph.restamp_async(db.db, "sub_almoxarifado", str(existing["_id"]))
     return {"status": "success", "message": "Sub-Almoxarifado atualizado"}
 
 @app.put("/api/sub_almoxarifados/{sub_id}/setores")
@@ -2849,6 +3577,7 @@ async def set_sub_almoxarifado_setores(
         setor_candidates.append(d)
 
     updated = 0
+    moved: List[str] = []
     for s in setor_candidates:
         sid = _norm_id(_public_id(s) or str(s.get("_id")))
         if not sid:
@@ -2875,7 +3604,11 @@ async def set_sub_almoxarifado_setores(
         res = await db.db.setores.update_one({"_id": s["_id"]}, {"$set": update_data})
         if res.modified_count:
             updated += 1
+            moved.append(str(s["_id"]))
 
+    await hierarchy_graph.invalidate_async(db.db)
+    for setor_oid in moved:
+        await hierarchy_graph.restamp_async(db.db, "setor", setor_oid)
     return {"status": "success", "updated": updated}
 
 @app.delete("/api/sub_almoxarifados/{sub_id}")
@@ -2904,6 +3637,7 @@ async def delete_sub_almoxarifado(sub_id: str, user: Dict[str, Any] = Depends(_r
     res = await db.db.sub_almoxarifados.delete_one(q)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Sub-Almoxarifado não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
     return {"status": "success", "message": "Sub-Almoxarifado removido"}
 
 @app.get("/api/categorias", response_model=List[CategoriaItem])
@@ -3070,6 +3804,7 @@ async def create_setor(item: SetorItem, user: Dict[str, Any] = Depends(_require_
             raise HTTPException(status_code=403, detail="Acesso negado")
 
     res = await db.db.setores.insert_one(doc)
+    await hierarchy_graph.invalidate_async(db.db)
     return {"id": str(res.inserted_id), **doc}
 
 @app.put("/api/setores/{setor_id}")
@@ -3116,6 +3851,9 @@ async def update_setor(setor_id: str, item: SetorItem, user: Dict[str, Any] = De
     res = await db.db.setores.update_one(q, {"$set": update_data})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Setor não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
+    if any(k in update_data for k in PARENT_FIELDS):
+        await hierarchy_graph.restamp_async(db.db, "setor", str(existing["_id"]))
     return {"status": "success", "message": "Setor atualizado"}
 
 @app.delete("/api/setores/{setor_id}")
@@ -3146,6 +3884,7 @@ async def delete_setor(setor_id: str, user: Dict[str, Any] = Depends(_require_ro
     res = await db.db.setores.delete_one(q)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Setor não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
     return {"status": "success", "message": "Setor removido"}
 
 @app.get("/api/centrais", response_model=List[CentralItem])
@@ -3203,6 +3942,7 @@ async def create_central(item: CentralItem, user: Dict[str, Any] = Depends(_requ
     doc = item.dict(exclude={"id"})
     doc["created_at"] = _now_utc()
     res = await db.db.centrais.insert_one(doc)
+    await hierarchy_graph.invalidate_async(db.db)
     return {"id": str(res.inserted_id), **doc}
 
 @app.put("/api/centrais/{central_id}")
@@ -3222,6 +3962,7 @@ async def update_central(central_id: str, item: CentralItem, user: Dict[str, Any
     res = await db.db.centrais.update_one(q, {"$set": update_data})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Central não encontrada")
+    await hierarchy_graph.invalidate_async(db.db)
     return {"status": "success", "message": "Central atualizada"}
 
 @app.delete("/api/centrais/{central_id}")
@@ -3233,6 +3974,7 @@ async def delete_central(central_id: str, user: Dict[str, Any] = Depends(_requir
     res = await db.db.centrais.delete_one(q)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Central não encontrada")
+    await hierarchy_graph.invalidate_async(db.db)
     return {"status": "success", "message": "Central removida"}
 
 @app.get("/api/almoxarifados", response_model=List[AlmoxarifadoItem])
@@ -3302,6 +4044,7 @@ async def create_almoxarifado(item: AlmoxarifadoItem, user: Dict[str, Any] = Dep
         doc["can_receive_inter_central"] = False
     doc["created_at"] = _now_utc()
     res = await db.db.almoxarifados.insert_one(doc)
+    await hierarchy_graph.invalidate_async(db.db)
     return {"id": str(res.inserted_id), **doc}
 
 @app.put("/api/almoxarifados/{almox_id}")
@@ -3328,6 +4071,9 @@ async def update_almoxarifado(almox_id: str, item: AlmoxarifadoItem, user: Dict[
     res = await db.db.almoxarifados.update_one(q, {"$set": update_data})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Almoxarifado não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
+    if "central_id" in update_data:
+        await hierarchy_graph.restamp_async(db.db, "almoxarifado", str(existing["_id"]))
     return {"status": "success", "message": "Almoxarifado atualizado"}
 
 @app.delete("/api/almoxarifados/{almox_id}")
@@ -3352,6 +4098,7 @@ async def delete_almoxarifado(almox_id: str, user: Dict[str, Any] = Depends(_req
     res = await db.db.almoxarifados.delete_one(q)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Almoxarifado não encontrado")
+    await hierarchy_graph.invalidate_async(db.db)
     return {"status": "success", "message": "Almoxarifado removido"}
 
 # --- Rotas de Usuários ---
@@ -3444,7 +4191,7 @@ async def _compute_user_central_id(role: str, scope_id: Optional[str], provided_
             if strict:
                 raise HTTPException(status_code=400, detail="scope_id é obrigatório para admin_central")
             return provided_central_id
-        central = await _find_one_by_id("centrais", scope_id)
+        central = await _hier_node("centrais", scope_id)
         if not central:
             if strict:
                 raise HTTPException(status_code=400, detail="Central inválida")
@@ -3459,7 +4206,7 @@ async def _compute_user_central_id(role: str, scope_id: Optional[str], provided_
             if strict:
                 raise HTTPException(status_code=400, detail="scope_id é obrigatório para gerente_almox")
             return provided_central_id
-        almox = await _find_one_by_id("almoxarifados", scope_id)
+        almox = await _hier_node("almoxarifados", scope_id)
         central_id = _norm_id(almox.get("central_id")) if almox else None
         if not central_id:
             if strict:
@@ -3474,9 +4221,9 @@ async def _compute_user_central_id(role: str, scope_id: Optional[str], provided_
             if strict:
                 raise HTTPException(status_code=400, detail="scope_id é obrigatório para resp_sub_almox")
             return provided_central_id
-        sub = await _find_one_by_id("sub_almoxarifados", scope_id)
+        sub = await _hier_node("sub_almoxarifados", scope_id)
         almox_id = _norm_id(sub.get("almoxarifado_id")) if sub else None
-        almox = await _find_one_by_id("almoxarifados", almox_id) if almox_id else None
+        almox = await _hier_node("almoxarifados", almox_id)
         central_id = _norm_id(almox.get("central_id")) if almox else None
         if not central_id:
             if strict:
@@ -3491,7 +4238,7 @@ async def _compute_user_central_id(role: str, scope_id: Optional[str], provided_
             if strict:
                 raise HTTPException(status_code=400, detail="scope_id é obrigatório para operador_setor")
             return provided_central_id
-        setor = await _find_one_by_id("setores", scope_id)
+        setor = await _hier_node("setores", scope_id)
         if not setor:
             if strict:
                 raise HTTPException(status_code=400, detail="Setor inválido")
@@ -3591,6 +4338,7 @@ class ProdutoCreate(BaseModel):
     categoria_id: Optional[str] = None
     categoria_nome: Optional[str] = None
     observacao: Optional[str] = None
+    estoque_minimo: Optional[float] = None
     ativo: bool = True
 
 class ProdutoUpdate(BaseModel):
@@ -3602,6 +4350,7 @@ class ProdutoUpdate(BaseModel):
     categoria_id: Optional[str] = None
     categoria_nome: Optional[str] = None
     observacao: Optional[str] = None
+    estoque_minimo: Optional[float] = None
     ativo: bool = True
 
 class CodigoRequest(BaseModel):
@@ -3619,7 +4368,7 @@ async def create_produto(prod: ProdutoCreate, user: Dict[str, Any] = Depends(get
     # Validar duplicidade de código
     existing = await db.db.produtos.find_one({"codigo": prod.codigo})
     if existing:
-         pid = existing.get('id') if existing.get('id') is not None else str(existing.get('_id'))
+         pid = _persist_id(existing)
          return {"id": pid, "message": "Produto já existe", "exists": True}
     
     central_id = prod.central_id
@@ -3633,6 +4382,10 @@ async def create_produto(prod: ProdutoCreate, user: Dict[str, Any] = Depends(get
     central = await _find_one_by_id("centrais", central_id)
     if not central:
         raise HTTPException(status_code=400, detail="Central inválida")
+    try:
+        reorder_points.parse_point(prod.estoque_minimo)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="estoque_minimo deve ser um número maior ou igual a zero")
 
     doc = prod.dict(exclude={"categoria_nome"})
     doc["central_id"] = _public_id(central) or _norm_id(central_id)
@@ -3656,6 +4409,8 @@ async def create_produto(prod: ProdutoCreate, user: Dict[str, Any] = Depends(get
         doc["categoria"] = prod.categoria_nome
 
     res = await db.db.produtos.insert_one(doc)
+    doc["_id"] = res.inserted_id
+    await _index_produto(doc)
     return {"id": str(res.inserted_id), "message": "Produto criado com sucesso"}
 
 @app.post("/api/produtos/gerar-codigo")
@@ -3684,6 +4439,12 @@ async def update_produto(produto_id: str, prod: ProdutoUpdate):
     if update_data.get("unidade") is not None and update_data.get("unidade_medida") is None:
         update_data["unidade_medida"] = update_data.get("unidade")
 
+    if "estoque_minimo" in update_data:
+        try:
+            update_data["estoque_minimo"] = reorder_points.parse_point(update_data["estoque_minimo"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="estoque_minimo deve ser um número maior ou igual a zero")
+
     if "central_id" in update_data and update_data.get("central_id"):
         central = await _find_one_by_id("centrais", str(update_data.get("central_id")))
         if not central:
@@ -3703,6 +4464,10 @@ async def update_produto(produto_id: str, prod: ProdutoUpdate):
              update_data["categoria"] = cat.get("nome")
 
     await db.db.produtos.update_one({"_id": existing["_id"]}, {"$set": update_data})
+    await _index_produto(await db.db.produtos.find_one({"_id": existing["_id"]}))
+    if "estoque_minimo" in update_data and update_data["estoque_minimo"] != existing.get("estoque_minimo"):
+        # Linhas de estoque que herdam o mínimo do produto passam a usar o novo valor
+        await reorder_points.propagate_async(db.db.estoques, await _produto_id_candidates(existing["_id"]), update_data["estoque_minimo"])
     return {"status": "success", "message": "Produto atualizado"}
 
 @app.delete("/api/produtos/{produto_id}")
@@ -3715,17 +4480,20 @@ async def delete_produto(produto_id: str):
     # Verificar se tem movimentações ou estoque antes de deletar
     # Por segurança, apenas deleta logicamente (ativo=False) ou se não tiver histórico
     
+    existing = await db.db.produtos.find_one(q, {"_id": 1})
     res = await db.db.produtos.delete_one(q)
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
+    if existing and await product_index.ensure_loaded_async(db.db):
+        product_index.remove(existing.get("_id"))
+        await product_index.publish_async(db.db, existing.get("_id"))
     return {"status": "success", "message": "Produto removido"}
 
 # --- Rota de Distribuição (Saída/Transferência) ---
-@app.post("/api/movimentacoes/distribuicao")
-async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Depends(get_current_user)):
-    if req.quantidade <= 0:
-        raise HTTPException(status_code=400, detail="Quantidade deve ser maior que zero")
-
+async def _resolve_distribuicao_locais(
+    origem_tipo: Optional[str], origem_id: str, destino_tipo: str, destino_id: str, user: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Valida origem, destino e permissões de uma distribuição; levanta HTTPException como a rota."""
     role = user.get("role")
     scope_id = user.get("scope_id")
     if role not in ("super_admin", "admin_central", "gerente_almox", "resp_sub_almox"):
@@ -3733,36 +4501,25 @@ async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Dep
     if role != "super_admin" and not scope_id:
         raise HTTPException(status_code=400, detail="Usuário sem escopo associado")
 
-    # 1. Validar Produto e Resolver ID
-    prod_query = {"$or": [{"_id": req.produto_id}, {"id": req.produto_id}, {"codigo": req.produto_id}]}
-    if ObjectId.is_valid(req.produto_id):
-        prod_query["$or"].append({"_id": ObjectId(req.produto_id)})
-    elif req.produto_id.isdigit():
-        prod_query["$or"].append({"id": int(req.produto_id)})
-        
-    produto = await db.db.produtos.find_one(prod_query)
-    if not produto:
-        raise HTTPException(status_code=404, detail="Produto não encontrado")
-    pid_out = produto.get('id') if produto.get('id') is not None else str(produto.get('_id'))
-
-    # 2. Validar Origem (Almox/Sub)
-    origem_tipo = (req.origem_tipo or "almoxarifado").strip()
+    # Validar Origem (Almox/Sub)
+    origem_tipo = (origem_tipo or "almoxarifado").strip()
     origem_nome = "Origem"
     oid_out = None
     origem_almox_id = None
+    almox = None
 
     if origem_tipo == "almoxarifado":
-        origem = await db.db.almoxarifados.find_one(_build_id_query(req.origem_id))
+        origem = await db.db.almoxarifados.find_one(_build_id_query(origem_id))
         if not origem:
             raise HTTPException(status_code=404, detail="Local de origem não encontrado")
-        oid_out = _public_id(origem) or req.origem_id
+        oid_out = _public_id(origem) or origem_id
         origem_nome = origem.get("nome") or "Almoxarifado"
         origem_almox_id = oid_out
     elif origem_tipo == "sub_almoxarifado":
-        origem = await db.db.sub_almoxarifados.find_one(_build_id_query(req.origem_id))
+        origem = await db.db.sub_almoxarifados.find_one(_build_id_query(origem_id))
         if not origem:
             raise HTTPException(status_code=404, detail="Local de origem não encontrado")
-        oid_out = _public_id(origem) or req.origem_id
+        oid_out = _public_id(origem) or origem_id
         origem_nome = origem.get("nome") or "Sub-Almoxarifado"
         origem_almox_id = _norm_id(origem.get("almoxarifado_id"))
         if not origem_almox_id:
@@ -3794,13 +4551,13 @@ async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Dep
             if not almox_doc or _norm_id(almox_doc.get("central_id")) != central_id:
                 raise HTTPException(status_code=403, detail="Acesso negado")
 
-    # 3. Validar Destino (Setor ou Almoxarifado)
-    destino_tipo = req.destino_tipo.strip()
+    # Validar Destino (Setor ou Almoxarifado)
+    destino_tipo = destino_tipo.strip()
     dest_coll = "setores" if destino_tipo == "setor" else "sub_almoxarifados" if destino_tipo == "sub_almoxarifado" else "almoxarifados"
-    destino = await db.db[dest_coll].find_one(_build_id_query(req.destino_id))
+    destino = await db.db[dest_coll].find_one(_build_id_query(destino_id))
     if not destino:
         raise HTTPException(status_code=404, detail="Local de destino não encontrado")
-    did_out = _public_id(destino) or req.destino_id
+    did_out = _public_id(destino) or destino_id
     destino_nome = destino.get('nome') or 'Destino'
 
     if role != "super_admin":
@@ -3808,7 +4565,7 @@ async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Dep
         if origem_tipo == "almoxarifado":
             origem_central_id = _norm_id(origem.get("central_id"))
         else:
-            almox_doc = almox if "almox" in locals() else None
+            almox_doc = almox
             if not almox_doc:
                 almox_doc = await db.db.almoxarifados.find_one(_build_id_query(origem_almox_id or ""))
             origem_central_id = _norm_id(almox_doc.get("central_id")) if almox_doc else None
@@ -3828,97 +4585,128 @@ async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Dep
             if not bool(destino.get("can_receive_inter_central", False)):
                 raise HTTPException(status_code=403, detail="Destino não autorizado para recebimento de outra central")
 
-    # 4. Verificar Saldo na Origem
-    pid_vals = _id_candidates(pid_out)
-    oid_vals = _id_candidates(oid_out)
+    return {
+        "origem_tipo": origem_tipo,
+        "origem_nome": origem_nome,
+        "oid_out": oid_out,
+        "destino_tipo": destino_tipo,
+        "destino": destino,
+        "did_out": did_out,
+        "destino_nome": destino_nome,
+    }
 
-    origem_query: Dict[str, Any] = {"produto_id": {"$in": pid_vals}}
-    if origem_tipo == "almoxarifado":
-        origem_query["$or"] = [
-            {"local_tipo": "almoxarifado", "local_id": {"$in": oid_vals}},
-            {"almoxarifado_id": {"$in": oid_vals}},
-            {"local_tipo": {"$exists": False}, "local_id": {"$in": oid_vals}},
-        ]
-    else:
-        origem_query["$or"] = [
-            {"local_tipo": "sub_almoxarifado", "local_id": {"$in": oid_vals}},
-            {"sub_almoxarifado_id": {"$in": oid_vals}},
-            {"local_tipo": {"$exists": False}, "local_id": {"$in": oid_vals}},
-        ]
+def _local_stock_query(pid_vals: List[Any], tipo: str, local_vals: List[Any]) -> Dict[str, Any]:
+    """Filtro do estoque de um produto em um local, com os formatos antigos de documento."""
+    id_field = {"setor": "setor_id", "sub_almoxarifado": "sub_almoxarifado_id"}.get(tipo, "almoxarifado_id")
+    return {
+        "produto_id": {"$in": pid_vals},
+        "$or": [
+            {"local_tipo": tipo, "local_id": {"$in": local_vals}},
+            {id_field: {"$in": local_vals}},
+            {"local_tipo": {"$exists": False}, "local_id": {"$in": local_vals}},
+        ],
+    }
 
-    estoque_origem = await db.db.estoques.find_one(origem_query)
+async def _destino_stock_fields(locais: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    """Campos `$set` do estoque de destino de uma distribuição (exceto `produto_id`)."""
+    destino_tipo = locais["destino_tipo"]
+    destino = locais["destino"]
+    did_out = locais["did_out"]
+    fields: Dict[str, Any] = {
+        'local_tipo': destino_tipo,
+        'local_id': did_out,
+        'nome_local': locais["destino_nome"],
+        'escopo': await _escopo_of(destino_tipo, did_out),
+        'updated_at': now
+    }
+    # Adicionar campos de relacionamento específicos
+    if destino_tipo == 'setor':
+        fields['setor_id'] = did_out
+        fields['almoxarifado_id'] = _norm_id(destino.get("almoxarifado_id"))
+        sub_ids = [str(x) for x in (destino.get("sub_almoxarifado_ids") or []) if x]
+        if not sub_ids:
+            single_sub = _norm_id(destino.get("sub_almoxarifado_id"))
+            sub_ids = [single_sub] if single_sub else []
+        fields['sub_almoxarifado_id'] = sub_ids[0] if sub_ids else None
+    elif destino_tipo == 'sub_almoxarifado':
+        fields['sub_almoxarifado_id'] = did_out
+        almox_id = _norm_id(destino.get("almoxarifado_id"))
+        if almox_id:
+            almox = await db.db.almoxarifados.find_one(_build_id_query(almox_id))
+            fields['almoxarifado_id'] = _public_id(almox) or almox_id if almox else almox_id
+    else:
+        fields['almoxarifado_id'] = did_out
+    return fields
 
-    if not estoque_origem:
-        raise HTTPException(status_code=400, detail="Não há estoque correspondente na origem")
+def _distribuicao_mov_doc(locais: Dict[str, Any], produto: Dict[str, Any], pid_out: Any, quantidade: float,
+                          observacoes: Optional[str], user: Dict[str, Any], escopo_origem: Dict[str, Any], now: datetime,
+                          alocacao: Optional[AllocationRequest] = None) -> Dict[str, Any]:
+    doc = {
+        'produto_id': pid_out,
+        'tipo': 'distribuicao' if locais["destino_tipo"] == 'setor' else 'transferencia',
+        'quantidade': quantidade,
+        'data_movimentacao': now,
+        'origem_nome': locais["origem_nome"],
+        'destino_nome': locais["destino_nome"],
+        'usuario_responsavel': user.get("id"),
+        'observacoes': observacoes,
+        'central_id': _norm_id(produto.get("central_id")) if produto else None,
+        'local_origem_id': locais["oid_out"],
+        'local_destino_id': locais["did_out"],
+        'local_origem_tipo': locais["origem_tipo"],
+        'local_destino_tipo': locais["destino_tipo"],
+        'escopo': escopo_origem,
+        'created_at': now
+    }
+    if alocacao is not None:
+        # Lotes baixados na origem (FEFO) e a parte que saiu de estoque sem lote
+        doc.update(alocacao.result())
+    return doc
 
-    qtd_raw = estoque_origem.get("quantidade")
-    try:
-        qtd_base = float(qtd_raw or 0)
-    except (TypeError, ValueError):
-        qtd_base = 0.0
+@app.post("/api/movimentacoes/distribuicao")
+async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Depends(get_current_user)):
+    if req.quantidade <= 0:
+        raise HTTPException(status_code=400, detail="Quantidade deve ser maior que zero")
 
-    atual_raw = estoque_origem.get("quantidade_atual")
-    if atual_raw is None:
-        atual_base = float(qtd_base)
-    else:
-        try:
-            atual_base = float(atual_raw or 0)
-        except (TypeError, ValueError):
-            atual_base = float(qtd_base)
+    # 1. Validar Origem, Destino e permissões
+    locais = await _resolve_distribuicao_locais(req.origem_tipo, req.origem_id, req.destino_tipo, req.destino_id, user)
+    origem_tipo, oid_out = locais["origem_tipo"], locais["oid_out"]
+    destino_tipo, did_out = locais["destino_tipo"], locais["did_out"]
 
-    disp_raw = estoque_origem.get("quantidade_disponivel")
-    if disp_raw is None:
-        disp_base = float(qtd_base)
-    else:
-        try:
-            disp_base = float(disp_raw or 0)
-        except (TypeError, ValueError):
-            disp_base = float(qtd_base)
+    # 2. Validar Produto e Resolver ID
+    prod_query = {"$or": [{"_id": req.produto_id}, {"id": req.produto_id}, {"codigo": req.produto_id}]}
+    if ObjectId.is_valid(req.produto_id):
+        prod_query["$or"].append({"_id": ObjectId(req.produto_id)})
+    elif req.produto_id.isdigit():
+        prod_query["$or"].append({"id": int(req.produto_id)})
+        
+    produto = await db.db.produtos.find_one(prod_query)
+    if not produto:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    pid_out = _persist_id(produto)
 
-    saldo_atual = float(disp_base)
-    if saldo_atual < req.quantidade:
-        raise HTTPException(status_code=400, detail=f"Saldo insuficiente na origem. Disponível: {saldo_atual}")
+    # 3. Localizar Estoque na Origem
+    pid_vals = _id_candidates(pid_out)
+    origem_query = _local_stock_query(pid_vals, origem_tipo, _id_candidates(oid_out))
 
     now = _now_utc()
+    escopo_origem = await _escopo_of(origem_tipo, oid_out)
 
-    # 5. Decrementar Origem
-    next_qtd = float(qtd_base) - float(req.quantidade)
-    next_atual = float(atual_base) - float(req.quantidade)
-    next_disp = float(disp_base) - float(req.quantidade)
-
-    await db.db.estoques.update_one(
-        {"_id": estoque_origem["_id"]},
-        {"$set": {"quantidade": next_qtd, "quantidade_atual": next_atual, "quantidade_disponivel": next_disp, "updated_at": now}},
-    )
+    # 4. Decrementar Origem (baixa condicionada ao saldo, sem leitura prévia)
+    try:
+        await take_async(db.db.estoques, [origem_query], req.quantidade, set_fields={"escopo": escopo_origem, "updated_at": now})
+    except StockNotFound:
+        raise HTTPException(status_code=400, detail="Não há estoque correspondente na origem")
+    except InsufficientStock as exc:
+        raise HTTPException(status_code=400, detail=f"Saldo insuficiente na origem. Disponível: {exc.disponivel}")
 
-    # 6. Incrementar Destino (Upsert)
+    # 5. Incrementar Destino (Upsert)
     estoque_dest_filter = {
         'produto_id': pid_out,
         'local_tipo': destino_tipo,
         'local_id': did_out
     }
-
-    did_vals = _id_candidates(did_out)
-    dest_query: Dict[str, Any] = {"produto_id": {"$in": pid_vals}}
-    if destino_tipo == "setor":
-        dest_query["$or"] = [
-            {"local_tipo": "setor", "local_id": {"$in": did_vals}},
-            {"setor_id": {"$in": did_vals}},
-            {"local_tipo": {"$exists": False}, "local_id": {"$in": did_vals}},
-        ]
-    elif destino_tipo == "sub_almoxarifado":
-        dest_query["$or"] = [
-            {"local_tipo": "sub_almoxarifado", "local_id": {"$in": did_vals}},
-            {"sub_almoxarifado_id": {"$in": did_vals}},
-            {"local_tipo": {"$exists": False}, "local_id": {"$in": did_vals}},
-        ]
-    else:
-        dest_query["$or"] = [
-            {"local_tipo": "almoxarifado", "local_id": {"$in": did_vals}},
-            {"almoxarifado_id": {"$in": did_vals}},
-            {"local_tipo": {"$exists": False}, "local_id": {"$in": did_vals}},
-        ]
-    existing_dest = await db.db.estoques.find_one(dest_query, {"_id": 1})
+    existing_dest = await db.db.estoques.find_one(_local_stock_query(pid_vals, destino_tipo, _id_candidates(did_out)), {"_id": 1})
     if existing_dest and existing_dest.get("_id") is not None:
         estoque_dest_filter = {"_id": existing_dest["_id"]}
     
@@ -3928,65 +4716,145 @@ async def post_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Dep
             'quantidade_atual': req.quantidade,
             'quantidade_disponivel': req.quantidade
         },
-        '$set': {
-            'produto_id': pid_out,
-            'local_tipo': destino_tipo,
-            'local_id': did_out,
-            'nome_local': destino_nome,
-            'updated_at': now
-        },
+        '$set': dict(await _destino_stock_fields(locais, now), produto_id=pid_out),
         '$setOnInsert': {
             'created_at': now
         }
     }
-    
-    # Adicionar campos de relacionamento específicos
-    if destino_tipo == 'setor':
-        estoque_dest_update['$set']['setor_id'] = did_out
-        estoque_dest_update['$set']['almoxarifado_id'] = _norm_id(destino.get("almoxarifado_id"))
-        sub_ids = [str(x) for x in (destino.get("sub_almoxarifado_ids") or []) if x]
-        if not sub_ids:
-            single_sub = _norm_id(destino.get("sub_almoxarifado_id"))
-            sub_ids = [single_sub] if single_sub else []
-        estoque_dest_update['$set']['sub_almoxarifado_id'] = sub_ids[0] if sub_ids else None
-    elif destino_tipo == 'sub_almoxarifado':
-        estoque_dest_update['$set']['sub_almoxarifado_id'] = did_out
-        almox_id = _norm_id(destino.get("almoxarifado_id"))
-        if almox_id:
-            almox = await db.db.almoxarifados.find_one(_build_id_query(almox_id))
-            estoque_dest_update['$set']['almoxarifado_id'] = _public_id(almox) or almox_id if almox else almox_id
-    else:
-        estoque_dest_update['$set']['almoxarifado_id'] = did_out
 
-    await db.db.estoques.find_one_and_update(
-        estoque_dest_filter,
-        estoque_dest_update,
-        upsert=True
+    # Os lotes da origem são baixados (FEFO) junto com o incremento do destino
+    alocacao = AllocationRequest(pid_vals, origem_tipo, _id_candidates(oid_out), req.quantidade)
+    estoque_dest, _ = await asyncio.gather(
+        db.db.estoques.find_one_and_update(
+            estoque_dest_filter,
+            estoque_dest_update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        ),
+        lot_allocator.allocate_many_async(db.db.lotes, [alocacao], now),
     )
+    await reorder_points.sync_async(db.db.estoques, estoque_dest)
 
-    # 7. Registrar Movimentação
-    mov_tipo = 'distribuicao' if destino_tipo == 'setor' else 'transferencia'
-    mov_doc = {
-        'produto_id': pid_out,
-        'tipo': mov_tipo,
-        'quantidade': req.quantidade,
-        'data_movimentacao': now,
-        'origem_nome': origem_nome,
-        'destino_nome': destino_nome,
-        'usuario_responsavel': user.get("id"),
-        'observacoes': req.observacoes,
-        'central_id': _norm_id(produto.get("central_id")) if produto else None,
-        'local_origem_id': oid_out,
-        'local_destino_id': did_out,
-        'local_origem_tipo': origem_tipo,
-        'local_destino_tipo': destino_tipo,
-        'created_at': now
-    }
-    
+    # 6. Registrar Movimentação
+    mov_doc = _distribuicao_mov_doc(locais, produto, pid_out, req.quantidade, req.observacoes, user, escopo_origem, now, alocacao)
     await db.db.movimentacoes.insert_one(mov_doc)
     
+    await _publish_stock_change([produto], [(origem_tipo, oid_out), (destino_tipo, did_out)])
     return {"status": "success", "message": "Distribuição realizada com sucesso"}
 
+DISTRIBUICAO_LOTE_MAX_ITEMS = int(os.getenv("DISTRIBUICAO_LOTE_MAX_ITEMS", "500"))
+
+@app.post("/api/movimentacoes/distribuicao/lote")
+async def post_distribuicao_lote(req: DistribuicaoLoteRequest, user: Dict[str, Any] = Depends(get_current_user)):
+    """Distribui vários produtos de uma origem para um destino em uma requisição.
+
+    Origem, destino e permissões são validados uma vez e os produtos resolvidos
+    em um único `$in`. Cada item baixa a origem com a baixa condicionada; os
+    itens baixados têm destino e movimentações gravados em `bulk_write`
+    ordenados, e os lotes da origem são baixados em FEFO num único
+    `bulk_write` (lot_allocation.py). Itens sem estoque ou com saldo
+    insuficiente não impedem os demais e voltam em `items`; uma falha
+    inesperada em qualquer baixa devolve à origem as baixas já feitas e é
+    propagada.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="Informe pelo menos um item")
+    if len(req.items) > DISTRIBUICAO_LOTE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {DISTRIBUICAO_LOTE_MAX_ITEMS} itens por lote")
+
+    locais = await _resolve_distribuicao_locais(req.origem_tipo, req.origem_id, req.destino_tipo, req.destino_id, user)
+    origem_tipo, oid_out = locais["origem_tipo"], locais["oid_out"]
+    destino_tipo, did_out = locais["destino_tipo"], locais["did_out"]
+
+    produtos = await _fetch_produtos_by_ref([str(it.produto_id).strip() for it in req.items])
+
+    now = _now_utc()
+    escopo_origem = await _escopo_of(origem_tipo, oid_out)
+    oid_vals = _id_candidates(oid_out)
+
+    results: List[Dict[str, Any]] = []
+    pending = []
+    for it in req.items:
+        out: Dict[str, Any] = {"produto_id": it.produto_id, "quantidade": it.quantidade}
+        results.append(out)
+        if it.quantidade <= 0:
+            out.update(status="erro", erro="Quantidade deve ser maior que zero")
+            continue
+        produto = produtos.get(str(it.produto_id).strip())
+        if not produto:
+            out.update(status="erro", erro="Produto não encontrado")
+            continue
+        pending.append((out, it, produto, _persist_id(produto)))
+
+    async def baixar(it, pid_out):
+        query = _local_stock_query(_id_candidates(pid_out), origem_tipo, oid_vals)
+        return await take_async(db.db.estoques, [query], it.quantidade, set_fields={"escopo": escopo_origem, "updated_at": now})
+
+    # Baixas na origem: uma operação atômica por item, em paralelo (até MONGO_FANOUT_LIMIT por vez)
+    baixas = await fanout.gather(*[functools.partial(baixar, it, pid_out) for _, it, _, pid_out in pending], return_exceptions=True)
+    failure = next((res for res in baixas if isinstance(res, BaseException)
+                    and not isinstance(res, (StockNotFound, InsufficientStock))), None)
+    if failure is not None:
+        # Falha inesperada: devolve à origem o que as demais baixas já tiraram e propaga o erro
+        taken = [(it, res) for (_, it, _, _), res in zip(pending, baixas) if isinstance(res, dict)]
+        if taken:
+            await db.db.estoques.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$inc": {f: it.quantidade for f in STOCK_FIELDS}}) for it, doc in taken
+            ], ordered=False)
+            await reorder_points.refresh_async(db.db.estoques, {"_id": {"$in": [doc["_id"] for _, doc in taken]}})
+        raise failure
+    moved = []
+    for (out, it, produto, pid_out), res in zip(pending, baixas):
+        if isinstance(res, StockNotFound):
+            out.update(status="erro", erro="Não há estoque correspondente na origem")
+        elif isinstance(res, InsufficientStock):
+            out.update(status="erro", erro=f"Saldo insuficiente na origem. Disponível: {res.disponivel}", disponivel=res.disponivel)
+        else:
+            out.update(status="ok", produto_id=pid_out)
+            moved.append((it, produto, pid_out))
+
+    if moved:
+        dest_fields = await _destino_stock_fields(locais, now)
+        all_pids = list(dict.fromkeys(v for _, _, pid_out in moved for v in _id_candidates(pid_out)))
+        dest_rows = await db.db.estoques.find(
+            _local_stock_query(all_pids, destino_tipo, _id_candidates(did_out)), {"_id": 1, "produto_id": 1}
+        ).to_list(length=None)
+        # Chave pelo valor gravado: casa como o `$in` (ex.: 7 e 7.0), não pela forma em texto
+        existing_dest: Dict[Any, Any] = {}
+        for row in dest_rows:
+            existing_dest.setdefault(row.get("produto_id"), row["_id"])
+
+        dest_ops = []
+        dest_filters = []
+        for it, produto, pid_out in moved:
+            row_id = next((existing_dest[v] for v in _id_candidates(pid_out) if v in existing_dest), None)
+            dest_filter = {"_id": row_id} if row_id is not None else {"produto_id": pid_out, "local_tipo": destino_tipo, "local_id": did_out}
+            dest_filters.append(dest_filter)
+            dest_ops.append(UpdateOne(dest_filter, {
+                "$inc": {"quantidade": it.quantidade, "quantidade_atual": it.quantidade, "quantidade_disponivel": it.quantidade},
+                "$set": dict(dest_fields, produto_id=pid_out),
+                "$setOnInsert": {"created_at": now},
+            }, upsert=True))
+
+        # Lotes da origem de todos os itens (FEFO) em um bulk_write, junto com o do destino
+        alocacoes = [AllocationRequest(_id_candidates(pid_out), origem_tipo, oid_vals, it.quantidade) for it, _, pid_out in moved]
+        await asyncio.gather(
+            db.db.estoques.bulk_write(dest_ops, ordered=True),
+            lot_allocator.allocate_many_async(db.db.lotes, alocacoes, now),
+        )
+        mov_ops = []
+        for (it, produto, pid_out), alocacao in zip(moved, alocacoes):
+            obs = it.observacoes if it.observacoes is not None else req.observacoes
+            mov_ops.append(InsertOne(_distribuicao_mov_doc(locais, produto, pid_out, it.quantidade, obs, user, escopo_origem, now, alocacao)))
+        await reorder_points.refresh_async(db.db.estoques, {"$or": dest_filters})
+        await db.db.movimentacoes.bulk_write(mov_ops, ordered=True)
+
+        await _publish_stock_change([p for _, p, _ in moved], [(origem_tipo, oid_out), (destino_tipo, did_out)])
+
+    ok = sum(1 for r in results if r.get("status") == "ok")
+    status_out = "success" if ok == len(results) else "parcial" if ok else "erro"
+    return {"status": status_out, "processados": ok, "erros": len(results) - ok, "items": results}
+
 @app.post("/api/movimentacoes/estorno_distribuicao")
 async def post_estorno_distribuicao(req: MovimentacaoRequest, user: Dict[str, Any] = Depends(get_current_user)):
     if req.quantidade <= 0:
@@ -4015,7 +4883,7 @@ async def post_estorno_distribuicao(req: MovimentacaoRequest, user: Dict[str, An
     produto = await db.db.produtos.find_one(prod_query)
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
-    pid_out = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+    pid_out = _persist_id(produto)
 
     setor = await db.db.setores.find_one(_build_id_query(req.origem_id))
     if not setor:
@@ -4081,16 +4949,18 @@ async def post_estorno_distribuicao(req: MovimentacaoRequest, user: Dict[str, An
         raise HTTPException(status_code=400, detail=f"Saldo insuficiente no setor. Disponível: {saldo_setor}")
 
     now = _now_utc()
+    escopo_origem = await _escopo_of("setor", setor_id)
 
     await db.db.estoques.update_one(
         {"_id": estoque_setor["_id"]},
-        {"$inc": {"quantidade": -req.quantidade, "quantidade_disponivel": -req.quantidade}, "$set": {"updated_at": now}},
+        {"$inc": {"quantidade": -req.quantidade, "quantidade_disponivel": -req.quantidade}, "$set": {"escopo": escopo_origem, "updated_at": now}},
     )
+    await reorder_points.refresh_async(db.db.estoques, {"_id": estoque_setor["_id"]})
 
     estoque_dest_filter = {"produto_id": pid_out, "local_tipo": destino_tipo, "local_id": did_out}
     estoque_dest_update: Dict[str, Any] = {
         "$inc": {"quantidade": req.quantidade, "quantidade_disponivel": req.quantidade},
-        "$set": {"produto_id": pid_out, "local_tipo": destino_tipo, "local_id": did_out, "nome_local": destino_nome, "updated_at": now},
+        "$set": {"produto_id": pid_out, "local_tipo": destino_tipo, "local_id": did_out, "nome_local": destino_nome, "escopo": await _escopo_of(destino_tipo, did_out), "updated_at": now},
         "$setOnInsert": {"created_at": now},
     }
     if destino_tipo == "almoxarifado":
@@ -4103,7 +4973,12 @@ async def post_estorno_distribuicao(req: MovimentacaoRequest, user: Dict[str, An
         estoque_dest_update["$set"]["almoxarifado_id"] = _public_id(dest_almox) or almox_id if dest_almox else almox_id
         estoque_dest_update["$set"]["setor_id"] = None
 
-    await db.db.estoques.find_one_and_update(estoque_dest_filter, estoque_dest_update, upsert=True)
+    estoque_dest = await db.db.estoques.find_one_and_update(estoque_dest_filter, estoque_dest_update, upsert=True, return_document=ReturnDocument.AFTER)
+    await reorder_points.sync_async(db.db.estoques, estoque_dest)
+
+    # A quantidade volta aos lotes baixados pelas distribuições destino → setor
+    devolucao = ReturnRequest(_id_candidates(pid_out), destino_tipo, _id_candidates(did_out), req.quantidade, "setor", sid_values)
+    await lot_allocator.give_back_async(db.db.lotes, db.db.movimentacoes, devolucao, now)
 
     mov_doc = {
         "produto_id": pid_out,
@@ -4119,9 +4994,12 @@ async def post_estorno_distribuicao(req: MovimentacaoRequest, user: Dict[str, An
         "local_origem_tipo": "setor",
         "local_destino_id": did_out,
         "local_destino_tipo": destino_tipo,
+        "escopo": escopo_origem,
         "created_at": now,
+        **devolucao.result(),
     }
     await db.db.movimentacoes.insert_one(mov_doc)
+    await _publish_stock_change([produto], [("setor", setor_id), (destino_tipo, did_out)])
     return {"status": "success", "message": "Estorno realizado com sucesso"}
 
 @app.post("/api/movimentacoes/consumo")
@@ -4144,27 +5022,28 @@ async def post_consumo_setor(req: SetorConsumoRequest, user: Dict[str, Any] = De
     produto = await db.db.produtos.find_one(prod_query)
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
-    pid_out = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+    pid_out = _persist_id(produto)
 
     sid_values: List[Any] = [setor_id]
     if str(setor_id).isdigit():
         sid_values.append(int(str(setor_id)))
-    estoque = await db.db.estoques.find_one({
+    estoque_query = {
         "produto_id": pid_out,
         "$or": [
             {"setor_id": {"$in": sid_values}},
             {"local_tipo": "setor", "local_id": {"$in": sid_values}},
         ],
-    })
-    saldo_atual = float(estoque.get("quantidade_disponivel", 0)) if estoque else 0.0
-    if saldo_atual < req.quantidade:
-        raise HTTPException(status_code=400, detail=f"Saldo insuficiente no setor. Disponível: {saldo_atual}")
-
+    }
     now = _now_utc()
-    await db.db.estoques.update_one(
-        {"_id": estoque["_id"]},
-        {"$inc": {"quantidade": -req.quantidade, "quantidade_disponivel": -req.quantidade}, "$set": {"updated_at": now}},
-    )
+    escopo = await _escopo_of("setor", setor_id)
+    try:
+        await take_async(
+            db.db.estoques, [estoque_query], req.quantidade,
+            fields=("quantidade", "quantidade_disponivel"), set_fields={"escopo": escopo, "updated_at": now},
+        )
+    except (StockNotFound, InsufficientStock) as exc:
+        saldo_atual = getattr(exc, "disponivel", 0.0)
+        raise HTTPException(status_code=400, detail=f"Saldo insuficiente no setor. Disponível: {saldo_atual}")
     mov_doc = {
         "produto_id": pid_out,
         "tipo": "saida",
@@ -4179,9 +5058,11 @@ async def post_consumo_setor(req: SetorConsumoRequest, user: Dict[str, Any] = De
         "local_origem_tipo": "setor",
         "local_destino_id": None,
         "local_destino_tipo": "consumo",
+        "escopo": escopo,
         "created_at": now,
     }
     await db.db.movimentacoes.insert_one(mov_doc)
+    await _publish_stock_change([produto], [("setor", setor_id)])
     return {"status": "success", "message": "Consumo registrado com sucesso"}
 
 @app.post("/api/movimentacoes/saida_justificada")
@@ -4222,7 +5103,7 @@ async def post_saida_justificada(
     produto = await db.db.produtos.find_one(prod_query)
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
-    pid_out = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+    pid_out = _persist_id(produto)
 
     origem_nome = "Origem"
     origem_doc = await db.db[("almoxarifados" if origem_tipo == "almoxarifado" else "sub_almoxarifados")].find_one(_build_id_query(origem_id))
@@ -4234,25 +5115,21 @@ async def post_saida_justificada(
     pid_vals = await _produto_id_candidates(pid_out)
     lid_vals = _id_candidates(origem_id_out)
 
-    estoque = await db.db.estoques.find_one({"produto_id": {"$in": pid_vals}, "local_tipo": origem_tipo, "local_id": {"$in": lid_vals}})
-    if not estoque and origem_tipo == "almoxarifado":
-        estoque = await db.db.estoques.find_one({"produto_id": {"$in": pid_vals}, "almoxarifado_id": {"$in": lid_vals}})
-    if not estoque and origem_tipo == "sub_almoxarifado":
-        estoque = await db.db.estoques.find_one({"produto_id": {"$in": pid_vals}, "sub_almoxarifado_id": {"$in": lid_vals}})
-    if not estoque:
-        raise HTTPException(status_code=400, detail="Não há estoque correspondente na origem")
-
-    saldo_atual = float(estoque.get("quantidade_disponivel", 0) or 0)
-    if saldo_atual < req.quantidade:
-        raise HTTPException(status_code=400, detail=f"Saldo insuficiente na origem. Disponível: {saldo_atual}")
+    estoque_queries = [
+        {"produto_id": {"$in": pid_vals}, "local_tipo": origem_tipo, "local_id": {"$in": lid_vals}},
+        {"produto_id": {"$in": pid_vals}, ("almoxarifado_id" if origem_tipo == "almoxarifado" else "sub_almoxarifado_id"): {"$in": lid_vals}},
+    ]
 
     now = _now_utc()
     data_mov = req.data_movimentacao or now
+    escopo = await _escopo_of(origem_tipo, origem_id_out)
 
-    await db.db.estoques.update_one(
-        {"_id": estoque.get("_id")},
-        {"$inc": {"quantidade": -req.quantidade, "quantidade_atual": -req.quantidade, "quantidade_disponivel": -req.quantidade}, "$set": {"updated_at": now}},
-    )
+    try:
+        await take_async(db.db.estoques, estoque_queries, req.quantidade, set_fields={"escopo": escopo, "updated_at": now})
+    except StockNotFound:
+        raise HTTPException(status_code=400, detail="Não há estoque correspondente na origem")
+    except InsufficientStock as exc:
+        raise HTTPException(status_code=400, detail=f"Saldo insuficiente na origem. Disponível: {exc.disponivel}")
 
     mov_doc = {
         "produto_id": pid_out,
@@ -4269,9 +5146,11 @@ async def post_saida_justificada(
         "local_origem_tipo": origem_tipo,
         "local_destino_id": None,
         "local_destino_tipo": "externo",
+        "escopo": escopo,
         "created_at": now,
     }
     await db.db.movimentacoes.insert_one(mov_doc)
+    await _publish_stock_change([produto], [(origem_tipo, origem_id_out)])
     return {"status": "success", "message": "Saída justificada registrada com sucesso"}
 
 @app.get("/api/demandas")
@@ -4280,10 +5159,12 @@ async def get_demandas(
     per_page: int = Query(20, ge=1, le=100),
     status: Optional[str] = None,
     mine: Optional[bool] = False,
+    count: Optional[str] = None,
     user: Dict[str, Any] = Depends(get_current_user),
 ):
     role = user.get("role")
     scope_id = user.get("scope_id")
+    count_mode = _count_mode(count)
     query: Dict[str, Any] = {}
     if status:
         query["status"] = (status or "").strip().lower()
@@ -4303,11 +5184,13 @@ async def get_demandas(
         elif role == "resp_sub_almox" and scope_id:
             query["sub_almoxarifado_id"] = scope_id
 
-    total = await db.db.demandas.count_documents(query)
-    pages = max(1, (total + per_page - 1) // per_page)
-    page = max(1, min(page, pages))
+    total = await _count_total("demandas", query, count_mode, "demandas")
+    if count_mode == count_estimates.EXACT:
+        page = max(1, min(page, count_estimates.total_pages(total, per_page)))
     skip = max(0, (page - 1) * per_page)
-    docs = await db.db.demandas.find(query).sort([("updated_at", -1), ("created_at", -1)]).skip(skip).limit(per_page).to_list(length=per_page)
+    docs = await db.db.demandas.find(query).sort([("updated_at", -1), ("created_at", -1)]).skip(skip).limit(per_page + 1).to_list(length=per_page + 1)
+    has_more = len(docs) > per_page
+    docs = docs[:per_page]
 
     prod_ids: List[str] = []
     setor_ids: List[str] = []
@@ -4371,7 +5254,7 @@ async def get_demandas(
             "updated_at": _dt_to_utc_iso(updated_at),
         })
 
-    return {"items": items_out, "pagination": {"total": total, "page": page, "pages": pages, "per_page": per_page}}
+    return {"items": items_out, "pagination": _page_info(page, per_page, count_mode, total, has_more)}
 
 @app.post("/api/demandas")
 async def create_demanda(req: DemandaCreateRequest, user: Dict[str, Any] = Depends(_require_roles(["operador_setor"]))):
@@ -4399,7 +5282,7 @@ async def create_demanda(req: DemandaCreateRequest, user: Dict[str, Any] = Depen
         produto = await db.db.produtos.find_one(prod_query, {"id": 1, "_id": 1})
         if not produto:
             raise HTTPException(status_code=404, detail="Produto não encontrado")
-        pid_out = produto.get("id") if produto.get("id") is not None else str(produto.get("_id"))
+        pid_out = _persist_id(produto)
         items_out.append({"produto_id": str(pid_out), "quantidade": float(it.quantidade), "atendido": 0.0, "observacao": it.observacao})
 
     now = _now_utc()
@@ -4546,21 +5429,23 @@ async def atender_demanda(demanda_id: str, req: DemandaAtenderRequest, user: Dic
     origem_nome = origem_doc.get("nome") or "Origem"
 
     now = _now_utc()
+    escopo_origem = await _escopo_of(origem_tipo, origem_id_out)
+    escopo_setor = await _escopo_of("setor", setor_id)
 
     async def move_item(pid_out: str, quantidade: float, obs: Optional[str]):
-        estoque_origem = await db.db.estoques.find_one({"produto_id": pid_out, "local_tipo": origem_tipo, "local_id": origem_id_out})
-        saldo_atual = float(estoque_origem.get("quantidade_disponivel", 0)) if estoque_origem else 0.0
-        if saldo_atual < quantidade:
+        try:
+            await take_async(
+                db.db.estoques, [{"produto_id": pid_out, "local_tipo": origem_tipo, "local_id": origem_id_out}], quantidade,
+                fields=("quantidade", "quantidade_disponivel"), set_fields={"escopo": escopo_origem, "updated_at": now},
+            )
+        except (StockNotFound, InsufficientStock) as exc:
+            saldo_atual = getattr(exc, "disponivel", 0.0)
             raise HTTPException(status_code=400, detail=f"Saldo insuficiente na origem para produto {pid_out}. Disponível: {saldo_atual}")
-        await db.db.estoques.update_one(
-            {"_id": estoque_origem["_id"]},
-            {"$inc": {"quantidade": -quantidade, "quantidade_disponivel": -quantidade}, "$set": {"updated_at": now}},
-        )
 
         estoque_dest_filter = {"produto_id": pid_out, "local_tipo": "setor", "local_id": setor_id}
         estoque_dest_update: Dict[str, Any] = {
             "$inc": {"quantidade": quantidade, "quantidade_disponivel": quantidade},
-            "$set": {"produto_id": pid_out, "local_tipo": "setor", "local_id": setor_id, "nome_local": setor_doc.get("nome") or "Setor", "updated_at": now},
+            "$set": {"produto_id": pid_out, "local_tipo": "setor", "local_id": setor_id, "nome_local": setor_doc.get("nome") or "Setor", "escopo": escopo_setor, "updated_at": now},
             "$setOnInsert": {"created_at": now},
         }
         chain2 = await _resolve_parent_chain_from_setor(setor_doc)
@@ -4568,7 +5453,8 @@ async def atender_demanda(demanda_id: str, req: DemandaAtenderRequest, user: Dic
         estoque_dest_update["$set"]["almoxarifado_id"] = chain2.get("almoxarifado_id")
         estoque_dest_update["$set"]["sub_almoxarifado_id"] = chain2.get("sub_almoxarifado_id")
 
-        await db.db.estoques.find_one_and_update(estoque_dest_filter, estoque_dest_update, upsert=True)
+        estoque_dest = await db.db.estoques.find_one_and_update(estoque_dest_filter, estoque_dest_update, upsert=True, return_document=ReturnDocument.AFTER)
+        await reorder_points.sync_async(db.db.estoques, estoque_dest)
 
         mov_doc = {
             "produto_id": pid_out,
@@ -4584,6 +5470,7 @@ async def atender_demanda(demanda_id: str, req: DemandaAtenderRequest, user: Dic
             "local_destino_id": setor_id,
             "local_origem_tipo": origem_tipo,
             "local_destino_tipo": "setor",
+            "escopo": escopo_origem,
             "created_at": now,
         }
         await db.db.movimentacoes.insert_one(mov_doc)
@@ -4624,9 +5511,11 @@ async def atender_demanda(demanda_id: str, req: DemandaAtenderRequest, user: Dic
         q,
         {"$set": {"items": items, "status": status_out, "updated_at": now}, "$push": {"atendimento": atendimento_entry}},
     )
+    await _publish_stock_change([it["produto_id"] for it in atendimento_items], [(origem_tipo, origem_id_out), ("setor", setor_id)])
     return {"status": "success", "demanda_status": status_out}
 
 @app.get("/api/dashboard/charts/consumo")
+@route_cache.cached("chart_consumo", ttl=60, stale_ttl=300, tags=_route_cache_tags)
 async def get_chart_consumo(user: Dict[str, Any] = Depends(get_current_user)):
     role = (user.get("role") or "").strip()
     if role not in ("super_admin", "admin_central"):
@@ -4684,6 +5573,7 @@ async def get_chart_consumo(user: Dict[str, Any] = Depends(get_current_user)):
     return [{"name": d.get("_id"), "value": d.get("total")} for d in data if d]
 
 @app.get("/api/dashboard/charts/movimentacoes")
+@route_cache.cached("chart_movimentacoes", ttl=60, stale_ttl=300, tags=_route_cache_tags)
 async def get_chart_movimentacoes():
     # Agrupar por data (últimos 7 dias)
     # Nota: Em produção, usar range de datas adequado
@@ -4716,6 +5606,7 @@ async def get_chart_movimentacoes():
     return sorted(list(processed.values()), key=lambda x: x["date"])[-7:]
 
 @app.get("/api/relatorios/consumo_setores")
+@route_cache.cached("relatorio_consumo_setores", ttl=120, stale_ttl=600, tags=_route_cache_tags)
 async def get_relatorio_consumo_setores(user: Dict[str, Any] = Depends(get_current_user)):
     role = (user.get("role") or "").strip()
     if role not in ("super_admin", "admin_central"):
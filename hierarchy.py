@@ -0,0 +1,355 @@
+"""Grafo em memória da hierarquia central → almoxarifado → sub-almoxarifado → setor.
+
+Usado pelos apps Flask e FastAPI para resolver cadeias de ancestrais sem
+consultar o MongoDB a cada salto. O grafo é carregado uma vez (uma consulta por
+coleção) e indexado por todas as formas de id (`_id`, `id` numérico ou string).
+
+Versionamento: toda escrita em endpoints de hierarquia chama `invalidate`
+(Flask) ou `invalidate_async` (FastAPI), que marca o grafo local como sujo e
+incrementa um contador persistido em `sistema_meta`. Outros processos comparam
+esse contador no máximo a cada `check_interval` segundos e recarregam quando ele
+muda. Falhas de carga nunca propagam: o chamador recebe `None`/`False` e deve
+cair no caminho antigo (consulta direta).
+
+Escopo denormalizado: `estoques` e `movimentacoes` recebem o subdocumento
+`escopo` com os ids canônicos (`str(_id)`) de central, almoxarifado, sub e setor
+do local. Os campos de topo (`central_id`, `almoxarifado_id`...) continuam
+identificando o local da linha e não são reaproveitados. Enquanto o backfill
+(`scripts/backfill_escopo.py`) não marcar `escopo_pronto` em `sistema_meta`,
+`scope_filter` devolve `None` e as rotas mantêm os filtros antigos. Quando um
+almoxarifado, sub ou setor muda de pai pelos endpoints de atualização, `restamp`
+regrava os ancestrais em `escopo` das linhas (e lotes) daquele local.
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+HIERARCHY_COLLECTIONS = ('centrais', 'almoxarifados', 'sub_almoxarifados', 'setores')
+META_COLLECTION = 'sistema_meta'
+META_KEY = 'hierarquia'
+SCOPE_FIELD = 'escopo'
+SCOPE_KEYS = ('central_id', 'almoxarifado_id', 'sub_almoxarifado_id', 'setor_id')
+# Coleções com `escopo` denormalizado (regravado quando um local muda de pai)
+SCOPED_COLLECTIONS = ('estoques', 'movimentacoes', 'lotes')
+# Campos do payload que mudam o pai de um local
+PARENT_FIELDS = ('central_id', 'almoxarifado_id', 'sub_almoxarifado_id', 'almoxarifado_ids', 'sub_almoxarifado_ids', 'parent_id')
+_TIPO_SCOPE_KEY = dict(zip(('central', 'almoxarifado', 'sub_almoxarifado', 'setor'), SCOPE_KEYS))
+
+# Nível do escopo do usuário por papel: (tipo do local, chave em `escopo`)
+_ROLE_SCOPE = {
+    'admin_central': ('central', 'central_id'),
+    'gerente_almox': ('almoxarifado', 'almoxarifado_id'),
+    'resp_sub_almox': ('sub_almoxarifado', 'sub_almoxarifado_id'),
+    'operador_setor': ('setor', 'setor_id'),
+}
+
+_PROJECTION = {
+    '_id': 1, 'id': 1, 'nome': 1, 'ativo': 1,
+    'central_id': 1, 'almoxarifado_id': 1, 'sub_almoxarifado_id': 1,
+    'almoxarifado_ids': 1, 'sub_almoxarifado_ids': 1,
+}
+
+
+def _keys_of(doc: Dict[str, Any]) -> List[str]:
+    keys = []
+    for field in ('_id', 'id'):
+        v = doc.get(field)
+        if v is not None:
+            keys.append(str(v))
+    return keys
+
+
+_TIPO_ALIASES = {
+    'subalmoxarifado': 'sub_almoxarifado',
+    'sub_almoxarifados': 'sub_almoxarifado',
+    'almoxarifados': 'almoxarifado',
+    'setores': 'setor',
+    'centrais': 'central',
+}
+
+
+def _norm_tipo(tipo: Any) -> str:
+    t = str(tipo or '').strip().lower().replace('-', '_')
+    return _TIPO_ALIASES.get(t, t)
+
+
+def _first(values) -> Any:
+    try:
+        if isinstance(values, list) and values:
+            return values[0]
+    except Exception:
+        pass
+    return None
+
+
+class HierarchyGraph:
+    def __init__(self, check_interval: float = 5.0, max_age: float = 300.0):
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.version = 0
+        self._lock = threading.Lock()
+        self._nodes: Dict[str, Dict[str, Dict[str, Any]]] = {c: {} for c in HIERARCHY_COLLECTIONS}
+        self._source = None
+        self._remote_version: Any = None
+        self._meta: Dict[str, Any] = {}
+        self._dirty = True
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    # --- Carga -------------------------------------------------------------
+
+    def _needs_reload(self, db, now: float) -> bool:
+        return (
+            self._dirty
+            or self._source is not db
+            or (now - self._loaded_at) > self.max_age
+        )
+
+    def _swap(self, db, docs_by_coll: Dict[str, List[Dict[str, Any]]], meta: Optional[Dict[str, Any]]) -> None:
+        nodes: Dict[str, Dict[str, Dict[str, Any]]] = {c: {} for c in HIERARCHY_COLLECTIONS}
+        for coll_name, docs in docs_by_coll.items():
+            index = nodes[coll_name]
+            for doc in docs or []:
+                for k in _keys_of(doc):
+                    index.setdefault(k, doc)
+        now = time.time()
+        with self._lock:
+            self._nodes = nodes
+            self._source = db
+            self._meta = dict(meta or {})
+            self._remote_version = self._remote_version_of(meta)
+            self._dirty = False
+            self._loaded_at = now
+            self._checked_at = now
+            self.version += 1
+
+    @staticmethod
+    def _remote_version_of(meta: Optional[Dict[str, Any]]) -> Any:
+        return (meta or {}).get('versao', 0)
+
+    def ensure_loaded(self, db) -> bool:
+        """Garante um grafo atualizado a partir de um banco pymongo/mongomock."""
+        if db is None:
+            return False
+        now = time.time()
+        try:
+            if not self._needs_reload(db, now):
+                if (now - self._checked_at) < self.check_interval:
+                    return True
+                remote = self._remote_version_of(db[META_COLLECTION].find_one({'_id': META_KEY}))
+                self._checked_at = now
+                if remote == self._remote_version:
+                    return True
+            meta = db[META_COLLECTION].find_one({'_id': META_KEY})
+            docs = {c: list(db[c].find({}, _PROJECTION)) for c in HIERARCHY_COLLECTIONS}
+            self._swap(db, docs, meta)
+            return True
+        except Exception:
+            return False
+
+    async def ensure_loaded_async(self, db) -> bool:
+        """Mesmo que `ensure_loaded`, para Motor ou o wrapper assíncrono do mongomock."""
+        if db is None:
+            return False
+        now = time.time()
+        try:
+            if not self._needs_reload(db, now):
+                if (now - self._checked_at) < self.check_interval:
+                    return True
+                remote = self._remote_version_of(await db[META_COLLECTION].find_one({'_id': META_KEY}))
+                self._checked_at = now
+                if remote == self._remote_version:
+                    return True
+            meta = await db[META_COLLECTION].find_one({'_id': META_KEY})
+            docs = {}
+            for c in HIERARCHY_COLLECTIONS:
+                docs[c] = await db[c].find({}, _PROJECTION).to_list(length=None)
+            self._swap(db, docs, meta)
+            return True
+        except Exception:
+            return False
+
+    # --- Invalidação -------------------------------------------------------
+
+    def mark_dirty(self) -> None:
+        with self._lock:
+            self._dirty = True
+
+    def invalidate(self, db=None) -> None:
+        """Marca o grafo como sujo e publica nova versão para os demais processos."""
+        self.mark_dirty()
+        if db is None:
+            return
+        try:
+            db[META_COLLECTION].update_one({'_id': META_KEY}, {'$inc': {'versao': 1}}, upsert=True)
+        except Exception:
+            pass
+
+    async def invalidate_async(self, db=None) -> None:
+        self.mark_dirty()
+        if db is None:
+            return
+        try:
+            await db[META_COLLECTION].update_one({'_id': META_KEY}, {'$inc': {'versao': 1}}, upsert=True)
+        except Exception:
+            pass
+
+    # --- Re-vínculo de locais ----------------------------------------------
+
+    def restamp_update(self, tipo: str, raw_id: Any) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """(filtro, update) que regrava em `escopo` os ancestrais das linhas de um local que mudou de pai.
+
+        Só os níveis acima do local mudam; os de baixo (ex.: setores de um sub) continuam
+        válidos. O grafo já precisa refletir o novo pai. `None` se o local não resolve.
+        """
+        key = _TIPO_SCOPE_KEY.get(_norm_tipo(tipo))
+        if key is None or key == SCOPE_KEYS[0]:
+            return None
+        scope = self.scope_of(tipo, raw_id)
+        if not scope.get(key):
+            return None
+        upper = SCOPE_KEYS[:SCOPE_KEYS.index(key)]
+        return {f'{SCOPE_FIELD}.{key}': scope[key]}, {'$set': {f'{SCOPE_FIELD}.{k}': scope.get(k) for k in upper}}
+
+    def restamp(self, db, tipo: str, raw_id: Any) -> int:
+        """Recarrega o grafo e regrava o `escopo` de estoques, movimentações e lotes do local."""
+        if db is None or not self.ensure_loaded(db):
+            return 0
+        op = self.restamp_update(tipo, raw_id)
+        if op is None:
+            return 0
+        return sum(db[c].update_many(*op).modified_count for c in SCOPED_COLLECTIONS)
+
+    async def restamp_async(self, db, tipo: str, raw_id: Any) -> int:
+        if db is None or not await self.ensure_loaded_async(db):
+            return 0
+        op = self.restamp_update(tipo, raw_id)
+        if op is None:
+            return 0
+        total = 0
+        for c in SCOPED_COLLECTIONS:
+            total += (await db[c].update_many(*op)).modified_count
+        return total
+
+    # --- Consultas (O(1), sem I/O) ----------------------------------------
+
+    def node(self, coll_name: str, raw_id: Any) -> Optional[Dict[str, Any]]:
+        if raw_id is None:
+            return None
+        return self._nodes.get(coll_name, {}).get(str(raw_id))
+
+    def almox_of_setor(self, setor: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Almoxarifado de um setor, com os mesmos fallbacks do Flask (sub, vínculo direto, listas)."""
+        if not setor:
+            return None
+        sub = self.node('sub_almoxarifados', setor.get('sub_almoxarifado_id'))
+        almox = self.node('almoxarifados', (sub or {}).get('almoxarifado_id')) if sub else None
+        if not almox:
+            almox = self.node('almoxarifados', setor.get('almoxarifado_id'))
+        if not almox:
+            almox = self.node('almoxarifados', _first(setor.get('almoxarifado_ids')))
+        if not almox:
+            sub_multi = self.node('sub_almoxarifados', _first(setor.get('sub_almoxarifado_ids')))
+            if sub_multi:
+                almox = self.node('almoxarifados', sub_multi.get('almoxarifado_id'))
+        return almox
+
+    def central_of(self, tipo: str, raw_id: Any) -> Optional[Dict[str, Any]]:
+        """Documento da central que contém o local (`central`, `almoxarifado`, `sub_almoxarifado`, `setor`)."""
+        tipo = _norm_tipo(tipo)
+        almox = None
+        if tipo == 'central':
+            return self.node('centrais', raw_id)
+        if tipo == 'almoxarifado':
+            almox = self.node('almoxarifados', raw_id)
+        elif tipo == 'sub_almoxarifado':
+            sub = self.node('sub_almoxarifados', raw_id)
+            almox = self.node('almoxarifados', (sub or {}).get('almoxarifado_id')) if sub else None
+        elif tipo == 'setor':
+            almox = self.almox_of_setor(self.node('setores', raw_id))
+        if not almox:
+            return None
+        return self.node('centrais', almox.get('central_id'))
+
+    def scope_of(self, tipo: str, raw_id: Any) -> Dict[str, Optional[str]]:
+        """Ids canônicos (`str(_id)`) do local e de seus ancestrais, no formato de `escopo`."""
+        tipo = _norm_tipo(tipo)
+        setor = sub = almox = central = None
+        if tipo == 'setor':
+            setor = self.node('setores', raw_id)
+            if setor:
+                sub = self.node('sub_almoxarifados', setor.get('sub_almoxarifado_id') or _first(setor.get('sub_almoxarifado_ids')))
+                almox = self.almox_of_setor(setor)
+        elif tipo == 'sub_almoxarifado':
+            sub = self.node('sub_almoxarifados', raw_id)
+            almox = self.node('almoxarifados', (sub or {}).get('almoxarifado_id')) if sub else None
+        elif tipo == 'almoxarifado':
+            almox = self.node('almoxarifados', raw_id)
+        elif tipo == 'central':
+            central = self.node('centrais', raw_id)
+        if almox and not central:
+            central = self.node('centrais', almox.get('central_id'))
+        out: Dict[str, Optional[str]] = {}
+        for key, doc in zip(SCOPE_KEYS, (central, almox, sub, setor)):
+            out[key] = str(doc.get('_id')) if doc else None
+        return out
+
+    @property
+    def scope_ready(self) -> bool:
+        """Verdadeiro quando o backfill de `escopo` já cobriu estoques e movimentações."""
+        return bool(self._meta.get('escopo_pronto'))
+
+    def meta_flag(self, name: str) -> bool:
+        """Marca de conclusão gravada em `sistema_meta` por outras migrações (ex.: lot_expiry.READY_KEY)."""
+        return bool(self._meta.get(name))
+
+    def scope_filter(self, role: str, scope_id: Any, key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Filtro de igualdade única em `escopo.<key>` para o escopo do usuário.
+
+        `key` permite subir de nível (ex.: `central_id` para listar a central inteira).
+        Retorna `None` quando o backfill não foi concluído ou o escopo não resolve;
+        nesse caso o chamador usa o filtro antigo.
+        """
+        if not self.scope_ready:
+            return None
+        resolved = self.scope_value(role, scope_id, key)
+        if resolved is None:
+            return None
+        return {f'{SCOPE_FIELD}.{resolved[0]}': resolved[1]}
+
+    def scope_value(self, role: str, scope_id: Any, key: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """(chave em `escopo`, id canônico) do escopo do usuário; `None` se o papel não tem escopo ou não resolve."""
+        level = _ROLE_SCOPE.get(role)
+        if not level or scope_id is None:
+            return None
+        tipo, own_key = level
+        value = self.scope_of(tipo, scope_id).get(key or own_key)
+        if not value:
+            return None
+        return key or own_key, value
+
+
+def local_of_estoque(doc: Dict[str, Any]):
+    """(tipo, id) do local de uma linha de estoque, aceitando os formatos Flask e FastAPI."""
+    lt = _norm_tipo(doc.get('local_tipo'))
+    if lt in ('setor', 'sub_almoxarifado', 'almoxarifado', 'central') and doc.get('local_id') is not None:
+        return lt, doc.get('local_id')
+    for field, tipo in (('setor_id', 'setor'), ('sub_almoxarifado_id', 'sub_almoxarifado'),
+                        ('almoxarifado_id', 'almoxarifado'), ('central_id', 'central')):
+        if doc.get(field) is not None:
+            return tipo, doc.get(field)
+    return None, None
+
+
+def local_of_movimentacao(doc: Dict[str, Any]):
+    """(tipo, id) do local "dono" de uma movimentação: a origem interna ou, na falta dela, o destino."""
+    for tipo_f, id_f in (('local_origem_tipo', 'local_origem_id'), ('origem_tipo', 'origem_id'),
+                         ('local_destino_tipo', 'local_destino_id'), ('destino_tipo', 'destino_id'),
+                         ('local_tipo', 'local_id')):
+        tipo = _norm_tipo(doc.get(tipo_f))
+        if tipo in ('setor', 'sub_almoxarifado', 'almoxarifado', 'central') and doc.get(id_f) is not None:
+            return tipo, doc.get(id_f)
+    return None, None
+
+
+hierarchy_graph = HierarchyGraph()
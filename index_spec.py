@@ -0,0 +1,228 @@
+"""Especificação declarativa dos índices do MongoDB, usada pelos dois apps.
+
+Antes só o Flask criava índices (`extensions.ensure_collections_and_indexes`,
+uma sequência de `create_index`); o app FastAPI, que é o servido no deploy,
+não criava nenhum e os filtros mais usados dele viravam varreduras completas.
+Agora a lista de índices fica em `INDEXES` e é aplicada:
+
+- pelo Flask, em `ensure_collections_and_indexes` (`apply`, síncrono);
+- pelo FastAPI, no startup, em uma tarefa em segundo plano (`apply_async`),
+  para não atrasar a subida do app.
+
+As duas funções devolvem um relatório por coleção com os índices criados, os
+que falharam e os que existem no banco mas não estão na especificação
+(`extras`), e registram no log o que faltava.
+
+`SlowQueryListener` é um `CommandListener` do pymongo/Motor: registra comandos
+de leitura mais lentos que `SLOW_QUERY_MS` e indica quando nenhum índice da
+especificação começa por um dos campos filtrados (candidato a índice novo).
+"""
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, monitoring
+
+import metrics
+
+SLOW_QUERY_MS = float(os.getenv('MONGO_SLOW_QUERY_MS', '200'))
+
+_ESCOPO = (('central_id', 'central'), ('almoxarifado_id', 'almox'), ('sub_almoxarifado_id', 'sub'), ('setor_id', 'setor'))
+_BAIXO = {'abaixo_minimo': True}
+
+# (campos, nome, opções) por coleção
+IndexSpec = Tuple[List[Tuple[str, int]], str, Dict[str, Any]]
+
+INDEXES: Dict[str, List[IndexSpec]] = {
+    'usuarios': [
+        ([('username', ASCENDING)], 'idx_unique_username', {'unique': True}),
+    ],
+    'produtos': [
+        ([('codigo', ASCENDING)], 'idx_prod_codigo', {}),
+        ([('nome', ASCENDING)], 'idx_prod_nome', {}),
+    ],
+    'movimentacoes': [
+        ([('data_movimentacao', ASCENDING)], 'idx_mov_data_movimentacao', {}),
+        # Ordem das listagens paginadas por cursor (pagination.py)
+        ([('data_movimentacao', DESCENDING), ('_id', DESCENDING)], 'idx_mov_data_id', {}),
+        ([('tipo', ASCENDING)], 'idx_mov_tipo', {}),
+        ([('produto_id', ASCENDING)], 'idx_mov_produto', {}),
+        ([('escopo.central_id', ASCENDING), ('data_movimentacao', DESCENDING), ('_id', DESCENDING)], 'idx_mov_escopo_central_data_id', {}),
+        # Consumo/saídas por local de origem em um período (dashboards do FastAPI)
+        ([('local_origem_id', ASCENDING), ('data_movimentacao', DESCENDING)], 'idx_mov_origem_data', {}),
+    ],
+    'estoques': [
+        ([('produto_id', ASCENDING)], 'idx_est_produto', {}),
+        ([('local_tipo', ASCENDING), ('local_id', ASCENDING)], 'idx_est_local', {}),
+        # Linha de estoque de um produto em um local (entradas, distribuições, baixas)
+        ([('produto_id', ASCENDING), ('local_tipo', ASCENDING), ('local_id', ASCENDING)], 'idx_est_produto_local', {}),
+        ([('updated_at', DESCENDING)], 'idx_est_updated', {}),
+        # Campos de localização específicos (documentos antigos)
+        ([('setor_id', ASCENDING)], 'idx_est_setor', {'sparse': True}),
+        ([('sub_almoxarifado_id', ASCENDING)], 'idx_est_sub', {'sparse': True}),
+        ([('almoxarifado_id', ASCENDING)], 'idx_est_almox', {'sparse': True}),
+        ([('central_id', ASCENDING)], 'idx_est_central', {'sparse': True}),
+        # Escopo denormalizado (ver hierarchy.py / scripts/backfill_escopo.py)
+        *[([(f'escopo.{key}', ASCENDING)], f'idx_est_escopo_{suffix}', {'sparse': True}) for key, suffix in _ESCOPO],
+        # Estoque abaixo do ponto de reposição (reorder_points.py): parciais só com as linhas sinalizadas
+        ([('abaixo_minimo', ASCENDING), ('produto_id', ASCENDING)], 'idx_est_baixo', {'partialFilterExpression': _BAIXO}),
+        *[([('abaixo_minimo', ASCENDING), (f'escopo.{key}', ASCENDING)], f'idx_est_baixo_{suffix}', {'partialFilterExpression': _BAIXO})
+          for key, suffix in _ESCOPO],
+    ],
+    'lotes': [
+        # Vencimentos por faixa de data (lot_expiry.py), com e sem escopo
+        ([('data_validade', ASCENDING)], 'idx_lote_validade', {'sparse': True}),
+        ([('produto_id', ASCENDING)], 'idx_lote_produto', {}),
+        # Lote pelo número (entradas e edição de lotes)
+        ([('produto_id', ASCENDING), ('numero_lote', ASCENDING)], 'idx_lote_produto_numero', {}),
+        *[([(f'escopo.{key}', ASCENDING), ('data_validade', ASCENDING)], f'idx_lote_escopo_{suffix}_validade', {'sparse': True})
+          for key, suffix in _ESCOPO],
+    ],
+    'demandas': [
+        # Demandas de um setor por status, mais recentes primeiro
+        ([('setor_id', ASCENDING), ('status', ASCENDING), ('updated_at', DESCENDING)], 'idx_dem_setor_status_updated', {}),
+    ],
+    'logs_auditoria': [
+        ([('timestamp', ASCENDING)], 'idx_audit_time', {}),
+        ([('usuario_id', ASCENDING)], 'idx_audit_user', {}),
+    ],
+    'listas_compras': [
+        ([('usuario_id', ASCENDING)], 'idx_lista_usuario', {}),
+        ([('created_at', ASCENDING)], 'idx_lista_created', {}),
+    ],
+}
+
+
+def _log(log: Optional[Callable[[str], Any]], msg: str) -> None:
+    if log is not None:
+        log(msg)
+
+
+def _key(keys) -> Tuple[Tuple[str, int], ...]:
+    return tuple((str(f), int(d)) for f, d in keys)
+
+
+def _diff(coll_name: str, info: Dict[str, Any]) -> Tuple[List[IndexSpec], List[str]]:
+    """(índices da especificação que faltam, nomes dos índices do banco fora da especificação).
+
+    Um índice conta como existente pelo nome ou pelos campos, para não duplicar
+    índices criados à mão com outro nome."""
+    specs = INDEXES.get(coll_name, [])
+    names = set(info)
+    keys = {_key(v.get('key') or ()) for v in info.values()}
+    missing = [s for s in specs if s[1] not in names and _key(s[0]) not in keys]
+    spec_names = {s[1] for s in specs}
+    spec_keys = {_key(s[0]) for s in specs}
+    extras = sorted(n for n, v in info.items()
+                    if n != '_id_' and n not in spec_names and _key(v.get('key') or ()) not in spec_keys)
+    return missing, extras
+
+
+def _summarize(report: Dict[str, Dict[str, List[str]]], log) -> Dict[str, Dict[str, List[str]]]:
+    for coll_name, r in report.items():
+        if r['criados'] or r['falhas'] or r['extras']:
+            _log(log, f"[Índices] {coll_name}: criados={r['criados']} falhas={r['falhas']} extras={r['extras']}")
+    return report
+
+
+def apply(db, log: Optional[Callable[[str], Any]] = print) -> Dict[str, Dict[str, List[str]]]:
+    """Cria os índices de `INDEXES` que faltam (pymongo/mongomock); devolve o relatório por coleção."""
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for coll_name in INDEXES:
+        coll = db[coll_name]
+        try:
+            info = coll.index_information()
+        except Exception:
+            info = {}
+        missing, extras = _diff(coll_name, info)
+        r = report[coll_name] = {'criados': [], 'falhas': [], 'extras': extras}
+        for keys, name, options in missing:
+            try:
+                coll.create_index(keys, name=name, **options)
+                r['criados'].append(name)
+            except Exception as e:
+                r['falhas'].append(name)
+                _log(log, f'[Índices] Falha ao criar {coll_name}.{name}: {e}')
+    return _summarize(report, log)
+
+
+@metrics.timed_job('index_spec_apply')
+async def apply_async(db, log: Optional[Callable[[str], Any]] = print) -> Dict[str, Dict[str, List[str]]]:
+    """Versão assíncrona de `apply` (Motor), para rodar em segundo plano no startup do FastAPI."""
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for coll_name in INDEXES:
+        coll = db[coll_name]
+        try:
+            info = await coll.index_information()
+        except Exception:
+            info = {}
+        missing, extras = _diff(coll_name, info)
+        r = report[coll_name] = {'criados': [], 'falhas': [], 'extras': extras}
+        for keys, name, options in missing:
+            try:
+                await coll.create_index(keys, name=name, **options)
+                r['criados'].append(name)
+            except Exception as e:
+                r['falhas'].append(name)
+                _log(log, f'[Índices] Falha ao criar {coll_name}.{name}: {e}')
+    return _summarize(report, log)
+
+
+def _filter_fields(filt: Any) -> List[str]:
+    """Campos de um filtro, incluindo os de `$and`/`$or` no primeiro nível."""
+    fields: List[str] = []
+    if isinstance(filt, dict):
+        for k, v in filt.items():
+            if k in ('$and', '$or') and isinstance(v, list):
+                for sub in v:
+                    fields += _filter_fields(sub)
+            elif not k.startswith('$'):
+                fields.append(k)
+    return list(dict.fromkeys(fields))
+
+
+def covering_index(coll_name: str, fields: Iterable[str]) -> Optional[str]:
+    """Nome de um índice da especificação cujo primeiro campo está em `fields` (None se nenhum)."""
+    fields = set(fields)
+    for keys, name, _ in INDEXES.get(coll_name, ()):
+        if keys[0][0] in fields:
+            return name
+    return None
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Registra leituras acima de `threshold_ms`, sinalizando filtros sem índice na especificação."""
+
+    _COMMANDS = {'find': 'filter', 'count': 'query', 'aggregate': None, 'distinct': 'query'}
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, log: Callable[[str], Any] = print):
+        self.threshold_ms = threshold_ms
+        self.log = log
+        self._pending: Dict[int, Tuple[str, List[str]]] = {}
+
+    def started(self, event):
+        name = event.command_name
+        if name not in self._COMMANDS:
+            return
+        cmd = event.command
+        coll_name = cmd.get(name)
+        if name == 'aggregate':
+            pipeline = cmd.get('pipeline') or [{}]
+            filt = pipeline[0].get('$match', {}) if pipeline and isinstance(pipeline[0], dict) else {}
+        else:
+            filt = cmd.get(self._COMMANDS[name]) or {}
+        self._pending[event.request_id] = (str(coll_name), _filter_fields(filt))
+
+    def succeeded(self, event):
+        info = self._pending.pop(event.request_id, None)
+        if info is None:
+            return
+        ms = event.duration_micros / 1000.0
+        if ms < self.threshold_ms:
+            return
+        coll_name, fields = info
+        index = covering_index(coll_name, fields) if fields else None
+        hint = f'índice {index}' if index else 'nenhum índice da especificação cobre o filtro'
+        self.log(f'[Consulta lenta] {event.command_name} {coll_name} {ms:.0f}ms campos={fields} ({hint})')
+
+    def failed(self, event):
+        self._pending.pop(event.request_id, None)
@@ -0,0 +1,322 @@
+"""Alocação FEFO (first-expired-first-out) de lotes nas saídas de estoque.
+
+As distribuições baixavam só a linha agregada de `estoques`; `lotes.quantidade_atual`
+ficava como estava e a soma dos lotes se afastava do saldo do local, o que só
+uma releitura completa das duas coleções corrigia. Agora, quando uma quantidade
+sai de um local, ela é alocada aos lotes do produto naquele local em ordem de
+`data_validade` (lotes sem validade por último) e os lotes escolhidos são
+baixados junto com a escrita do estoque:
+
+- `LotAllocator` mantém, por (produto, local), um heap dos lotes com saldo em um
+  `LRUTTLCache` pequeno: produtos movimentados com frequência não releem
+  `lotes` a cada saída; os demais saem do cache pelo LRU/TTL.
+- A baixa de cada lote é condicionada ao saldo (`quantidade_atual >= q`), como em
+  stock_ledger.py. `allocate_many_async` grava todas as baixas de uma requisição
+  em um único `bulk_write`; cada baixa registra o seu id em `alocacoes`, então,
+  se alguma não casar (o heap estava velho porque outro processo baixou o
+  lote), o heap é descartado e só o que faltou é realocado a partir do banco.
+  Se a escrita falhar, os heaps planejados também são descartados.
+- O que não couber em lotes (estoque sem lote) volta em `sem_lote`.
+- Estornos fazem o caminho inverso (`give_back`): a quantidade devolvida volta aos
+  lotes registrados nas saídas originais (`movimentacoes.lotes`), da mais recente
+  para a mais antiga, e cada saída guarda em `lotes_devolvidos` o que já voltou,
+  para que dois estornos não devolvam o mesmo lote duas vezes.
+
+O documento de estoque e o de lotes ficam em coleções diferentes: sem transação
+(exige replica set) a baixa dos lotes é uma segunda escrita logo após a do
+estoque, executada em lote e na mesma requisição.
+"""
+import heapq
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from extensions import LRUTTLCache
+import metrics
+from hierarchy import _norm_tipo
+
+LOT_HEAP_TTL = int(os.getenv('LOT_HEAP_TTL', '30'))
+LOT_HEAP_MAX_BYTES = int(os.getenv('LOT_HEAP_MAX_BYTES', str(2 * 1024 * 1024)))
+# Ids de baixa guardados por lote (conferência das baixas em lote)
+_ALLOC_HISTORY = 20
+_MAX_ROUNDS = 3
+_PROJECTION = {'_id': 1, 'data_validade': 1, 'quantidade_atual': 1, 'lote': 1, 'numero_lote': 1}
+_FAR_FUTURE = datetime.max
+RETURNED_FIELD = 'lotes_devolvidos'
+_OUTFLOW_PROJECTION = {'_id': 1, 'lotes': 1, RETURNED_FIELD: 1}
+
+
+def lots_query(pid_vals: Sequence[Any], tipo: str, local_vals: Sequence[Any]) -> Dict[str, Any]:
+    """Lotes com saldo de um produto em um local (formato FastAPI `local_tipo/local_id` ou Flask `almoxarifado_id`)."""
+    tipo = _norm_tipo(tipo)
+    tipos = ['sub_almoxarifado', 'subalmoxarifado'] if tipo == 'sub_almoxarifado' else [tipo]
+    id_field = {'setor': 'setor_id', 'sub_almoxarifado': 'sub_almoxarifado_id', 'central': 'central_id'}.get(tipo, 'almoxarifado_id')
+    local_vals = list(local_vals)
+    return {
+        'produto_id': {'$in': list(pid_vals)},
+        'quantidade_atual': {'$gt': 0},
+        '$or': [
+            {'local_tipo': {'$in': tipos}, 'local_id': {'$in': local_vals}},
+            {'local_tipo': {'$exists': False}, id_field: {'$in': local_vals}},
+        ],
+    }
+
+
+def _entry(doc: Dict[str, Any]) -> list:
+    dv = doc.get('data_validade')
+    dv = dv if isinstance(dv, datetime) else None
+    # [sem validade?, validade, _id (desempate estável), saldo, número do lote]
+    return [dv is None, dv or _FAR_FUTURE, str(doc['_id']), doc['_id'], float(doc.get('quantidade_atual') or 0),
+            doc.get('numero_lote') or doc.get('lote')]
+
+
+class AllocationRequest:
+    """Uma saída a alocar: `quantidade` do produto (`pid_vals`) no local (`tipo`, `local_vals`)."""
+
+    def __init__(self, pid_vals: Sequence[Any], tipo: str, local_vals: Sequence[Any], quantidade: float):
+        self.pid_vals = list(pid_vals)
+        self.tipo = _norm_tipo(tipo)
+        self.local_vals = list(local_vals)
+        self.quantidade = float(quantidade)
+        self.lotes: List[Dict[str, Any]] = []
+        self.restante = float(quantidade)
+
+    @property
+    def key(self) -> str:
+        return f"{sorted(map(str, self.pid_vals))}|{self.tipo}|{sorted(map(str, self.local_vals))}"
+
+    @property
+    def query(self) -> Dict[str, Any]:
+        return lots_query(self.pid_vals, self.tipo, self.local_vals)
+
+    def result(self) -> Dict[str, Any]:
+        """Resumo gravado na movimentação: lotes baixados e a parte sem lote."""
+        return {'lotes': self.lotes, 'sem_lote': round(self.restante, 6)}
+
+
+class ReturnRequest:
+    """Uma devolução: `quantidade` do produto que volta de (`from_tipo`, `from_vals`) ao local (`tipo`, `local_vals`)."""
+
+    def __init__(self, pid_vals: Sequence[Any], tipo: str, local_vals: Sequence[Any], quantidade: float,
+                 from_tipo: str, from_vals: Sequence[Any]):
+        self.pid_vals = list(pid_vals)
+        self.tipo = _norm_tipo(tipo)
+        self.local_vals = list(local_vals)
+        self.from_tipo = _norm_tipo(from_tipo)
+        self.from_vals = list(from_vals)
+        self.quantidade = float(quantidade)
+        self.lotes: List[Dict[str, Any]] = []
+        self.restante = float(quantidade)
+
+    @property
+    def query(self) -> Dict[str, Any]:
+        """Saídas do local para a origem da devolução com lotes registrados (campos FastAPI `local_*` ou Flask)."""
+        def side(name, tipo, vals):
+            tipos = ['sub_almoxarifado', 'subalmoxarifado'] if tipo == 'sub_almoxarifado' else [tipo]
+            return {'$or': [{f'local_{name}_tipo': {'$in': tipos}, f'local_{name}_id': {'$in': vals}},
+                            {f'{name}_tipo': {'$in': tipos}, f'{name}_id': {'$in': vals}}]}
+        return {
+            'produto_id': {'$in': self.pid_vals},
+            'lotes.0': {'$exists': True},
+            '$and': [side('origem', self.tipo, self.local_vals), side('destino', self.from_tipo, self.from_vals)],
+        }
+
+    def plan(self, movs) -> List[Tuple[Any, Dict[str, Any], float]]:
+        """(movimentação, lote registrado, quantidade) cobrindo a devolução, da saída mais recente para a mais antiga."""
+        plan = []
+        need = self.restante
+        for mov in movs:
+            devolvidos = mov.get(RETURNED_FIELD) or {}
+            for lote in reversed(mov.get('lotes') or []):
+                livre = float(lote.get('quantidade') or 0) - float(devolvidos.get(str(lote.get('lote_id'))) or 0)
+                if need > 1e-9 and livre > 1e-9:
+                    q = min(livre, need)
+                    plan.append((mov['_id'], lote, q))
+                    need -= q
+        return plan
+
+    @staticmethod
+    def ops(mov_id: Any, lote: Dict[str, Any], q: float, now: datetime) -> Tuple[tuple, tuple]:
+        """Filtro/update da movimentação (condicionado ao que ainda não voltou) e do lote."""
+        lote_id = str(lote.get('lote_id'))
+        key = f'{RETURNED_FIELD}.{lote_id}'
+        limite = float(lote.get('quantidade') or 0) - q + 1e-9
+        ids = [lote_id] + ([ObjectId(lote_id)] if ObjectId.is_valid(lote_id) else [])
+        return (
+            ({'_id': mov_id, '$or': [{key: {'$exists': False}}, {key: {'$lte': limite}}]}, {'$inc': {key: q}}),
+            ({'_id': {'$in': ids}}, {'$inc': {'quantidade_atual': q}, '$set': {'updated_at': now}}),
+        )
+
+    def applied(self, lote: Dict[str, Any], q: float) -> None:
+        self.restante -= q
+        self.lotes.append({'lote_id': str(lote.get('lote_id')), 'lote': lote.get('lote'), 'quantidade': q,
+                           'data_validade': lote.get('data_validade')})
+
+    def result(self) -> Dict[str, Any]:
+        """Resumo gravado no estorno: lotes creditados e a parte que voltou sem lote."""
+        return {'lotes': self.lotes, 'sem_lote': round(self.restante, 6)}
+
+
+class LotAllocator:
+    def __init__(self, ttl: int = LOT_HEAP_TTL, max_bytes: int = LOT_HEAP_MAX_BYTES):
+        self.ttl = ttl
+        self.heaps = LRUTTLCache(max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.conflicts = 0
+
+    def forget(self, produto_ids: Optional[Sequence[Any]] = None) -> None:
+        """Descarta os heaps dos produtos (ou todos) após entrada/edição de lotes fora do alocador."""
+        if produto_ids is None:
+            self.heaps.clear()
+        else:
+            self.heaps.invalidate_tags([f'produto:{p}' for p in produto_ids])
+
+    def _store(self, req: AllocationRequest, docs) -> list:
+        heap = [_entry(d) for d in docs if float(d.get('quantidade_atual') or 0) > 0]
+        heapq.heapify(heap)
+        self.heaps.set(req.key, heap, ttl=self.ttl, tags=[f'produto:{p}' for p in req.pid_vals])
+        self.loads += 1
+        return heap
+
+    def _cached(self, req: AllocationRequest, round_: int) -> Optional[list]:
+        """Heap em cache, se cobrir a saída; um heap que não cobre pode estar velho (lote novo em outro processo)."""
+        heap = self.heaps.get(req.key) if round_ == 0 else None
+        if heap is not None and sum(e[4] for e in heap) + 1e-9 < req.restante:
+            return None
+        return heap
+
+    def _plan(self, req: AllocationRequest, heap: list) -> List[Tuple[list, float]]:
+        """Retira do heap os lotes que cobrem `req.restante` (FEFO); devolve (entrada, quantidade)."""
+        takes = []
+        with self._lock:
+            need = req.restante
+            while heap and need > 1e-9:
+                entry = heapq.heappop(heap)
+                q = min(entry[4], need)
+                takes.append((entry, q))
+                need -= q
+                if entry[4] - q > 1e-9:
+                    entry = entry[:4] + [entry[4] - q] + entry[5:]
+                    heapq.heappush(heap, entry)
+        return takes
+
+    def _discard(self, requests) -> None:
+        """Descarta os heaps das saídas: a próxima alocação relê os lotes do banco."""
+        for key in {req.key for req in requests}:
+            self.heaps.delete(key)
+
+    @staticmethod
+    def _op(entry: list, q: float, op_id: ObjectId, now: datetime) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        return (
+            {'_id': entry[3], 'quantidade_atual': {'$gte': q}},
+            {'$inc': {'quantidade_atual': -q}, '$set': {'updated_at': now},
+             '$push': {'alocacoes': {'$each': [op_id], '$slice': -_ALLOC_HISTORY}}},
+        )
+
+    @staticmethod
+    def _applied(req: AllocationRequest, entry: list, q: float) -> None:
+        req.restante -= q
+        for lote in req.lotes:
+            if lote['lote_id'] == entry[2]:
+                lote['quantidade'] += q
+                return
+        req.lotes.append({'lote_id': str(entry[3]), 'lote': entry[5], 'quantidade': q,
+                          'data_validade': None if entry[0] else entry[1]})
+
+    async def allocate_many_async(self, coll, requests: Sequence[AllocationRequest], now: Optional[datetime] = None) -> None:
+        """Aloca e baixa os lotes de várias saídas com um `bulk_write` por rodada (Motor ou wrapper do mongomock)."""
+        now = now or datetime.utcnow()
+        pending = [r for r in requests if r.restante > 1e-9]
+        for round_ in range(_MAX_ROUNDS):
+            if not pending:
+                return
+            planned: List[Tuple[AllocationRequest, list, float, ObjectId]] = []
+            for req in pending:
+                heap = self._cached(req, round_)
+                if heap is None:
+                    heap = self._store(req, await coll.find(req.query, _PROJECTION).to_list(length=None))
+                planned += [(req, e, q, ObjectId()) for e, q in self._plan(req, heap)]
+            if not planned:
+                return
+            try:
+                res = await coll.bulk_write([UpdateOne(*self._op(e, q, op_id, now)) for _, e, q, op_id in planned], ordered=False)
+            except BaseException:
+                # Os heaps já saíram com as baixas planejadas, que o banco pode não ter gravado
+                self._discard(r for r, _, _, _ in planned)
+                raise
+            if res.matched_count == len(planned):
+                for req, e, q, _ in planned:
+                    self._applied(req, e, q)
+                return
+            # Alguma baixa não casou: confere cada uma pelo seu id e realoca o resto a partir do banco
+            self.conflicts += 1
+            op_ids = [op_id for _, _, _, op_id in planned]
+            docs = await coll.find({'_id': {'$in': [e[3] for _, e, _, _ in planned]}, 'alocacoes': {'$in': op_ids}},
+                                   {'alocacoes': 1}).to_list(length=None)
+            ok = {a for d in docs for a in (d.get('alocacoes') or [])}
+            for req, e, q, op_id in planned:
+                if op_id in ok:
+                    self._applied(req, e, q)
+            self._discard(r for r, _, _, _ in planned)
+            pending = [r for r in pending if r.restante > 1e-9]
+
+    def allocate(self, coll, req: AllocationRequest, now: Optional[datetime] = None) -> AllocationRequest:
+        """Versão síncrona (pymongo/mongomock) para uma saída: baixas condicionadas lote a lote."""
+        now = now or datetime.utcnow()
+        for round_ in range(_MAX_ROUNDS):
+            if req.restante <= 1e-9:
+                break
+            heap = self._cached(req, round_)
+            if heap is None:
+                heap = self._store(req, coll.find(req.query, _PROJECTION))
+            takes = self._plan(req, heap)
+            if not takes:
+                break
+            stale = False
+            try:
+                for e, q in takes:
+                    if coll.update_one(*self._op(e, q, ObjectId(), now)).matched_count:
+                        self._applied(req, e, q)
+                    else:
+                        stale = True
+            except BaseException:
+                self._discard([req])
+                raise
+            if not stale:
+                break
+            self.conflicts += 1
+            self.heaps.delete(req.key)
+        return req
+
+    def give_back(self, lotes, movimentacoes, req: ReturnRequest, now: Optional[datetime] = None) -> ReturnRequest:
+        """Credita a devolução nos lotes das saídas originais (pymongo/mongomock)."""
+        now = now or datetime.utcnow()
+        movs = movimentacoes.find(req.query, _OUTFLOW_PROJECTION).sort('data_movimentacao', -1)
+        for mov_id, lote, q in req.plan(movs):
+            mov_op, lote_op = req.ops(mov_id, lote, q, now)
+            if movimentacoes.update_one(*mov_op).matched_count:
+                lotes.update_one(*lote_op)
+                req.applied(lote, q)
+        self.forget(req.pid_vals)
+        return req
+
+    async def give_back_async(self, lotes, movimentacoes, req: ReturnRequest, now: Optional[datetime] = None) -> ReturnRequest:
+        """Versão assíncrona (Motor ou wrapper do mongomock) de `give_back`."""
+        now = now or datetime.utcnow()
+        movs = await movimentacoes.find(req.query, _OUTFLOW_PROJECTION).sort('data_movimentacao', -1).to_list(length=None)
+        for mov_id, lote, q in req.plan(movs):
+            mov_op, lote_op = req.ops(mov_id, lote, q, now)
+            if (await movimentacoes.update_one(*mov_op)).matched_count:
+                await lotes.update_one(*lote_op)
+                req.applied(lote, q)
+        self.forget(req.pid_vals)
+        return req
+
+
+lot_allocator = LotAllocator()
+metrics.register_cache('lot_heaps', lot_allocator.heaps.stats)
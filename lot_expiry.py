@@ -0,0 +1,162 @@
+"""Validade normalizada de lotes e consulta de vencimentos por faixa de índice.
+
+Os lotes chegavam com a validade em dois campos e vários formatos: o FastAPI
+gravava `data_validade` (datetime), o Flask `data_vencimento` (datetime ou
+string ISO/`dd/mm/aaaa` vinda do formulário). O widget de vencimentos e as
+sugestões de compras liam a coleção inteira e interpretavam as strings em
+Python, linha a linha.
+
+Agora todo lote tem um único `data_validade` datetime (UTC, sem fuso, como o
+pymongo devolve), gravado pelos dois apps e corrigido nos lotes antigos por
+`scripts/migrate_lotes_validade.py`, que também grava o `escopo` (ids dos
+ancestrais do local, como em estoques). Com os índices
+`idx_lote_validade` e `idx_lote_escopo_*_validade` (extensions.py),
+"lotes vencendo nos próximos N dias no meu escopo" é uma varredura de faixa:
+
+    {escopo.<nível>: id, data_validade: {$gte: agora, $lt: agora + N dias}, quantidade_atual > 0}
+
+O filtro de escopo só é usado depois que a migração marca `lotes_validade_pronto`
+em `sistema_meta`; antes disso o chamador usa `expiring_with_legacy`, que soma à
+faixa de datas os lotes ainda não migrados (validade só nos campos antigos ou em
+string, interpretada em Python como antes), e confere o escopo em Python, como fazia.
+"""
+import heapq
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from hierarchy import HierarchyGraph
+
+FIELD = 'data_validade'
+LEGACY_FIELDS = ('data_vencimento', 'validade', 'vencimento')
+READY_KEY = 'lotes_validade_pronto'
+
+# Lotes com saldo (linhas antigas sem `quantidade_atual` contam como com saldo)
+WITH_BALANCE = {'$or': [{'quantidade_atual': {'$gt': 0}}, {'quantidade_atual': {'$exists': False}}]}
+
+# Lotes não migrados: `data_validade` em string, ou ausente com a validade em um campo antigo
+LEGACY_ONLY = {'$or': [
+    {FIELD: {'$type': 'string'}},
+    {'$and': [{FIELD: None}, {'$or': [{f: {'$nin': [None, '']}} for f in LEGACY_FIELDS]}]},
+]}
+
+_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M')
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def parse(value: Any) -> Optional[datetime]:
+    """Validade em datetime UTC sem fuso; None quando vazia ou ilegível."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return _naive_utc(value)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    s = str(value).strip()
+    if not s:
+        return None
+    try:
+        return _naive_utc(datetime.fromisoformat(s.replace('Z', '+00:00')))
+    except ValueError:
+        pass
+    for fmt in _FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def expiry_of(doc: Dict[str, Any]) -> Optional[datetime]:
+    """Validade de um lote, aceitando os campos antigos enquanto a migração não rodou."""
+    for field in (FIELD,) + LEGACY_FIELDS:
+        dt = parse(doc.get(field))
+        if dt is not None:
+            return dt
+    return None
+
+
+def normalized_update(doc: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Update que deixa o lote só com `data_validade` normalizado; None se já está certo."""
+    legacy = [f for f in LEGACY_FIELDS if f in doc]
+    dt = expiry_of(doc)
+    current = doc.get(FIELD)
+    if not legacy and (current is None or (isinstance(current, datetime) and current.tzinfo is None)):
+        return None
+    update: Dict[str, Any] = {}
+    if dt is not None and dt != current:
+        update['$set'] = {FIELD: dt}
+    elif dt is None and current is not None:
+        update['$unset'] = {FIELD: ''}
+    if legacy:
+        update.setdefault('$unset', {}).update({f: '' for f in legacy})
+    return update or None
+
+
+def ready(graph: HierarchyGraph) -> bool:
+    """Verdadeiro quando a migração já gravou `escopo` e `data_validade` em todos os lotes."""
+    return graph.scope_ready and graph.meta_flag(READY_KEY)
+
+
+def window(days: int, now: Optional[datetime] = None, include_expired: bool = False) -> Dict[str, Any]:
+    """Faixa de `data_validade` até `now + days` (a partir de `now`, ou sem início com os vencidos)."""
+    now = _naive_utc(now or datetime.utcnow())
+    rng: Dict[str, Any] = {'$lt': now + timedelta(days=days)}
+    if not include_expired:
+        rng['$gte'] = now
+    return {FIELD: rng}
+
+
+def expiring_query(days: int, scope: Optional[Dict[str, Any]] = None, now: Optional[datetime] = None,
+                   include_expired: bool = False, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Filtro "lotes com saldo vencendo em `days` dias", opcionalmente no `scope` (`escopo.<nível>`)."""
+    clauses: List[Dict[str, Any]] = [window(days, now, include_expired), WITH_BALANCE]
+    if scope:
+        clauses.insert(0, scope)
+    if extra:
+        clauses.append(extra)
+    return {'$and': clauses}
+
+
+def expiring(coll, days: int, scope: Optional[Dict[str, Any]] = None, now: Optional[datetime] = None,
+             include_expired: bool = False, limit: int = 0, projection: Optional[Dict[str, Any]] = None):
+    """Cursor dos lotes vencendo em `days` dias, do vencimento mais próximo para o mais distante."""
+    cursor = coll.find(expiring_query(days, scope, now, include_expired), projection).sort(FIELD, 1)
+    return cursor.limit(limit) if limit else cursor
+
+
+def expiring_with_legacy(coll, days: int, now: Optional[datetime] = None, include_expired: bool = False,
+                         projection: Optional[Dict[str, Any]] = None):
+    """`expiring` mais os lotes de `LEGACY_ONLY` na mesma janela, na mesma ordem (antes da migração)."""
+    now = _naive_utc(now or datetime.utcnow())
+    end = now + timedelta(days=days)
+    legacy = []
+    for doc in coll.find({'$and': [LEGACY_ONLY, WITH_BALANCE]}, projection):
+        dt = expiry_of(doc)
+        if dt is not None and dt < end and (include_expired or dt >= now):
+            legacy.append(doc)
+    legacy.sort(key=expiry_of)
+    return heapq.merge(expiring(coll, days, now=now, include_expired=include_expired, projection=projection),
+                       legacy, key=expiry_of)
+
+
+def next_expiry(coll, now: Optional[datetime] = None, scope: Optional[Dict[str, Any]] = None):
+    """Próxima validade (> agora) por produto entre os lotes com saldo: `{_id: produto_id, prox_vencimento}`."""
+    now = _naive_utc(now or datetime.utcnow())
+    match: Dict[str, Any] = {FIELD: {'$gt': now}, 'quantidade_atual': {'$gt': 0}}
+    if scope:
+        match.update(scope)
+    return coll.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$produto_id', 'prox_vencimento': {'$min': f'${FIELD}'}}},
+    ])
+
+
+def days_until(expiry: datetime, now: Optional[datetime] = None) -> int:
+    """Dias inteiros até o vencimento (negativo para vencidos)."""
+    now = _naive_utc(now or datetime.utcnow())
+    return int((expiry - now).total_seconds() // 86400)
@@ -0,0 +1,324 @@
+"""Registro de métricas em memória com exposição no formato texto do Prometheus.
+
+A única superfície operacional eram `/health/app` (uptime) e `/health/mongo`:
+não havia p95/p99 por rota, atraso do event loop do FastAPI, taxa de acerto
+dos caches nem espera por conexão no pool do Mongo. Este módulo mantém
+contadores, gauges e histogramas por processo, sem dependências nem serviços
+extras; `/metrics` (Flask e FastAPI) devolve `REGISTRY.render()`.
+
+Métricas registradas aqui (os apps só alimentam):
+- `http_request_duration_seconds{app,method,route,status}`: histograma por
+  template de rota (`/api/estoque/<id>`, não o caminho com o id);
+- `http_requests_in_flight{app}`;
+- `mongo_pool_checkout_seconds{app}` e `mongo_pool_checked_out{app}`, via
+  `PoolMetricsListener` registrado nos clientes pymongo e Motor;
+- `event_loop_lag_seconds` (FastAPI), medido por `watch_event_loop`;
+- `background_job_duration_seconds{job}` e `background_job_failures_total{job}`
+  via `timed_job` (revalidações de cache, contagens estimadas, índices);
+- estatísticas dos caches, lidas no momento da coleta (`register_cache`).
+
+Com vários workers (gunicorn/uvicorn) cada processo expõe os próprios números;
+o Prometheus agrega por instância.
+"""
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _num(v: float) -> str:
+    v = float(v)
+    if v == float('inf'):
+        return '+Inf'
+    return str(int(v)) if v.is_integer() else repr(v)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_labels(self.label_names, k)} {_num(v)}' for k, v in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # chave -> [contagem por bucket..., soma, total]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(self._key(labels))
+        return int(row[-1]) if row else 0
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out = []
+        for key, row in items:
+            acc = 0.0
+            for i, bound in enumerate(self.buckets):
+                acc += row[i]
+                out.append(f'{self.name}_bucket{_labels(self.label_names, key, ("le", _num(bound)))} {_num(acc)}')
+            out.append(f'{self.name}_bucket{_labels(self.label_names, key, ("le", "+Inf"))} {_num(row[-1])}')
+            out.append(f'{self.name}_sum{_labels(self.label_names, key)} {_num(row[-2])}')
+            out.append(f'{self.name}_count{_labels(self.label_names, key)} {_num(row[-1])}')
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> Any:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, fn: Callable[[], None]) -> Callable[[], None]:
+        """Função chamada a cada coleta, antes da renderização (atualiza gauges a partir de estado externo)."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for fn in list(self._collectors):
+            try:
+                fn()
+            except Exception:
+                pass
+        lines: List[str] = []
+        for metric in sorted(self._metrics.values(), key=lambda m: m.name):
+            samples = metric.samples()
+            if samples:
+                lines += metric.header() + samples
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_duration = REGISTRY.histogram('http_request_duration_seconds', 'Duração das requisições HTTP por template de rota',
+                                   ('app', 'method', 'route', 'status'))
+http_in_flight = REGISTRY.gauge('http_requests_in_flight', 'Requisições HTTP em andamento', ('app',))
+pool_checkout = REGISTRY.histogram('mongo_pool_checkout_seconds', 'Espera para obter conexão do pool do MongoDB', ('app',),
+                                   buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+pool_checked_out = REGISTRY.gauge('mongo_pool_checked_out', 'Conexões do pool do MongoDB em uso', ('app',))
+pool_checkout_failures = REGISTRY.counter('mongo_pool_checkout_failures_total', 'Falhas ao obter conexão do pool', ('app', 'reason'))
+loop_lag = REGISTRY.gauge('event_loop_lag_seconds', 'Atraso do event loop do FastAPI na última medição')
+loop_lag_max = REGISTRY.gauge('event_loop_lag_max_seconds', 'Maior atraso do event loop desde a subida')
+job_duration = REGISTRY.histogram('background_job_duration_seconds', 'Duração das tarefas em segundo plano', ('job',),
+                                  buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0))
+job_failures = REGISTRY.counter('background_job_failures_total', 'Tarefas em segundo plano que terminaram com erro', ('job',))
+cache_stat = REGISTRY.gauge('cache_stat', 'Estatísticas dos caches em memória (hits, misses, entries, bytes...)', ('cache', 'stat'))
+
+
+def observe_request(app: str, method: str, route: str, status: int, seconds: float) -> None:
+    http_duration.observe(seconds, app=app, method=method, route=route or 'unmatched', status=status)
+
+
+@contextlib.contextmanager
+def track_job(job: str):
+    """Mede uma tarefa em segundo plano; exceções são contadas e propagadas."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        job_failures.inc(job=job)
+        raise
+    finally:
+        job_duration.observe(time.perf_counter() - start, job=job)
+
+
+def timed_job(job: str):
+    """Decorator de `track_job` para funções síncronas e corrotinas."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with track_job(job):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track_job(job):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+_caches: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register_cache(name: str, stats: Callable[[], Dict[str, Any]]) -> None:
+    """Expõe os valores numéricos de `stats()` de um cache como `cache_stat{cache,stat}` (um registro por nome)."""
+    _caches[name] = stats
+
+
+@REGISTRY.collector
+def _collect_caches() -> None:
+    for name, stats in list(_caches.items()):
+        for stat, value in (stats() or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cache_stat.set(value, cache=name, stat=stat)
+
+
+async def watch_event_loop(interval: float = 1.0) -> None:
+    """Mede o atraso do event loop: quanto um `sleep(interval)` demora além do pedido."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        loop_lag.set(lag)
+        if lag > loop_lag_max.value():
+            loop_lag_max.set(lag)
+
+
+def authorized(header: Optional[str]) -> bool:
+    """Com `METRICS_TOKEN` definido, exige `Authorization: Bearer <token>`."""
+    return not METRICS_TOKEN or (header or '') == f'Bearer {METRICS_TOKEN}'
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Espera por conexão e conexões em uso no pool do pymongo/Motor."""
+
+    def __init__(self, app: str):
+        self.app = app
+        self._started: Dict[Tuple[Any, int], float] = {}
+
+    def connection_check_out_started(self, event):
+        self._started[(event.address, threading.get_ident())] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        start = self._started.pop((event.address, threading.get_ident()), None)
+        waited = getattr(event, 'duration', None)
+        if waited is None and start is not None:
+            waited = time.perf_counter() - start
+        if waited is not None:
+            pool_checkout.observe(waited, app=self.app)
+        pool_checked_out.inc(app=self.app)
+
+    def connection_check_out_failed(self, event):
+        self._started.pop((event.address, threading.get_ident()), None)
+        pool_checkout_failures.inc(app=self.app, reason=getattr(event, 'reason', ''))
+
+    def connection_checked_in(self, event):
+        pool_checked_out.dec(app=self.app)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
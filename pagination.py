@@ -0,0 +1,137 @@
+"""Paginação por cursor (keyset) para listagens ordenadas por data.
+
+As listagens de movimentações ordenavam por `data_movimentacao` e pulavam
+`(page-1)*per_page` linhas: o custo de `skip` cresce com a página e o ledger
+só cresce. Com cursor, a página seguinte é `data < d OU (data == d E _id < i)`
+sobre a ordem `(data_movimentacao desc, _id desc)` — servida direto pelo índice
+composto `idx_mov_data_id`, com custo constante em qualquer profundidade.
+
+O token é opaco para o cliente (base64url de JSON) e guarda o par
+(`data_movimentacao`, `_id`) da última (ou primeira, para voltar) linha da
+página, preservando o tipo BSON de cada valor para que a comparação no banco
+caia no mesmo tipo.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+SORT_FIELD = 'data_movimentacao'
+NEXT = 'next'
+PREV = 'prev'
+
+
+class InvalidCursor(ValueError):
+    """Token de cursor malformado ou adulterado."""
+
+
+def _enc(value: Any) -> List[Any]:
+    if value is None:
+        return ['n', None]
+    if isinstance(value, datetime):
+        return ['d', value.isoformat()]
+    if isinstance(value, ObjectId):
+        return ['o', str(value)]
+    if isinstance(value, bool):
+        return ['s', str(value)]
+    if isinstance(value, int):
+        return ['i', value]
+    if isinstance(value, float):
+        return ['f', value]
+    return ['s', str(value)]
+
+
+def _dec(raw: Any) -> Any:
+    tag, value = raw
+    if tag == 'n':
+        return None
+    if tag == 'd':
+        return datetime.fromisoformat(value)
+    if tag == 'o':
+        return ObjectId(value)
+    if tag == 'i':
+        return int(value)
+    if tag == 'f':
+        return float(value)
+    if tag == 's':
+        return str(value)
+    raise InvalidCursor(f'Tipo desconhecido no cursor: {tag}')
+
+
+def encode_cursor(doc: Dict[str, Any], direction: str = NEXT, field: str = SORT_FIELD) -> str:
+    """Token que continua a listagem a partir de `doc` na direção informada."""
+    payload = {'k': _enc(doc.get(field)), 'id': _enc(doc.get('_id')), 'r': direction}
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str) -> Tuple[Any, Any, str]:
+    """(valor de ordenação, `_id`, direção) de um token; levanta `InvalidCursor`."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+        direction = payload.get('r')
+        if direction not in (NEXT, PREV):
+            raise InvalidCursor('Direção inválida no cursor')
+        return _dec(payload['k']), _dec(payload['id']), direction
+    except InvalidCursor:
+        raise
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError, AttributeError) as exc:
+        raise InvalidCursor('Cursor inválido') from exc
+
+
+def keyset_filter(key: Any, doc_id: Any, direction: str, field: str = SORT_FIELD) -> Dict[str, Any]:
+    """Filtro das linhas depois (`next`) ou antes (`prev`) de (`key`, `doc_id`) na ordem desc.
+
+    Linhas sem data ficam no fim da ordem decrescente (null é o menor valor BSON).
+    """
+    if direction == NEXT:
+        if key is None:
+            return {field: None, '_id': {'$lt': doc_id}}
+        return {'$or': [
+            {field: {'$lt': key}},
+            {field: key, '_id': {'$lt': doc_id}},
+            {field: None},
+        ]}
+    if key is None:
+        return {'$or': [{field: {'$ne': None}}, {field: None, '_id': {'$gt': doc_id}}]}
+    return {'$or': [{field: {'$gt': key}}, {field: key, '_id': {'$gt': doc_id}}]}
+
+
+def sort_spec(direction: str = NEXT, field: str = SORT_FIELD) -> List[Tuple[str, int]]:
+    """Ordem de leitura: `prev` lê ao contrário e a página é invertida depois."""
+    order = -1 if direction == NEXT else 1
+    return [(field, order), ('_id', order)]
+
+
+def apply_cursor(query: Dict[str, Any], token: Optional[str], field: str = SORT_FIELD) -> Tuple[Dict[str, Any], str]:
+    """(consulta restrita pelo cursor, direção); sem token devolve a consulta original e `next`."""
+    if not token:
+        return query, NEXT
+    key, doc_id, direction = decode_cursor(token)
+    keyset = keyset_filter(key, doc_id, direction, field)
+    return ({'$and': [query, keyset]} if query else keyset), direction
+
+
+def page_cursors(rows: List[Dict[str, Any]], per_page: int, direction: str, first_page: bool,
+                 field: str = SORT_FIELD) -> Tuple[List[Dict[str, Any]], Dict[str, Optional[str]]]:
+    """Corta as `per_page + 1` linhas lidas e calcula `next_cursor`/`prev_cursor`.
+
+    A linha extra só indica se existe página além desta na direção da leitura;
+    `first_page` diz se a leitura `next` partiu do início da listagem.
+    """
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == PREV:
+        rows.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, not first_page
+    cursors = {
+        'next_cursor': encode_cursor(rows[-1], NEXT, field) if rows and has_next else None,
+        'prev_cursor': encode_cursor(rows[0], PREV, field) if rows and has_prev else None,
+    }
+    return rows, cursors
@@ -0,0 +1,403 @@
+"""Índice de busca de produtos em memória (typeahead de `busca-rapida` e `/api/produtos/search`).
+
+Substitui o `$regex` sem âncora sobre `nome`/`codigo`/`descricao`, que varria a
+coleção inteira a cada tecla. O índice é carregado uma vez (uma consulta) e
+mantido incrementalmente pelas rotas de escrita de produtos (`upsert`/`remove`).
+
+Estruturas (texto sempre dobrado: NFD sem acentos, minúsculo):
+- prefixos de 1 e 2 caracteres de cada token → ids (termos curtos);
+- trigramas do texto de `nome + codigo + descricao` → ids (busca por trecho);
+- `codigo` completo → ids (casamento exato do código);
+- `id` sequencial e `str(_id)` → id interno.
+
+Termos com menos de 3 caracteres casam apenas por início de palavra; os demais
+casam em qualquer posição (mesma semântica do regex antigo). Vários termos são
+combinados com E; se nenhum produto tiver todos, com OU. O ranking é o mesmo da
+busca rápida antiga (código/nome exatos, prefixos, tokens); termos muito amplos
+ranqueiam no máximo `MAX_SCORED` candidatos, como o limite de 120 do caminho
+antigo, sempre incluindo o código exato.
+
+Versionamento como o do grafo da hierarquia: cada escrita incrementa
+`sistema_meta.busca_produtos.versao` e acrescenta o id do produto ao log
+`alteracoes` (últimos `CHANGE_LOG`). Outros processos checam a versão no máximo a
+cada `check_interval` segundos e reindexam só os produtos do log; se ficaram
+para trás além do log (ou a cada `max_age`), recarregam tudo. Falhas de carga
+devolvem `False` e o chamador deve usar a consulta direta.
+"""
+import heapq
+import itertools
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from hierarchy import META_COLLECTION
+
+META_KEY = 'busca_produtos'
+MIN_GRAM = 3
+MAX_SCORED = 1000
+CHANGE_LOG = 500
+
+_PROJECTION = {
+    '_id': 1, 'id': 1, 'nome': 1, 'codigo': 1, 'descricao': 1, 'ativo': 1,
+    'categoria_id': 1, 'categoria': 1, 'central_id': 1,
+    'unidade_medida': 1, 'unidade': 1, 'updated_at': 1,
+}
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def fold(value: Any) -> str:
+    """Texto sem acentos e em minúsculas."""
+    if value is None:
+        return ''
+    s = str(value)
+    if s.isascii():
+        return s.lower()
+    s = unicodedata.normalize('NFD', s)
+    return ''.join(c for c in s if unicodedata.category(c) != 'Mn').lower()
+
+
+def tokenize(value: Any) -> List[str]:
+    return _TOKEN_RE.findall(fold(value))
+
+
+def _oids(ids: Iterable[str]) -> List[Any]:
+    return [ObjectId(i) if ObjectId.is_valid(i) else i for i in ids]
+
+
+def _grams(text: str) -> Set[str]:
+    return {text[i:i + MIN_GRAM] for i in range(len(text) - MIN_GRAM + 1)}
+
+
+class ProductSearchIndex:
+    def __init__(self, check_interval: float = 5.0, max_age: float = 1800.0):
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.version = 0
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._prefixes: Dict[str, Set[str]] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._codes: Dict[str, Set[str]] = {}
+        self._aliases: Dict[str, str] = {}
+        self._source = None
+        self._remote_version: Any = None
+        self._dirty = True
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    # --- Manutenção das postagens -----------------------------------------
+
+    @staticmethod
+    def _entry_of(doc: Dict[str, Any]) -> Dict[str, Any]:
+        nome = fold(doc.get('nome'))
+        codigo = fold(doc.get('codigo'))
+        descricao = fold(doc.get('descricao'))
+        text = ' '.join(t for t in (nome, codigo, descricao) if t)
+        return {
+            'doc': {k: doc.get(k) for k in _PROJECTION if k in doc},
+            'nome': nome,
+            'codigo': codigo.strip(),
+            'descricao': descricao,
+            'text': text,
+            'aliases': [str(doc.get(f)) for f in ('_id', 'id') if doc.get(f) is not None],
+        }
+
+    @staticmethod
+    def _short_prefixes(text: str) -> Set[str]:
+        return {tok[:n] for tok in _TOKEN_RE.findall(text) for n in range(1, MIN_GRAM)}
+
+    def _add(self, key: str, entry: Dict[str, Any]) -> None:
+        self._entries[key] = entry
+        prefixes, grams = self._prefixes, self._grams
+        for p in self._short_prefixes(entry['text']):
+            prefixes.setdefault(p, set()).add(key)
+        for g in _grams(entry['text']):
+            grams.setdefault(g, set()).add(key)
+        if entry['codigo']:
+            self._codes.setdefault(entry['codigo'], set()).add(key)
+        for alias in entry['aliases']:
+            self._aliases[alias] = key
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        def discard(index: Dict[str, Set[str]], term: str) -> None:
+            keys = index.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[term]
+
+        for p in self._short_prefixes(entry['text']):
+            discard(self._prefixes, p)
+        for g in _grams(entry['text']):
+            discard(self._grams, g)
+        if entry['codigo']:
+            discard(self._codes, entry['codigo'])
+        for alias in entry['aliases']:
+            if self._aliases.get(alias) == key:
+                del self._aliases[alias]
+
+    def upsert(self, doc: Optional[Dict[str, Any]]) -> None:
+        """Indexa (ou reindexa) um produto a partir do documento atual."""
+        if not doc or doc.get('_id') is None:
+            return
+        key = str(doc.get('_id'))
+        entry = self._entry_of(doc)
+        with self._lock:
+            self._drop(key)
+            self._add(key, entry)
+
+    def remove(self, raw_id: Any) -> None:
+        if raw_id is None:
+            return
+        with self._lock:
+            key = self._aliases.get(str(raw_id))
+            if key is not None:
+                self._drop(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # --- Carga -------------------------------------------------------------
+
+    def _needs_reload(self, db, now: float) -> bool:
+        return self._dirty or self._source is not db or (now - self._loaded_at) > self.max_age
+
+    def _swap(self, db, docs: List[Dict[str, Any]], meta: Optional[Dict[str, Any]]) -> None:
+        fresh = ProductSearchIndex()
+        for doc in docs or []:
+            if doc.get('_id') is not None:
+                fresh._add(str(doc.get('_id')), self._entry_of(doc))
+        now = time.time()
+        with self._lock:
+            self._entries = fresh._entries
+            self._prefixes = fresh._prefixes
+            self._grams = fresh._grams
+            self._codes = fresh._codes
+            self._aliases = fresh._aliases
+            self._source = db
+            self._remote_version = (meta or {}).get('versao', 0)
+            self._dirty = False
+            self._loaded_at = now
+            self._checked_at = now
+            self.version += 1
+
+    def _pending_ids(self, meta: Optional[Dict[str, Any]]) -> Optional[List[str]]:
+        """Ids alterados desde a versão local, se todos ainda estiverem no log de alterações."""
+        remote = (meta or {}).get('versao', 0)
+        log = (meta or {}).get('alteracoes') or []
+        if not isinstance(self._remote_version, int) or not isinstance(remote, int):
+            return None
+        gap = remote - self._remote_version
+        if gap <= 0 or gap > len(log):
+            return None
+        return list(dict.fromkeys(log[-gap:]))
+
+    def _apply(self, ids: List[str], docs: List[Dict[str, Any]], meta: Optional[Dict[str, Any]]) -> None:
+        found = set()
+        with self._lock:
+            for doc in docs or []:
+                found.add(str(doc.get('_id')))
+                self.upsert(doc)
+            for raw_id in ids:
+                if raw_id not in found:
+                    self.remove(raw_id)
+            self._remote_version = (meta or {}).get('versao', 0)
+            self.version += 1
+
+    def ensure_loaded(self, db) -> bool:
+        """Garante um índice atualizado a partir de um banco pymongo/mongomock."""
+        if db is None:
+            return False
+        now = time.time()
+        try:
+            if not self._needs_reload(db, now):
+                if (now - self._checked_at) < self.check_interval:
+                    return True
+                meta = db[META_COLLECTION].find_one({'_id': META_KEY})
+                self._checked_at = now
+                if (meta or {}).get('versao', 0) == self._remote_version:
+                    return True
+                ids = self._pending_ids(meta)
+                if ids is not None:
+                    self._apply(ids, list(db['produtos'].find({'_id': {'$in': _oids(ids)}}, _PROJECTION)), meta)
+                    return True
+            meta = db[META_COLLECTION].find_one({'_id': META_KEY})
+            self._swap(db, list(db['produtos'].find({}, _PROJECTION)), meta)
+            return True
+        except Exception:
+            return False
+
+    async def ensure_loaded_async(self, db) -> bool:
+        """Mesmo que `ensure_loaded`, para Motor ou o wrapper assíncrono do mongomock."""
+        if db is None:
+            return False
+        now = time.time()
+        try:
+            if not self._needs_reload(db, now):
+                if (now - self._checked_at) < self.check_interval:
+                    return True
+                meta = await db[META_COLLECTION].find_one({'_id': META_KEY})
+                self._checked_at = now
+                if (meta or {}).get('versao', 0) == self._remote_version:
+                    return True
+                ids = self._pending_ids(meta)
+                if ids is not None:
+                    docs = await db['produtos'].find({'_id': {'$in': _oids(ids)}}, _PROJECTION).to_list(length=None)
+                    self._apply(ids, docs, meta)
+                    return True
+            meta = await db[META_COLLECTION].find_one({'_id': META_KEY})
+            docs = await db['produtos'].find({}, _PROJECTION).to_list(length=None)
+            self._swap(db, docs, meta)
+            return True
+        except Exception:
+            return False
+
+    # --- Publicação de versão ---------------------------------------------
+
+    @staticmethod
+    def _publish_update(raw_id: Any) -> Dict[str, Any]:
+        return {
+            '$inc': {'versao': 1},
+            '$push': {'alteracoes': {'$each': [str(raw_id)], '$slice': -CHANGE_LOG}},
+        }
+
+    def _adopt(self, meta: Optional[Dict[str, Any]]) -> None:
+        # Só adota a nova versão se ninguém mais escreveu desde a última carga;
+        # senão, a próxima `ensure_loaded` aplica as alterações pendentes.
+        with self._lock:
+            remote = (meta or {}).get('versao')
+            if isinstance(self._remote_version, int) and remote == self._remote_version + 1:
+                self._remote_version = remote
+            else:
+                self._checked_at = 0.0
+
+    def publish(self, db, raw_id: Any) -> None:
+        """Registra no log compartilhado um produto já atualizado localmente."""
+        if db is None:
+            return
+        try:
+            meta = db[META_COLLECTION].find_one_and_update(
+                {'_id': META_KEY}, self._publish_update(raw_id), upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self._adopt(meta)
+        except Exception:
+            self._dirty = True
+
+    async def publish_async(self, db, raw_id: Any) -> None:
+        if db is None:
+            return
+        try:
+            meta = await db[META_COLLECTION].find_one_and_update(
+                {'_id': META_KEY}, self._publish_update(raw_id), upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self._adopt(meta)
+        except Exception:
+            self._dirty = True
+
+    # --- Consulta ------------------------------------------------------------
+
+    def _term_keys(self, term: str) -> Set[str]:
+        """Ids que contêm `term`; o conjunto devolvido pode ser a própria postagem (não alterar)."""
+        if len(term) < MIN_GRAM:
+            return self._prefixes.get(term, set())
+        postings = sorted((self._grams.get(g, set()) for g in _grams(term)), key=len)
+        if not postings[0]:
+            return set()
+        found = postings[0].intersection(*postings[1:])
+        if len(term) == MIN_GRAM:
+            return found
+        return {k for k in found if term in self._entries[k]['text']}
+
+    @staticmethod
+    def _score(entry: Dict[str, Any], q_norm: str, terms: List[str]) -> int:
+        nome, codigo, desc = entry['nome'], entry['codigo'], entry['descricao']
+        score = 0
+        if q_norm == codigo:
+            score += 120
+        if q_norm == nome:
+            score += 90
+        if codigo.startswith(q_norm):
+            score += 60
+        if nome.startswith(q_norm):
+            score += 45
+        for t in terms:
+            if t in codigo:
+                score += 35
+            if t in nome:
+                score += 25
+            if t in desc:
+                score += 10
+        if bool(entry['doc'].get('ativo', True)):
+            score += 5
+        return score
+
+    def search(
+        self,
+        q: str,
+        limit: int = 10,
+        offset: int = 0,
+        ativos: bool = False,
+        central_ids: Optional[Iterable[Any]] = None,
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        """Produtos que casam com `q`, como (score, documento) em ordem de relevância.
+
+        `central_ids`, quando informado, restringe aos produtos dessas centrais
+        (qualquer forma de id); `ativos` exclui produtos inativos.
+        """
+        q_norm = fold(q).strip()
+        if not q_norm:
+            return []
+        terms = tokenize(q_norm) or [q_norm]
+        allowed = {str(c) for c in central_ids} if central_ids is not None else None
+        want = max(0, offset) + max(1, limit)
+
+        with self._lock:
+            exact = set(self._codes.get(q_norm, ()))
+            alias = self._aliases.get(q.strip())
+            if alias is not None:
+                exact.add(alias)
+            per_term = sorted((self._term_keys(t) for t in dict.fromkeys(terms)), key=len)
+
+            def admitted(ks: Iterable[str]) -> Iterable[str]:
+                for k in ks:
+                    doc = self._entries[k]['doc']
+                    if ativos and not bool(doc.get('ativo', True)):
+                        continue
+                    if allowed is not None and str(doc.get('central_id')) not in allowed:
+                        continue
+                    yield k
+
+            matched = list(admitted(exact))
+            cap = max(MAX_SCORED, want)
+            keys = per_term[0].intersection(*per_term[1:]) if len(per_term) > 1 else per_term[0]
+            matched += itertools.islice(admitted(k for k in keys if k not in exact), cap)
+            if len(matched) == len(exact) and len(per_term) > 1:
+                others = (k for k in set().union(*per_term) if k not in exact)
+                matched += itertools.islice(admitted(others), cap)
+
+            scored = []
+            for k in matched:
+                entry = self._entries[k]
+                score = self._score(entry, q_norm, terms) + (120 if k == alias else 0)
+                scored.append((-score, entry['nome'], k))
+            top = heapq.nsmallest(want, scored)
+            return [(-neg, self._entries[k]['doc']) for neg, _, k in top[offset:]]
+
+
+def relevance(doc: Dict[str, Any], q: str) -> int:
+    """Score de um documento avulso (mesmo ranking do índice), para o caminho de consulta direta."""
+    q_norm = fold(q).strip()
+    return ProductSearchIndex._score(ProductSearchIndex._entry_of(doc), q_norm, tokenize(q_norm) or [q_norm])
+
+
+product_index = ProductSearchIndex()
@@ -0,0 +1,166 @@
+"""Ponto de reposição por linha de estoque e flag `abaixo_minimo` indexada.
+
+"Estoque baixo" era decidido em cada tela: o dashboard contava
+`quantidade_disponivel < 10`, as listagens por hierarquia usavam 10% do saldo
+inicial e o widget de estoque baixo relia a coleção inteira e comparava o total
+por produto com `produtos.estoque_minimo`. Cada contagem varria `estoques`.
+
+Agora cada linha (produto × local) guarda o seu `ponto_reposicao` (sem valor,
+vale `ESTOQUE_PONTO_REPOSICAO`, 10 por padrão, o mesmo corte do dashboard) e a
+flag `abaixo_minimo = disponível < ponto_reposicao`, recalculada após toda
+escrita de saldo. Os índices parciais `idx_est_baixo_*` (extensions.py) só
+contêm as linhas com a flag ligada, então a contagem do dashboard e o widget
+leem apenas o índice.
+
+Linhas novas herdam o `estoque_minimo` do produto: na primeira vez que `sync`
+vê uma linha sem `ponto_reposicao`, lê o mínimo do produto e grava o ponto
+(nulo quando o produto não tem mínimo) com `ponto_reposicao_herdado`. Quando o
+mínimo do produto muda, `propagate` regrava só as linhas que herdaram o valor;
+um ponto definido na própria linha não é sobrescrito.
+
+O banco não calcula a flag na mesma escrita (os `$inc` das rotas não combinam
+com updates em pipeline, que o mongomock também não aceita): `sync` compara a
+flag do documento já atualizado e grava só quando ela muda, condicionada aos
+saldos lidos; se outra escrita passou no meio, o `sync` dela prevalece.
+"""
+import os
+from typing import Any, Dict, Optional, Sequence
+
+from bson import ObjectId
+
+FLAG_FIELD = 'abaixo_minimo'
+POINT_FIELD = 'ponto_reposicao'
+INHERITED_FIELD = 'ponto_reposicao_herdado'
+MINIMUM_FIELD = 'estoque_minimo'
+DEFAULT_POINT = float(os.getenv('ESTOQUE_PONTO_REPOSICAO', '10'))
+
+# Campos que decidem a flag (leitura mínima em `refresh`)
+_INPUT_FIELDS = ('quantidade', 'quantidade_atual', 'quantidade_disponivel', 'quantidade_reservada', POINT_FIELD)
+PROJECTION = dict({f: 1 for f in _INPUT_FIELDS}, **{FLAG_FIELD: 1, 'produto_id': 1})
+
+
+def _num(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def available(doc: Dict[str, Any]) -> float:
+    """Saldo disponível da linha: `quantidade_disponivel` ou, em linhas antigas, quantidade − reservada."""
+    disp = _num(doc.get('quantidade_disponivel'))
+    if disp is not None:
+        return disp
+    qtd = _num(doc.get('quantidade'))
+    if qtd is None:
+        qtd = _num(doc.get('quantidade_atual')) or 0.0
+    return qtd - (_num(doc.get('quantidade_reservada')) or 0.0)
+
+
+def point(doc: Dict[str, Any]) -> float:
+    value = _num(doc.get(POINT_FIELD))
+    return DEFAULT_POINT if value is None else value
+
+
+def is_below(doc: Dict[str, Any]) -> bool:
+    return available(doc) < point(doc)
+
+
+def parse_point(raw: Any) -> Optional[float]:
+    """Valor aceito para `ponto_reposicao`: número >= 0, ou None para voltar ao padrão. Levanta ValueError."""
+    if raw is None or raw == '':
+        return None
+    value = _num(raw)
+    if value is None or value < 0:
+        raise ValueError('ponto_reposicao deve ser um número maior ou igual a zero')
+    return value
+
+
+def produto_query(produto_id: Any) -> Dict[str, Any]:
+    """Produto referenciado por uma linha de estoque, em qualquer forma de id."""
+    s = str(produto_id)
+    ors = [{'_id': produto_id}, {'id': produto_id}, {'_id': s}, {'id': s}]
+    if ObjectId.is_valid(s):
+        ors.append({'_id': ObjectId(s)})
+    if s.isdigit():
+        ors.append({'id': int(s)})
+    return {'$or': ors}
+
+
+def _minimum(produto: Optional[Dict[str, Any]]) -> Optional[float]:
+    value = _num((produto or {}).get(MINIMUM_FIELD))
+    return value if value is not None and value >= 0 else None
+
+
+def _needs_seed(doc: Optional[Dict[str, Any]]) -> bool:
+    return bool(doc) and doc.get('_id') is not None and POINT_FIELD not in doc and doc.get('produto_id') is not None
+
+
+def _flag_write(doc: Optional[Dict[str, Any]], seed: bool = False):
+    """(filtro, update) que corrige a flag de `doc` (e grava o ponto herdado com `seed`); None quando já está certa."""
+    if not doc or doc.get('_id') is None:
+        return None
+    below = is_below(doc)
+    if doc.get(FLAG_FIELD) is below and not seed:
+        return None
+    guard = {'_id': doc['_id']}
+    guard.update({f: doc.get(f) for f in _INPUT_FIELDS})
+    fields = {FLAG_FIELD: below}
+    if seed:
+        guard[POINT_FIELD] = {'$exists': False}
+        fields.update({POINT_FIELD: doc[POINT_FIELD], INHERITED_FIELD: True})
+    return guard, {'$set': fields}
+
+
+def sync(coll, doc: Optional[Dict[str, Any]]) -> None:
+    """Acerta a flag de uma linha a partir do documento já atualizado (na primeira vez, herda o mínimo do produto)."""
+    seed = _needs_seed(doc)
+    if seed:
+        doc[POINT_FIELD] = _minimum(coll.database['produtos'].find_one(produto_query(doc['produto_id']), {MINIMUM_FIELD: 1}))
+    write = _flag_write(doc, seed)
+    if write:
+        coll.update_one(*write)
+
+
+async def sync_async(coll, doc: Optional[Dict[str, Any]]) -> None:
+    seed = _needs_seed(doc)
+    if seed:
+        doc[POINT_FIELD] = _minimum(await coll.database['produtos'].find_one(produto_query(doc['produto_id']), {MINIMUM_FIELD: 1}))
+    write = _flag_write(doc, seed)
+    if write:
+        await coll.update_one(*write)
+
+
+def refresh(coll, query: Dict[str, Any]) -> None:
+    """Acerta a flag das linhas que casam com `query` (escritas que não devolvem o documento)."""
+    for doc in coll.find(query, PROJECTION):
+        sync(coll, doc)
+
+
+async def refresh_async(coll, query: Dict[str, Any]) -> None:
+    for doc in await coll.find(query, PROJECTION).to_list(length=None):
+        await sync_async(coll, doc)
+
+
+def _propagate_write(pid_vals: Sequence[Any], minimo: Optional[float]):
+    query = {'produto_id': {'$in': list(pid_vals)}, '$or': [{INHERITED_FIELD: True}, {POINT_FIELD: {'$exists': False}}]}
+    return query, {'$set': {POINT_FIELD: minimo, INHERITED_FIELD: True}}
+
+
+def propagate(coll, pid_vals: Sequence[Any], minimo: Optional[float]) -> None:
+    """Novo `estoque_minimo` do produto nas linhas que herdam o ponto; recalcula as flags."""
+    coll.update_many(*_propagate_write(pid_vals, minimo))
+    refresh(coll, {'produto_id': {'$in': list(pid_vals)}})
+
+
+async def propagate_async(coll, pid_vals: Sequence[Any], minimo: Optional[float]) -> None:
+    await coll.update_many(*_propagate_write(pid_vals, minimo))
+    await refresh_async(coll, {'produto_id': {'$in': list(pid_vals)}})
+
+
+def low_stock_query(scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Filtro das linhas abaixo do ponto de reposição, coberto pelos índices parciais."""
+    query: Dict[str, Any] = {FLAG_FIELD: True}
+    if scope:
+        query.update(scope)
+    return query
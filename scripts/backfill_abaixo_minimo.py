@@ -0,0 +1,96 @@
+import sys
+import os
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from bson import ObjectId
+
+import reorder_points
+
+
+def _produto_minimos(db, pids) -> dict:
+    """`estoque_minimo` numérico dos produtos referenciados, indexado por todas as formas de id."""
+    oids, seqs = [], []
+    for raw in pids:
+        s = str(raw)
+        if ObjectId.is_valid(s):
+            oids.append(ObjectId(s))
+        seqs.append(int(s) if s.isdigit() else s)
+    out = {}
+    query = {'$or': [{'_id': {'$in': oids}}, {'id': {'$in': seqs}}], 'estoque_minimo': {'$type': 'number'}}
+    for p in db['produtos'].find(query, {'_id': 1, 'id': 1, 'estoque_minimo': 1}):
+        for key in (p.get('_id'), p.get('id')):
+            if key is not None:
+                out[str(key)] = float(p['estoque_minimo'])
+    return out
+
+
+def backfill_abaixo_minimo(db, batch_size: int = 500, seed_from_produto: bool = True, log=print) -> dict:
+    """Grava `abaixo_minimo` em todas as linhas de `estoques`.
+
+    - Com `seed_from_produto`, linhas sem `ponto_reposicao` herdam o
+      `estoque_minimo` do produto (o limite que o widget de estoque baixo usava).
+    - Percorre a coleção em ordem de `_id`, em lotes de `batch_size`, e grava com
+      um `update_many` por valor (ponto, flag) dentro do lote. Pode ser repetido:
+      linhas já corretas não são regravadas.
+    """
+    if db is None:
+        raise RuntimeError('MongoDB não inicializado. Verifique MONGO_URI/MONGO_DB e inicialização do app.')
+
+    coll = db['estoques']
+    projection = dict(reorder_points.PROJECTION, produto_id=1)
+    last_id = None
+    seeded = flagged = updated = 0
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = list(coll.find(query, projection).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        minimos = {}
+        if seed_from_produto:
+            minimos = _produto_minimos(db, {d.get('produto_id') for d in batch
+                                            if d.get('produto_id') is not None and d.get(reorder_points.POINT_FIELD) is None})
+        groups = {}
+        for doc in batch:
+            fields = {}
+            minimo = minimos.get(str(doc.get('produto_id'))) if doc.get(reorder_points.POINT_FIELD) is None else None
+            if minimo is not None:
+                fields[reorder_points.POINT_FIELD] = minimo
+                fields[reorder_points.INHERITED_FIELD] = True
+                doc[reorder_points.POINT_FIELD] = minimo
+                seeded += 1
+            below = reorder_points.is_below(doc)
+            flagged += 1 if below else 0
+            if doc.get(reorder_points.FLAG_FIELD) is not below:
+                fields[reorder_points.FLAG_FIELD] = below
+            if fields:
+                groups.setdefault(tuple(sorted(fields.items())), []).append(doc['_id'])
+        for key, ids in groups.items():
+            coll.update_many({'_id': {'$in': ids}}, {'$set': dict(key)})
+            updated += len(ids)
+        last_id = batch[-1]['_id']
+        if log:
+            log(f'[Backfill abaixo_minimo] {updated} atualizados até _id={last_id}')
+    return {'database': db.name, 'updated': updated, 'seeded': seeded, 'abaixo_minimo': flagged}
+
+
+if __name__ == '__main__':
+    # CLI: python scripts/backfill_abaixo_minimo.py [--batch-size N] [--sem-produto]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Backfill da flag abaixo_minimo (ponto de reposição) em estoques')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--sem-produto', action='store_true', help='não copia produtos.estoque_minimo para ponto_reposicao')
+    args = parser.parse_args()
+
+    # Importa o app para inicializar o Mongo via extensions.init_mongo
+    from app import app  # noqa: F401
+    import extensions
+
+    summary = backfill_abaixo_minimo(extensions.mongo_db, batch_size=max(1, args.batch_size), seed_from_produto=not args.sem_produto)
+    print('[Backfill abaixo_minimo] Banco:', summary['database'])
+    print(f"  - {summary['updated']} linhas atualizadas, {summary['seeded']} pontos herdados do produto, "
+          f"{summary['abaixo_minimo']} abaixo do mínimo")
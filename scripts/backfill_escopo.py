@@ -0,0 +1,94 @@
+import sys
+import os
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from hierarchy import (
+    META_COLLECTION, META_KEY, SCOPE_FIELD, SCOPE_KEYS, HierarchyGraph, local_of_estoque, local_of_movimentacao,
+)
+
+CHECKPOINT_KEY = 'escopo_backfill'
+TARGETS = (
+    ('estoques', local_of_estoque),
+    ('movimentacoes', local_of_movimentacao),
+)
+
+
+def backfill_escopo(db, batch_size: int = 500, reset: bool = False, log=print) -> dict:
+    """Preenche `escopo` (ids canônicos de central/almox/sub/setor) em estoques e movimentações.
+
+    - Percorre cada coleção em ordem de `_id`, em lotes de `batch_size`; dentro do lote
+      agrupa os documentos por escopo e grava com um `update_many` por grupo.
+    - Grava o último `_id` processado em `sistema_meta` após cada lote; uma nova
+      execução retoma de onde parou (use `reset=True` para recomeçar do zero,
+      por exemplo depois de mover setores/subs entre almoxarifados).
+    - Ao final marca `escopo_pronto` e incrementa a versão da hierarquia, o que
+      habilita os filtros de escopo por igualdade nos dois apps.
+    """
+    if db is None:
+        raise RuntimeError('MongoDB não inicializado. Verifique MONGO_URI/MONGO_DB e inicialização do app.')
+
+    graph = HierarchyGraph()
+    if not graph.ensure_loaded(db):
+        raise RuntimeError('Falha ao carregar a hierarquia (centrais/almoxarifados/sub_almoxarifados/setores).')
+
+    meta = db[META_COLLECTION]
+    if reset:
+        meta.delete_one({'_id': CHECKPOINT_KEY})
+    checkpoint = meta.find_one({'_id': CHECKPOINT_KEY}) or {}
+
+    result = {'database': db.name, 'collections': {}}
+    for coll_name, locate in TARGETS:
+        coll = db[coll_name]
+        last_id = checkpoint.get(coll_name)
+        updated = 0
+        unresolved = 0
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = list(coll.find(query).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            groups = {}
+            for doc in batch:
+                tipo, local_id = locate(doc)
+                escopo = graph.scope_of(tipo, local_id) if tipo else None
+                if not escopo or not any(escopo.values()):
+                    unresolved += 1
+                    continue
+                if doc.get(SCOPE_FIELD) != escopo:
+                    key = tuple(escopo[k] for k in SCOPE_KEYS)
+                    groups.setdefault(key, []).append(doc['_id'])
+            for key, ids in groups.items():
+                coll.update_many({'_id': {'$in': ids}}, {'$set': {SCOPE_FIELD: dict(zip(SCOPE_KEYS, key))}})
+                updated += len(ids)
+            last_id = batch[-1]['_id']
+            meta.update_one({'_id': CHECKPOINT_KEY}, {'$set': {coll_name: last_id}}, upsert=True)
+            if log:
+                log(f'[Backfill escopo] {coll_name}: {updated} atualizados até _id={last_id}')
+        result['collections'][coll_name] = {'updated': updated, 'unresolved': unresolved}
+
+    meta.update_one({'_id': META_KEY}, {'$set': {'escopo_pronto': True}, '$inc': {'versao': 1}}, upsert=True)
+    result['escopo_pronto'] = True
+    return result
+
+
+if __name__ == '__main__':
+    # CLI: python scripts/backfill_escopo.py [--reset] [--batch-size N]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Backfill do campo escopo em estoques e movimentações')
+    parser.add_argument('--reset', action='store_true', help='ignora o checkpoint e reprocessa tudo')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    # Importa o app para inicializar o Mongo via extensions.init_mongo
+    from app import app  # noqa: F401
+    import extensions
+
+    summary = backfill_escopo(extensions.mongo_db, batch_size=max(1, args.batch_size), reset=args.reset)
+    print('[Backfill escopo] Banco:', summary['database'])
+    for k, v in summary['collections'].items():
+        print(f"  - {k}: {v['updated']} atualizados, {v['unresolved']} sem local resolvido")
@@ -0,0 +1,175 @@
+import sys
+import os
+from datetime import datetime, timezone
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from canonical_ids import (
+    FIELD_TARGETS, ID_MAP_COLLECTION, META_KEY, TYPED_FIELDS, collection_for_tipo,
+)
+from hierarchy import META_COLLECTION, META_KEY as HIERARCHY_META_KEY
+
+CHECKPOINT_KEY = 'ids_canonicos_migracao'
+
+# Coleções referenciadas (têm `id` legado a mapear)
+ENTITY_COLLECTIONS = ('centrais', 'almoxarifados', 'sub_almoxarifados', 'setores', 'categorias', 'produtos', 'usuarios')
+# Coleções cujas chaves estrangeiras são reescritas
+MIGRATED_COLLECTIONS = (
+    'produtos', 'almoxarifados', 'sub_almoxarifados', 'setores', 'usuarios',
+    'estoques', 'movimentacoes', 'lotes', 'demandas', 'listas_compras',
+)
+
+
+def _build_index(db, log=print):
+    """{coleção: {forma_do_id: str(_id)}} e documentos de mapeamento legado."""
+    index = {}
+    mappings = []
+    for coll_name in ENTITY_COLLECTIONS:
+        forms = index.setdefault(coll_name, {})
+        for doc in db[coll_name].find({}, {'_id': 1, 'id': 1}):
+            canon = str(doc['_id'])
+            forms[canon] = canon
+            legacy = doc.get('id')
+            if legacy is not None and str(legacy) != canon:
+                forms[str(legacy)] = canon
+                mappings.append({
+                    '_id': f'{coll_name}:{legacy}',
+                    'colecao': coll_name,
+                    'legado': legacy,
+                    'canonico': canon,
+                })
+        if log:
+            log(f'[IDs canônicos] {coll_name}: {len(forms)} formas de id indexadas')
+    return index, mappings
+
+
+def _canon(index, coll_name, value):
+    if value is None or coll_name is None:
+        return value, True
+    if isinstance(value, ObjectId):
+        value = str(value)
+    canon = index.get(coll_name, {}).get(str(value))
+    return (canon, True) if canon is not None else (value, False)
+
+
+def _rewrite(doc, index):
+    """Campos a reescrever em `doc` e quantidade de valores não resolvidos."""
+    changes = {}
+    unresolved = 0
+    fields = [(f, target) for f, target in FIELD_TARGETS.items() if f in doc]
+    fields += [(f, collection_for_tipo(doc.get(tipo_f))) for f, tipo_f in TYPED_FIELDS.items() if f in doc]
+    for field, target in fields:
+        value = doc.get(field)
+        if target is None or value is None:
+            continue
+        if isinstance(value, list):
+            out = []
+            for v in value:
+                c, ok = _canon(index, target, v)
+                unresolved += 0 if ok else 1
+                out.append(c)
+            if out != value:
+                changes[field] = out
+        else:
+            c, ok = _canon(index, target, value)
+            unresolved += 0 if ok else 1
+            if c != value:
+                changes[field] = c
+    return changes, unresolved
+
+
+def _bulk(coll, ops):
+    """`bulk_write` não ordenado (nada a fazer sem operações)."""
+    if not ops:
+        return
+    coll.bulk_write(ops, ordered=False)
+
+
+def migrate_canonical_ids(db, dry_run: bool = False, batch_size: int = 1000, reset: bool = False, log=print) -> dict:
+    """Reescreve chaves estrangeiras para `str(_id)` e registra o mapeamento legado.
+
+    - Percorre cada coleção em ordem de `_id`, em lotes de `batch_size`, com um
+      `bulk_write` por lote e checkpoint em `sistema_meta`: uma execução
+      interrompida retoma de onde parou (`reset=True` recomeça do zero). Ao
+      terminar, o checkpoint é removido.
+    - Idempotente: valores já canônicos não geram escrita; pode ser reexecutado
+      depois que o app Flask criar novos registros com ids sequenciais.
+    - O campo `id` das próprias entidades é mantido (id público legado).
+    - Valores que não correspondem a nenhum documento ficam como estão e são
+      contados em `unresolved`.
+    """
+    if db is None:
+        raise RuntimeError('MongoDB não inicializado. Verifique MONGO_URI/MONGO_DB e inicialização do app.')
+
+    index, mappings = _build_index(db, log=log)
+    result = {'database': db.name, 'dry_run': dry_run, 'mapped': len(mappings), 'collections': {}}
+
+    meta = db[META_COLLECTION]
+    if reset and not dry_run:
+        meta.delete_one({'_id': CHECKPOINT_KEY})
+    checkpoint = {} if dry_run else (meta.find_one({'_id': CHECKPOINT_KEY}) or {})
+
+    if not dry_run:
+        id_map = db[ID_MAP_COLLECTION]
+        for i in range(0, len(mappings), batch_size):
+            _bulk(id_map, [UpdateOne({'_id': m['_id']}, {'$set': m}, upsert=True) for m in mappings[i:i + batch_size]])
+
+    for coll_name in MIGRATED_COLLECTIONS:
+        coll = db[coll_name]
+        last_id = checkpoint.get(coll_name)
+        updated = 0
+        unresolved = 0
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = list(coll.find(query).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            ops = []
+            for doc in batch:
+                changes, miss = _rewrite(doc, index)
+                unresolved += miss
+                if changes:
+                    ops.append(UpdateOne({'_id': doc['_id']}, {'$set': changes}))
+            updated += len(ops)
+            last_id = batch[-1]['_id']
+            if not dry_run:
+                _bulk(coll, ops)
+                meta.update_one({'_id': CHECKPOINT_KEY}, {'$set': {coll_name: last_id}}, upsert=True)
+        result['collections'][coll_name] = {'updated': updated, 'unresolved': unresolved}
+        if log:
+            log(f'[IDs canônicos] {coll_name}: {updated} atualizados, {unresolved} valores sem correspondência')
+
+    if not dry_run:
+        meta.update_one({'_id': META_KEY}, {'$set': {'migrado_em': datetime.now(timezone.utc)}}, upsert=True)
+        # Campos de parentesco mudaram de formato: forçar recarga do grafo
+        meta.update_one({'_id': HIERARCHY_META_KEY}, {'$inc': {'versao': 1}}, upsert=True)
+        meta.delete_one({'_id': CHECKPOINT_KEY})
+    return result
+
+
+if __name__ == '__main__':
+    # CLI: python scripts/migrate_canonical_ids.py [--dry-run] [--reset] [--batch-size N]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Migra chaves estrangeiras para o id canônico str(_id)')
+    parser.add_argument('--dry-run', action='store_true', help='apenas conta o que seria alterado')
+    parser.add_argument('--reset', action='store_true', help='ignora o checkpoint de uma execução interrompida')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    # Importa o app para inicializar o Mongo via extensions.init_mongo
+    from app import app  # noqa: F401
+    import extensions
+
+    summary = migrate_canonical_ids(extensions.mongo_db, dry_run=args.dry_run, batch_size=max(1, args.batch_size),
+                                    reset=args.reset)
+    print('[IDs canônicos] Banco:', summary['database'], '(dry-run)' if summary['dry_run'] else '')
+    print(f"  - mapeamentos legados: {summary['mapped']}")
+    for k, v in summary['collections'].items():
+        print(f"  - {k}: {v['updated']} atualizados, {v['unresolved']} sem correspondência")
@@ -0,0 +1,85 @@
+import sys
+import os
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from hierarchy import META_COLLECTION, META_KEY, SCOPE_FIELD, HierarchyGraph, local_of_estoque
+import lot_expiry
+
+CHECKPOINT_KEY = 'lotes_validade_migracao'
+
+
+def migrate_lotes_validade(db, batch_size: int = 500, reset: bool = False, log=print) -> dict:
+    """Normaliza a validade dos lotes em `data_validade` (datetime) e grava o `escopo` de cada lote.
+
+    - `data_vencimento`/`validade`/`vencimento` (datetime ou string) viram
+      `data_validade` e os campos antigos são removidos; lotes com data ilegível
+      ficam sem validade e são contados em `sem_validade`.
+    - Percorre `lotes` em ordem de `_id`, em lotes de `batch_size`, com checkpoint
+      em `sistema_meta` (use `reset=True` para recomeçar).
+    - Ao final marca `lotes_validade_pronto` e incrementa a versão da hierarquia,
+      o que habilita o filtro de escopo nas consultas de vencimento.
+    """
+    if db is None:
+        raise RuntimeError('MongoDB não inicializado. Verifique MONGO_URI/MONGO_DB e inicialização do app.')
+
+    graph = HierarchyGraph()
+    if not graph.ensure_loaded(db):
+        raise RuntimeError('Falha ao carregar a hierarquia (centrais/almoxarifados/sub_almoxarifados/setores).')
+
+    meta = db[META_COLLECTION]
+    if reset:
+        meta.delete_one({'_id': CHECKPOINT_KEY})
+    last_id = (meta.find_one({'_id': CHECKPOINT_KEY}) or {}).get('lotes')
+
+    coll = db['lotes']
+    updated = sem_validade = sem_local = 0
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = list(coll.find(query).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        for doc in batch:
+            update = lot_expiry.normalized_update(doc) or {}
+            if lot_expiry.expiry_of(doc) is None:
+                sem_validade += 1
+            tipo, local_id = local_of_estoque(doc)
+            escopo = graph.scope_of(tipo, local_id) if tipo else None
+            if escopo and any(escopo.values()):
+                if doc.get(SCOPE_FIELD) != escopo:
+                    update.setdefault('$set', {})[SCOPE_FIELD] = escopo
+            else:
+                sem_local += 1
+            if update:
+                coll.update_one({'_id': doc['_id']}, update)
+                updated += 1
+        last_id = batch[-1]['_id']
+        meta.update_one({'_id': CHECKPOINT_KEY}, {'$set': {'lotes': last_id}}, upsert=True)
+        if log:
+            log(f'[Migração lotes] {updated} atualizados até _id={last_id}')
+
+    meta.update_one({'_id': META_KEY}, {'$set': {lot_expiry.READY_KEY: True}, '$inc': {'versao': 1}}, upsert=True)
+    return {'database': db.name, 'updated': updated, 'sem_validade': sem_validade, 'sem_local': sem_local,
+            lot_expiry.READY_KEY: True}
+
+
+if __name__ == '__main__':
+    # CLI: python scripts/migrate_lotes_validade.py [--reset] [--batch-size N]
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Normaliza data_validade e grava escopo nos lotes')
+    parser.add_argument('--reset', action='store_true', help='ignora o checkpoint e reprocessa tudo')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    # Importa o app para inicializar o Mongo via extensions.init_mongo
+    from app import app  # noqa: F401
+    import extensions
+
+    summary = migrate_lotes_validade(extensions.mongo_db, batch_size=max(1, args.batch_size), reset=args.reset)
+    print('[Migração lotes] Banco:', summary['database'])
+    print(f"  - {summary['updated']} atualizados, {summary['sem_validade']} sem validade, "
+          f"{summary['sem_local']} sem local resolvido")
@@ -0,0 +1,308 @@
+import sys
+import os
+import math
+import random
+from datetime import datetime, timedelta
+
+# Garantir que o diretório raiz do projeto esteja no PYTHONPATH
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from bson import ObjectId
+
+from hierarchy import META_COLLECTION, META_KEY
+import lot_expiry
+import reorder_points
+
+SEEDED_COLLECTIONS = ('centrais', 'almoxarifados', 'sub_almoxarifados', 'setores', 'categorias', 'produtos',
+                      'estoques', 'lotes', 'movimentacoes')
+
+_UNIDADES = ('UN', 'CX', 'FR', 'AMP', 'CP', 'ML', 'PCT', 'TB')
+_CATEGORIAS = ('Medicamentos', 'Material hospitalar', 'Material de limpeza', 'Expediente', 'Laboratório',
+               'Odontológico', 'Nutrição', 'EPI')
+_PREFIXOS = ('Dipirona', 'Paracetamol', 'Amoxicilina', 'Soro fisiológico', 'Luva', 'Seringa', 'Gaze', 'Atadura',
+             'Cateter', 'Máscara', 'Álcool', 'Omeprazol', 'Losartana', 'Insulina', 'Ibuprofeno', 'Sonda',
+             'Equipo', 'Agulha', 'Esparadrapo', 'Clorexidina')
+_SETORES = ('UTI', 'Pronto-socorro', 'Centro cirúrgico', 'Pediatria', 'Maternidade', 'Clínica médica',
+            'Ambulatório', 'Farmácia', 'Laboratório', 'Radiologia', 'Enfermaria', 'Odontologia')
+
+# Sazonalidade diária das movimentações: dias úteis cheios, fim de semana fraco,
+# pico de consumo no inverno (junho/julho) e horário comercial
+_PESO_DIA_SEMANA = (1.15, 1.1, 1.05, 1.0, 0.95, 0.35, 0.2)
+_PESO_HORA = [0.05] * 6 + [0.4, 1.0, 1.4, 1.5, 1.4, 1.0, 0.6, 1.1, 1.3, 1.2, 0.9, 0.5] + [0.15] * 6
+# Tipos de movimentação e participação no total
+_TIPOS = (('distribuicao', 0.5), ('entrada', 0.15), ('transferencia', 0.1), ('saida', 0.25))
+
+
+def _oid(rng: random.Random) -> ObjectId:
+    """ObjectId reproduzível (derivado da semente), em vez de um baseado no relógio."""
+    return ObjectId(rng.getrandbits(96).to_bytes(12, 'big'))
+
+
+def _escopo(central=None, almox=None, sub=None, setor=None) -> dict:
+    return {'central_id': central, 'almoxarifado_id': almox, 'sub_almoxarifado_id': sub, 'setor_id': setor}
+
+
+def _flush(coll, batch: list, counts: dict, name: str) -> None:
+    if batch:
+        coll.insert_many(batch, ordered=False)
+        counts[name] = counts.get(name, 0) + len(batch)
+        batch.clear()
+
+
+def _daily_weights(days: int, end: datetime) -> list:
+    """Peso relativo de cada dia da janela (dia da semana x estação)."""
+    start = end - timedelta(days=days)
+    weights = []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        season = 1.0 + 0.25 * math.cos((day.timetuple().tm_yday - 190) / 365.0 * 2 * math.pi)
+        weights.append(_PESO_DIA_SEMANA[day.weekday()] * season)
+    return weights
+
+
+def seed_synthetic(db, centrais: int = 2, almox_por_central: int = 3, subs_por_almox: int = 2,
+                   setores_por_sub: int = 5, produtos: int = 50000, lotes_por_estoque: int = 3,
+                   movimentacoes: int = 1000000, dias: int = 365, batch_size: int = 10000, seed: int = 42,
+                   reset: bool = False, now: datetime = None, log=print) -> dict:
+    """Gera uma rede hospitalar sintética e reproduzível para testes de carga.
+
+    - Hierarquia: `centrais` x `almox_por_central` x `subs_por_almox` x
+      `setores_por_sub`, com `escopo` já gravado (como depois do backfill).
+    - `produtos` distribuídos entre as centrais; cada produto tem estoque em um
+      a três almoxarifados da sua central, com ponto de reposição e a flag
+      `abaixo_minimo` (reorder_points.py) coerentes.
+    - Até `lotes_por_estoque` lotes por linha de estoque, somando o saldo da
+      linha, com validade espalhada: ~5% vencidos, ~10% nos próximos 30 dias e
+      o resto entre 1 e 24 meses.
+    - `movimentacoes` espalhadas em `dias` dias com sazonalidade (dia da
+      semana, inverno, horário comercial) e popularidade de produtos em cauda
+      longa. Os totais das movimentações não reconciliam com os saldos; servem
+      para carga de leitura (listagens, relatórios, exportações).
+
+    Escreve com `insert_many` em lotes de `batch_size`; a mesma `seed` gera os
+    mesmos documentos (inclusive `_id`). Com `reset=True` esvazia antes as
+    coleções geradas (usuários não são tocados).
+
+    `escopo_pronto` e `lotes_validade_pronto` só são marcados quando o banco
+    fica só com dados gerados (`reset=True` ou coleções vazias antes): dados
+    antigos que já estivessem lá ainda precisam dos backfills.
+    """
+    if db is None:
+        raise RuntimeError('MongoDB não inicializado. Verifique MONGO_URI/MONGO_DB e inicialização do app.')
+
+    rng = random.Random(seed)
+    now = (now or datetime.utcnow()).replace(microsecond=0)
+    counts: dict = {}
+    if reset:
+        for name in SEEDED_COLLECTIONS:
+            db[name].delete_many({})
+    only_seeded = reset or all(db[name].find_one({}, {'_id': 1}) is None for name in SEEDED_COLLECTIONS)
+
+    # 1. Hierarquia
+    hier = {'centrais': [], 'almoxarifados': [], 'sub_almoxarifados': [], 'setores': []}
+    almox_da_central = {}
+    subs_do_almox = {}
+    setores_do_sub = {}
+    for c in range(centrais):
+        cid = _oid(rng)
+        hier['centrais'].append({'_id': cid, 'nome': f'Central {c + 1}', 'ativo': True, 'created_at': now})
+        almox_da_central[str(cid)] = []
+        for a in range(almox_por_central):
+            aid = _oid(rng)
+            hier['almoxarifados'].append({'_id': aid, 'nome': f'Almoxarifado {c + 1}.{a + 1}', 'central_id': str(cid),
+                                          'ativo': True, 'created_at': now})
+            almox_da_central[str(cid)].append(str(aid))
+            subs_do_almox[str(aid)] = []
+            for s in range(subs_por_almox):
+                sid = _oid(rng)
+                hier['sub_almoxarifados'].append({'_id': sid, 'nome': f'Sub-Almoxarifado {c + 1}.{a + 1}.{s + 1}',
+                                                  'almoxarifado_id': str(aid), 'ativo': True, 'created_at': now})
+                subs_do_almox[str(aid)].append(str(sid))
+                setores_do_sub[str(sid)] = []
+                for t in range(setores_por_sub):
+                    tid = _oid(rng)
+                    nome = f'{_SETORES[t % len(_SETORES)]} {c + 1}.{a + 1}.{s + 1}.{t + 1}'
+                    hier['setores'].append({'_id': tid, 'nome': nome, 'almoxarifado_id': str(aid), 'sub_almoxarifado_id': str(sid),
+                                            'sub_almoxarifado_ids': [str(sid)], 'ativo': True, 'created_at': now})
+                    setores_do_sub[str(sid)].append(str(tid))
+    for name, docs in hier.items():
+        for i in range(0, len(docs), batch_size):
+            _flush(db[name], docs[i:i + batch_size], counts, name)
+    central_do_almox = {a: c for c, almoxes in almox_da_central.items() for a in almoxes}
+    almox_do_sub = {s: a for a, subs in subs_do_almox.items() for s in subs}
+    sub_do_setor = {t: s for s, setores in setores_do_sub.items() for t in setores}
+    nomes = {str(d['_id']): d['nome'] for docs in hier.values() for d in docs}
+    categorias = [{'_id': _oid(rng), 'nome': n, 'created_at': now} for n in _CATEGORIAS]
+    _flush(db['categorias'], list(categorias), counts, 'categorias')
+    if log:
+        log(f"[Seed] Hierarquia: {centrais} centrais, {len(hier['almoxarifados'])} almoxarifados, "
+            f"{len(hier['sub_almoxarifados'])} sub-almoxarifados, {len(hier['setores'])} setores")
+
+    # 2. Produtos, estoques e lotes
+    central_ids = list(almox_da_central)
+    produto_ids = []
+    batches = {'produtos': [], 'estoques': [], 'lotes': []}
+    for p in range(produtos):
+        pid = _oid(rng)
+        cid = central_ids[p % len(central_ids)] if central_ids else None
+        estoque_minimo = rng.choice((0, 5, 10, 20, 50, 100))
+        batches['produtos'].append({
+            '_id': pid, 'codigo': f'SYN-{p + 1:06d}', 'nome': f'{rng.choice(_PREFIXOS)} {p + 1}',
+            'unidade_medida': rng.choice(_UNIDADES), 'categoria_id': str(rng.choice(categorias)['_id']),
+            'central_id': cid, 'estoque_minimo': estoque_minimo, 'ativo': True, 'created_at': now, 'updated_at': now,
+        })
+        produto_ids.append(str(pid))
+        almoxes = almox_da_central.get(cid) or []
+        for aid in rng.sample(almoxes, min(len(almoxes), rng.randint(1, 3))):
+            qtd = float(rng.choice((0, rng.randint(1, 30), rng.randint(30, 500), rng.randint(500, 5000))))
+            escopo = _escopo(central=cid, almox=aid)
+            row = {
+                '_id': _oid(rng), 'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': aid, 'almoxarifado_id': aid,
+                'nome_local': nomes[aid], 'quantidade': qtd, 'quantidade_atual': qtd, 'quantidade_disponivel': qtd,
+                reorder_points.POINT_FIELD: float(estoque_minimo), reorder_points.INHERITED_FIELD: True, 'escopo': escopo, 'created_at': now, 'updated_at': now,
+            }
+            row[reorder_points.FLAG_FIELD] = reorder_points.is_below(row)
+            batches['estoques'].append(row)
+            n_lotes = rng.randint(1, max(1, lotes_por_estoque)) if qtd > 0 and lotes_por_estoque > 0 else 0
+            restante = qtd
+            for n in range(n_lotes):
+                q = restante if n == n_lotes - 1 else float(int(restante * rng.uniform(0.2, 0.6)))
+                restante -= q
+                r = rng.random()
+                if r < 0.05:
+                    validade = now - timedelta(days=rng.randint(1, 120))
+                elif r < 0.15:
+                    validade = now + timedelta(days=rng.randint(0, 30))
+                else:
+                    validade = now + timedelta(days=rng.randint(31, 730))
+                numero = f'L{p + 1:06d}-{aid[-4:]}-{n + 1}'
+                batches['lotes'].append({
+                    '_id': _oid(rng), 'produto_id': str(pid), 'numero_lote': numero, 'lote': numero, 'local_tipo': 'almoxarifado',
+                    'local_id': aid, 'almoxarifado_id': aid, 'quantidade_atual': q, lot_expiry.FIELD: validade,
+                    'escopo': escopo, 'created_at': now, 'updated_at': now,
+                })
+        for name, batch in batches.items():
+            if len(batch) >= batch_size:
+                _flush(db[name], batch, counts, name)
+    for name, batch in batches.items():
+        _flush(db[name], batch, counts, name)
+    if log:
+        log(f"[Seed] {counts.get('produtos', 0)} produtos, {counts.get('estoques', 0)} estoques, {counts.get('lotes', 0)} lotes")
+
+    # 3. Movimentações com sazonalidade
+    setores = list(sub_do_setor)
+    almoxes_all = list(central_do_almox)
+    subs_all = list(almox_do_sub)
+    tipos = [t for t, _ in _TIPOS]
+    tipo_pesos = [w for _, w in _TIPOS]
+    pesos_dia = _daily_weights(dias, now) if dias > 0 else []
+    total_peso = sum(pesos_dia) or 1.0
+    horas = list(range(24))
+    start = now - timedelta(days=dias)
+    batch: list = []
+    gerados = 0
+    for i, peso in enumerate(pesos_dia):
+        if not (produto_ids and almoxes_all):
+            break
+        # Último dia fecha a conta para o total bater exatamente
+        n_dia = movimentacoes - gerados if i == len(pesos_dia) - 1 else int(round(movimentacoes * peso / total_peso))
+        n_dia = max(0, min(n_dia, movimentacoes - gerados))
+        dia = start + timedelta(days=i)
+        for _ in range(n_dia):
+            # Cauda longa: poucos produtos concentram a maior parte das movimentações
+            pid = produto_ids[int(len(produto_ids) * rng.random() ** 3)]
+            tipo = rng.choices(tipos, tipo_pesos)[0]
+            quando = dia + timedelta(hours=rng.choices(horas, _PESO_HORA)[0], minutes=rng.randrange(60), seconds=rng.randrange(60))
+            qtd = float(rng.choice((1, 1, 2, 2, 3, 5, 10, 20, 50)))
+            aid = rng.choice(almoxes_all)
+            cid = central_do_almox[aid]
+            if tipo == 'entrada':
+                origem = (None, None)
+                destino = ('almoxarifado', aid)
+                escopo = _escopo(central=cid, almox=aid)
+            elif tipo == 'transferencia' and subs_all:
+                sid = rng.choice(subs_do_almox[aid]) if subs_do_almox[aid] else rng.choice(subs_all)
+                origem = ('almoxarifado', aid)
+                destino = ('sub_almoxarifado', sid)
+                escopo = _escopo(central=cid, almox=aid)
+            elif tipo == 'saida' and setores:
+                tid = rng.choice(setores)
+                sid = sub_do_setor[tid]
+                a2 = almox_do_sub[sid]
+                origem = ('setor', tid)
+                destino = (None, None)
+                escopo = _escopo(central=central_do_almox[a2], almox=a2, sub=sid, setor=tid)
+            else:
+                tipo = 'distribuicao'
+                tid = rng.choice(setores) if setores else None
+                origem = ('almoxarifado', aid)
+                destino = ('setor', tid)
+                escopo = _escopo(central=cid, almox=aid)
+            batch.append({
+                '_id': _oid(rng), 'produto_id': pid, 'tipo': tipo, 'quantidade': qtd, 'data_movimentacao': quando,
+                'origem_nome': nomes.get(origem[1]) if origem[1] else 'Fornecedor',
+                'destino_nome': nomes.get(destino[1]) if destino[1] else 'Consumo',
+                'usuario_responsavel': 'seed', 'central_id': escopo['central_id'],
+                'local_origem_id': origem[1], 'local_origem_tipo': origem[0],
+                'local_destino_id': destino[1], 'local_destino_tipo': destino[0],
+                'escopo': escopo, 'created_at': quando,
+            })
+            if len(batch) >= batch_size:
+                _flush(db['movimentacoes'], batch, counts, 'movimentacoes')
+                if log:
+                    log(f"[Seed] {counts['movimentacoes']} movimentações")
+        gerados += n_dia
+    _flush(db['movimentacoes'], batch, counts, 'movimentacoes')
+
+    # Dados gerados já nascem no formato pós-migração (escopo e validade normalizados)
+    if only_seeded:
+        db[META_COLLECTION].update_one({'_id': META_KEY}, {'$set': {'escopo_pronto': True, lot_expiry.READY_KEY: True},
+                                                            '$inc': {'versao': 1}}, upsert=True)
+    elif log:
+        log('[Seed] Coleções já tinham dados: rode scripts/backfill_escopo.py e scripts/migrate_lotes_validade.py')
+    return {'database': db.name, 'seed': seed, 'counts': counts, 'flags_marcadas': only_seeded}
+
+
+if __name__ == '__main__':
+    # CLI: python scripts/seed_synthetic.py [--produtos N] [--movimentacoes N] [--now AAAA-MM-DD] [--reset] [--mock]
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Gera dados sintéticos de uma rede hospitalar para testes de carga')
+    parser.add_argument('--centrais', type=int, default=2)
+    parser.add_argument('--almoxarifados', type=int, default=3, help='almoxarifados por central')
+    parser.add_argument('--subs', type=int, default=2, help='sub-almoxarifados por almoxarifado')
+    parser.add_argument('--setores', type=int, default=5, help='setores por sub-almoxarifado')
+    parser.add_argument('--produtos', type=int, default=50000)
+    parser.add_argument('--lotes', type=int, default=3, help='máximo de lotes por linha de estoque')
+    parser.add_argument('--movimentacoes', type=int, default=1000000)
+    parser.add_argument('--dias', type=int, default=365, help='janela das movimentações')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='esvazia as coleções geradas antes de gravar')
+    parser.add_argument('--now', type=datetime.fromisoformat, default=None,
+                        help='data de referência (ISO, ex.: 2026-07-01); fixa validades e datas para repetir a carga')
+    parser.add_argument('--mock', action='store_true', help='gera em um mongomock em memória (mede só o gerador)')
+    args = parser.parse_args()
+
+    if args.mock:
+        import mongomock
+        target = mongomock.MongoClient()[os.getenv('MONGO_DB', 'almox_seed')]
+    else:
+        # Importa o app para inicializar o Mongo via extensions.init_mongo
+        from app import app  # noqa: F401
+        import extensions
+        target = extensions.mongo_db
+
+    t0 = time.perf_counter()
+    summary = seed_synthetic(
+        target, centrais=args.centrais, almox_por_central=args.almoxarifados, subs_por_almox=args.subs,
+        setores_por_sub=args.setores, produtos=args.produtos, lotes_por_estoque=args.lotes,
+        movimentacoes=args.movimentacoes, dias=args.dias, batch_size=max(1, args.batch_size), seed=args.seed,
+        reset=args.reset, now=args.now,
+    )
+    print('[Seed] Banco:', summary['database'], f'(seed={summary["seed"]}, {time.perf_counter() - t0:.1f}s)')
+    for name, n in sorted(summary['counts'].items()):
+        print(f'  - {name}: {n} documentos')
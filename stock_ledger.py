@@ -0,0 +1,89 @@
+"""Baixa atômica de saldo em `estoques`.
+
+As rotas de saída liam o estoque de origem (`find_one`), comparavam o saldo em
+Python e depois gravavam (`update_one` com `$set` absoluto ou `$inc`): duas idas
+ao banco por item e decrementos perdidos quando dois operadores baixavam o mesmo
+estoque ao mesmo tempo. `take_async` faz a baixa em um único
+`find_one_and_update` condicionado a `quantidade_disponivel >= quantidade`, com
+`$inc` negativo: o banco serializa as baixas concorrentes e nenhuma deixa o
+saldo negativo.
+
+`queries` é uma lista de filtros tentados em ordem (os mesmos fallbacks de local
+que as rotas já usavam). Só quando o filtro condicionado não casa é feita uma
+leitura, para distinguir "sem estoque" de "saldo insuficiente" e para completar
+linhas antigas sem `quantidade_disponivel`/`quantidade_atual` (que passam a
+valer `quantidade`, como a distribuição já considerava).
+
+Depois da baixa a flag `abaixo_minimo` da linha é acertada (reorder_points.py).
+"""
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import ReturnDocument
+
+import reorder_points
+
+AVAILABLE_FIELD = 'quantidade_disponivel'
+# Campos baixados por padrão (saldo total, atual e disponível)
+STOCK_FIELDS = ('quantidade', 'quantidade_atual', 'quantidade_disponivel')
+
+
+class StockNotFound(LookupError):
+    """Nenhuma linha de estoque casa com os filtros informados."""
+
+
+class InsufficientStock(ValueError):
+    def __init__(self, disponivel: float, estoque: Optional[Dict[str, Any]] = None):
+        super().__init__(f'Saldo insuficiente. Disponível: {disponivel}')
+        self.disponivel = disponivel
+        self.estoque = estoque
+
+
+def _guarded(query: Dict[str, Any], quantidade: float) -> Dict[str, Any]:
+    return {'$and': [query, {AVAILABLE_FIELD: {'$gte': quantidade}}]}
+
+
+def _update(quantidade: float, fields: Iterable[str], set_fields: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    update: Dict[str, Any] = {'$inc': {f: -quantidade for f in fields}}
+    if set_fields:
+        update['$set'] = dict(set_fields)
+    return update
+
+
+def _as_float(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _missing_fields(doc: Dict[str, Any]) -> Dict[str, float]:
+    """Campos de saldo ausentes/nulos de uma linha antiga, preenchidos a partir de `quantidade`."""
+    base = _as_float(doc.get('quantidade')) or 0.0
+    return {f: base for f in STOCK_FIELDS[1:] if doc.get(f) is None}
+
+
+async def take_async(coll, queries: List[Dict[str, Any]], quantidade: float, fields: Iterable[str] = STOCK_FIELDS,
+                     set_fields: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Baixa `quantidade` do primeiro estoque que casar; devolve o documento já atualizado.
+
+    Levanta `StockNotFound` ou `InsufficientStock`.
+    """
+    fields = tuple(fields)
+    update = _update(quantidade, fields, set_fields)
+    for query in queries:
+        for _ in range(2):
+            doc = await coll.find_one_and_update(_guarded(query, quantidade), update, return_document=ReturnDocument.AFTER)
+            if doc is not None:
+                await reorder_points.sync_async(coll, doc)
+                return doc
+            current = await coll.find_one(query)
+            if current is None:
+                break
+            missing = _missing_fields(current)
+            if not missing:
+                raise InsufficientStock(_as_float(current.get(AVAILABLE_FIELD)) or 0.0, current)
+            for f, v in missing.items():
+                await coll.update_one({'_id': current['_id'], f: None}, {'$set': {f: v}})
+        else:
+            raise InsufficientStock(_as_float(current.get(AVAILABLE_FIELD)) or 0.0, current)
+    raise StockNotFound()
@@ -0,0 +1,225 @@
+"""Listagem de estoque por hierarquia em uma única agregação.
+
+As rotas `/api/estoque/hierarquia` (Flask e FastAPI) buscavam as linhas de
+`estoques`, resolviam produtos e os quatro tipos de local com consultas em
+sequência, classificavam o local e filtravam em Python (o Flask ainda lia
+`per_page * 5` linhas para compensar o filtro). Aqui a mesma listagem vira um
+pipeline:
+
+    $match (filtros + escopo + status) → $sort → [classificação do local → $match]
+    → $facet { items: $skip/$limit → classificação → $lookup produtos → saldos/status,
+               total: $count }
+
+O `$lookup` de produtos aceita as três formas de referência (`str(_id)`,
+ObjectId e id sequencial) convertendo `produto_id` no servidor. Nomes de locais
+vêm do grafo em memória (`hierarchy_graph`), que já mantém as quatro coleções,
+em vez de quatro `$lookup` por linha.
+
+O pipeline usa `$convert` (MongoDB 4.0+); o banco em memória dos testes
+(mongomock) não implementa o operador, então as rotas mantêm o caminho antigo
+quando rodam sobre ele.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from hierarchy import HierarchyGraph
+
+DEFAULT_SORT = {'updated_at': -1, '_id': -1}
+
+# Campo de local → tipo, na mesma ordem de precedência das rotas antigas
+LOCAL_FIELDS = (
+    ('setor_id', 'setor'),
+    ('sub_almoxarifado_id', 'sub_almoxarifado'),
+    ('almoxarifado_id', 'almoxarifado'),
+    ('central_id', 'central'),
+)
+TIPO_COLLECTIONS = {
+    'central': 'centrais',
+    'almoxarifado': 'almoxarifados',
+    'sub_almoxarifado': 'sub_almoxarifados',
+    'setor': 'setores',
+}
+_TIPO_VARIANTS = {'sub_almoxarifado': ['sub_almoxarifado', 'subalmoxarifado']}
+
+
+def _present(field: str) -> Dict[str, Any]:
+    return {'$ne': [{'$ifNull': [f'${field}', None]}, None]}
+
+
+LOCAL_STAGE = {'$addFields': {
+    '_local_tipo': {'$switch': {
+        'branches': [{'case': _present(f), 'then': t} for f, t in LOCAL_FIELDS],
+        'default': {'$ifNull': ['$local_tipo', None]},
+    }},
+    '_local_id': {'$switch': {
+        'branches': [{'case': _present(f), 'then': f'${f}'} for f, _ in LOCAL_FIELDS],
+        'default': {'$ifNull': ['$local_id', None]},
+    }},
+}}
+
+
+class StockRules:
+    """Expressões de saldo de uma listagem: saldo atual, disponível, inicial e limiar de "Baixo"."""
+
+    def __init__(self, atual: Dict[str, Any], disponivel: Dict[str, Any], inicial: Dict[str, Any], limiar_baixo: Dict[str, Any]):
+        self.atual = atual
+        self.disponivel = disponivel
+        self.inicial = inicial
+        self.limiar_baixo = limiar_baixo
+
+    def _conditions(self) -> Dict[str, Dict[str, Any]]:
+        disp, limiar = self.disponivel, self.limiar_baixo
+        return {
+            'Zerado': {'$lte': [disp, 0]},
+            'Baixo': {'$and': [{'$gt': [disp, 0]}, {'$lte': [disp, limiar]}]},
+            'Normal': {'$and': [{'$gt': [disp, 0]}, {'$gt': [disp, limiar]}]},
+        }
+
+    def status_filter(self, status: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Filtro `$expr` equivalente ao status calculado (Zerado/Baixo/Normal); None se o status não existe."""
+        st = (status or '').strip().lower()
+        st = 'normal' if st == 'disponivel' else st
+        for name, cond in self._conditions().items():
+            if name.lower() == st:
+                return {'$expr': cond}
+        return None
+
+    def computed_fields(self) -> Dict[str, Any]:
+        conds = self._conditions()
+        return {
+            '_atual': self.atual,
+            '_disp': self.disponivel,
+            '_inicial': self.inicial,
+            '_status': {'$switch': {
+                'branches': [{'case': conds['Zerado'], 'then': 'Zerado'}, {'case': conds['Baixo'], 'then': 'Baixo'}],
+                'default': 'Normal',
+            }},
+        }
+
+
+# FastAPI: atual = quantidade_atual|quantidade; disponível e inicial caem para o atual; Baixo = até 10% do inicial
+ATUAL_EXPR = {'$ifNull': ['$quantidade_atual', {'$ifNull': ['$quantidade', 0]}]}
+RULES = StockRules(
+    atual=ATUAL_EXPR,
+    disponivel={'$ifNull': ['$quantidade_disponivel', ATUAL_EXPR]},
+    inicial={'$ifNull': ['$quantidade_inicial', ATUAL_EXPR]},
+    limiar_baixo={'$multiply': [{'$ifNull': ['$quantidade_inicial', ATUAL_EXPR]}, 0.1]},
+)
+
+# Flask: saldo = quantidade|quantidade_atual; disponível desconta a reserva; Baixo = até max(10% do inicial, 5)
+_QTD_EXPR = {'$ifNull': ['$quantidade', {'$ifNull': ['$quantidade_atual', 0]}]}
+RESERVA_RULES = StockRules(
+    atual=_QTD_EXPR,
+    disponivel={'$ifNull': ['$quantidade_disponivel', {'$subtract': [_QTD_EXPR, {'$ifNull': ['$quantidade_reservada', 0]}]}]},
+    inicial={'$ifNull': ['$quantidade_inicial', _QTD_EXPR]},
+    limiar_baixo={'$max': [{'$multiply': [{'$ifNull': ['$quantidade_inicial', _QTD_EXPR]}, 0.1]}, 5]},
+)
+
+
+def _convert(to: str) -> Dict[str, Any]:
+    return {'$convert': {'input': '$produto_id', 'to': to, 'onError': None, 'onNull': None}}
+
+
+# `produto_id` em todas as formas aceitas; `_id` tem prioridade sobre o id sequencial
+PRODUCT_STAGES = [
+    {'$addFields': {'_pid_keys': {'$setDifference': [['$produto_id', _convert('objectId'), _convert('int')], [None]]}}},
+    {'$lookup': {'from': 'produtos', 'localField': '_pid_keys', 'foreignField': '_id', 'as': '_p_oid'}},
+    {'$lookup': {'from': 'produtos', 'localField': '_pid_keys', 'foreignField': 'id', 'as': '_p_seq'}},
+    {'$addFields': {'produto': {'$ifNull': [{'$arrayElemAt': ['$_p_oid', 0]}, {'$arrayElemAt': ['$_p_seq', 0]}]}}},
+    {'$project': {'_pid_keys': 0, '_p_oid': 0, '_p_seq': 0}},
+]
+
+
+def _row_stages(rules: StockRules, classified: bool) -> List[Dict[str, Any]]:
+    stages = [] if classified else [LOCAL_STAGE]
+    return stages + PRODUCT_STAGES + [{'$addFields': rules.computed_fields()}]
+
+
+def _head(match: Dict[str, Any], sort: Dict[str, int], post_match: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # $sort logo após o $match para usar o índice; a classificação só entra antes do $facet quando filtrada
+    stages: List[Dict[str, Any]] = [{'$match': match or {}}, {'$sort': dict(sort)}]
+    if post_match:
+        stages += [LOCAL_STAGE, {'$match': post_match}]
+    return stages
+
+
+def page_pipeline(match: Dict[str, Any], skip: int, limit: int, rules: StockRules = RULES, with_total: bool = True,
+                  post_match: Optional[Dict[str, Any]] = None, sort: Dict[str, int] = DEFAULT_SORT) -> List[Dict[str, Any]]:
+    """Página (`skip`/`limit`) já com produto, local classificado e saldos; total no mesmo comando."""
+    items = [{'$skip': max(0, skip)}, {'$limit': limit}] + _row_stages(rules, classified=bool(post_match))
+    facet: Dict[str, Any] = {'items': items}
+    if with_total:
+        facet['total'] = [{'$count': 'n'}]
+    return _head(match, sort, post_match) + [{'$facet': facet}]
+
+
+def rows_pipeline(match: Dict[str, Any], rules: StockRules = RULES, post_match: Optional[Dict[str, Any]] = None,
+                  sort: Dict[str, int] = DEFAULT_SORT) -> List[Dict[str, Any]]:
+    """Todas as linhas, sem `$facet` (que limitaria o resultado a um documento de 16 MB)."""
+    return _head(match, sort, post_match) + _row_stages(rules, classified=bool(post_match))
+
+
+def unpack_page(docs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """(linhas, total) do resultado de `page_pipeline`; total None quando não foi pedido."""
+    out = docs[0] if docs else {}
+    total = None
+    if 'total' in out:
+        total = int(out['total'][0]['n']) if out['total'] else 0
+    return out.get('items') or [], total
+
+
+def tipo_match(tipo: str) -> Dict[str, Any]:
+    """Filtro por tipo do local já classificado (`_local_tipo`)."""
+    return {'_local_tipo': {'$in': _TIPO_VARIANTS.get(tipo, [tipo])}}
+
+
+def local_ids(graph: HierarchyGraph, raw_id: Any) -> List[Any]:
+    """Todas as formas de id conhecidas de um local (texto, int, ObjectId e as do grafo)."""
+    s = str(raw_id)
+    values: List[Any] = [s]
+    if s.isdigit():
+        values.append(int(s))
+    if ObjectId.is_valid(s):
+        values.append(ObjectId(s))
+    for coll in TIPO_COLLECTIONS.values():
+        node = graph.node(coll, raw_id)
+        if node:
+            for v in (node.get('_id'), node.get('id')):
+                if v is not None:
+                    values += [v, str(v)]
+    return list(dict.fromkeys(values))
+
+
+def local_match(graph: HierarchyGraph, raw_id: Any) -> Dict[str, Any]:
+    """Filtro por local já classificado (`_local_id`) em todas as formas de id conhecidas."""
+    return {'_local_id': {'$in': local_ids(graph, raw_id)}}
+
+
+def classified_filter(tipo: Optional[str] = None, ids: Optional[List[Any]] = None) -> Dict[str, Any]:
+    """`tipo_match`/`local_match` como filtro de `find`, sem o `$addFields` de `LOCAL_STAGE`.
+
+    Cada ramo exige vazios os campos de local de maior precedência, como a classificação.
+    """
+    branches: List[Dict[str, Any]] = []
+    empty: Dict[str, Any] = {}
+    for field, t in LOCAL_FIELDS:
+        if tipo is None or t == tipo:
+            branches.append(dict(empty, **{field: {'$in': ids} if ids is not None else {'$ne': None}}))
+        empty[field] = None
+    fallback = dict(empty)
+    if tipo is not None:
+        fallback['local_tipo'] = {'$in': _TIPO_VARIANTS.get(tipo, [tipo])}
+    if ids is not None:
+        fallback['local_id'] = {'$in': ids}
+    branches.append(fallback)
+    return {'$or': branches}
+
+
+def local_node(graph: HierarchyGraph, row: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """(tipo normalizado, documento do local no grafo) de uma linha classificada."""
+    tipo = str(row.get('_local_tipo') or '').strip().lower().replace('-', '_')
+    tipo = 'sub_almoxarifado' if tipo == 'subalmoxarifado' else tipo
+    coll = TIPO_COLLECTIONS.get(tipo)
+    node = graph.node(coll, row.get('_local_id')) if coll else None
+    return (tipo or None), node
@@ -0,0 +1,30 @@
+import asyncio
+from datetime import datetime
+
+
+def test_percentile_and_compare():
+    from benchmarks.api_bench import compare, percentile
+
+    values = [float(v) for v in range(1, 101)]
+    assert (percentile(values, 50), percentile(values, 99), percentile([], 50)) == (50.0, 99.0, 0.0)
+    lines = compare({'results': {'x': {'p50_ms': 2.0, 'p99_ms': 4.0, 'db_ops_mean': 3.0}}},
+                    {'results': {'x': {'p50_ms': 4.0, 'p99_ms': 4.0, 'db_ops_mean': 0.0}}})
+    assert lines == ['x: p50_ms 4.0 -> 2.0 (-50.0%), p99_ms 4.0 -> 4.0 (+0.0%)']
+
+
+def test_bench_runs_every_hot_route_against_seeded_mock():
+    import mongomock
+    from benchmarks.api_bench import counting_mock_database, run_async
+    from scripts.seed_synthetic import seed_synthetic
+
+    sync_db = mongomock.MongoClient()['bench_test']
+    seed_synthetic(sync_db, centrais=1, almox_por_central=2, subs_por_almox=1, setores_por_sub=2, produtos=40,
+                   movimentacoes=200, dias=14, batch_size=100, now=datetime(2026, 7, 1), log=None)
+    results = asyncio.run(run_async(sync_db, counting_mock_database(sync_db), requests=4, concurrency=2, warmup=1, log=None))
+
+    assert set(results) == {'estoque_hierarquia', 'produtos_search', 'produto_detalhes', 'movimentacoes', 'dashboard_stats',
+                            'relatorio_consumo_setores', 'distribuicao', 'entrada'}
+    for name, r in results.items():
+        assert r['requests'] == 4 and r['errors'] == 0, name
+        assert r['db_ops_mean'] >= 1 and r['p50_ms'] <= r['p99_ms'] <= r['max_ms'], name
+    assert sync_db['movimentacoes'].count_documents({'tipo': 'distribuicao', 'usuario_responsavel': {'$ne': 'seed'}}) == 5
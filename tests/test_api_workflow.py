@@ -185,6 +185,55 @@ def test_fastapi_update_lote_updates_estoque():
     assert float(prod.get("estoque_total", 0)) == 30.0
 
 
+def test_fastapi_update_lote_upsert_stamps_escopo():
+    import asyncio
+    from datetime import datetime, timezone
+
+    from bson import ObjectId
+    import mongomock
+
+    from fastapi_app.main import MONGO_DB
+    from fastapi_app.main import LoteUpdate
+    from fastapi_app.main import _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import update_lote
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    fastapi_db.client = None
+    fastapi_db.is_mock = True
+
+    now = datetime.now(timezone.utc)
+    central_oid, almox_oid, produto_oid, lote_oid = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+
+    async def _seed():
+        await fastapi_db.db.centrais.insert_one({"_id": central_oid, "nome": "Central"})
+        await fastapi_db.db.almoxarifados.insert_one({"_id": almox_oid, "nome": "Almox", "central_id": str(central_oid)})
+        await fastapi_db.db.produtos.insert_one({"_id": produto_oid, "nome": "Produto Teste", "codigo": "P-ESC"})
+        await fastapi_db.db.lotes.insert_one(
+            {
+                "_id": lote_oid,
+                "produto_id": str(produto_oid),
+                "numero_lote": "L-ESC",
+                "quantidade_atual": 0.0,
+                "local_tipo": "almoxarifado",
+                "local_id": str(almox_oid),
+                "created_at": now,
+                "updated_at": now,
+            }
+        )
+
+    asyncio.run(_seed())
+
+    # Sem linha de estoque: o ajuste cria a linha, já com o escopo do local do lote
+    user_ctx = {"id": str(ObjectId()), "role": "super_admin", "scope_id": None}
+    asyncio.run(update_lote(str(lote_oid), LoteUpdate(quantidade_atual=12), user=user_ctx))
+
+    estoque_doc = asyncio.run(fastapi_db.db.estoques.find_one({"produto_id": str(produto_oid)})) or {}
+    assert float(estoque_doc.get("quantidade", 0)) == 12.0
+    assert estoque_doc["escopo"]["almoxarifado_id"] == str(almox_oid)
+    assert estoque_doc["escopo"]["central_id"] == str(central_oid)
+
+
 def test_fastapi_delete_lote_updates_estoque():
     import asyncio
     from datetime import datetime, timezone
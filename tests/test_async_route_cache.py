@@ -0,0 +1,117 @@
+import asyncio
+
+
+def test_single_flight_and_stale_while_revalidate():
+    from async_cache import AsyncResponseCache
+
+    cache = AsyncResponseCache()
+    calls = {'n': 0}
+
+    @cache.cached('teste', ttl=0.05, stale_ttl=5)
+    async def handler(x: int, user=None):
+        calls['n'] += 1
+        await asyncio.sleep(0.02)
+        return {'x': x, 'n': calls['n']}
+
+    user = {'role': 'admin_central', 'scope_id': 'c1'}
+
+    async def scenario():
+        # 50 chamadas simultâneas -> uma computação
+        results = await asyncio.gather(*[handler(1, user=user) for _ in range(50)])
+        assert calls['n'] == 1 and all(r['n'] == 1 for r in results)
+        # Escopo diferente -> chave diferente
+        await handler(1, user={'role': 'admin_central', 'scope_id': 'c2'})
+        assert calls['n'] == 2
+
+        # Vencido: serve o valor antigo e recalcula em segundo plano
+        await asyncio.sleep(0.06)
+        stale = await handler(1, user=user)
+        assert stale['n'] == 1
+        await asyncio.sleep(0.05)
+        fresh = await handler(1, user=user)
+        assert fresh['n'] == 3
+
+    asyncio.run(scenario())
+    st = cache.stats()
+    assert st['coalesced'] == 49 and st['stale_served'] == 1 and st['refreshes'] == 1
+
+
+def test_errors_are_not_cached_and_waiters_get_them():
+    from fastapi import HTTPException
+    from async_cache import AsyncResponseCache
+
+    cache = AsyncResponseCache()
+    calls = {'n': 0}
+
+    @cache.cached('erro', ttl=30)
+    async def handler(user=None):
+        calls['n'] += 1
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=403, detail='Acesso negado')
+
+    async def scenario():
+        results = await asyncio.gather(*[handler(user={'role': 'x'}) for _ in range(5)], return_exceptions=True)
+        assert all(isinstance(r, HTTPException) for r in results)
+        assert calls['n'] == 1
+        await asyncio.gather(handler(user={'role': 'x'}), return_exceptions=True)
+        assert calls['n'] == 2
+
+    asyncio.run(scenario())
+
+
+def test_invalidation_during_computation_is_not_cached():
+    from async_cache import AsyncResponseCache
+
+    cache = AsyncResponseCache()
+    calls = {'n': 0}
+
+    async def tags(user):
+        return ['estq:p1']
+
+    @cache.cached('geracao', ttl=30, tags=tags)
+    async def handler(user=None):
+        calls['n'] += 1
+        n = calls['n']
+        await asyncio.sleep(0.02)
+        return n
+
+    async def scenario():
+        first = asyncio.ensure_future(handler())
+        await asyncio.sleep(0.005)
+        # Escrita durante a computação: o valor em andamento já nasce obsoleto
+        cache.invalidate_tags(['estq:p1'])
+        second = await handler()
+        assert await first == 1 and second == 2
+        assert await handler() == 2 and calls['n'] == 2
+
+    asyncio.run(scenario())
+    assert cache.stats()['discarded'] == 1 and not cache._generations
+
+
+def test_fastapi_chart_cache_is_invalidated_by_stock_write():
+    import mongomock
+    from bson import ObjectId
+
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase, _publish_stock_change
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import get_chart_movimentacoes, route_cache
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    fastapi_db.client = None
+    fastapi_db.is_mock = True
+    route_cache.store.clear()
+
+    almox = ObjectId()
+
+    async def scenario():
+        await fastapi_db.db.almoxarifados.insert_one({'_id': almox, 'nome': 'A'})
+        assert await get_chart_movimentacoes() == []
+        from datetime import datetime
+        await fastapi_db.db.movimentacoes.insert_one({'tipo': 'entrada', 'quantidade': 4, 'data_movimentacao': datetime.utcnow()})
+        # Ainda em cache
+        assert await get_chart_movimentacoes() == []
+        await _publish_stock_change(['p1'], [('almoxarifado', str(almox))])
+        data = await get_chart_movimentacoes()
+        assert len(data) == 1 and data[0]['entrada'] == 4
+
+    asyncio.run(scenario())
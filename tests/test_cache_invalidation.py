@@ -0,0 +1,96 @@
+def _get_csrf_token(client):
+    client.get('/')
+    with client.session_transaction() as sess:
+        return sess.get('csrf_token')
+
+
+def _json_headers(token):
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-CSRF-Token': token,
+    }
+
+
+def _cached(prefix):
+    import extensions
+    return [k for k in list(extensions.response_cache._data) if str(k).startswith(prefix)]
+
+
+def test_stock_writes_evict_only_dependent_cache_entries(client):
+    import extensions
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central T', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    r = client.post('/api/almoxarifados', json={'nome': 'Almox T', 'ativo': True, 'central_id': central_id}, headers=_json_headers(csrf))
+    almox_id = r.get_json().get('id')
+    r = client.post('/api/sub-almoxarifados', json={'nome': 'Sub T', 'ativo': True, 'almoxarifado_id': almox_id}, headers=_json_headers(csrf))
+    sub_id = r.get_json().get('id')
+    setores = []
+    for nome in ('Setor T1', 'Setor T2'):
+        r = client.post('/api/setores', json={'nome': nome, 'ativo': True, 'sub_almoxarifado_ids': [sub_id]}, headers=_json_headers(csrf))
+        setores.append(r.get_json().get('id'))
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'TAG-1', 'nome': 'Produto T', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+    r = client.post(f'/api/produtos/{produto_id}/recebimento', json={'almoxarifado_id': almox_id, 'quantidade': 20}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+
+    def distribuir(setor_id, qtd):
+        payload = {'produto_id': produto_id, 'origem': {'tipo': 'almoxarifado', 'id': almox_id}, 'destinos': [{'id': setor_id, 'quantidade': qtd}]}
+        r = client.post('/api/movimentacoes/distribuicao', json=payload, headers=_json_headers(csrf))
+        assert r.status_code == 200
+
+    distribuir(setores[0], 5)
+
+    r = client.get(f'/api/setores/{setores[0]}/produtos/{produto_id}/resumo-dia')
+    assert r.status_code == 200
+    assert float(r.get_json().get('estoque_disponivel', 0)) == 5.0
+    r = client.get('/api/estoque/hierarquia')
+    assert r.status_code == 200
+    assert _cached('resd:') and _cached('estq:')
+
+    # Escrita em outro setor: a listagem global sai, o resumo do setor 1 fica
+    distribuir(setores[1], 2)
+    assert _cached('resd:') and not _cached('estq:')
+
+    # Escrita no próprio setor: o resumo sai e a próxima leitura reflete o saldo novo
+    distribuir(setores[0], 3)
+    assert not _cached('resd:')
+    r = client.get(f'/api/setores/{setores[0]}/produtos/{produto_id}/resumo-dia')
+    assert float(r.get_json().get('estoque_disponivel', 0)) == 8.0
+    assert extensions.response_cache.stats()['invalidations'] >= 2
+
+
+def test_invalidation_reaches_other_workers_through_sistema_meta():
+    import mongomock
+    import cache_tags
+    import extensions
+    from extensions import LRUTTLCache, SharedInvalidation
+
+    db = mongomock.MongoClient().db
+    # Dois workers: cada um com seu cache e sua visão da versão compartilhada
+    worker_a, worker_b = SharedInvalidation(check_interval=0, log_size=2), SharedInvalidation(check_interval=0)
+    cache_b = LRUTTLCache(sweep_interval=0)
+    extensions.subscribe_invalidation(cache_b.invalidate_tags)
+    try:
+        worker_b.sync(db)
+        cache_b.set('estq:1', [1], tags=['estq:p1', cache_tags.ALL_TAG])
+        cache_b.set('estq:2', [2], tags=['estq:p2', cache_tags.ALL_TAG])
+
+        worker_a.publish(db, ['estq:p1'])
+        assert cache_b.get('estq:1') is not None  # B só vê na próxima checagem
+        worker_b.sync(db)
+        assert cache_b.get('estq:1') is None
+        assert cache_b.get('estq:2') is not None
+
+        # B ficou para trás além do log: invalida tudo
+        for tag in ('a', 'b', 'c'):
+            worker_a.publish(db, [tag])
+        worker_b.sync(db)
+        assert cache_b.get('estq:2') is None
+    finally:
+        extensions._invalidation_subscribers.remove(cache_b.invalidate_tags)
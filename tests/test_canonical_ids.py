@@ -0,0 +1,155 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _mongomock_bulk_write(monkeypatch):
+    """O mongomock não aceita o `UpdateOne` do pymongo atual em `bulk_write`: aplica as operações em sequência."""
+    import mongomock
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        for op in requests:
+            self.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', bulk_write)
+
+
+def _get_csrf_token(client):
+    client.get('/')
+    with client.session_transaction() as sess:
+        return sess.get('csrf_token')
+
+
+def _json_headers(token):
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-CSRF-Token': token,
+    }
+
+
+def test_migration_rewrites_foreign_keys_and_strict_mode_uses_single_value(client, monkeypatch):
+    import extensions
+    from bson import ObjectId
+    from canonical_ids import ID_MAP_COLLECTION, legacy_ids
+    from scripts.migrate_canonical_ids import migrate_canonical_ids
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central K', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    r = client.post('/api/almoxarifados', json={'nome': 'Almox K', 'ativo': True, 'central_id': central_id}, headers=_json_headers(csrf))
+    almox_id = r.get_json().get('id')
+    r = client.post('/api/sub-almoxarifados', json={'nome': 'Sub K', 'ativo': True, 'almoxarifado_id': almox_id}, headers=_json_headers(csrf))
+    sub_id = r.get_json().get('id')
+    r = client.post('/api/setores', json={'nome': 'Setor K', 'ativo': True, 'sub_almoxarifado_ids': [sub_id]}, headers=_json_headers(csrf))
+    setor_id = r.get_json().get('id')
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'CAN-1', 'nome': 'Produto K', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+    r = client.post(f'/api/produtos/{produto_id}/recebimento', json={'almoxarifado_id': almox_id, 'quantidade': 8}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    almox_doc = db['almoxarifados'].find_one({'id': int(almox_id)})
+    a_oid = str(almox_doc['_id'])
+    s_oid = str(db['sub_almoxarifados'].find_one({'id': int(sub_id)})['_id'])
+    assert db['estoques'].find_one({'local_tipo': 'almoxarifado'})['local_id'] == int(almox_id)
+
+    summary = migrate_canonical_ids(db, log=None)
+    assert summary['mapped'] >= 4
+    row = db['estoques'].find_one({'local_tipo': 'almoxarifado'})
+    assert row['local_id'] == a_oid and row['almoxarifado_id'] == a_oid
+    assert db['setores'].find_one({'id': int(setor_id)})['sub_almoxarifado_ids'] == [s_oid]
+    assert db[ID_MAP_COLLECTION].find_one({'_id': f'almoxarifados:{almox_id}'})['canonico'] == a_oid
+    # Idempotente
+    again = migrate_canonical_ids(db, log=None)
+    assert all(v['updated'] == 0 for v in again['collections'].values())
+
+    # Modo estrito: id legado resolvido uma vez via mapa, consulta por valor único
+    monkeypatch.setenv('STRICT_IDS', '1')
+    from blueprints.main import _find_by_id
+    from fastapi_app.main import _build_id_query, _id_candidates
+
+    legacy_ids.ensure_loaded(db)
+    assert _find_by_id('almoxarifados', almox_id)['_id'] == almox_doc['_id']
+    assert _id_candidates(a_oid) == [a_oid]
+    assert _build_id_query(a_oid) == {'_id': ObjectId(a_oid)}
+
+    payload = {'produto_id': produto_id, 'origem': {'tipo': 'almoxarifado', 'id': almox_id}, 'destinos': [{'id': setor_id, 'quantidade': 3}]}
+    r = client.post('/api/movimentacoes/distribuicao', json=payload, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    saida = db['movimentacoes'].find_one({'tipo': 'saida'})
+    assert saida['origem_id'] == a_oid
+    assert ObjectId.is_valid(saida['destino_id']) and ObjectId.is_valid(saida['produto_id'])
+    assert float(db['estoques'].find_one({'local_id': a_oid})['quantidade']) == 5.0
+
+
+def test_flask_reads_match_rows_before_and_after_migration(client):
+    import extensions
+    from scripts.migrate_canonical_ids import migrate_canonical_ids
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central R', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    r = client.post('/api/almoxarifados', json={'nome': 'Almox R', 'ativo': True, 'central_id': central_id}, headers=_json_headers(csrf))
+    almox_id = r.get_json().get('id')
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'CAN-R', 'nome': 'Produto R', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+    r = client.post(f'/api/produtos/{produto_id}/recebimento', json={'almoxarifado_id': almox_id, 'quantidade': 8}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+
+    def almox_row():
+        r = client.get(f'/api/produtos/{produto_id}/almoxarifados')
+        return next(a for a in r.get_json()['almoxarifados'] if str(a['id']) == str(almox_id))
+
+    def estoque_total():
+        return client.get(f'/api/produtos/{produto_id}/estoque').get_json()['resumo']
+
+    before = (almox_row(), estoque_total())
+    assert before[0]['quantidade_atual'] == 8.0 and before[0]['tem_estoque']
+
+    migrate_canonical_ids(extensions.mongo_db, log=None)
+    after = (almox_row(), estoque_total())
+    assert after == before
+
+
+def test_migration_resumes_from_checkpoint(client, monkeypatch):
+    import extensions
+    from hierarchy import META_COLLECTION
+    import scripts.migrate_canonical_ids as mig
+
+    db = extensions.mongo_db
+    central = db['centrais'].insert_one({'id': 901, 'nome': 'Central C'}).inserted_id
+    almox = db['almoxarifados'].insert_one({'id': 902, 'nome': 'Almox C', 'central_id': 901}).inserted_id
+    db['estoques'].insert_many([{'produto_id': 'x', 'local_tipo': 'almoxarifado', 'local_id': 902, 'almoxarifado_id': 902}
+                                for _ in range(5)])
+
+    real_bulk = mig._bulk
+    calls = []
+
+    def flaky_bulk(coll, ops):
+        if coll.name == 'estoques' and ops:
+            calls.append(len(ops))
+            if len(calls) == 3:
+                raise RuntimeError('queda no meio')
+        return real_bulk(coll, ops)
+
+    monkeypatch.setattr(mig, '_bulk', flaky_bulk)
+    try:
+        mig.migrate_canonical_ids(db, batch_size=2, log=None)
+    except RuntimeError:
+        pass
+    checkpoint = db[META_COLLECTION].find_one({'_id': mig.CHECKPOINT_KEY})
+    assert checkpoint and 'estoques' in checkpoint
+    assert db['estoques'].count_documents({'local_id': str(almox)}) == 4
+
+    monkeypatch.setattr(mig, '_bulk', real_bulk)
+    summary = mig.migrate_canonical_ids(db, batch_size=2, log=None)
+    assert summary['collections']['estoques']['updated'] == 1  # só o restante depois do checkpoint
+    assert db['estoques'].count_documents({'local_id': 902}) == 0
+    assert db['almoxarifados'].find_one({'_id': almox})['central_id'] == str(central)
+    assert db[META_COLLECTION].find_one({'_id': mig.CHECKPOINT_KEY}) is None
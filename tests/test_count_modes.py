@@ -0,0 +1,56 @@
+import asyncio
+
+
+def test_demandas_count_modes_and_has_more():
+    import mongomock
+    import pytest
+    from fastapi import HTTPException
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import count_estimator, get_demandas
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    count_estimator.store.clear()
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+
+    async def listar(count, page=1):
+        return await get_demandas(page=page, per_page=3, status='pendente', mine=False, count=count, user=user)
+
+    async def scenario():
+        for _ in range(5):
+            await db.demandas.insert_one({'status': 'pendente', 'items': []})
+
+        out = await listar(None)
+        assert out['pagination']['count'] == 'exact' and out['pagination']['total'] == 5
+        assert out['pagination']['has_more'] is True and len(out['items']) == 3
+
+        out = await listar('none', page=2)
+        assert out['pagination']['total'] is None and out['pagination']['pages'] is None
+        assert out['pagination']['has_more'] is False and len(out['items']) == 2
+
+        # Estimativa: primeira leitura conta; depois serve o valor guardado até vencer
+        assert (await listar('estimate'))['pagination']['total'] == 5
+        await db.demandas.insert_one({'status': 'pendente', 'items': []})
+        assert (await listar('estimate'))['pagination']['total'] == 5
+        for key in list(count_estimator.store._data):
+            value, _ = count_estimator.store.get(key)
+            count_estimator.store.set(key, (value, 0), ttl=60)
+        assert (await listar('estimate'))['pagination']['total'] == 5  # vencido: serve e recalcula
+        await asyncio.sleep(0)
+        assert (await listar('estimate'))['pagination']['total'] == 6
+
+        with pytest.raises(HTTPException) as exc:
+            await listar('aproximado')
+        assert exc.value.status_code == 400
+
+    asyncio.run(scenario())
+
+
+def test_flask_produtos_count_none(client):
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    body = client.get('/api/produtos?per_page=1&count=none').get_json()
+    assert body['total'] is None and body['count'] == 'none'
+    assert 'has_more' in body
+    assert client.get('/api/produtos?count=xyz').status_code == 400
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+
+def _event(name, micros, reply=None):
+    return SimpleNamespace(command_name=name, duration_micros=micros, reply=reply or {})
+
+
+def test_listener_counts_current_request_and_warns_over_budget(caplog):
+    import db_metrics
+
+    listener = db_metrics.CommandStatsListener()
+    listener.succeeded(_event('find', 1000))  # fora de requisição: ignorado
+
+    token = db_metrics.begin()
+    for _ in range(3):
+        listener.succeeded(_event('find', 2500, {'cursor': {'firstBatch': [{}, {}]}}))
+    listener.succeeded(_event('findAndModify', 1000, {'value': {'_id': 1}}))
+    listener.succeeded(_event('ping', 1000))
+    listener.failed(_event('update', 500))
+    stats = db_metrics.end(token)
+    assert db_metrics.current() is None
+
+    assert (stats.ops, stats.docs, stats.commands) == (5, 7, {'find': 3, 'findAndModify': 1, 'update': 1})
+    assert stats.server_timing() == 'db;dur=9.0;desc="5 ops, 7 docs"'
+
+    with caplog.at_level(logging.INFO, logger='almox.db'):
+        db_metrics.report(stats, 'GET', '/api/setores', 200, budget=4)
+    assert caplog.records[-1].levelno == logging.WARNING
+    assert '"event": "db_op_budget_exceeded"' in caplog.records[-1].getMessage()
+    assert '"path": "/api/setores"' in caplog.records[-1].getMessage()
+
+
+def test_flask_response_has_server_timing(client):
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    assert r.headers.get('Server-Timing', '').startswith('db;dur=')
+
+
+def test_fastapi_middleware_adds_server_timing():
+    import httpx
+    from fastapi_app.main import app
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as ac:
+            return await ac.get('/api/health/app')
+
+    r = asyncio.run(scenario())
+    assert r.status_code == 200
+    assert r.headers['server-timing'] == 'db;dur=0.0;desc="0 ops, 0 docs"'
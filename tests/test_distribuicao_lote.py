@@ -0,0 +1,129 @@
+import asyncio
+
+
+def test_distribuicao_lote_reports_per_item_results():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import (DistribuicaoLoteItem, DistribuicaoLoteRequest, MovimentacaoRequest,
+                                  post_distribuicao, post_distribuicao_lote)
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setor = ObjectId(), ObjectId()
+    prods = [ObjectId() for _ in range(3)]
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox L'})
+        await db.setores.insert_one({'_id': setor, 'nome': 'Setor L', 'almoxarifado_id': str(almox)})
+        for i, pid in enumerate(prods):
+            await db.produtos.insert_one({'_id': pid, 'nome': f'Prod {i}', 'codigo': f'LT-{i}'})
+            await db.estoques.insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                          'quantidade': 10, 'quantidade_atual': 10, 'quantidade_disponivel': 10})
+        # Destino já existente para o primeiro produto
+        await post_distribuicao(MovimentacaoRequest(produto_id=str(prods[0]), quantidade=1, origem_id=str(almox),
+                                                    destino_id=str(setor), destino_tipo='setor'), user=user)
+
+        req = DistribuicaoLoteRequest(origem_id=str(almox), destino_id=str(setor), destino_tipo='setor', items=[
+            DistribuicaoLoteItem(produto_id=str(prods[0]), quantidade=4),
+            DistribuicaoLoteItem(produto_id='LT-1', quantidade=6),
+            DistribuicaoLoteItem(produto_id=str(prods[2]), quantidade=50),
+            DistribuicaoLoteItem(produto_id='nao-existe', quantidade=1),
+            DistribuicaoLoteItem(produto_id='LT-1', quantidade=2),
+        ])
+        out = await post_distribuicao_lote(req, user=user)
+        assert out['status'] == 'parcial' and out['processados'] == 3 and out['erros'] == 2
+        assert [r['status'] for r in out['items']] == ['ok', 'ok', 'erro', 'erro', 'ok']
+        assert out['items'][2]['disponivel'] == 10.0
+        assert out['items'][3]['erro'] == 'Produto não encontrado'
+
+        async def saldo(pid, tipo, local):
+            rows = await db.estoques.find({'produto_id': str(pid), 'local_tipo': tipo, 'local_id': str(local)}).to_list(length=None)
+            assert len(rows) == 1
+            return rows[0]['quantidade_disponivel']
+
+        assert await saldo(prods[0], 'almoxarifado', almox) == 5 and await saldo(prods[0], 'setor', setor) == 5
+        assert await saldo(prods[1], 'almoxarifado', almox) == 2 and await saldo(prods[1], 'setor', setor) == 8
+        assert await saldo(prods[2], 'almoxarifado', almox) == 10
+        assert await db.movimentacoes.count_documents({'tipo': 'distribuicao'}) == 4
+
+    asyncio.run(scenario())
+
+
+def test_distribuicao_lote_restores_origin_when_one_take_fails(monkeypatch):
+    import mongomock
+    import pytest
+    from bson import ObjectId
+    import fastapi_app.main as fastapi_main
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import DistribuicaoLoteItem, DistribuicaoLoteRequest, post_distribuicao_lote
+
+    fastapi_main.db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_main.db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setor = ObjectId(), ObjectId()
+    prods = [ObjectId() for _ in range(2)]
+    real_take = fastapi_main.take_async
+
+    async def flaky_take(coll, queries, quantidade, **kwargs):
+        if any(str(prods[1]) in str(q) for q in queries):
+            raise RuntimeError('conexão perdida')
+        return await real_take(coll, queries, quantidade, **kwargs)
+
+    monkeypatch.setattr(fastapi_main, 'take_async', flaky_take)
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox F'})
+        await db.setores.insert_one({'_id': setor, 'nome': 'Setor F', 'almoxarifado_id': str(almox)})
+        for i, pid in enumerate(prods):
+            await db.produtos.insert_one({'_id': pid, 'nome': f'Prod {i}', 'codigo': f'FL-{i}'})
+            await db.estoques.insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                          'quantidade': 10, 'quantidade_atual': 10, 'quantidade_disponivel': 10})
+        req = DistribuicaoLoteRequest(origem_id=str(almox), destino_id=str(setor), destino_tipo='setor', items=[
+            DistribuicaoLoteItem(produto_id=str(prods[0]), quantidade=3),
+            DistribuicaoLoteItem(produto_id=str(prods[1]), quantidade=3),
+        ])
+        with pytest.raises(RuntimeError):
+            await post_distribuicao_lote(req, user=user)
+
+        # A baixa do item que deu certo volta para a origem; nada chega ao destino
+        origem = await db.estoques.find_one({'produto_id': str(prods[0]), 'local_tipo': 'almoxarifado'})
+        assert origem['quantidade_disponivel'] == 10 and origem['quantidade'] == 10
+        assert await db.estoques.count_documents({'local_tipo': 'setor'}) == 0
+        assert await db.movimentacoes.count_documents({}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_distribuicao_lote_reuses_destination_row_with_legacy_id_form():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import DistribuicaoLoteItem, DistribuicaoLoteRequest, post_distribuicao_lote
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setor = ObjectId(), ObjectId()
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox G'})
+        await db.setores.insert_one({'_id': setor, 'nome': 'Setor G', 'almoxarifado_id': str(almox)})
+        await db.produtos.insert_one({'_id': ObjectId(), 'id': 7, 'nome': 'Prod legado', 'codigo': 'LG-7'})
+        await db.estoques.insert_one({'produto_id': 7, 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                      'quantidade': 10, 'quantidade_atual': 10, 'quantidade_disponivel': 10})
+        # Linha de destino antiga: id numérico importado como float e local só em `setor_id`
+        await db.estoques.insert_one({'produto_id': 7.0, 'setor_id': str(setor),
+                                      'quantidade': 1, 'quantidade_atual': 1, 'quantidade_disponivel': 1})
+        req = DistribuicaoLoteRequest(origem_id=str(almox), destino_id=str(setor), destino_tipo='setor', items=[
+            DistribuicaoLoteItem(produto_id='LG-7', quantidade=4),
+        ])
+        out = await post_distribuicao_lote(req, user=user)
+        assert out['status'] == 'success'
+        rows = await db.estoques.find({'setor_id': str(setor)}).to_list(length=None)
+        assert len(rows) == 1 and rows[0]['quantidade_disponivel'] == 5
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+
+def test_entrada_lote_writes_whole_invoice_and_rejects_bad_lines():
+    import mongomock
+    from bson import ObjectId
+    from fastapi import HTTPException
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import EntradaNotaItem, EntradaNotaRequest, post_entrada_lote
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox = ObjectId()
+    validade = datetime(2030, 1, 1)
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox NF'})
+        for i in range(100):
+            await db.produtos.insert_one({'codigo': f'NF-{i}', 'nome': f'Produto {i}'})
+        # Linha 1 de cada produto em L1, linha 2 em L1 de novo, linha 3 em L2
+        items = []
+        for rep, lote in enumerate(('L1', 'L1', 'L2')):
+            items += [EntradaNotaItem(produto_id=f'NF-{i}', quantidade=rep + 1, lote=lote, data_validade=validade) for i in range(100)]
+
+        bad = EntradaNotaRequest(destino_id=str(almox), nota_fiscal='123', items=items[:2] + [
+            EntradaNotaItem(produto_id='NF-x', quantidade=1, lote='L1', data_validade=validade),
+            EntradaNotaItem(produto_id='NF-1', quantidade=0, lote='L1', data_validade=validade),
+        ])
+        with pytest.raises(HTTPException) as exc:
+            await post_entrada_lote(bad, user=user)
+        assert [e['linha'] for e in exc.value.detail['erros']] == [3, 4]
+        assert await db.movimentacoes.count_documents({}) == 0
+
+        out = await post_entrada_lote(EntradaNotaRequest(destino_id=str(almox), nota_fiscal='123', fornecedor='ACME', items=items), user=user)
+        assert (out['linhas'], out['produtos'], out['lotes']) == (300, 100, 200)
+
+        prod = await db.produtos.find_one({'codigo': 'NF-7'})
+        pid = str(prod['_id'])
+        estoque = await db.estoques.find({'produto_id': pid}).to_list(length=None)
+        assert len(estoque) == 1 and estoque[0]['quantidade'] == 6 and estoque[0]['local_id'] == str(almox)
+        lotes = {l['numero_lote']: l['quantidade_atual'] for l in await db.lotes.find({'produto_id': pid}).to_list(length=None)}
+        assert lotes == {'L1': 3, 'L2': 3}
+        assert await db.movimentacoes.count_documents({'nota_fiscal': '123', 'tipo': 'entrada'}) == 300
+
+    asyncio.run(scenario())
@@ -0,0 +1,117 @@
+from datetime import datetime
+
+
+def _get_csrf_token(client):
+    client.get('/')
+    with client.session_transaction() as sess:
+        return sess.get('csrf_token')
+
+
+def _json_headers(token):
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-CSRF-Token': token,
+    }
+
+
+def test_escopo_stamped_on_writes_and_backfill_is_resumable(client):
+    import extensions
+    from hierarchy import hierarchy_graph
+    from scripts.backfill_escopo import CHECKPOINT_KEY, backfill_escopo
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central E', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    r = client.post('/api/almoxarifados', json={'nome': 'Almox E', 'ativo': True, 'central_id': central_id}, headers=_json_headers(csrf))
+    almox_id = r.get_json().get('id')
+    r = client.post('/api/sub-almoxarifados', json={'nome': 'Sub E', 'ativo': True, 'almoxarifado_id': almox_id}, headers=_json_headers(csrf))
+    sub_id = r.get_json().get('id')
+    r = client.post('/api/setores', json={'nome': 'Setor E', 'ativo': True, 'sub_almoxarifado_ids': [sub_id]}, headers=_json_headers(csrf))
+    setor_id = r.get_json().get('id')
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'ESC-1', 'nome': 'Produto E', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+
+    r = client.post(f'/api/produtos/{produto_id}/recebimento', json={'almoxarifado_id': almox_id, 'quantidade': 10}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    payload = {'produto_id': produto_id, 'origem': {'tipo': 'almoxarifado', 'id': almox_id}, 'destinos': [{'id': setor_id, 'quantidade': 4}]}
+    r = client.post('/api/movimentacoes/distribuicao', json=payload, headers=_json_headers(csrf))
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    oid = lambda coll, seq: str(db[coll].find_one({'id': int(seq)})['_id'])
+    c_oid, a_oid = oid('centrais', central_id), oid('almoxarifados', almox_id)
+    s_oid, st_oid = oid('sub_almoxarifados', sub_id), oid('setores', setor_id)
+
+    setor_row = db['estoques'].find_one({'local_tipo': 'setor'})
+    assert setor_row['escopo'] == {'central_id': c_oid, 'almoxarifado_id': a_oid, 'sub_almoxarifado_id': s_oid, 'setor_id': st_oid}
+    saida = db['movimentacoes'].find_one({'tipo': 'saida'})
+    assert saida['escopo']['almoxarifado_id'] == a_oid and saida['escopo']['setor_id'] is None
+
+    # Linhas legadas (sem escopo) são preenchidas pelo backfill, com checkpoint
+    db['estoques'].insert_one({'produto_id': produto_id, 'setor_id': setor_id, 'quantidade': 1, 'updated_at': datetime.utcnow()})
+    db['movimentacoes'].update_many({}, {'$unset': {'escopo': ''}})
+    assert hierarchy_graph.scope_filter('gerente_almox', almox_id) is None
+
+    summary = backfill_escopo(db, batch_size=1, log=None)
+    assert summary['collections']['movimentacoes']['updated'] == 2
+    assert db['estoques'].count_documents({'escopo.setor_id': st_oid}) == 2
+    checkpoint = db['sistema_meta'].find_one({'_id': CHECKPOINT_KEY})
+    assert checkpoint['estoques'] == max(d['_id'] for d in db['estoques'].find())
+
+    # Nova execução retoma do checkpoint sem reprocessar
+    again = backfill_escopo(db, log=None)
+    assert again['collections']['estoques']['updated'] == 0
+
+    hierarchy_graph.mark_dirty()
+    hierarchy_graph.ensure_loaded(db)
+    filtro = hierarchy_graph.scope_filter('gerente_almox', almox_id)
+    assert filtro == {'escopo.almoxarifado_id': a_oid}
+    assert db['estoques'].count_documents(filtro) == 3
+    assert db['movimentacoes'].count_documents(hierarchy_graph.scope_filter('admin_central', central_id, key='central_id')) == 2
+
+
+def test_reparenting_a_local_restamps_escopo(client):
+    import extensions
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central R', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    almox_ids = []
+    for nome in ('Almox R1', 'Almox R2'):
+        r = client.post('/api/almoxarifados', json={'nome': nome, 'ativo': True, 'central_id': central_id}, headers=_json_headers(csrf))
+        almox_ids.append(r.get_json().get('id'))
+    r = client.post('/api/sub-almoxarifados', json={'nome': 'Sub R', 'ativo': True, 'almoxarifado_id': almox_ids[0]}, headers=_json_headers(csrf))
+    sub_id = r.get_json().get('id')
+    r = client.post('/api/setores', json={'nome': 'Setor R', 'ativo': True, 'sub_almoxarifado_ids': [sub_id]}, headers=_json_headers(csrf))
+    setor_id = r.get_json().get('id')
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'REP-1', 'nome': 'Produto R', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+    r = client.post(f'/api/produtos/{produto_id}/recebimento', json={'almoxarifado_id': almox_ids[0], 'quantidade': 10}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    payload = {'produto_id': produto_id, 'origem': {'tipo': 'almoxarifado', 'id': almox_ids[0]}, 'destinos': [{'id': setor_id, 'quantidade': 4}]}
+    r = client.post('/api/movimentacoes/distribuicao', json=payload, headers=_json_headers(csrf))
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    oid = lambda coll, seq: str(db[coll].find_one({'id': int(seq)})['_id'])
+    a1, a2, st = oid('almoxarifados', almox_ids[0]), oid('almoxarifados', almox_ids[1]), oid('setores', setor_id)
+    escopo_setor = db['estoques'].find_one({'escopo.setor_id': st})['escopo']
+    assert escopo_setor['almoxarifado_id'] == a1
+    db['lotes'].insert_one({'produto_id': produto_id, 'setor_id': setor_id, 'quantidade_atual': 4, 'escopo': escopo_setor})
+    db['movimentacoes'].insert_one({'produto_id': produto_id, 'tipo': 'consumo', 'quantidade': 1, 'escopo': escopo_setor})
+
+    # Sub passa para o segundo almoxarifado: as linhas do setor (abaixo dele) acompanham
+    r = client.put(f'/api/sub-almoxarifados/{sub_id}', json={'almoxarifado_id': almox_ids[1]}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    for coll in ('estoques', 'movimentacoes', 'lotes'):
+        rows = list(db[coll].find({'escopo.setor_id': st}))
+        assert rows and all(row['escopo']['almoxarifado_id'] == a2 for row in rows), coll
+    # A linha do próprio almoxarifado de origem não muda
+    assert db['estoques'].find_one({'local_tipo': 'almoxarifado'})['escopo']['almoxarifado_id'] == a1
@@ -0,0 +1,44 @@
+import asyncio
+
+
+def test_estoque_hierarquia_filters_status_in_query():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import get_estoque_hierarquia, route_cache
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    route_cache.store.clear()
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox = ObjectId()
+
+    async def listar(status, page=1):
+        return await get_estoque_hierarquia(page=page, per_page=5, produto=None, tipo=None, local=None, status=status, user=user)
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox S'})
+        rows = []
+        for i in range(12):  # Normal
+            rows.append({'quantidade': 100, 'quantidade_disponivel': 50, 'quantidade_inicial': 100})
+        for i in range(7):  # Baixo
+            rows.append({'quantidade': 100, 'quantidade_disponivel': 5, 'quantidade_inicial': 100})
+        for i in range(4):  # Zerado (linha antiga sem disponível/inicial)
+            rows.append({'quantidade': 0, 'quantidade_atual': 0})
+        for n, r in enumerate(rows):
+            r.update({'produto_id': f'p{n}', 'almoxarifado_id': str(almox), 'local_tipo': 'almoxarifado', 'local_id': str(almox)})
+            await db.estoques.insert_one(r)
+
+        out = await listar('Baixo')
+        assert out['pagination']['total'] == 7 and len(out['items']) == 5
+        assert {i['status'] for i in out['items']} == {'Baixo'}
+        out = await listar('Baixo', page=2)
+        assert len(out['items']) == 2
+        out = await listar('zerado')
+        assert out['pagination']['total'] == 4 and {i['status'] for i in out['items']} == {'Zerado'}
+        assert (await listar('Normal'))['pagination']['total'] == 12
+        assert (await listar(None))['pagination']['total'] == 23
+        assert (await listar('inexistente'))['items'] == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import time
+import warnings
+
+import pytest
+
+
+def test_gather_bounds_concurrency_and_keeps_order():
+    import fanout
+
+    state = {'running': 0, 'peak': 0}
+
+    async def job(i):
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+        await asyncio.sleep(0.01 * (5 - i % 5))
+        state['running'] -= 1
+        return i
+
+    async def scenario():
+        out = await fanout.gather(*[functools.partial(job, i) for i in range(12)], limit=3)
+        named = await fanout.gather_dict({'a': lambda: job(1), 'b': lambda: job(2)})
+        return out, named
+
+    out, named = asyncio.run(scenario())
+    assert out == list(range(12)) and state['peak'] == 3
+    assert named == {'a': 1, 'b': 2}
+
+
+def test_gather_cancels_pending_on_failure():
+    import fanout
+
+    cancelled = []
+    started = []
+
+    async def slow():
+        started.append('slow')
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def boom():
+        raise ValueError('falhou')
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await fanout.gather(slow, boom, slow, slow, slow, limit=2)
+        return await fanout.gather(boom, lambda: asyncio.sleep(0, 'ok'), return_exceptions=True)
+
+    t0 = time.perf_counter()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        res = asyncio.run(scenario())
+    assert time.perf_counter() - t0 < 1 and cancelled  # nenhuma consulta lenta ficou rodando
+    # Só a lenta que herdou a vaga da `boom` chegou a começar; as que esperavam o
+    # semáforo foram canceladas sem nunca criar a corrotina
+    assert started == ['slow', 'slow']
+    assert not [w for w in caught if 'never awaited' in str(w.message)]
+    assert isinstance(res[0], ValueError) and res[1] == 'ok'
@@ -0,0 +1,97 @@
+def _get_csrf_token(client):
+    client.get('/')
+    with client.session_transaction() as sess:
+        return sess.get('csrf_token')
+
+
+def _json_headers(token):
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-CSRF-Token': token,
+    }
+
+
+def test_fastapi_chain_resolution_uses_graph_and_refreshes_on_write():
+    import asyncio
+
+    from bson import ObjectId
+    import mongomock
+
+    from fastapi_app.main import MONGO_DB
+    from fastapi_app.main import SubAlmoxarifadoItem
+    from fastapi_app.main import _AsyncMockDatabase
+    from fastapi_app.main import _compute_user_central_id
+    from fastapi_app.main import _resolve_parent_chain_from_setor
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import update_sub_almoxarifado
+    from hierarchy import hierarchy_graph
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    fastapi_db.client = None
+    fastapi_db.is_mock = True
+
+    c1, c2 = ObjectId(), ObjectId()
+    a1, a2 = ObjectId(), ObjectId()
+    sub_oid, setor_oid = ObjectId(), ObjectId()
+
+    async def _seed():
+        await fastapi_db.db.centrais.insert_one({"_id": c1, "nome": "C1"})
+        await fastapi_db.db.centrais.insert_one({"_id": c2, "nome": "C2"})
+        await fastapi_db.db.almoxarifados.insert_one({"_id": a1, "nome": "A1", "central_id": str(c1)})
+        await fastapi_db.db.almoxarifados.insert_one({"_id": a2, "nome": "A2", "central_id": str(c2)})
+        await fastapi_db.db.sub_almoxarifados.insert_one({"_id": sub_oid, "nome": "S1", "almoxarifado_id": str(a1)})
+        await fastapi_db.db.setores.insert_one({"_id": setor_oid, "nome": "Setor 1", "sub_almoxarifado_ids": [str(sub_oid)]})
+
+    asyncio.run(_seed())
+
+    setor = {"_id": setor_oid, "sub_almoxarifado_ids": [str(sub_oid)]}
+    chain = asyncio.run(_resolve_parent_chain_from_setor(setor))
+    assert chain == {"central_id": str(c1), "almoxarifado_id": str(a1), "sub_almoxarifado_id": str(sub_oid)}
+    version = hierarchy_graph.version
+
+    # Com o grafo carregado, a resolução não depende mais do banco
+    async def _drop_almox():
+        await fastapi_db.db.almoxarifados.delete_one({"_id": a1})
+
+    asyncio.run(_drop_almox())
+    assert asyncio.run(_compute_user_central_id("operador_setor", str(setor_oid), None, strict=True)) == str(c1)
+    assert hierarchy_graph.version == version
+
+    # Escrita via endpoint de hierarquia invalida e recarrega o grafo
+    user_ctx = {"id": str(ObjectId()), "role": "super_admin", "scope_id": None}
+    asyncio.run(update_sub_almoxarifado(str(sub_oid), SubAlmoxarifadoItem(nome="S1", almoxarifado_id=str(a2)), user=user_ctx))
+    assert asyncio.run(_compute_user_central_id("resp_sub_almox", str(sub_oid), None, strict=True)) == str(c2)
+    assert hierarchy_graph.version > version
+
+
+def test_flask_central_of_local_follows_hierarchy_updates(client):
+    import extensions
+    from auth import MongoUser
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central G1', 'ativo': True}, headers=_json_headers(csrf))
+    central1 = r.get_json().get('id')
+    r = client.post('/api/centrais', json={'nome': 'Central G2', 'ativo': True}, headers=_json_headers(csrf))
+    central2 = r.get_json().get('id')
+    r = client.post('/api/almoxarifados', json={'nome': 'Almox G', 'ativo': True, 'central_id': central1}, headers=_json_headers(csrf))
+    almox_id = r.get_json().get('id')
+    r = client.post('/api/sub-almoxarifados', json={'nome': 'Sub G', 'ativo': True, 'almoxarifado_id': almox_id}, headers=_json_headers(csrf))
+    sub_id = r.get_json().get('id')
+    r = client.post('/api/setores', json={'nome': 'Setor G', 'ativo': True, 'sub_almoxarifado_ids': [sub_id]}, headers=_json_headers(csrf))
+    setor_id = r.get_json().get('id')
+
+    centrais = extensions.mongo_db['centrais']
+    c1_oid = str(centrais.find_one({'id': int(central1)})['_id'])
+    c2_oid = str(centrais.find_one({'id': int(central2)})['_id'])
+
+    user = MongoUser({'nivel_acesso': 'operador_setor', 'setor_id': setor_id})
+    assert user._central_id_of_local('setor', setor_id) == c1_oid
+    assert user._central_id_of_local('sub_almoxarifado', sub_id) == c1_oid
+
+    r = client.put(f'/api/almoxarifados/{almox_id}', json={'central_id': central2}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    assert user._central_id_of_local('setor', setor_id) == c2_oid
@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def test_apply_creates_missing_and_reports_extras():
+    import mongomock
+    import index_spec
+    from fastapi_app.main import _AsyncMockDatabase
+
+    raw = mongomock.MongoClient().db_indices
+    raw['lotes'].create_index([('produto_id', 1)], name='lote_prod_manual')
+    raw['lotes'].create_index([('fornecedor', 1)], name='idx_velho')
+
+    report = asyncio.run(index_spec.apply_async(_AsyncMockDatabase(raw), log=None))
+    assert 'idx_lote_produto_numero' in report['lotes']['criados']
+    # Mesmo campo com outro nome não é duplicado nem contado como extra
+    assert 'idx_lote_produto' not in report['lotes']['criados']
+    assert report['lotes']['extras'] == ['idx_velho']
+    assert 'idx_est_produto_local' in raw['estoques'].index_information()
+    assert 'idx_dem_setor_status_updated' in raw['demandas'].index_information()
+    assert 'idx_mov_origem_data' in raw['movimentacoes'].index_information()
+
+    again = index_spec.apply(raw, log=None)
+    assert all(not r['criados'] and not r['falhas'] for r in again.values())
+
+
+def test_flask_startup_uses_spec(client):
+    import extensions
+    import index_spec
+
+    info = extensions.mongo_db['estoques'].index_information()
+    assert {name for _, name, _ in index_spec.INDEXES['estoques']} <= set(info)
+
+
+def test_slow_query_listener_flags_unindexed_filters():
+    import index_spec
+
+    logs = []
+    listener = index_spec.SlowQueryListener(threshold_ms=50, log=logs.append)
+
+    def run(request_id, command, micros):
+        name = next(iter(command))
+        listener.started(SimpleNamespace(command_name=name, command=command, request_id=request_id))
+        listener.succeeded(SimpleNamespace(command_name=name, request_id=request_id, duration_micros=micros))
+
+    run(1, {'find': 'estoques', 'filter': {'produto_id': 'p1', 'local_id': 'a1'}}, 80_000)
+    run(2, {'find': 'estoques', 'filter': {'nome_local': 'X'}}, 80_000)
+    run(3, {'aggregate': 'lotes', 'pipeline': [{'$match': {'$or': [{'fornecedor': 'F'}]}}]}, 10_000)
+    run(4, {'insert': 'lotes', 'documents': []}, 900_000)
+    assert len(logs) == 2
+    assert 'idx_est_produto' in logs[0]
+    assert "campos=['nome_local']" in logs[1] and 'nenhum índice' in logs[1]
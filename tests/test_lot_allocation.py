@@ -0,0 +1,202 @@
+import asyncio
+from datetime import datetime, timedelta
+
+
+def test_distribuicao_baixa_lotes_fefo_e_recupera_heap_velho():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import (DistribuicaoLoteItem, DistribuicaoLoteRequest, MovimentacaoRequest,
+                                  post_distribuicao, post_distribuicao_lote)
+    from lot_allocation import lot_allocator
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setor = ObjectId(), ObjectId()
+    prods = [ObjectId(), ObjectId()]
+    now = datetime.utcnow()
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox F'})
+        await db.setores.insert_one({'_id': setor, 'nome': 'Setor F', 'almoxarifado_id': str(almox)})
+        for i, pid in enumerate(prods):
+            await db.produtos.insert_one({'_id': pid, 'nome': f'Prod {i}', 'codigo': f'FE-{i}'})
+            await db.estoques.insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                          'quantidade': 20, 'quantidade_atual': 20, 'quantidade_disponivel': 20})
+        lote = {'produto_id': str(prods[0]), 'local_tipo': 'almoxarifado', 'local_id': str(almox), 'almoxarifado_id': str(almox)}
+        await db.lotes.insert_many([
+            dict(lote, numero_lote='TARDE', quantidade_atual=5, data_validade=now + timedelta(days=90)),
+            dict(lote, numero_lote='CEDO', quantidade_atual=3, data_validade=now + timedelta(days=10)),
+            dict(lote, numero_lote='SEM', quantidade_atual=10),
+            dict(lote, numero_lote='OUTRO', quantidade_atual=7, local_id=str(setor), local_tipo='setor'),
+        ])
+
+        async def saldos():
+            return {l['numero_lote']: l['quantidade_atual'] for l in await db.lotes.find({}).to_list(length=None)}
+
+        await post_distribuicao(MovimentacaoRequest(produto_id=str(prods[0]), quantidade=4, origem_id=str(almox),
+                                                    destino_id=str(setor), destino_tipo='setor'), user=user)
+        assert await saldos() == {'TARDE': 4, 'CEDO': 0, 'SEM': 10, 'OUTRO': 7}
+        mov = await db.movimentacoes.find_one({'produto_id': str(prods[0])})
+        assert [(l['lote'], l['quantidade']) for l in mov['lotes']] == [('CEDO', 3), ('TARDE', 1)] and mov['sem_lote'] == 0
+
+        # Outro processo baixa o lote TARDE: o heap em cache fica velho
+        await db.lotes.update_one({'numero_lote': 'TARDE'}, {'$inc': {'quantidade_atual': -4}})
+        conflicts = lot_allocator.conflicts
+        out = await post_distribuicao_lote(DistribuicaoLoteRequest(
+            origem_id=str(almox), destino_id=str(setor), destino_tipo='setor', items=[
+                DistribuicaoLoteItem(produto_id='FE-0', quantidade=6),
+                DistribuicaoLoteItem(produto_id='FE-1', quantidade=2),
+            ]), user=user)
+        assert out['status'] == 'success'
+        assert lot_allocator.conflicts == conflicts + 1
+        assert await saldos() == {'TARDE': 0, 'CEDO': 0, 'SEM': 4, 'OUTRO': 7}
+        movs = {m['produto_id']: m for m in await db.movimentacoes.find({'quantidade': {'$in': [6, 2]}}).to_list(length=None)}
+        assert [(l['lote'], l['quantidade']) for l in movs[str(prods[0])]['lotes']] == [('SEM', 6)]
+        assert movs[str(prods[1])]['lotes'] == [] and movs[str(prods[1])]['sem_lote'] == 2
+
+    asyncio.run(scenario())
+
+
+def test_allocate_sync_respeita_validade_e_saldo():
+    import mongomock
+    from lot_allocation import AllocationRequest, LotAllocator
+
+    coll = mongomock.MongoClient().db.lotes
+    now = datetime.utcnow()
+    coll.insert_many([
+        {'produto_id': 1, 'lote': 'B', 'almoxarifado_id': 'a1', 'quantidade_atual': 2, 'data_validade': now + timedelta(days=5)},
+        {'produto_id': 1, 'lote': 'A', 'almoxarifado_id': 'a1', 'quantidade_atual': 2, 'data_validade': now + timedelta(days=1)},
+        {'produto_id': 1, 'lote': 'X', 'almoxarifado_id': 'a2', 'quantidade_atual': 9, 'data_validade': now},
+    ])
+    allocator = LotAllocator()
+    req = allocator.allocate(coll, AllocationRequest([1], 'almoxarifado', ['a1'], 5))
+    assert [(l['lote'], l['quantidade']) for l in req.lotes] == [('A', 2), ('B', 2)]
+    assert req.result()['sem_lote'] == 1
+    assert {l['lote']: l['quantidade_atual'] for l in coll.find()} == {'A': 0, 'B': 0, 'X': 9}
+
+
+def test_failed_bulk_write_discards_planned_heap():
+    import mongomock
+    import pytest
+    from fastapi_app.main import _AsyncMockDatabase
+    from lot_allocation import AllocationRequest, LotAllocator
+
+    lotes = _AsyncMockDatabase(mongomock.MongoClient().db).lotes
+    now = datetime.utcnow()
+    allocator = LotAllocator()
+    real_bulk_write = lotes.bulk_write
+    calls = {'n': 0}
+
+    async def flaky_bulk_write(ops, **kwargs):
+        calls['n'] += 1
+        if calls['n'] == 1:
+            raise ConnectionError('conexão perdida')
+        return await real_bulk_write(ops, **kwargs)
+
+    lotes.bulk_write = flaky_bulk_write
+
+    async def scenario():
+        await lotes.insert_many([
+            {'produto_id': 1, 'lote': 'A', 'almoxarifado_id': 'a1', 'quantidade_atual': 2, 'data_validade': now + timedelta(days=1)},
+            {'produto_id': 1, 'lote': 'B', 'almoxarifado_id': 'a1', 'quantidade_atual': 2, 'data_validade': now + timedelta(days=5)},
+        ])
+        with pytest.raises(ConnectionError):
+            await allocator.allocate_many_async(lotes, [AllocationRequest([1], 'almoxarifado', ['a1'], 3)], now)
+        # Nada foi gravado: a próxima saída relê os lotes e começa pelo A
+        req = AllocationRequest([1], 'almoxarifado', ['a1'], 1)
+        await allocator.allocate_many_async(lotes, [req], now)
+        assert [(l['lote'], l['quantidade']) for l in req.lotes] == [('A', 1)]
+        assert allocator.loads == 2
+
+    asyncio.run(scenario())
+
+
+def test_estorno_distribuicao_devolve_lotes_baixados():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import MovimentacaoRequest, post_distribuicao, post_estorno_distribuicao
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setor, pid = ObjectId(), ObjectId(), ObjectId()
+    now = datetime.utcnow()
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox E'})
+        await db.setores.insert_one({'_id': setor, 'nome': 'Setor E', 'almoxarifado_id': str(almox)})
+        await db.produtos.insert_one({'_id': pid, 'nome': 'Prod E', 'codigo': 'ES-1'})
+        await db.estoques.insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                      'quantidade': 8, 'quantidade_atual': 8, 'quantidade_disponivel': 8})
+        lote = {'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox)}
+        await db.lotes.insert_many([
+            dict(lote, numero_lote='TARDE', quantidade_atual=5, data_validade=now + timedelta(days=90)),
+            dict(lote, numero_lote='CEDO', quantidade_atual=3, data_validade=now + timedelta(days=10)),
+        ])
+
+        async def saldos():
+            return {l['numero_lote']: l['quantidade_atual'] for l in await db.lotes.find({}).to_list(length=None)}
+
+        async def estorno(q):
+            await post_estorno_distribuicao(MovimentacaoRequest(produto_id=str(pid), quantidade=q, origem_tipo='setor', origem_id=str(setor),
+                                                                destino_tipo='almoxarifado', destino_id=str(almox)), user=user)
+            return await db.movimentacoes.find_one({'tipo': 'estorno_distribuicao'}, sort=[('_id', -1)])
+
+        await post_distribuicao(MovimentacaoRequest(produto_id=str(pid), quantidade=6, origem_id=str(almox),
+                                                    destino_id=str(setor), destino_tipo='setor'), user=user)
+        assert await saldos() == {'TARDE': 2, 'CEDO': 0}
+
+        # Volta primeiro o último lote baixado; o que já voltou não é devolvido de novo
+        mov = await estorno(4)
+        assert [(l['lote'], l['quantidade']) for l in mov['lotes']] == [('TARDE', 3), ('CEDO', 1)] and mov['sem_lote'] == 0
+        assert await saldos() == {'TARDE': 5, 'CEDO': 1}
+        mov = await estorno(2)
+        assert [(l['lote'], l['quantidade']) for l in mov['lotes']] == [('CEDO', 2)]
+        assert await saldos() == {'TARDE': 5, 'CEDO': 3}
+
+        # Saldo do setor que não veio de distribuição com lote volta sem lote
+        await db.estoques.update_one({'local_tipo': 'setor'}, {'$inc': {'quantidade': 3, 'quantidade_disponivel': 3}})
+        mov = await estorno(3)
+        assert mov['lotes'] == [] and mov['sem_lote'] == 3
+        assert await saldos() == {'TARDE': 5, 'CEDO': 3}
+
+    asyncio.run(scenario())
+
+
+def test_flask_transferencia_do_setor_devolve_lotes(client):
+    import extensions
+    from bson import ObjectId
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    client.get('/')
+    with client.session_transaction() as sess:
+        headers = {'X-CSRF-Token': sess.get('csrf_token'), 'Accept': 'application/json'}
+    db = extensions.mongo_db
+    almox, setor, pid = ObjectId(), ObjectId(), ObjectId()
+    db['almoxarifados'].insert_one({'_id': almox, 'nome': 'Almox T'})
+    db['setores'].insert_one({'_id': setor, 'nome': 'Setor T', 'almoxarifado_id': str(almox)})
+    db['produtos'].insert_one({'_id': pid, 'nome': 'Prod T', 'codigo': 'TR-1'})
+    db['estoques'].insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                               'quantidade': 10, 'quantidade_disponivel': 10})
+    db['lotes'].insert_one({'produto_id': str(pid), 'lote': 'L1', 'almoxarifado_id': str(almox), 'quantidade_atual': 10,
+                            'data_validade': datetime.utcnow() + timedelta(days=30)})
+
+    def transferir(origem, destino, q):
+        r = client.post('/api/movimentacoes/transferencia', headers=headers, json={
+            'produto_id': str(pid), 'quantidade': q, 'origem': origem, 'destino': destino})
+        assert r.status_code == 200, r.get_json()
+        return db['movimentacoes'].find_one({'_id': ObjectId(r.get_json()['movimentacao_id'])})
+
+    a, s = {'tipo': 'almoxarifado', 'id': str(almox)}, {'tipo': 'setor', 'id': str(setor)}
+    saida = transferir(a, s, 6)
+    assert [(l['lote'], l['quantidade']) for l in saida['lotes']] == [('L1', 6)]
+    volta = transferir(s, a, 4)
+    assert [(l['lote'], l['quantidade']) for l in volta['lotes']] == [('L1', 4)] and volta['sem_lote'] == 0
+    assert db['lotes'].find_one({'lote': 'L1'})['quantidade_atual'] == 8
+    assert db['movimentacoes'].find_one({'_id': saida['_id']})['lotes_devolvidos'] == {str(saida['lotes'][0]['lote_id']): 4}
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, timezone
+
+
+def test_parse_accepts_legacy_formats():
+    import lot_expiry
+
+    assert lot_expiry.parse('2026-05-01') == datetime(2026, 5, 1)
+    assert lot_expiry.parse('01/05/2026') == datetime(2026, 5, 1)
+    assert lot_expiry.parse('2026-05-01T03:00:00Z') == datetime(2026, 5, 1, 3)
+    assert lot_expiry.parse(datetime(2026, 5, 1, 3, tzinfo=timezone(timedelta(hours=-3)))) == datetime(2026, 5, 1, 6)
+    assert lot_expiry.parse('sem data') is None and lot_expiry.parse('') is None
+    assert lot_expiry.expiry_of({'data_vencimento': '2026-05-01'}) == datetime(2026, 5, 1)
+
+
+def test_migration_normalizes_lots_and_dashboard_uses_range(client):
+    import extensions
+    import lot_expiry
+    from hierarchy import META_COLLECTION, META_KEY
+    from scripts.migrate_lotes_validade import migrate_lotes_validade
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    db['lotes'].delete_many({})
+    central = db['centrais'].insert_one({'nome': 'Central Lotes'}).inserted_id
+    almox = db['almoxarifados'].insert_one({'nome': 'Almox Lotes', 'central_id': str(central)}).inserted_id
+    pid = db['produtos'].insert_one({'nome': 'Vacina'}).inserted_id
+    now = datetime.utcnow()
+    db['lotes'].insert_many([
+        {'produto_id': str(pid), 'lote': 'V1', 'almoxarifado_id': str(almox), 'quantidade_atual': 5,
+         'data_vencimento': (now - timedelta(days=3, hours=-1)).strftime('%Y-%m-%dT%H:%M:%S')},
+        {'produto_id': str(pid), 'lote': 'P1', 'almoxarifado_id': str(almox), 'quantidade_atual': 5,
+         'data_vencimento': now + timedelta(days=10, hours=1)},
+        {'produto_id': str(pid), 'lote': 'L1', 'almoxarifado_id': str(almox), 'quantidade_atual': 5,
+         'data_validade': now + timedelta(days=90)},
+        {'produto_id': str(pid), 'lote': 'Z1', 'almoxarifado_id': str(almox), 'quantidade_atual': 0,
+         'data_vencimento': now + timedelta(days=2)},
+        {'produto_id': str(pid), 'lote': 'X1', 'almoxarifado_id': str(almox), 'data_vencimento': 'ilegível'},
+    ])
+
+    summary = migrate_lotes_validade(db, batch_size=2, log=None)
+    assert summary['updated'] == 5 and summary['sem_validade'] == 1 and summary['sem_local'] == 0
+    assert db['lotes'].count_documents({'data_vencimento': {'$exists': True}}) == 0
+    assert all(isinstance(l['data_validade'], datetime) for l in db['lotes'].find({'lote': {'$ne': 'X1'}}))
+    assert {l['escopo']['central_id'] for l in db['lotes'].find()} == {str(central)}
+    assert db[META_COLLECTION].find_one({'_id': META_KEY})[lot_expiry.READY_KEY] is True
+    assert migrate_lotes_validade(db, log=None)['updated'] == 0
+
+    lots = list(lot_expiry.expiring(db['lotes'], 30, {'escopo.almoxarifado_id': str(almox)}, now=now))
+    assert [l['lote'] for l in lots] == ['P1']
+
+    body = client.get('/api/dashboard/vencimentos?dias_aviso=30&limit=10').get_json()
+    assert body['success'] is True
+    assert (body['total_vencidos'], body['total_proximos']) == (1, 1)
+    assert [(i['numero_lote'], i['status'], i['dias_para_vencer']) for i in body['items']] == [('V1', 'vencido', -3), ('P1', 'proximo', 10)]
+
+
+def test_vencimentos_before_migration_includes_legacy_fields(client):
+    import extensions
+    import lot_expiry
+    from hierarchy import META_COLLECTION, META_KEY, hierarchy_graph
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    db['lotes'].delete_many({})
+    db[META_COLLECTION].update_one({'_id': META_KEY}, {'$unset': {lot_expiry.READY_KEY: ''}})
+    hierarchy_graph.invalidate(db)
+    pid = db['produtos'].insert_one({'nome': 'Soro'}).inserted_id
+    now = datetime.utcnow()
+    db['lotes'].insert_many([
+        {'produto_id': str(pid), 'lote': 'N1', 'quantidade_atual': 5, 'data_validade': now + timedelta(days=5, hours=1)},
+        {'produto_id': str(pid), 'lote': 'S1', 'quantidade_atual': 5,
+         'data_vencimento': (now + timedelta(days=2, hours=1)).strftime('%d/%m/%Y %H:%M')},
+        {'produto_id': str(pid), 'lote': 'D1', 'quantidade_atual': 5, 'validade': now - timedelta(days=1, hours=-1)},
+        {'produto_id': str(pid), 'lote': 'T1', 'quantidade_atual': 5,
+         'data_validade': (now + timedelta(days=8, hours=1)).strftime('%Y-%m-%dT%H:%M:%S')},
+        {'produto_id': str(pid), 'lote': 'F1', 'quantidade_atual': 5, 'data_vencimento': '01/01/2099'},
+    ])
+
+    body = client.get('/api/dashboard/vencimentos?dias_aviso=30&limit=10').get_json()
+    assert body['success'] is True
+    assert (body['total_vencidos'], body['total_proximos']) == (1, 3)
+    assert [i['numero_lote'] for i in body['items']] == ['D1', 'S1', 'N1', 'T1']
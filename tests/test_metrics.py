@@ -0,0 +1,70 @@
+import asyncio
+
+
+def test_registry_renders_prometheus_text():
+    import metrics
+
+    reg = metrics.Registry()
+    hist = reg.histogram('req_seconds', 'Duração', ('route',), buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 3.0):
+        hist.observe(v, route='/api/x/<id>')
+    reg.counter('jobs_total', 'Tarefas', ('job',)).inc(job='a"b')
+    g = reg.gauge('lag', 'Atraso')
+    reg.collector(lambda: g.set(0.25))
+
+    text = reg.render()
+    assert '# TYPE req_seconds histogram' in text
+    assert 'req_seconds_bucket{route="/api/x/<id>",le="0.1"} 1' in text
+    assert 'req_seconds_bucket{route="/api/x/<id>",le="1"} 2' in text
+    assert 'req_seconds_bucket{route="/api/x/<id>",le="+Inf"} 3' in text
+    assert 'req_seconds_sum{route="/api/x/<id>"} 3.55' in text
+    assert 'jobs_total{job="a\\"b"} 1' in text
+    assert 'lag 0.25' in text
+
+
+def test_track_job_counts_failures():
+    import metrics
+
+    before = metrics.job_failures.value(job='teste')
+    try:
+        with metrics.track_job('teste'):
+            raise RuntimeError('x')
+    except RuntimeError:
+        pass
+    with metrics.track_job('teste'):
+        pass
+    assert metrics.job_failures.value(job='teste') == before + 1
+    assert metrics.job_duration.count(job='teste') >= 2
+
+
+def test_flask_metrics_use_route_template(client):
+    import metrics
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    client.get('/api/produtos/nao-existe/lotes')
+
+    r = client.get('/metrics')
+    assert r.status_code == 200 and r.content_type.startswith('text/plain')
+    body = r.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{app="flask",method="POST",route="/auth/login",status="200"}' in body
+    assert 'route="/api/produtos/<string:produto_id>/lotes"' in body
+    assert 'cache_stat{cache="response_cache",stat="max_bytes"}' in body
+    assert 'http_requests_in_flight{app="flask"} 1' in body  # só a própria coleta
+    assert metrics.http_in_flight.value(app='flask') == 0
+
+
+def test_fastapi_metrics_endpoint():
+    import httpx
+    from fastapi_app.main import app
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as ac:
+            await ac.get('/api/health/app')
+            return await ac.get('/metrics')
+
+    r = asyncio.run(scenario())
+    assert r.status_code == 200
+    assert 'http_request_duration_seconds_count{app="fastapi",method="GET",route="/api/health/app",status="200"}' in r.text
+    assert 'cache_stat{cache="route_cache",stat="hits"}' in r.text
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timedelta
+
+
+def test_movimentacoes_cursor_walks_forward_and_back():
+    import mongomock
+    import pytest
+    from fastapi import HTTPException
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+    from fastapi_app.main import get_movimentacoes
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_db.db
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    base = datetime(2026, 1, 1)
+
+    async def listar(**kw):
+        params = {'page': 1, 'per_page': 4, 'tipo': None, 'produto': None, 'cursor': None, 'count': None}
+        params.update(kw)
+        return await get_movimentacoes(user=user, **params)
+
+    async def scenario():
+        # Datas repetidas em pares: o desempate por _id não pode perder nem repetir linhas
+        for i in range(11):
+            await db.movimentacoes.insert_one({'tipo': 'entrada', 'quantidade': i, 'data_movimentacao': base + timedelta(hours=i // 2)})
+        esperado = [float(q) for q in sorted(range(11), key=lambda q: (q // 2, q), reverse=True)]
+
+        first = await listar()
+        assert first['pagination']['total'] == 11 and first['pagination']['prev_cursor'] is None
+        vistos = [i['quantidade'] for i in first['items']]
+        pages = [first]
+        token = first['pagination']['next_cursor']
+        while token:
+            out = await listar(cursor=token)
+            assert out['pagination']['total'] is None and out['pagination']['count'] == 'none'
+            vistos += [i['quantidade'] for i in out['items']]
+            pages.append(out)
+            token = out['pagination']['next_cursor']
+        assert vistos == esperado and len(pages) == 3
+
+        # Voltando da última página chega-se à mesma segunda página, sem `skip`
+        back = await listar(cursor=pages[-1]['pagination']['prev_cursor'], count='exact')
+        assert [i['id'] for i in back['items']] == [i['id'] for i in pages[1]['items']]
+        assert back['pagination']['total'] == 11
+        back = await listar(cursor=back['pagination']['prev_cursor'])
+        assert [i['id'] for i in back['items']] == [i['id'] for i in first['items']]
+        assert back['pagination']['prev_cursor'] is None
+
+        # Página por número continua funcionando e também devolve cursor
+        p2 = await listar(page=2)
+        assert [i['id'] for i in p2['items']] == [i['id'] for i in pages[1]['items']]
+        assert p2['pagination']['prev_cursor'] and p2['pagination']['next_cursor']
+
+        with pytest.raises(HTTPException) as exc:
+            await listar(cursor='nao-e-um-cursor')
+        assert exc.value.status_code == 400
+
+    asyncio.run(scenario())
+
+
+def test_flask_movimentacoes_cursor(client):
+    import extensions
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    coll = extensions.mongo_db['movimentacoes']
+    coll.delete_many({})
+    base = datetime(2026, 1, 1)
+    coll.insert_many([{'tipo': 'saida', 'quantidade': i, 'data_movimentacao': base + timedelta(minutes=i)} for i in range(7)])
+
+    r = client.get('/api/movimentacoes?per_page=3')
+    body = r.get_json()
+    assert body['pagination']['total'] == 7
+    quantidades = [i['quantidade'] for i in body['items']]
+    token = body['pagination']['next_cursor']
+    while token:
+        body = client.get(f'/api/movimentacoes?per_page=3&cursor={token}').get_json()
+        assert body['pagination']['total'] is None
+        quantidades += [i['quantidade'] for i in body['items']]
+        token = body['pagination']['next_cursor']
+    assert quantidades == list(range(6, -1, -1))
+
+    assert client.get('/api/movimentacoes?cursor=%%%').status_code == 400
@@ -0,0 +1,51 @@
+import asyncio
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+
+def test_movimentacoes_export_streams_ndjson_and_csv(monkeypatch):
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app import main as fastapi_main
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase, export_movimentacoes
+
+    fastapi_main.db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_main.db.db
+    monkeypatch.setattr(fastapi_main, 'MOV_EXPORT_BATCH_SIZE', 3)
+    user = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    base = datetime(2026, 3, 1)
+
+    async def collect(**kw):
+        params = {'formato': 'ndjson', 'data_inicio': None, 'data_fim': None, 'tipo': None, 'produto_id': None}
+        params.update(kw)
+        resp = await export_movimentacoes(user=user, **params)
+        chunks = [c async for c in resp.body_iterator]
+        return resp, chunks
+
+    async def scenario():
+        pid = ObjectId()
+        uid = ObjectId()
+        await db.produtos.insert_one({'_id': pid, 'nome': 'Luva', 'codigo': 'LUV-1'})
+        await db.usuarios.insert_one({'_id': uid, 'nome': 'Operador X'})
+        for i in range(8):
+            await db.movimentacoes.insert_one({
+                'tipo': 'entrada' if i % 2 else 'saida', 'produto_id': str(pid), 'quantidade': i,
+                'usuario_responsavel': str(uid), 'data_movimentacao': base + timedelta(days=i),
+            })
+
+        resp, chunks = await collect()
+        assert resp.media_type == 'application/x-ndjson'
+        assert len(chunks) == 3  # blocos de 3, 3 e 2
+        rows = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        assert [r['quantidade'] for r in rows] == [float(i) for i in range(8)]
+        assert {r['produto_nome'] for r in rows} == {'Luva'} and {r['usuario'] for r in rows} == {'Operador X'}
+
+        # Data simples no fim é inclusiva (até o fim do dia)
+        _, chunks = await collect(formato='csv', data_inicio='2026-03-02', data_fim='2026-03-04', tipo='entrada')
+        rows = list(csv.DictReader(io.StringIO(''.join(chunks)), delimiter=';'))
+        assert [r['quantidade'] for r in rows] == ['1.0', '3.0']
+        assert rows[0]['produto_codigo'] == 'LUV-1'
+
+    asyncio.run(scenario())
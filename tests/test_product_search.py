@@ -0,0 +1,101 @@
+def _get_csrf_token(client):
+    client.get('/')
+    with client.session_transaction() as sess:
+        return sess.get('csrf_token')
+
+
+def _json_headers(token):
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'X-CSRF-Token': token,
+    }
+
+
+def test_index_folds_accents_ranks_and_updates_incrementally():
+    from bson import ObjectId
+    from product_search import ProductSearchIndex
+
+    idx = ProductSearchIndex()
+    a, b, c = ObjectId(), ObjectId(), ObjectId()
+    idx.upsert({'_id': a, 'id': 7, 'nome': 'Sabão em Pó', 'codigo': 'LIMP-001', 'central_id': 1})
+    idx.upsert({'_id': b, 'nome': 'Detergente neutro', 'codigo': 'LIMP-002', 'descricao': 'para louça', 'central_id': 2})
+    idx.upsert({'_id': c, 'nome': 'Luva de látex', 'codigo': 'EPI-010', 'ativo': False, 'central_id': 1})
+
+    def ids(q, **kw):
+        return [str(doc['_id']) for _, doc in idx.search(q, **kw)]
+
+    assert ids('sabao') == [str(a)]
+    assert ids('SAB') == [str(a)]          # prefixo
+    assert ids('tergen') == [str(b)]       # trecho (trigramas)
+    assert ids('louca') == [str(b)]        # descrição sem acento
+    assert ids('limp-002')[0] == str(b)    # código exato primeiro
+    assert ids('7') == [str(a)]            # id sequencial
+    assert ids('luva latex') == [str(c)]   # vários termos com E
+    assert ids('luva', ativos=True) == []
+    assert ids('limp', central_ids=['2']) == [str(b)]
+
+    idx.upsert({'_id': a, 'id': 7, 'nome': 'Sabonete líquido', 'codigo': 'LIMP-001', 'central_id': 1})
+    assert ids('sabao') == [] and ids('sabonete') == [str(a)]
+    idx.remove(7)
+    assert ids('limp') == [str(b)] and len(idx) == 2
+
+
+def test_busca_rapida_uses_index_and_sees_product_writes(client):
+    import extensions
+    from product_search import META_KEY, product_index
+    from hierarchy import META_COLLECTION
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    csrf = _get_csrf_token(client)
+
+    r = client.post('/api/centrais', json={'nome': 'Central B', 'ativo': True}, headers=_json_headers(csrf))
+    central_id = r.get_json().get('id')
+    r = client.post('/api/produtos', json={'central_id': central_id, 'codigo': 'ALC-70', 'nome': 'Álcool 70%', 'descricao': 'Antisséptico', 'ativo': True}, headers=_json_headers(csrf))
+    produto_id = r.get_json().get('id')
+    assert product_index.ensure_loaded(extensions.mongo_db) and len(product_index) >= 1
+
+    r = client.get('/api/produtos/busca-rapida?q=alcool')
+    items = r.get_json()['items']
+    assert [i['codigo'] for i in items] == ['ALC-70']
+    r = client.get('/api/produtos/busca-rapida?q=antissep')
+    assert [i['codigo'] for i in r.get_json()['items']] == ['ALC-70']
+
+    r = client.put(f'/api/produtos/{produto_id}', json={'nome': 'Álcool em gel'}, headers=_json_headers(csrf))
+    assert r.status_code == 200
+    assert client.get('/api/produtos/busca-rapida?q=gel').get_json()['items'][0]['nome'] == 'Álcool em gel'
+
+    r = client.delete(f'/api/produtos/{produto_id}', headers=_json_headers(csrf))
+    assert r.status_code == 200
+    assert client.get('/api/produtos/busca-rapida?q=gel').get_json()['items'] == []
+    assert client.get('/api/produtos/busca-rapida?q=gel&ativos=false').get_json()['items'][0]['ativo'] is False
+
+    # Escritas publicam a versão sem forçar recarga no próprio processo
+    meta = extensions.mongo_db[META_COLLECTION].find_one({'_id': META_KEY})
+    assert meta['versao'] >= 3 and product_index._remote_version == meta['versao']
+
+
+def test_other_processes_apply_change_log_without_full_reload():
+    import mongomock
+    from product_search import ProductSearchIndex
+
+    db = mongomock.MongoClient().db
+    db['produtos'].insert_one({'nome': 'Gaze estéril', 'codigo': 'G-1'})
+    writer, reader = ProductSearchIndex(), ProductSearchIndex(check_interval=0)
+    assert writer.ensure_loaded(db) and reader.ensure_loaded(db)
+    loaded_at = reader._loaded_at
+
+    res = db['produtos'].insert_one({'nome': 'Seringa 5ml', 'codigo': 'S-5'})
+    doc = db['produtos'].find_one({'_id': res.inserted_id})
+    writer.upsert(doc)
+    writer.publish(db, doc['_id'])
+    gaze = db['produtos'].find_one({'codigo': 'G-1'})
+    db['produtos'].delete_one({'_id': gaze['_id']})
+    writer.remove(gaze['_id'])
+    writer.publish(db, gaze['_id'])
+
+    assert reader.ensure_loaded(db)
+    assert [d['codigo'] for _, d in reader.search('seringa')] == ['S-5']
+    assert reader.search('gaze') == []
+    assert reader._loaded_at == loaded_at and reader._remote_version == writer._remote_version == 2
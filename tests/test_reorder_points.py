@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+
+def test_flag_follows_writes_and_point_updates():
+    import mongomock
+    from bson import ObjectId
+    from fastapi import HTTPException
+    from fastapi_app import main as fastapi_main
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase, PontoReposicaoRequest, get_dashboard_stats, put_ponto_reposicao
+    from stock_ledger import take_async
+
+    fastapi_main.db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_main.db.db
+    admin = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+
+    async def scenario():
+        row_id = ObjectId()
+        await db.estoques.insert_one({'_id': row_id, 'produto_id': 'p1', 'local_tipo': 'almoxarifado', 'local_id': 'a1',
+                                      'quantidade': 12, 'quantidade_atual': 12, 'quantidade_disponivel': 12})
+        await take_async(db.estoques, [{'_id': row_id}], 1)
+        assert (await db.estoques.find_one({'_id': row_id}))['abaixo_minimo'] is False
+        await take_async(db.estoques, [{'_id': row_id}], 3)  # 8 < 10 (padrão)
+        assert (await db.estoques.find_one({'_id': row_id}))['abaixo_minimo'] is True
+        assert (await get_dashboard_stats(user=admin))['baixo_estoque'] == 1
+
+        out = await put_ponto_reposicao(str(row_id), PontoReposicaoRequest(ponto_reposicao=5), user=admin)
+        assert out['abaixo_minimo'] is False and out['ponto_reposicao'] == 5
+        assert (await get_dashboard_stats(user=admin))['baixo_estoque'] == 0
+
+        out = await put_ponto_reposicao(str(row_id), PontoReposicaoRequest(ponto_reposicao=None), user=admin)
+        assert out['abaixo_minimo'] is True and out['ponto_reposicao'] == 10
+
+        with pytest.raises(HTTPException) as exc:
+            await put_ponto_reposicao(str(row_id), PontoReposicaoRequest(ponto_reposicao=-1), user=admin)
+        assert exc.value.status_code == 400
+
+    asyncio.run(scenario())
+
+
+def test_backfill_seeds_point_from_produto_and_widget_reads_flagged_rows(client):
+    import extensions
+    from scripts.backfill_abaixo_minimo import backfill_abaixo_minimo
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+
+    db = extensions.mongo_db
+    db['estoques'].delete_many({})
+    almox = db['almoxarifados'].insert_one({'nome': 'Almox Reposição'}).inserted_id
+    p_min = db['produtos'].insert_one({'nome': 'Com mínimo', 'estoque_minimo': 50}).inserted_id
+    p_std = db['produtos'].insert_one({'nome': 'Sem mínimo'}).inserted_id
+    db['estoques'].insert_many([
+        {'produto_id': str(p_min), 'almoxarifado_id': str(almox), 'quantidade': 30, 'quantidade_disponivel': 30},
+        {'produto_id': str(p_std), 'almoxarifado_id': str(almox), 'quantidade': 30, 'quantidade_disponivel': 30},
+        {'produto_id': str(p_std), 'almoxarifado_id': str(almox), 'quantidade': 4, 'quantidade_reservada': 1},
+    ])
+
+    summary = backfill_abaixo_minimo(db, batch_size=2, log=None)
+    assert summary['updated'] == 3 and summary['seeded'] == 1 and summary['abaixo_minimo'] == 2
+    assert backfill_abaixo_minimo(db, log=None)['updated'] == 0
+
+    body = client.get('/api/dashboard/estoque-baixo').get_json()
+    assert body['success'] is True
+    assert [(p['nome'], p['estoque_atual'], p['estoque_minimo']) for p in body['produtos']] == [
+        ('Sem mínimo', 3.0, 10.0), ('Com mínimo', 30.0, 50.0),
+    ]
+    assert {p['local'] for p in body['produtos']} == {'Almox Reposição'}
+
+
+def test_new_rows_inherit_produto_minimum_and_follow_updates():
+    import mongomock
+    from bson import ObjectId
+    from fastapi_app import main as fastapi_main
+    from fastapi_app.main import (MONGO_DB, _AsyncMockDatabase, MovimentacaoRequest, PontoReposicaoRequest, ProdutoUpdate,
+                                  post_distribuicao, put_ponto_reposicao, update_produto)
+
+    fastapi_main.db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    db = fastapi_main.db.db
+    admin = {'id': 'u1', 'role': 'super_admin', 'scope_id': None}
+    almox, setores, pid = ObjectId(), [ObjectId(), ObjectId()], ObjectId()
+
+    async def scenario():
+        await db.almoxarifados.insert_one({'_id': almox, 'nome': 'Almox M'})
+        for i, setor in enumerate(setores):
+            await db.setores.insert_one({'_id': setor, 'nome': f'Setor M{i}', 'almoxarifado_id': str(almox)})
+        await db.produtos.insert_one({'_id': pid, 'nome': 'Prod M', 'codigo': 'RM-1', 'estoque_minimo': 20})
+        await db.estoques.insert_one({'produto_id': str(pid), 'local_tipo': 'almoxarifado', 'local_id': str(almox),
+                                      'quantidade': 100, 'quantidade_atual': 100, 'quantidade_disponivel': 100})
+
+        async def row(setor):
+            return await db.estoques.find_one({'local_tipo': 'setor', 'local_id': str(setor)})
+
+        # Linhas criadas pela distribuição já nascem com o mínimo do produto (15 < 20)
+        for setor in setores:
+            await post_distribuicao(MovimentacaoRequest(produto_id=str(pid), quantidade=15, origem_id=str(almox),
+                                                        destino_id=str(setor), destino_tipo='setor'), user=admin)
+            doc = await row(setor)
+            assert (doc['ponto_reposicao'], doc['ponto_reposicao_herdado'], doc['abaixo_minimo']) == (20, True, True)
+        origem = await db.estoques.find_one({'local_tipo': 'almoxarifado'})
+        assert origem['ponto_reposicao'] == 20 and origem['abaixo_minimo'] is False
+
+        # Ponto próprio de uma linha não é sobrescrito quando o mínimo do produto muda
+        await put_ponto_reposicao(str((await row(setores[1]))['_id']), PontoReposicaoRequest(ponto_reposicao=30), user=admin)
+        await update_produto(str(pid), ProdutoUpdate(nome='Prod M', codigo='RM-1', estoque_minimo=5))
+        assert ((await row(setores[0]))['ponto_reposicao'], (await row(setores[0]))['abaixo_minimo']) == (5, False)
+        assert ((await row(setores[1]))['ponto_reposicao'], (await row(setores[1]))['abaixo_minimo']) == (30, True)
+
+        # Sem ponto próprio, a linha volta a herdar o mínimo do produto
+        out = await put_ponto_reposicao(str((await row(setores[1]))['_id']), PontoReposicaoRequest(ponto_reposicao=None), user=admin)
+        assert out['ponto_reposicao'] == 5 and out['abaixo_minimo'] is False
+
+    asyncio.run(scenario())
+
+
+def test_flask_produto_update_propagates_minimum(client):
+    import extensions
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    client.get('/')
+    with client.session_transaction() as sess:
+        headers = {'X-CSRF-Token': sess.get('csrf_token'), 'Accept': 'application/json'}
+
+    db = extensions.mongo_db
+    pid = db['produtos'].insert_one({'nome': 'Prod F', 'codigo': 'RF-1', 'estoque_minimo': 2}).inserted_id
+    herdada = db['estoques'].insert_one({'produto_id': str(pid), 'almoxarifado_id': 'a1', 'quantidade': 8, 'quantidade_disponivel': 8,
+                                         'ponto_reposicao': 2, 'ponto_reposicao_herdado': True}).inserted_id
+    nova = db['estoques'].insert_one({'produto_id': str(pid), 'almoxarifado_id': 'a2', 'quantidade': 8, 'quantidade_disponivel': 8}).inserted_id
+    propria = db['estoques'].insert_one({'produto_id': str(pid), 'almoxarifado_id': 'a3', 'quantidade': 8, 'quantidade_disponivel': 8,
+                                         'ponto_reposicao': 1}).inserted_id
+
+    r = client.put(f'/api/produtos/{pid}', json={'estoque_minimo': -1}, headers=headers)
+    assert r.status_code == 400
+    r = client.put(f'/api/produtos/{pid}', json={'estoque_minimo': 12}, headers=headers)
+    assert r.status_code == 200
+    rows = {d['_id']: d for d in db['estoques'].find({'produto_id': str(pid)})}
+    assert (rows[herdada]['ponto_reposicao'], rows[herdada]['abaixo_minimo']) == (12, True)
+    assert (rows[nova]['ponto_reposicao'], rows[nova]['abaixo_minimo']) == (12, True)
+    assert rows[propria]['ponto_reposicao'] == 1 and rows[propria]['abaixo_minimo'] is False
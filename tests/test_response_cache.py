@@ -0,0 +1,35 @@
+import time
+
+
+def test_lru_ttl_cache_budget_recency_and_expiry():
+    from extensions import LRUTTLCache
+
+    cache = LRUTTLCache(max_bytes=60, sweep_interval=0)
+    cache.set('a', 'x' * 20)  # 22 bytes em JSON
+    cache.set('b', 'y' * 20)
+    assert cache.get('a') == 'x' * 20  # 'a' passa a ser o mais recente
+    cache.set('c', 'z' * 20)  # estoura o orçamento: sai 'b' (LRU)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+    # Regravar a mesma chave não duplica bytes
+    cache.set('a', 'x' * 20)
+    st = cache.stats()
+    assert st['entries'] == 2 and st['bytes'] == 44
+    assert st['evictions'] == 1 and st['hits'] == 3 and st['misses'] == 1
+
+    # Entrada maior que o orçamento é recusada
+    cache.set('big', 'w' * 100)
+    assert cache.get('big') is None and cache.stats()['rejected'] == 1
+
+    cache.set('t', 1, ttl=1)
+    cache._data['t'] = (1, time.time() - 1) + cache._data['t'][2:]
+    assert cache.purge_expired() == 1
+    assert 't' not in cache._data
+
+
+def test_health_app_exposes_cache_stats(client):
+    r = client.get('/health/app')
+    assert r.status_code == 200
+    st = r.get_json().get('response_cache')
+    assert {'hits', 'misses', 'evictions', 'bytes', 'max_bytes'} <= set(st)
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import mongomock
+
+
+def _seed(seed=7, db=None, reset=False):
+    from scripts.seed_synthetic import seed_synthetic
+
+    db = mongomock.MongoClient()['seed_test'] if db is None else db
+    summary = seed_synthetic(db, centrais=2, almox_por_central=2, subs_por_almox=2, setores_por_sub=3, produtos=60,
+                             lotes_por_estoque=3, movimentacoes=3000, dias=70, batch_size=500, seed=seed,
+                             reset=reset, now=datetime(2026, 7, 1), log=None)
+    return db, summary
+
+
+def test_seed_is_reproducible_and_consistent():
+    from hierarchy import META_COLLECTION, META_KEY
+
+    db, summary = _seed()
+    counts = summary['counts']
+    assert (counts['centrais'], counts['almoxarifados'], counts['sub_almoxarifados'], counts['setores']) == (2, 4, 8, 24)
+    assert counts['produtos'] == 60 and counts['movimentacoes'] == 3000
+    assert db['movimentacoes'].count_documents({}) == 3000
+
+    # Lotes somam o saldo de cada linha de estoque
+    for row in db['estoques'].find({'quantidade_atual': {'$gt': 0}}):
+        lotes = db['lotes'].find({'produto_id': row['produto_id'], 'local_id': row['local_id']})
+        assert sum(l['quantidade_atual'] for l in lotes) == row['quantidade_atual']
+    assert db['lotes'].count_documents({'data_validade': {'$lt': datetime(2026, 7, 1)}}) > 0
+
+    meta = db[META_COLLECTION].find_one({'_id': META_KEY})
+    assert meta['escopo_pronto'] and meta['lotes_validade_pronto']
+
+    again, _ = _seed()
+    for name in ('produtos', 'lotes', 'movimentacoes'):
+        first = list(db[name].find({}, {'_id': 1}).sort('_id', 1).limit(50))
+        assert first == list(again[name].find({}, {'_id': 1}).sort('_id', 1).limit(50))
+    other, _ = _seed(seed=8)
+    assert other['produtos'].find_one({'codigo': 'SYN-000001'})['_id'] != db['produtos'].find_one({'codigo': 'SYN-000001'})['_id']
+
+
+def test_seed_movements_follow_weekday_seasonality():
+    db, _ = _seed()
+    por_dia = [0] * 7
+    for mov in db['movimentacoes'].find({}, {'data_movimentacao': 1}):
+        por_dia[mov['data_movimentacao'].weekday()] += 1
+    assert min(por_dia[:5]) > 2 * max(por_dia[5:])
+
+
+def test_seed_marks_migration_flags_only_on_seeded_only_database():
+    from hierarchy import META_COLLECTION, META_KEY
+
+    # Estoque antigo (sem escopo) no banco: os backfills ainda são necessários
+    db = mongomock.MongoClient()['seed_test']
+    db['estoques'].insert_one({'produto_id': 'legado', 'almoxarifado_id': 'a1', 'quantidade': 1})
+    _, summary = _seed(db=db)
+    assert summary['flags_marcadas'] is False
+    assert db[META_COLLECTION].find_one({'_id': META_KEY}) is None
+
+    _, summary = _seed(db=db, reset=True)
+    assert summary['flags_marcadas'] is True
+    assert db['estoques'].count_documents({'produto_id': 'legado'}) == 0
+    meta = db[META_COLLECTION].find_one({'_id': META_KEY})
+    assert meta['escopo_pronto'] and meta['lotes_validade_pronto']
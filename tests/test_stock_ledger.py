@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+
+def _fresh_fastapi_db():
+    import mongomock
+    from fastapi_app.main import MONGO_DB, _AsyncMockDatabase
+    from fastapi_app.main import db as fastapi_db
+
+    fastapi_db.db = _AsyncMockDatabase(mongomock.MongoClient()[MONGO_DB])
+    fastapi_db.client = None
+    fastapi_db.is_mock = True
+    return fastapi_db.db
+
+
+def test_take_never_overdraws_and_completes_legacy_rows():
+    from stock_ledger import InsufficientStock, StockNotFound, take_async
+
+    db = _fresh_fastapi_db()
+
+    async def scenario():
+        await db.estoques.insert_one({'produto_id': 'p1', 'local_id': 'a1', 'quantidade': 10, 'quantidade_atual': 10, 'quantidade_disponivel': 10})
+        results = await asyncio.gather(*[take_async(db.estoques, [{'produto_id': 'p1'}], 1) for _ in range(15)], return_exceptions=True)
+        assert sum(1 for r in results if isinstance(r, dict)) == 10
+        assert all(isinstance(r, InsufficientStock) and r.disponivel == 0 for r in results if not isinstance(r, dict))
+        row = await db.estoques.find_one({'produto_id': 'p1'})
+        assert row['quantidade'] == row['quantidade_disponivel'] == 0
+
+        # Linha antiga só com `quantidade`: saldo disponível passa a valer `quantidade`
+        await db.estoques.insert_one({'produto_id': 'p2', 'sub_almoxarifado_id': 's1', 'quantidade': 5})
+        doc = await take_async(db.estoques, [{'produto_id': 'p2', 'local_id': 's1'}, {'produto_id': 'p2', 'sub_almoxarifado_id': 's1'}], 2)
+        assert doc['quantidade'] == doc['quantidade_atual'] == doc['quantidade_disponivel'] == 3
+
+        with pytest.raises(StockNotFound):
+            await take_async(db.estoques, [{'produto_id': 'nada'}], 1)
+
+    asyncio.run(scenario())
+
+
+def test_consumo_setor_uses_conditional_decrement():
+    from bson import ObjectId
+    from fastapi import HTTPException
+    from fastapi_app.main import SetorConsumoRequest, post_consumo_setor
+
+    db = _fresh_fastapi_db()
+    setor_oid, prod_oid = ObjectId(), ObjectId()
+    user = {'id': 'u1', 'role': 'operador_setor', 'scope_id': str(setor_oid)}
+
+    async def scenario():
+        await db.setores.insert_one({'_id': setor_oid, 'nome': 'Setor L'})
+        await db.produtos.insert_one({'_id': prod_oid, 'nome': 'Produto L', 'codigo': 'L-1'})
+        await db.estoques.insert_one({'produto_id': str(prod_oid), 'local_tipo': 'setor', 'local_id': str(setor_oid), 'quantidade': 4, 'quantidade_disponivel': 4})
+
+        out = await post_consumo_setor(SetorConsumoRequest(produto_id=str(prod_oid), quantidade=3), user=user)
+        assert out['status'] == 'success'
+        with pytest.raises(HTTPException) as exc:
+            await post_consumo_setor(SetorConsumoRequest(produto_id=str(prod_oid), quantidade=3), user=user)
+        assert exc.value.status_code == 400 and 'Disponível: 1' in exc.value.detail
+        row = await db.estoques.find_one({'produto_id': str(prod_oid)})
+        assert row['quantidade_disponivel'] == 1 and await db.movimentacoes.count_documents({'tipo': 'saida'}) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,241 @@
+def test_local_classification_and_status_stages_match_row_rules():
+    import mongomock
+    from bson import ObjectId
+
+    import stock_listing
+
+    coll = mongomock.MongoClient().db.estoques
+    setor, almox = ObjectId(), ObjectId()
+    coll.insert_many([
+        {'_id': 1, 'setor_id': str(setor), 'almoxarifado_id': str(almox), 'quantidade': 100, 'quantidade_disponivel': 50, 'quantidade_inicial': 100},
+        {'_id': 2, 'almoxarifado_id': str(almox), 'quantidade': 100, 'quantidade_disponivel': 5, 'quantidade_inicial': 100},
+        {'_id': 3, 'local_tipo': 'subalmoxarifado', 'local_id': 7, 'quantidade': 0, 'quantidade_atual': 0},
+        {'_id': 4, 'setor_id': None, 'central_id': 9, 'quantidade_atual': 3, 'quantidade_inicial': 10},
+    ])
+
+    stages = [stock_listing.LOCAL_STAGE, {'$addFields': stock_listing.RULES.computed_fields()}, {'$sort': {'_id': 1}}]
+    rows = {r['_id']: r for r in coll.aggregate(stages)}
+    assert (rows[1]['_local_tipo'], rows[1]['_local_id']) == ('setor', str(setor))
+    assert (rows[2]['_local_tipo'], rows[2]['_local_id']) == ('almoxarifado', str(almox))
+    assert (rows[3]['_local_tipo'], rows[3]['_local_id']) == ('subalmoxarifado', 7)
+    assert (rows[4]['_local_tipo'], rows[4]['_local_id']) == ('central', 9)
+    assert [rows[i]['_status'] for i in (1, 2, 3, 4)] == ['Normal', 'Baixo', 'Zerado', 'Normal']
+    assert rows[4]['_atual'] == 3 and rows[4]['_disp'] == 3
+
+    # O filtro de status do $match concorda com o status calculado por linha
+    for status in ('Zerado', 'Baixo', 'Normal'):
+        ids = {d['_id'] for d in coll.find(stock_listing.RULES.status_filter(status))}
+        assert ids == {i for i, r in rows.items() if r['_status'] == status}
+    assert stock_listing.RULES.status_filter('inexistente') is None
+
+    # Regras do Flask: disponível desconta a reserva e Baixo vai até max(10% do inicial, 5)
+    coll.insert_one({'_id': 5, 'quantidade': 10, 'quantidade_reservada': 6})
+    row = next(coll.aggregate([{'$match': {'_id': 5}}, {'$addFields': stock_listing.RESERVA_RULES.computed_fields()}]))
+    assert row['_disp'] == 4 and row['_status'] == 'Baixo'
+
+
+def test_page_pipeline_shape_and_unpack():
+    import stock_listing
+
+    pipeline = stock_listing.page_pipeline({'a': 1}, 40, 21, post_match=stock_listing.tipo_match('sub_almoxarifado'))
+    assert pipeline[0] == {'$match': {'a': 1}} and '$sort' in pipeline[1]
+    assert pipeline[3] == {'$match': {'_local_tipo': {'$in': ['sub_almoxarifado', 'subalmoxarifado']}}}
+    facet = pipeline[-1]['$facet']
+    assert facet['items'][:2] == [{'$skip': 40}, {'$limit': 21}] and facet['total'] == [{'$count': 'n'}]
+    assert 'total' not in stock_listing.page_pipeline({}, 0, 5, with_total=False)[-1]['$facet']
+
+    assert stock_listing.unpack_page([{'items': [{'x': 1}], 'total': [{'n': 7}]}]) == ([{'x': 1}], 7)
+    assert stock_listing.unpack_page([{'items': [], 'total': []}]) == ([], 0)
+    assert stock_listing.unpack_page([{'items': []}]) == ([], None)
+
+
+# --- Golden: a agregação de produção devolve o mesmo que o caminho alternativo (mongomock) ---
+
+def _pid_keys(pid):
+    """`_pid_keys` de PRODUCT_STAGES ($convert para ObjectId/int + $setDifference) calculado em Python."""
+    from bson import ObjectId
+
+    keys = [pid]
+    if isinstance(pid, str) and ObjectId.is_valid(pid):
+        keys.append(ObjectId(pid))
+    if isinstance(pid, str) and pid.isdigit():
+        keys.append(int(pid))
+    return [k for k in dict.fromkeys(keys) if k is not None]
+
+
+def _without_convert(pipeline):
+    """Pipeline sem o estágio de `$convert` (o mongomock não implementa o operador); o resto roda como em produção."""
+    out = []
+    for stage in pipeline:
+        if '_pid_keys' in stage.get('$addFields', {}):
+            continue
+        if '$facet' in stage:
+            stage = {'$facet': {k: _without_convert(v) for k, v in stage['$facet'].items()}}
+        out.append(stage)
+    return out
+
+
+def _use_emulated_pipeline(monkeypatch, db):
+    import stock_listing
+
+    for d in db['estoques'].find({}, {'produto_id': 1}):
+        db['estoques'].update_one({'_id': d['_id']}, {'$set': {'_pid_keys': _pid_keys(d.get('produto_id'))}})
+    for name in ('page_pipeline', 'rows_pipeline'):
+        real = getattr(stock_listing, name)
+        monkeypatch.setattr(stock_listing, name, lambda *a, _real=real, **k: _without_convert(_real(*a, **k)))
+
+
+def _seed_stock(db, local_fields=True):
+    """Estoques com produto_id em todas as formas legadas; `updated_at` distintos e inseridos fora de ordem
+    (os dois caminhos precisam ordenar igual), com um empate decidido por `_id`. `local_fields=False` troca
+    local_tipo/local_id pelos campos *_id, os únicos que o caminho alternativo do FastAPI resolve."""
+    from datetime import datetime, timedelta
+    from bson import ObjectId
+
+    central, almox, sub, setor = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+    db['centrais'].insert_one({'_id': central, 'id': 51, 'nome': 'Central G'})
+    db['almoxarifados'].insert_one({'_id': almox, 'id': 52, 'nome': 'Almox G', 'central_id': 51})
+    db['sub_almoxarifados'].insert_one({'_id': sub, 'nome': 'Sub G', 'almoxarifado_id': str(almox)})
+    db['setores'].insert_one({'_id': setor, 'nome': 'Setor G', 'sub_almoxarifado_id': str(sub)})
+    p_oid, p_seq = ObjectId(), ObjectId()
+    db['produtos'].insert_many([
+        {'_id': p_oid, 'nome': 'Gaze G', 'codigo': 'G-1', 'central_id': 51},
+        {'_id': p_seq, 'id': 77, 'nome': 'Luva G', 'codigo': 'G-2', 'central_id': 51},
+    ])
+    t0 = datetime(2026, 1, 1)
+    rows = [
+        {'produto_id': str(p_oid), 'almoxarifado_id': 52, 'quantidade': 100, 'quantidade_inicial': 100},
+        {'produto_id': p_oid, 'local_tipo': 'setor', 'local_id': str(setor), 'quantidade_atual': 3, 'quantidade_inicial': 50},
+        {'produto_id': 77, 'sub_almoxarifado_id': str(sub), 'quantidade': 0},
+        {'produto_id': '77', 'local_tipo': 'almoxarifado', 'local_id': str(almox), 'quantidade': 40, 'quantidade_reservada': 38},
+        {'produto_id': 'nao-existe', 'central_id': str(central), 'quantidade': 9},
+    ]
+    if not local_fields:
+        rows[1] = {**{k: v for k, v in rows[1].items() if k not in ('local_tipo', 'local_id')}, 'setor_id': str(setor)}
+        rows[3] = {**{k: v for k, v in rows[3].items() if k not in ('local_tipo', 'local_id')}, 'almoxarifado_id': str(almox)}
+    for i, r in enumerate(rows):
+        r['updated_at'] = t0 - timedelta(hours=min(i, 3))
+    # Ordem da listagem: 0, 1, 2, 4, 3 (empate em updated_at: maior _id primeiro)
+    db['estoques'].insert_many([rows[i] for i in (2, 0, 3, 4, 1)])
+    return {'almox': almox, 'produtos': (p_oid, p_seq)}
+
+
+def test_fastapi_pipeline_matches_fallback(monkeypatch):
+    import asyncio
+
+    import mongomock
+    import fastapi_app.main as fastapi_main
+
+    sync_db = mongomock.MongoClient()['golden_fastapi']
+    _seed_stock(sync_db, local_fields=False)
+    fastapi_main.db.db = fastapi_main._AsyncMockDatabase(sync_db)
+    user = {'id': 'u', 'role': 'super_admin', 'scope_id': None}
+
+    def listing(**filters):
+        async def run():
+            pages = []
+            for page in (1, 2):
+                fastapi_main.route_cache.store.clear()
+                args = dict(page=page, per_page=3, produto=None, tipo=None, local=None, status=None, count='exact')
+                args.update(filters)
+                pages.append(await fastapi_main.get_estoque_hierarquia(**args, user=user))
+            return pages
+        return asyncio.run(run())
+
+    cases = [{}, {'status': 'zerado'}, {'status': 'baixo'}]
+    fallback = [listing(**c) for c in cases]
+    _use_emulated_pipeline(monkeypatch, sync_db)
+    monkeypatch.setattr(fastapi_main, '_supports_pipeline', lambda: True)
+    pipeline = [listing(**c) for c in cases]
+
+    assert [it['produto_nome'] for it in fallback[0][0]['items']] == ['Gaze G', 'Gaze G', 'Luva G']
+    assert [it['local_nome'] for it in fallback[0][0]['items']] == ['Almox G', 'Setor G', 'Sub G']
+    for expected, got in zip(fallback, pipeline):
+        assert [p['items'] for p in got] == [p['items'] for p in expected]
+        assert [p['pagination']['total'] for p in got] == [p['pagination']['total'] for p in expected]
+
+
+def test_flask_pipeline_matches_fallback_and_keeps_restricted_pages_full(client, monkeypatch):
+    from datetime import datetime
+
+    import extensions
+    from werkzeug.security import generate_password_hash
+    from blueprints.main import hierarchy_graph
+    from scripts.backfill_escopo import backfill_escopo
+
+    r = client.post('/auth/login', json={'username': 'admin', 'password': 'admin'})
+    assert r.status_code == 200
+    db = extensions.mongo_db
+    _seed_stock(db)
+
+    def listing(query):
+        extensions.response_cache.clear()
+        return [client.get(f'/api/estoque/hierarquia?per_page=2&page={p}&{query}').get_json() for p in (1, 2, 3)]
+
+    # O caminho alternativo filtra status/tipo depois da página: os filtros são comparados sem paginação
+    cases = ['', 'no_pagination=1', 'no_pagination=1&status=baixo', 'no_pagination=1&status=zerado', 'no_pagination=1&tipo=setor']
+    fallback = [listing(q) for q in cases]
+    _use_emulated_pipeline(monkeypatch, db)
+    monkeypatch.setattr(extensions, 'mongo_is_mock', False)
+    pipeline = [listing(q) for q in cases]
+    assert [len(p['items']) for p in fallback[0]] == [2, 2, 1]
+    assert len(fallback[2][0]['items']) == 2 and len(fallback[3][0]['items']) == 1
+    for expected, got in zip(fallback, pipeline):
+        assert got == expected
+
+    # Produto de outra central guardado no almoxarifado do gerente: a página não encolhe
+    other = db['produtos'].insert_one({'nome': 'Fora G', 'codigo': 'G-3', 'central_id': 999}).inserted_id
+    db['estoques'].insert_one({'produto_id': str(other), 'almoxarifado_id': 52, 'quantidade': 1,
+                                'updated_at': datetime(2026, 2, 1), '_pid_keys': [str(other), other]})
+    backfill_escopo(db, reset=True, log=None)
+    hierarchy_graph.invalidate(db)
+    db['usuarios'].insert_one({'username': 'gerente_g', 'password_hash': generate_password_hash('x'), 'ativo': True,
+                               'nivel_acesso': 'gerente_almox', 'almoxarifado_id': 52})
+    client.get('/auth/logout')
+    r = client.post('/auth/login', json={'username': 'gerente_g', 'password': 'x'})
+    assert r.status_code == 200
+    pages = listing('')
+    assert [len(p['items']) for p in pages] == [2, 2, 1] and pages[0]['pagination']['total'] == 5
+    assert pages[0]['items'][0]['produto_codigo'] == 'G-3'
+
+
+def test_page_pipeline_on_real_mongod_matches_emulation():
+    """Com `MONGO_TEST_URI` (mongod descartável) roda o pipeline completo, inclusive $convert/$setDifference."""
+    import os
+    import uuid
+
+    import mongomock
+    import pytest
+
+    import stock_listing
+
+    uri = os.getenv('MONGO_TEST_URI')
+    if not uri:
+        pytest.skip('MONGO_TEST_URI não definido')
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command('ping')
+    except Exception as e:
+        pytest.skip(f'mongod indisponível: {e}')
+
+    name = f'stock_listing_{uuid.uuid4().hex[:8]}'
+    real, emulated = client[name], mongomock.MongoClient()[name]
+    try:
+        _seed_stock(emulated)
+        for coll in ('centrais', 'almoxarifados', 'sub_almoxarifados', 'setores', 'produtos', 'estoques'):
+            real[coll].insert_many(list(emulated[coll].find()))
+        for d in emulated['estoques'].find({}, {'produto_id': 1}):
+            emulated['estoques'].update_one({'_id': d['_id']}, {'$set': {'_pid_keys': _pid_keys(d.get('produto_id'))}})
+
+        for rules in (stock_listing.RULES, stock_listing.RESERVA_RULES):
+            for skip in (0, 2, 4):
+                pipeline = stock_listing.page_pipeline({}, skip, 2, rules)
+                got = stock_listing.unpack_page(list(real['estoques'].aggregate(pipeline)))
+                expected = stock_listing.unpack_page(list(emulated['estoques'].aggregate(_without_convert(pipeline))))
+                assert got == expected
+            post_match = stock_listing.tipo_match('almoxarifado')
+            pipeline = stock_listing.rows_pipeline({}, rules, post_match)
+            assert list(real['estoques'].aggregate(pipeline)) == list(emulated['estoques'].aggregate(_without_convert(pipeline)))
+    finally:
+        client.drop_database(name)